@@ -0,0 +1,77 @@
+"""
+Script de migration pour ajouter la colonne campaign_id à la table metric
+
+Ajoute la colonne (clé étrangère vers campaign), la remplit par lots à partir de
+data->>'campaign_id' pour les métriques existantes, puis crée l'index (name, campaign_id)
+utilisé par campaign_analytics pour la jointure métriques d'API -> campagnes.
+"""
+import os
+import logging
+from sqlalchemy import create_engine, text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# Nombre de lignes mises à jour par transaction lors du remplissage
+BACKFILL_BATCH_SIZE = 50000
+
+def run_migration():
+    """Execute the database migration"""
+    try:
+        # Récupérer l'URL de la base de données depuis les variables d'environnement
+        db_url = os.environ.get("DATABASE_URL")
+        if not db_url:
+            logger.error("DATABASE_URL environment variable not set")
+            return False
+
+        # Créer un moteur de base de données
+        engine = create_engine(db_url)
+
+        with engine.connect() as conn:
+            # Vérifier si la colonne existe déjà
+            result = conn.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='metric' AND column_name='campaign_id'"))
+            exists = result.fetchone() is not None
+
+            if exists:
+                logger.info("Column 'campaign_id' already exists in table 'metric'")
+            else:
+                logger.info("Adding 'campaign_id' column to 'metric' table")
+                conn.execute(text("ALTER TABLE metric ADD COLUMN campaign_id INTEGER REFERENCES campaign(id) ON DELETE SET NULL"))
+                conn.commit()
+
+            # Remplir la colonne par plages d'id pour garder des transactions courtes
+            max_id = conn.execute(text("SELECT coalesce(max(id), 0) FROM metric")).scalar()
+            updated = 0
+            for start in range(0, max_id + 1, BACKFILL_BATCH_SIZE):
+                result = conn.execute(text("""
+                    UPDATE metric m SET campaign_id = (m.data->>'campaign_id')::integer
+                    WHERE m.id >= :start AND m.id < :end
+                      AND m.campaign_id IS NULL
+                      AND m.data->>'campaign_id' ~ '^[0-9]+$'
+                      AND EXISTS (SELECT 1 FROM campaign c WHERE c.id = (m.data->>'campaign_id')::integer)
+                """), {'start': start, 'end': start + BACKFILL_BATCH_SIZE})
+                conn.commit()
+                updated += result.rowcount
+            logger.info(f"Backfilled campaign_id on {updated} metrics")
+
+        # CREATE INDEX CONCURRENTLY ne peut pas s'exécuter dans une transaction
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            logger.info("Creating index 'idx_metric_name_campaign'")
+            conn.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS idx_metric_name_campaign ON metric (name, campaign_id)"))
+
+        logger.info("Migration completed successfully")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error during migration: {e}")
+        return False
+
+if __name__ == "__main__":
+    # Execute migration
+    success = run_migration()
+
+    if success:
+        print("Migration completed successfully")
+    else:
+        print("Migration failed")
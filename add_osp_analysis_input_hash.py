@@ -0,0 +1,61 @@
+"""
+Script de migration pour ajouter l'empreinte des entrées des analyses OSP
+
+Ajoute à osp_analysis la colonne input_hash (clé osp_cache: template de prompt, version et
+entrées de l'analyse) et son index: une analyse enregistrée est réutilisée tant que ses
+entrées sont identiques et que le produit ou la campagne source n'a pas été modifié.
+Les analyses existantes restent sans empreinte (elles ne servent pas de cache).
+"""
+import os
+import logging
+from sqlalchemy import create_engine, text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def run_migration():
+    """Execute the database migration"""
+    try:
+        # Récupérer l'URL de la base de données depuis les variables d'environnement
+        db_url = os.environ.get("DATABASE_URL")
+        if not db_url:
+            logger.error("DATABASE_URL environment variable not set")
+            return False
+
+        # Créer un moteur de base de données
+        engine = create_engine(db_url)
+
+        with engine.connect() as conn:
+            # Vérifier si la colonne existe déjà
+            result = conn.execute(text(
+                "SELECT column_name FROM information_schema.columns "
+                "WHERE table_name='osp_analysis' AND column_name='input_hash'"
+            ))
+            if result.fetchone() is not None:
+                logger.info("Column 'input_hash' already exists in table 'osp_analysis'")
+            else:
+                logger.info("Adding 'input_hash' column to 'osp_analysis' table")
+                conn.execute(text("ALTER TABLE osp_analysis ADD COLUMN input_hash VARCHAR(100)"))
+            conn.commit()
+
+        # CREATE INDEX CONCURRENTLY ne peut pas s'exécuter dans une transaction
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            logger.info("Creating index 'ix_osp_analysis_input_hash'")
+            conn.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_osp_analysis_input_hash ON osp_analysis (input_hash)"))
+
+        logger.info("Migration completed successfully")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error during migration: {e}")
+        return False
+
+if __name__ == "__main__":
+    # Execute migration
+    success = run_migration()
+
+    if success:
+        print("Migration completed successfully")
+    else:
+        print("Migration failed")
@@ -0,0 +1,97 @@
+"""
+Script de migration pour ajouter l'index de recherche plein texte des personas
+
+Ajoute à la table customer_persona une colonne générée search_vector (tsvector pondéré:
+titre en A, objectif/points de douleur/déclencheurs en B, description en C) avec un index GIN,
+un index trigramme (pg_trgm) sur le titre pour la recherche approchée et un index lower() par
+attribut structuré. Les accents sont supprimés (unaccent) comme dans l'index mémoire.
+"""
+import os
+import logging
+from sqlalchemy import create_engine, text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+# unaccent() n'est pas IMMUTABLE (dictionnaire modifiable): enveloppe utilisable dans une
+# colonne générée et un index
+UNACCENT_FUNCTION = """
+    CREATE OR REPLACE FUNCTION persona_unaccent(text) RETURNS text
+    AS $$ SELECT public.unaccent('public.unaccent'::regdictionary, $1) $$
+    LANGUAGE sql IMMUTABLE PARALLEL SAFE STRICT
+"""
+
+SEARCH_VECTOR_EXPRESSION = """
+    setweight(to_tsvector('simple', persona_unaccent(coalesce(title, ''))), 'A') ||
+    setweight(to_tsvector('simple', persona_unaccent(coalesce(primary_goal, '') || ' ' ||
+                                                     coalesce(pain_points, '') || ' ' ||
+                                                     coalesce(buying_triggers, ''))), 'B') ||
+    setweight(to_tsvector('simple', persona_unaccent(coalesce(description, ''))), 'C')
+"""
+
+# Attributs structurés comparés par lower(col) = valeur (voir persona_search.ATTRIBUTE_WEIGHTS)
+ATTRIBUTE_COLUMNS = ('age_range', 'income_bracket', 'price_sensitivity', 'gender_affinity', 'education_level')
+
+def run_migration():
+    """Execute the database migration"""
+    try:
+        # Récupérer l'URL de la base de données depuis les variables d'environnement
+        db_url = os.environ.get("DATABASE_URL")
+        if not db_url:
+            logger.error("DATABASE_URL environment variable not set")
+            return False
+
+        # Créer un moteur de base de données
+        engine = create_engine(db_url)
+
+        with engine.connect() as conn:
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS pg_trgm"))
+            conn.execute(text("CREATE EXTENSION IF NOT EXISTS unaccent"))
+            conn.execute(text(UNACCENT_FUNCTION))
+            conn.commit()
+
+            # Vérifier si la colonne existe déjà
+            result = conn.execute(text("SELECT generation_expression FROM information_schema.columns WHERE table_name='customer_persona' AND column_name='search_vector'"))
+            row = result.fetchone()
+            exists = row is not None and 'persona_unaccent' in (row[0] or '')
+
+            if exists:
+                logger.info("Column 'search_vector' already exists in table 'customer_persona'")
+            else:
+                if row is not None:
+                    # Colonne d'une version antérieure (sans unaccent): recréée, son index GIN avec elle
+                    logger.info("Dropping 'search_vector' column created without unaccent")
+                    conn.execute(text("ALTER TABLE customer_persona DROP COLUMN search_vector"))
+                # Colonne générée: PostgreSQL la maintient à jour à chaque INSERT/UPDATE
+                logger.info("Adding 'search_vector' column to 'customer_persona' table")
+                conn.execute(text(
+                    f"ALTER TABLE customer_persona ADD COLUMN search_vector tsvector "
+                    f"GENERATED ALWAYS AS ({SEARCH_VECTOR_EXPRESSION}) STORED"
+                ))
+                conn.commit()
+
+            logger.info("Creating persona search indexes")
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_customer_persona_search_vector ON customer_persona USING GIN (search_vector)"))
+            conn.execute(text("DROP INDEX IF EXISTS idx_customer_persona_title_trgm"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_customer_persona_title_unaccent_trgm ON customer_persona USING GIN (persona_unaccent(title) gin_trgm_ops)"))
+            conn.execute(text("CREATE INDEX IF NOT EXISTS idx_customer_persona_niche_boutique ON customer_persona (niche_market_id, boutique_id)"))
+            for column in ATTRIBUTE_COLUMNS:
+                conn.execute(text(f"CREATE INDEX IF NOT EXISTS idx_customer_persona_lower_{column} ON customer_persona (lower({column}))"))
+            conn.commit()
+
+        logger.info("Migration completed successfully")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error during migration: {e}")
+        return False
+
+if __name__ == "__main__":
+    # Execute migration
+    success = run_migration()
+
+    if success:
+        print("Migration completed successfully")
+    else:
+        print("Migration failed")
@@ -0,0 +1,54 @@
+"""
+Script de migration pour ajouter les index du ramasse-miettes des images stockées
+
+Crée sur stored_images les index parcourus par image_gc: (created_at, id) pour
+l'expiration par âge, coalesce(last_accessed, created_at) pour l'éviction LRU globale
+et par utilisateur.
+"""
+import os
+import logging
+from sqlalchemy import create_engine, text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+GC_INDEXES = {
+    'idx_stored_images_created': "(created_at, id)",
+    'idx_stored_images_last_used': "((coalesce(last_accessed, created_at)), id)",
+    'idx_stored_images_user_last_used': "(user_id, (coalesce(last_accessed, created_at)))",
+}
+
+def run_migration():
+    """Execute the database migration"""
+    try:
+        # Récupérer l'URL de la base de données depuis les variables d'environnement
+        db_url = os.environ.get("DATABASE_URL")
+        if not db_url:
+            logger.error("DATABASE_URL environment variable not set")
+            return False
+
+        # Créer un moteur de base de données
+        engine = create_engine(db_url)
+
+        # CREATE INDEX CONCURRENTLY ne peut pas s'exécuter dans une transaction
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            for name, columns in GC_INDEXES.items():
+                logger.info(f"Creating index '{name}'")
+                conn.execute(text(f"CREATE INDEX CONCURRENTLY IF NOT EXISTS {name} ON stored_images {columns}"))
+
+        logger.info("Migration completed successfully")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error during migration: {e}")
+        return False
+
+if __name__ == "__main__":
+    # Execute migration
+    success = run_migration()
+
+    if success:
+        print("Migration completed successfully")
+    else:
+        print("Migration failed")
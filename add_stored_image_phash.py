@@ -0,0 +1,69 @@
+"""
+Script de migration pour ajouter la déduplication perceptuelle des images stockées
+
+Ajoute à stored_images les empreintes dhash/ahash, la référence vers l'image canonique
+dont le fichier est partagé (canonical_id) et son compteur de références (ref_count).
+Les empreintes des images existantes sont ensuite calculées par
+image_dedup.image_deduplicator.backfill() (lecture des fichiers, hors migration SQL).
+"""
+import os
+import logging
+from sqlalchemy import create_engine, text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+NEW_COLUMNS = {
+    'dhash': "BIGINT",
+    'ahash': "BIGINT",
+    'canonical_id': "INTEGER REFERENCES stored_images(id)",
+    'ref_count': "INTEGER DEFAULT 1",
+}
+
+def run_migration():
+    """Execute the database migration"""
+    try:
+        # Récupérer l'URL de la base de données depuis les variables d'environnement
+        db_url = os.environ.get("DATABASE_URL")
+        if not db_url:
+            logger.error("DATABASE_URL environment variable not set")
+            return False
+
+        # Créer un moteur de base de données
+        engine = create_engine(db_url)
+
+        with engine.connect() as conn:
+            for column, definition in NEW_COLUMNS.items():
+                # Vérifier si la colonne existe déjà
+                result = conn.execute(text(
+                    "SELECT column_name FROM information_schema.columns "
+                    "WHERE table_name='stored_images' AND column_name=:column"
+                ), {'column': column})
+                if result.fetchone() is not None:
+                    logger.info(f"Column '{column}' already exists in table 'stored_images'")
+                    continue
+                logger.info(f"Adding '{column}' column to 'stored_images' table")
+                conn.execute(text(f"ALTER TABLE stored_images ADD COLUMN {column} {definition}"))
+            conn.commit()
+
+        # CREATE INDEX CONCURRENTLY ne peut pas s'exécuter dans une transaction
+        with engine.connect().execution_options(isolation_level="AUTOCOMMIT") as conn:
+            logger.info("Creating index 'ix_stored_images_canonical_id'")
+            conn.execute(text("CREATE INDEX CONCURRENTLY IF NOT EXISTS ix_stored_images_canonical_id ON stored_images (canonical_id)"))
+
+        logger.info("Migration completed successfully")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error during migration: {e}")
+        return False
+
+if __name__ == "__main__":
+    # Execute migration
+    success = run_migration()
+
+    if success:
+        print("Migration completed successfully")
+    else:
+        print("Migration failed")
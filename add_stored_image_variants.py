@@ -0,0 +1,55 @@
+"""
+Script de migration pour ajouter les déclinaisons responsives des images stockées
+
+Ajoute la colonne variants (JSONB) à la table stored_images et un index sur filename,
+utilisé par /images/<filename> pour retrouver l'image et ses déclinaisons.
+"""
+import os
+import logging
+from sqlalchemy import create_engine, text
+
+# Configure logging
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger(__name__)
+
+def run_migration():
+    """Execute the database migration"""
+    try:
+        # Récupérer l'URL de la base de données depuis les variables d'environnement
+        db_url = os.environ.get("DATABASE_URL")
+        if not db_url:
+            logger.error("DATABASE_URL environment variable not set")
+            return False
+
+        # Créer un moteur de base de données
+        engine = create_engine(db_url)
+
+        with engine.connect() as conn:
+            # Vérifier si la colonne existe déjà
+            result = conn.execute(text("SELECT column_name FROM information_schema.columns WHERE table_name='stored_images' AND column_name='variants'"))
+            exists = result.fetchone() is not None
+
+            if exists:
+                logger.info("Column 'variants' already exists in table 'stored_images'")
+            else:
+                logger.info("Adding 'variants' column to 'stored_images' table")
+                conn.execute(text("ALTER TABLE stored_images ADD COLUMN variants JSONB"))
+
+            conn.execute(text("CREATE INDEX IF NOT EXISTS ix_stored_images_filename ON stored_images (filename)"))
+            conn.commit()
+
+        logger.info("Migration completed successfully")
+        return True
+
+    except Exception as e:
+        logger.error(f"Error during migration: {e}")
+        return False
+
+if __name__ == "__main__":
+    # Execute migration
+    success = run_migration()
+
+    if success:
+        print("Migration completed successfully")
+    else:
+        print("Migration failed")
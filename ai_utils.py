@@ -4,6 +4,7 @@ et journalisation des métriques
 """
 import json
 import time
+import datetime
 import logging
 import traceback
 from typing import Dict, Any, Optional, Union, Callable
@@ -20,6 +21,10 @@ except ImportError:
     OPENAI_AVAILABLE = False
 
 from app import log_metric
+from llm_router import llm_router, InvalidProviderResponse, ProviderUnavailableError, REQUEST_TIMEOUT, CLIENT_MAX_RETRIES
+from prompt_registry import prompt_registry
+from structured_output import structured_output, repair_json, JSONRepairError
+from token_accounting import token_accountant, usage_context
 
 # Constantes pour les modèles
 GROK_MODEL = "grok-2-1212"
@@ -107,16 +112,32 @@ def with_ai_error_handling(func):
             if 'model' in kwargs:
                 metric_data['model'] = kwargs['model']
                 
-            # Enregistrer la métrique
+            # Enregistrer la métrique (ou la confier à l'appelant pour une insertion groupée)
             try:
-                log_metric(
-                    metric_name=metric_name,
-                    data=metric_data,
-                    category='ai',
-                    status=status,
-                    response_time=response_time,
-                    customer_id=kwargs.get('customer_id')
-                )
+                if isinstance(kwargs.get('metric_sink'), list):
+                    kwargs['metric_sink'].append({
+                        'name': metric_name,
+                        'category': 'ai',
+                        'status': status == 'success',
+                        'data': metric_data,
+                        'response_time': response_time,
+                        'created_at': datetime.datetime.now(),
+                        'customer_id': kwargs.get('customer_id'),
+                        'campaign_id': kwargs.get('campaign_id'),
+                    })
+                else:
+                    metric = log_metric(
+                        metric_name=metric_name,
+                        data=metric_data,
+                        category='ai',
+                        status=status,
+                        response_time=response_time,
+                        customer_id=kwargs.get('customer_id'),
+                        campaign_id=kwargs.get('campaign_id')
+                    )
+                    # Permet à l'appelant de rattacher la métrique a posteriori (ex: campagne créée après l'appel)
+                    if metric is not None and isinstance(kwargs.get('metric_context'), dict):
+                        kwargs['metric_context']['metric_id'] = metric.id
             except Exception as log_error:
                 logging.error(f"Failed to log AI metric: {log_error}")
     
@@ -138,10 +159,15 @@ class AIManager:
         """Initialise les clients API si les clés sont disponibles"""
         if OPENAI_AVAILABLE:
             if openai_api_key:
-                self.openai_client = OpenAI(api_key=openai_api_key)
+                self.openai_client = token_accountant.metered(
+                    OpenAI(api_key=openai_api_key, timeout=REQUEST_TIMEOUT, max_retries=CLIENT_MAX_RETRIES),
+                    'ai_manager')
                 logging.info("OpenAI client initialized")
             if xai_api_key:
-                self.grok_client = OpenAI(base_url="https://api.x.ai/v1", api_key=xai_api_key)
+                self.grok_client = token_accountant.metered(
+                    OpenAI(base_url="https://api.x.ai/v1", api_key=xai_api_key,
+                           timeout=REQUEST_TIMEOUT, max_retries=CLIENT_MAX_RETRIES),
+                    'ai_manager')
                 logging.info("xAI (Grok) client initialized")
     
     @with_ai_error_handling
@@ -156,6 +182,9 @@ class AIManager:
         """
         Génère du texte avec le modèle spécifié, avec fallback automatique
         
+        Le fournisseur est choisi par llm_router: un fournisseur dont le disjoncteur est ouvert
+        est évité sans attendre son timeout.
+        
         Args:
             prompt: Texte de prompt pour l'IA
             model: Modèle à utiliser (GROK_MODEL ou OPENAI_MODEL par défaut)
@@ -183,34 +212,33 @@ class AIManager:
         if kwargs.get('json_format', False):
             params["response_format"] = {"type": "json_object"}
         
-        # Tentative avec le client principal
-        client = self.grok_client if is_grok else self.openai_client
-        if client:
-            try:
-                response = client.chat.completions.create(**params)
-                return response.choices[0].message.content
-            except Exception as e:
-                logging.error(f"Primary AI API error ({model}): {e}")
-                if not use_fallback:
-                    raise
-        elif not use_fallback:
-            return "Error: Primary AI client not initialized"
-            
-        # Fallback vers l'autre client si disponible
-        fallback_client = self.openai_client if is_grok else self.grok_client
-        fallback_model = OPENAI_MODEL if is_grok else GROK_MODEL
+        # Fournisseur du modèle demandé puis, si autorisé, l'autre fournisseur (ordre ajusté par le routeur)
+        providers = [('xai', self.grok_client, model), ('openai', self.openai_client, OPENAI_MODEL)]
+        if not is_grok:
+            providers = [('openai', self.openai_client, model), ('xai', self.grok_client, GROK_MODEL)]
+        if not use_fallback:
+            providers = providers[:1]
+        candidates = [(name, self._chat_call(client, dict(params, model=provider_model)))
+                      for name, client, provider_model in providers if client]
         
-        if fallback_client:
-            try:
-                logging.info(f"Using fallback model {fallback_model}")
-                params["model"] = fallback_model
-                response = fallback_client.chat.completions.create(**params)
-                return response.choices[0].message.content
-            except Exception as e:
-                logging.error(f"Fallback AI API error ({fallback_model}): {e}")
-                raise
+        if not candidates:
+            return "Error: No AI clients available" if use_fallback else "Error: Primary AI client not initialized"
         
-        return "Error: No AI clients available"
+        try:
+            # L'usage des clients mesurés est attribué à la métrique de l'appel
+            with usage_context(feature=metric_name):
+                return llm_router.execute(candidates, validate=lambda text: text is not None)
+        except ProviderUnavailableError as e:
+            logging.error(f"AI text generation failed ({model}): {e}")
+            raise
+    
+    @staticmethod
+    def _chat_call(client, params: Dict[str, Any]) -> Callable[[], str]:
+        """Appel de complétion de chat pour le routeur"""
+        def call():
+            response = client.chat.completions.create(**params)
+            return response.choices[0].message.content
+        return call
     
     @with_ai_error_handling
     def generate_json(self, 
@@ -219,20 +247,25 @@ class AIManager:
                      schema: Dict = None,
                      max_tokens: int = 1000,
                      metric_name: str = "ai_json_generation",
+                     response_model=None,
                      **kwargs) -> Dict:
         """
         Génère une réponse au format JSON structuré
         
+        La réponse est parsée par structured_output: un JSON mal formé est réparé localement,
+        et seule la suite d'une réponse tronquée est redemandée au modèle.
+        
         Args:
             prompt: Texte de prompt pour l'IA
             model: Modèle à utiliser
             schema: Schéma JSON attendu (optionnel)
             max_tokens: Nombre maximum de tokens
             metric_name: Nom de la métrique à enregistrer
+            response_model: Modèle pydantic de validation (optionnel)
             **kwargs: Arguments supplémentaires
             
         Returns:
-            Dictionnaire contenant la réponse JSON
+            Dictionnaire contenant la réponse JSON (instance de response_model si fourni)
         """
         # Ajouter des instructions sur le format JSON
         system_message = "Output must be formatted as valid JSON. "
@@ -251,22 +284,20 @@ class AIManager:
             **kwargs
         )
         
-        # Parsing du JSON
+        def continue_json(partial: str) -> str:
+            # La suite seule n'est pas un document JSON: pas de response_format
+            return self.generate_text(
+                prompt=prompt_registry.render('json_continuation', prompt=prompt, partial=partial),
+                model=model,
+                max_tokens=max_tokens,
+                metric_name=metric_name,
+                **kwargs
+            )
+        
         try:
-            return json.loads(json_text)
-        except json.JSONDecodeError as e:
-            logging.error(f"JSON parsing error: {e}. Response: {json_text}")
-            # Tentative de nettoyage et re-parsing
-            cleaned_text = json_text.strip()
-            # Trouver le début et la fin du JSON si entouré de texte
-            start = cleaned_text.find('{')
-            end = cleaned_text.rfind('}') + 1
-            if start >= 0 and end > start:
-                cleaned_text = cleaned_text[start:end]
-                try:
-                    return json.loads(cleaned_text)
-                except:
-                    pass
+            return structured_output.parse(json_text, response_model, continuation=continue_json)
+        except JSONRepairError:
+            logging.error(f"JSON parsing error. Response: {json_text}")
             raise
     
     @with_ai_error_handling
@@ -306,139 +337,67 @@ class AIManager:
             logging.warning(f"Prompt too long ({len(prompt)} chars). Truncating.")
             params["prompt"] = prompt[:1000]
         
-        # Tentative avec le client principal
-        primary_client = self.grok_client if is_grok_model else self.openai_client
-        primary_model = model if is_grok_model else DALL_E_MODEL
-        
-        if primary_client:
-            try:
-                logging.info(f"Generating image with {primary_model}")
-                
-                # Si c'est un modèle Grok, utiliser la vision API  
-                if is_grok_model:
-                    # Pour les modèles Grok, nous utilisons l'API de chat avec entrée texte et sortie image
-                    chat_response = primary_client.chat.completions.create(
-                        model=primary_model,
-                        messages=[
-                            {
-                                "role": "user", 
-                                "content": [
-                                    {"type": "text", "text": f"Generate an image based on this description: {prompt}"}
-                                ]
-                            }
-                        ],
-                        max_tokens=1000
-                    )
-                    
-                    # Vérifier si la réponse contient une URL d'image valide
-                    if hasattr(chat_response.choices[0].message, 'content'):
-                        # Extraire l'URL de l'image générée - pourrait nécessiter un parsing
-                        content = chat_response.choices[0].message.content
-                        # Vérifier si le contenu est une URL d'image
-                        if content and (content.startswith('http://') or content.startswith('https://')):
-                            return content
-                        else:
-                            logging.warning(f"Grok didn't return a valid image URL: {content[:100]}...")
-                            if not use_fallback:
-                                raise ValueError(f"Invalid image URL from Grok: {content[:100]}...")
-                    else:
-                        logging.warning("Grok didn't return valid content.")
-                        if not use_fallback:
-                            raise ValueError("No valid content returned from Grok.")
-                else:
-                    # Pour OpenAI, utiliser l'API d'images standard
-                    response = primary_client.images.generate(
-                        model=primary_model,
-                        prompt=params["prompt"],
-                        n=params["n"],
-                        size=params["size"],
-                        **kwargs
-                    )
-                    if response.data and len(response.data) > 0 and hasattr(response.data[0], 'url'):
-                        return response.data[0].url
-                    else:
-                        logging.warning("OpenAI didn't return a valid image URL.")
-                        if not use_fallback:
-                            raise ValueError("No valid URL returned from OpenAI.")
-            except Exception as e:
-                logging.error(f"Primary image generation error ({primary_model}): {e}")
-                if not use_fallback:
-                    raise
-                    
-        # Fallback vers l'autre client si disponible
-        if use_fallback:
-            fallback_client = self.openai_client if is_grok_model else self.grok_client
-            fallback_model = DALL_E_MODEL if is_grok_model else GROK_IMAGE_MODEL
-            
-            if fallback_client:
-                try:
-                    logging.info(f"Using fallback model {fallback_model}")
-                    
-                    # Si c'est un fallback vers Grok
-                    if fallback_model in [GROK_IMAGE_MODEL, GROK_VISION_MODEL]:
-                        chat_response = fallback_client.chat.completions.create(
-                            model=fallback_model,
-                            messages=[
-                                {
-                                    "role": "user", 
-                                    "content": [
-                                        {"type": "text", "text": f"Generate an image based on this description: {prompt}"}
-                                    ]
-                                }
-                            ],
-                            max_tokens=1000
-                        )
-                        
-                        if hasattr(chat_response.choices[0].message, 'content'):
-                            content = chat_response.choices[0].message.content
-                            if content and (content.startswith('http://') or content.startswith('https://')):
-                                return content
-                    else:
-                        # Fallback vers OpenAI
-                        response = fallback_client.images.generate(
-                            model=fallback_model,
-                            prompt=params["prompt"],
-                            n=params["n"],
-                            size=params["size"],
-                            **kwargs
-                        )
-                        if response.data and len(response.data) > 0 and hasattr(response.data[0], 'url'):
-                            return response.data[0].url
-                except Exception as e:
-                    logging.error(f"Fallback image generation error ({fallback_model}): {e}")
-                    raise
+        # Fournisseur du modèle demandé puis, si autorisé, l'autre fournisseur (ordre ajusté par le routeur)
+        grok_model = model if is_grok_model else GROK_IMAGE_MODEL
+        providers = [('xai', self.grok_client, self._grok_image_call(self.grok_client, grok_model, prompt)),
+                     ('openai', self.openai_client,
+                      self._openai_image_call(self.openai_client, DALL_E_MODEL, params, kwargs))]
+        if not is_grok_model:
+            providers.reverse()
+        if not use_fallback:
+            providers = providers[:1]
+        candidates = [(name, call) for name, client, call in providers if client]
         
-        # Si on arrive ici, c'est que ni le client principal ni le fallback n'ont fonctionné
-        raise ValueError("Failed to generate image with both primary and fallback models.")
+        try:
+            with usage_context(feature=metric_name):
+                return llm_router.execute(candidates, operation='image')
+        except ProviderUnavailableError as e:
+            logging.error(f"Image generation failed: {e}")
+            raise ValueError("Failed to generate image with both primary and fallback models.") from e
+    
+    @staticmethod
+    def _grok_image_call(client, model: str, prompt: str) -> Callable[[], str]:
+        """Génération d'image Grok via l'API de chat (la réponse doit être une URL)"""
+        def call():
+            logging.info(f"Generating image with {model}")
+            chat_response = client.chat.completions.create(
+                model=model,
+                messages=[
+                    {
+                        "role": "user", 
+                        "content": [
+                            {"type": "text", "text": f"Generate an image based on this description: {prompt}"}
+                        ]
+                    }
+                ],
+                max_tokens=1000
+            )
+            content = getattr(chat_response.choices[0].message, 'content', None)
+            if content and (content.startswith('http://') or content.startswith('https://')):
+                return content
+            raise InvalidProviderResponse(f"Invalid image URL from Grok: {(content or '')[:100]}...")
+        return call
+    
+    @staticmethod
+    def _openai_image_call(client, model: str, params: Dict[str, Any], extra: Dict[str, Any]) -> Callable[[], str]:
+        """Génération d'image OpenAI (API d'images standard)"""
+        def call():
+            logging.info(f"Generating image with {model}")
+            response = client.images.generate(
+                model=model,
+                prompt=params["prompt"],
+                n=params["n"],
+                size=params["size"],
+                **extra
+            )
+            if response.data and len(response.data) > 0 and getattr(response.data[0], 'url', None):
+                return response.data[0].url
+            raise InvalidProviderResponse("No valid URL returned from OpenAI.")
+        return call
             
     def extract_json_safely(self, text):
-        """Extrait proprement un objet JSON d'un texte, même s'il est entouré d'autres contenus"""
+        """Extrait proprement un objet JSON d'un texte, même entouré d'autres contenus ou mal formé"""
         try:
-            # Si c'est déjà un JSON valide
-            return json.loads(text)
-        except:
-            pass
-            
-        # Chercher les accolades de début et de fin
-        start = text.find('{')
-        end = text.rfind('}') + 1
-        
-        if start >= 0 and end > start:
-            try:
-                return json.loads(text[start:end])
-            except:
-                pass
-                
-        # Essayer d'extraire avec une regex plus robuste
-        import re
-        json_pattern = r'\{.*\}'
-        match = re.search(json_pattern, text, re.DOTALL)
-        
-        if match:
-            try:
-                return json.loads(match.group(0))
-            except:
-                pass
-                
-        # Si toutes les tentatives échouent
-        raise ValueError(f"Unable to extract valid JSON from text: {text[:100]}...")
\ No newline at end of file
+            return repair_json(text).value
+        except JSONRepairError:
+            raise ValueError(f"Unable to extract valid JSON from text: {(text or '')[:100]}...")
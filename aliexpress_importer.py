@@ -9,17 +9,37 @@ import asyncio
 import urllib.parse
 import datetime
 from typing import Dict, List, Optional, Tuple, Union
-import random
-import trafilatura
 from urllib.parse import urlparse, parse_qs
 
 # Configuration du client AI
 from boutique_ai import AsyncOpenAI, GROK_3, grok_client
+from async_runner import run_async
+from page_fetcher import page_fetcher, PageFetchError
+from pricing_engine import price_products
+from prompt_registry import prompt_registry
+from prompt_compaction import prompt_compactor
+from token_accounting import token_accountant
+
+# Usage des complétions attribué à l'import AliExpress
+grok_client = token_accountant.metered(grok_client, 'aliexpress_importer')
 
 # Pattern pour extraire l'ID du produit AliExpress
 ALIEXPRESS_ID_PATTERN = r'/item/(\d+)\.html'
 ALIEXPRESS_ITEM_API_URL = "https://www.aliexpress.com/item/{item_id}.html"
 
+# Texte explicatif de la stratégie de prix (les prix eux-mêmes sont calculés par pricing_engine)
+prompt_registry.register('pricing_explanation', """
+    Explique en 3 phrases maximum, pour le marchand, la stratégie de prix suivante du produit "{title}":
+    - Segment de marché: {market_segment}
+    - Prix d'achat: {base_price}
+    - Prix de vente conseillé: {price}
+    - Promotion: {promo}
+    - Marge: {profit_margin}%
+    - Fourchette des concurrents: {competitor_band}
+    - Facteurs appliqués: {factors}
+    Ne modifie aucun chiffre et ne propose pas d'autre prix.
+""")
+
 async def extract_aliexpress_product_data(url: str) -> Dict:
     """
     Extrait les données d'un produit AliExpress à partir de l'URL
@@ -38,20 +58,19 @@ async def extract_aliexpress_product_data(url: str) -> Dict:
         
         item_id = match.group(1)
         
-        # Télécharger le contenu HTML
-        downloaded = trafilatura.fetch_url(url)
-        if not downloaded:
-            raise ValueError(f"Impossible de télécharger la page: {url}")
-        
-        # Extraction du texte principal et du contenu HTML
-        main_text = trafilatura.extract(downloaded)
+        # Page et texte extrait, depuis le cache disque tant que la page n'a pas changé
+        try:
+            page = await page_fetcher.afetch(url, key=f"aliexpress-{item_id}")
+        except PageFetchError as e:
+            raise ValueError(f"Impossible de télécharger la page: {url}") from e
+        main_text = page["text"]
         
         # Utiliser Grok pour extraire les informations structurées
         prompt = f"""
         J'ai besoin d'extraire des informations structurées à partir de cette page produit AliExpress. 
         Voici le contenu de la page:
         
-        {main_text[:5000]}... (contenu tronqué)
+        {prompt_compactor.text('aliexpress_page', main_text)}
         
         Extrais les informations suivantes de manière précise et complète. Réponds strictement au format JSON suivant:
         {{
@@ -95,133 +114,81 @@ async def extract_aliexpress_product_data(url: str) -> Dict:
         logging.error(f"Erreur lors de l'extraction des données AliExpress: {e}")
         raise
 
-async def optimize_pricing_strategy(product_data: Dict, target_market: str = "moyenne_gamme") -> Dict:
+async def optimize_pricing_strategy(product_data: Dict, target_market: str = "moyenne_gamme",
+                                    competitor_prices: Optional[List[float]] = None, explain: bool = False) -> Dict:
     """
     Optimise la stratégie de prix pour un produit importé
     
+    Le prix est calculé par le moteur déterministe (pricing_engine); le modèle n'est
+    appelé que si un texte explicatif est demandé.
+    
     Args:
         product_data: Données du produit
         target_market: Marché cible (entrée_gamme, moyenne_gamme, haut_de_gamme, luxe)
+        competitor_prices: Prix des produits concurrents (optionnel)
+        explain: Ajouter un texte explicatif généré par le modèle (clé "explanation")
         
     Returns:
         Dictionnaire contenant la stratégie de prix optimisée
     """
-    try:
-        # Extraire le prix de base
-        base_price = 0
-        try:
-            if isinstance(product_data.get("prix"), str):
-                # Nettoyer le prix (supprimer les symboles de devise et convertir en float)
-                base_price = float(re.sub(r'[^\d.,]', '', product_data.get("prix", "0").replace(',', '.')))
-            else:
-                base_price = float(product_data.get("prix", 0))
-        except (ValueError, TypeError):
-            base_price = 0
-        
-        # Coefficients par marché cible
-        markup_coefficients = {
-            "entrée_gamme": 1.5,  # +50%
-            "moyenne_gamme": 2.0,  # +100%
-            "haut_de_gamme": 2.5,  # +150%
-            "luxe": 3.5  # +250%
-        }
+    strategy = optimize_pricing_batch([product_data], target_market,
+                                      [competitor_prices] if competitor_prices else None)[0]
+    if explain:
+        strategy["explanation"] = await explain_pricing(product_data, strategy)
+    return strategy
+
+def optimize_pricing_batch(products: List[Dict], target_market: Union[str, List[str]] = "moyenne_gamme",
+                           competitor_prices: Optional[List[Optional[List[float]]]] = None) -> List[Dict]:
+    """
+    Stratégies de prix d'un lot de produits importés, calculées en une passe NumPy
+    
+    Args:
+        products: Données des produits
+        target_market: Marché cible commun ou par produit
+        competitor_prices: Prix des produits concurrents par produit (optionnel)
         
-        # Appliquer le coefficient de base
-        coefficient = markup_coefficients.get(target_market, 2.0)
-        
-        # Facteurs de correction
-        popularity_factor = 1.0
-        if product_data.get("nombre_commandes"):
-            try:
-                orders = int(re.sub(r'[^\d]', '', str(product_data.get("nombre_commandes", "0"))))
-                if orders > 1000:
-                    popularity_factor = 1.1  # Produits populaires +10%
-                elif orders > 5000:
-                    popularity_factor = 1.15  # Produits très populaires +15%
-            except (ValueError, TypeError):
-                pass
-        
-        rating_factor = 1.0
-        if product_data.get("note_moyenne"):
-            try:
-                rating = float(str(product_data.get("note_moyenne", "0")).replace(',', '.'))
-                if rating >= 4.8:
-                    rating_factor = 1.1  # Produits très bien notés +10%
-                elif rating >= 4.5:
-                    rating_factor = 1.05  # Produits bien notés +5%
-            except (ValueError, TypeError):
-                pass
-        
-        # Calcul du prix optimisé
-        optimal_price = base_price * coefficient * popularity_factor * rating_factor
-        
-        # Arrondir à un prix psychologique
-        def psychological_rounding(price):
-            # Arrondir aux .99 ou .95
-            if price < 50:
-                return int(price) - 0.01
-            elif price < 100:
-                return int(price) - 0.05
-            else:
-                return int(price / 10) * 10 - 0.01
-        
-        psychological_price = psychological_rounding(optimal_price)
-        
-        # Calculer les potentielles promos
-        promo_percent = random.choice([0, 5, 10, 15, 20]) if random.random() < 0.7 else 0
-        promo_price = round(psychological_price * (1 - promo_percent/100), 2)
-        
-        # Générer différentes stratégies de prix
-        return {
-            "base_price": base_price,
-            "optimal_price": round(optimal_price, 2),
-            "psychological_price": psychological_price,
-            "promo_percent": promo_percent,
-            "promo_price": promo_price,
-            "market_segment": target_market,
-            "profit_margin": round((psychological_price - base_price) / psychological_price * 100, 2),
-            "price_factors": {
-                "base_coefficient": coefficient,
-                "popularity_factor": popularity_factor,
-                "rating_factor": rating_factor
-            },
-            "price_recommendations": [
-                {"name": "Prix compétitif", "price": round(optimal_price * 0.9, 2)},
-                {"name": "Prix standard", "price": round(optimal_price, 2)},
-                {"name": "Prix premium", "price": round(optimal_price * 1.1, 2)}
-            ]
-        }
+    Returns:
+        Stratégies de prix, dans l'ordre des produits
+    """
+    return price_products(products, target_market, competitor_prices)
+
+async def explain_pricing(product_data: Dict, pricing_data: Dict) -> str:
+    """
+    Texte explicatif d'une stratégie de prix (seul appel au modèle de la tarification)
     
+    Args:
+        product_data: Données du produit
+        pricing_data: Stratégie calculée par optimize_pricing_strategy
+        
+    Returns:
+        Texte explicatif, chaîne vide si la génération échoue
+    """
+    factors = pricing_data["price_factors"]
+    band = pricing_data.get("competitor_band")
+    prompt = prompt_registry.render(
+        'pricing_explanation',
+        title=product_data.get("titre", ""),
+        market_segment=pricing_data["market_segment"],
+        base_price=pricing_data["base_price"],
+        price=pricing_data["psychological_price"],
+        promo=f"-{pricing_data['promo_percent']}% ({pricing_data['promo_price']})" if pricing_data["promo_percent"] else "-",
+        profit_margin=pricing_data["profit_margin"],
+        competitor_band=f"{band['low']} - {band['high']}" if band else "-",
+        factors=", ".join(f"{name}={value}" for name, value in factors.items()),
+    )
+    try:
+        response = await grok_client.chat.completions.create(
+            model=GROK_3,
+            messages=[
+                {"role": "system", "content": "Tu es un expert en stratégie de prix e-commerce."},
+                {"role": "user", "content": prompt}
+            ],
+            max_tokens=300
+        )
+        return response.choices[0].message.content.strip()
     except Exception as e:
-        logging.error(f"Erreur lors de l'optimisation de la stratégie de prix: {e}")
-        # Retourner une stratégie de prix par défaut en cas d'erreur
-        default_price = 29.99  # Prix par défaut si la base_price n'est pas disponible
-        try:
-            # Essayer d'utiliser base_price s'il est défini
-            price_base = base_price
-        except NameError:
-            # Sinon utiliser le prix par défaut
-            price_base = default_price
-            
-        return {
-            "original_price": price_base,
-            "optimal_price": price_base * 2,
-            "psychological_price": price_base * 2,
-            "promo_percent": 0,
-            "promo_price": price_base * 2,
-            "market_segment": target_market,
-            "profit_margin": 50,
-            "price_factors": {
-                "base_coefficient": 2.0,
-                "popularity_factor": 1.0,
-                "rating_factor": 1.0
-            },
-            "price_recommendations": [
-                {"name": "Prix compétitif", "price": price_base * 1.8},
-                {"name": "Prix standard", "price": price_base * 2},
-                {"name": "Prix premium", "price": price_base * 2.2}
-            ]
-        }
+        logging.error(f"Erreur lors de la génération de l'explication de prix: {e}")
+        return ""
 
 async def generate_shopify_html_template(product_data: Dict, pricing_data: Dict) -> Dict:
     """
@@ -244,7 +211,7 @@ async def generate_shopify_html_template(product_data: Dict, pricing_data: Dict)
         prompt = f"""
         Je dois créer du contenu HTML optimisé pour une boutique Shopify à partir de ces données de produit AliExpress:
         
-        {json.dumps(context, indent=2, ensure_ascii=False)}
+        {prompt_compactor.json('aliexpress_html', context)}
         
         Génère un template HTML complet pour Shopify avec les sections suivantes:
         
@@ -367,4 +334,4 @@ def import_aliexpress_product(url: str, target_market: str = "moyenne_gamme") ->
             "template": template_data
         }
     
-    return asyncio.run(process_import())
\ No newline at end of file
+    return run_async(process_import())
\ No newline at end of file
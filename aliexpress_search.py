@@ -2,24 +2,69 @@ import os
 import asyncio
 import logging
 import re
-from typing import Dict, List, Optional, Tuple
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple
+from urllib.parse import urlparse
 
 from openai import AsyncOpenAI
+from pydantic import BaseModel, ConfigDict, ValidationError
 from trafilatura import fetch_url, extract
 
+from aliexpress_importer import extract_aliexpress_product_id
+from async_runner import run_async
+from structured_output import structured_output, JSONRepairError
+from token_accounting import token_accountant
+
 # Configuration
 GROK_API_KEY = os.environ.get("XAI_API_KEY")
 GROK_MODEL = "grok-3"  # Modèle le plus récent de xAI
 ALIEXPRESS_BASE_URL = "https://www.aliexpress.com"
 ALIEXPRESS_SEARCH_URL = f"{ALIEXPRESS_BASE_URL}/wholesale?SearchText="
+# Recherches Grok simultanées (toutes variantes et campagnes confondues)
+SEARCH_CONCURRENCY = int(os.environ.get("ALIEXPRESS_SEARCH_CONCURRENCY", "4"))
+# Durée de vie (secondes) des résultats en cache par requête normalisée
+SEARCH_CACHE_TTL = int(os.environ.get("ALIEXPRESS_SEARCH_CACHE_TTL", "3600"))
+# Nombre maximum de requêtes gardées en cache
+SEARCH_CACHE_SIZE = int(os.environ.get("ALIEXPRESS_SEARCH_CACHE_SIZE", "512"))
+# Délai maximum (secondes) d'une requête Grok; au-delà, la requête compte comme un échec
+SEARCH_TIMEOUT = float(os.environ.get("ALIEXPRESS_SEARCH_TIMEOUT", "30"))
+# Marge (secondes) ajoutée au délai global d'une recherche lancée depuis une route synchrone
+SEARCH_TIMEOUT_MARGIN = 5.0
+# Mots-clés de la description retenus dans une variante de requête
+KEYWORDS_PER_QUERY = 6
+
+# Mots vides ignorés lors de l'extraction des mots-clés
+STOPWORDS = frozenset("""
+    the and for with from this that your our are was were will can has have into over under about
+    les des une pour avec dans sur par aux est sont qui que vos nos leur leurs plus très sans
+    social email sms campaign campagne produit product description
+""".split())
 
 logger = logging.getLogger(__name__)
 
-# Client pour l'API xAI (Grok)
-grok_client = AsyncOpenAI(
+# Client pour l'API xAI (Grok), complétions comptabilisées
+grok_client = token_accountant.metered(AsyncOpenAI(
     api_key=GROK_API_KEY,
     base_url="https://api.x.ai/v1"
-)
+), 'aliexpress_search')
+
+
+class SearchResult(BaseModel):
+    """Produit renvoyé par la recherche Grok (prix en USD, sans symbole)"""
+    model_config = ConfigDict(extra='allow')
+
+    name: str
+    description: str = ""
+    price: Optional[float] = None
+    image_url: str = ""
+    product_url: str = ""
+    relevance_notes: str = ""
+
+
+class SearchResults(BaseModel):
+    products: List[SearchResult]
 
 
 async def web_search_with_grok(query: str, max_results: int = 5) -> List[Dict]:
@@ -58,12 +103,13 @@ async def web_search_with_grok(query: str, max_results: int = 5) -> List[Dict]:
         Format your response as a JSON array of product objects.
         """
         
+        messages = [
+            {"role": "system", "content": "You are a specialist in e-commerce and product search. You help find relevant products on AliExpress by searching the web and extracting structured information."},
+            {"role": "user", "content": prompt}
+        ]
         response = await grok_client.chat.completions.create(
             model=GROK_MODEL,
-            messages=[
-                {"role": "system", "content": "You are a specialist in e-commerce and product search. You help find relevant products on AliExpress by searching the web and extracting structured information."},
-                {"role": "user", "content": prompt}
-            ],
+            messages=messages,
             temperature=0.2,
             response_format={"type": "json_object"}
         )
@@ -71,18 +117,28 @@ async def web_search_with_grok(query: str, max_results: int = 5) -> List[Dict]:
         # Extraire les données JSON de la réponse
         result_text = response.choices[0].message.content
         
-        # Tentative de conversion en JSON structuré (s'il n'est pas déjà formaté correctement)
-        import json
+        async def continue_search(partial: str) -> str:
+            # Réponse coupée: seule la suite est demandée
+            continuation = await grok_client.chat.completions.create(
+                model=GROK_MODEL,
+                messages=messages + [
+                    {"role": "assistant", "content": partial},
+                    {"role": "user", "content": "Your answer was cut off. Continue the JSON exactly where it stops, output only the remainder."}
+                ],
+                temperature=0.2
+            )
+            return continuation.choices[0].message.content
+        
+        # JSON réparé localement si nécessaire, produits invalides écartés
         try:
-            result_data = json.loads(result_text)
-            if isinstance(result_data, dict) and "products" in result_data:
-                products = result_data["products"]
-            else:
-                # Si le résultat est déjà une liste, l'utiliser directement
-                products = result_data if isinstance(result_data, list) else []
-        except Exception as e:
+            result_data = await structured_output.aparse(result_text, continuation=continue_search)
+            if isinstance(result_data, dict):
+                result_data = result_data.get("products", [])
+            results = structured_output.validate(SearchResults, {"products": result_data if isinstance(result_data, list) else []})
+        except (JSONRepairError, ValidationError) as e:
             logger.error(f"Error parsing product data: {e}")
             return []
+        products = [product.model_dump() for product in results.products]
         
         return products[:max_results]
         
@@ -91,11 +147,331 @@ async def web_search_with_grok(query: str, max_results: int = 5) -> List[Dict]:
         return []
 
 
+def normalize_query(query: str) -> str:
+    """Requête normalisée (casse, ponctuation, espaces) servant de clé de cache"""
+    return ' '.join(re.sub(r"[^\w$.\-]+", ' ', (query or '').lower()).split())
+
+
+def description_keywords(text: str, limit: int = KEYWORDS_PER_QUERY) -> List[str]:
+    """Mots significatifs d'une description, dans leur ordre d'apparition, sans doublons"""
+    keywords = []
+    for word in re.findall(r"[^\W\d_][\w'-]*", (text or '').lower()):
+        word = word.strip("'-")
+        if len(word) > 2 and word not in STOPWORDS and word not in keywords:
+            keywords.append(word)
+            if len(keywords) == limit:
+                break
+    return keywords
+
+
+def build_query_variants(product_description: str, niche: str = "",
+                         price_band: Optional[Tuple[float, float]] = None) -> List[str]:
+    """
+    Variantes de requête pour une même recherche de produits similaires
+
+    Args:
+        product_description: Description du produit recherché
+        niche: Créneau de marché
+        price_band: Fourchette de prix (min, max) en USD (optionnel)
+
+    Returns:
+        Requêtes distinctes: requête complète (description + créneau), créneau + mots-clés,
+        mots-clés de la description, mots-clés dans la fourchette de prix
+    """
+    keywords = ' '.join(description_keywords(product_description)) or product_description.strip()
+    variants = [f"{product_description} {niche}" if niche else product_description]
+    if niche:
+        variants.append(f"{niche} {' '.join(keywords.split()[:3])}".strip())
+    variants.append(keywords)
+    if price_band:
+        low, high = price_band
+        variants.append(f"{keywords} between ${low:g} and ${high:g}")
+    unique = {}
+    for variant in variants:
+        unique.setdefault(normalize_query(variant), variant.strip())
+    return [variant for key, variant in unique.items() if key]
+
+
+def product_key(product: Dict) -> Optional[str]:
+    """
+    Clé de déduplication d'un produit: ID AliExpress, sinon URL normalisée, sinon nom
+
+    Args:
+        product: Produit renvoyé par la recherche
+
+    Returns:
+        Clé ('id:...', 'url:...' ou 'name:...') ou None si le produit n'est pas identifiable
+    """
+    url = (product.get("product_url") or '').strip()
+    if url:
+        product_id = extract_aliexpress_product_id(url)
+        if product_id:
+            return f"id:{product_id}"
+        parsed = urlparse(url if '//' in url else f"//{url}")
+        host = re.sub(r"^(www|m|[a-z]{2})\.", '', parsed.netloc.lower().split(':')[0])
+        return f"url:{host}{parsed.path.rstrip('/')}"
+    name = normalize_query(product.get("name") or '')
+    return f"name:{name}" if name else None
+
+
+def merge_results(result_lists: List[List[Dict]], max_results: int) -> List[Dict]:
+    """
+    Fusionne les résultats de plusieurs requêtes en dédupliquant par product_key
+
+    Les produits trouvés par le plus de variantes passent en tête (ordre d'apparition sinon);
+    sans score fourni par le modèle, le score de similarité dépend de cette couverture.
+
+    Args:
+        result_lists: Résultats de chaque variante
+        max_results: Nombre maximum de produits conservés
+
+    Returns:
+        Produits dédupliqués
+    """
+    merged: Dict[str, Dict] = {}
+    hits: Dict[str, int] = {}
+    for results in result_lists:
+        for key in {product_key(product): product for product in results}.keys() - {None}:
+            hits[key] = hits.get(key, 0) + 1
+        for product in results:
+            key = product_key(product)
+            if key is not None and key not in merged:
+                merged[key] = dict(product)
+    ranked = sorted(merged, key=lambda key: -hits[key])[:max_results]
+    variants = max(len(result_lists), 1)
+    products = []
+    for key in ranked:
+        product = merged[key]
+        if product.get("similarity_score") is None:
+            product["similarity_score"] = round(0.6 + 0.4 * hits[key] / variants, 2)
+        products.append(product)
+    return products
+
+
+class SimilarProductSearch:
+    """
+    Agrégateur de recherches Grok: variantes en parallèle (concurrence bornée), résultats en
+    cache par requête normalisée, fusion et déduplication des produits
+    """
+
+    def __init__(self, search_fn: Callable[[str, int], Awaitable[List[Dict]]] = None,
+                 max_concurrency: int = SEARCH_CONCURRENCY, cache_ttl: float = SEARCH_CACHE_TTL,
+                 cache_size: int = SEARCH_CACHE_SIZE, query_timeout: float = SEARCH_TIMEOUT,
+                 clock: Callable[[], float] = time.monotonic):
+        self.search_fn = search_fn or web_search_with_grok
+        self.max_concurrency = max_concurrency
+        self.query_timeout = query_timeout
+        self.cache_ttl = cache_ttl
+        self.cache_size = cache_size
+        self.clock = clock
+        self._lock = threading.Lock()
+        self._cache: "OrderedDict[Tuple[str, int], Tuple[float, List[Dict]]]" = OrderedDict()
+        self._stats = {'queries': 0, 'cache_hits': 0, 'failures': 0, 'products': 0, 'duplicates': 0}
+
+    def _count(self, **increments: int) -> None:
+        with self._lock:
+            for name, increment in increments.items():
+                self._stats[name] += increment
+
+    def _cached(self, key: Tuple[str, int]) -> Optional[List[Dict]]:
+        with self._lock:
+            entry = self._cache.get(key)
+            if entry is None:
+                return None
+            if self.clock() - entry[0] > self.cache_ttl:
+                del self._cache[key]
+                return None
+            self._cache.move_to_end(key)
+            return entry[1]
+
+    def _store(self, key: Tuple[str, int], products: List[Dict]) -> None:
+        with self._lock:
+            self._cache[key] = (self.clock(), products)
+            self._cache.move_to_end(key)
+            while len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+
+    async def search_many(self, queries: List[str], max_results: int) -> Dict[str, List[Dict]]:
+        """
+        Exécute des requêtes en parallèle (au plus max_concurrency à la fois)
+
+        Les requêtes identiques une fois normalisées ne partent qu'une fois; une requête qui
+        dépasse query_timeout est abandonnée sans retarder les autres. Un résultat vide, en
+        erreur ou hors délai n'est pas mis en cache.
+
+        Args:
+            queries: Requêtes de recherche
+            max_results: Nombre de produits demandés par requête
+
+        Returns:
+            Produits par requête normalisée (liste vide pour une requête en erreur ou hors délai)
+        """
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+        results: Dict[str, List[Dict]] = {}
+        pending = {}
+        for query in queries:
+            normalized = normalize_query(query)
+            if normalized in results or normalized in pending:
+                continue
+            cached = self._cached((normalized, max_results))
+            if cached is not None:
+                self._count(queries=1, cache_hits=1)
+                results[normalized] = cached
+            else:
+                pending[normalized] = query
+
+        async def run(normalized: str, query: str) -> None:
+            async with semaphore:
+                try:
+                    products = await asyncio.wait_for(self.search_fn(query, max_results), self.query_timeout)
+                except asyncio.TimeoutError:
+                    logger.error(f"AliExpress search timed out after {self.query_timeout:g}s for {query!r}")
+                    products = None
+                except Exception as e:
+                    logger.error(f"AliExpress search failed for {query!r}: {e}")
+                    products = None
+            self._count(queries=1, failures=0 if products else 1)
+            results[normalized] = products or []
+            if products:
+                self._store((normalized, max_results), products)
+
+        await asyncio.gather(*(run(normalized, query) for normalized, query in pending.items()))
+        return results
+
+    async def find_many(self, searches: List[Dict], max_results: int = 3) -> List[List[Dict]]:
+        """
+        Recherche de produits similaires pour plusieurs descriptions à la fois
+
+        Toutes les variantes de toutes les recherches partagent la même limite de concurrence.
+
+        Args:
+            searches: Dictionnaires product_description, niche (optionnel), price_band (optionnel)
+            max_results: Nombre maximum de produits par recherche
+
+        Returns:
+            Produits dédupliqués pour chaque recherche, dans l'ordre de searches
+        """
+        variants = [
+            build_query_variants(search["product_description"], search.get("niche", ""), search.get("price_band"))
+            for search in searches
+        ]
+        results = await self.search_many([query for queries in variants for query in queries], max_results)
+        merged = []
+        for queries in variants:
+            lists = [results.get(normalize_query(query), []) for query in queries]
+            products = merge_results(lists, max_results)
+            self._count(products=len(products), duplicates=sum(len(found) for found in lists) - len(products))
+            merged.append(products)
+        return merged
+
+    async def find(self, product_description: str, niche: str = "", max_results: int = 3,
+                   price_band: Optional[Tuple[float, float]] = None) -> List[Dict]:
+        """Recherche de produits similaires pour une description (voir find_many)"""
+        searches = [{"product_description": product_description, "niche": niche, "price_band": price_band}]
+        return (await self.find_many(searches, max_results))[0]
+
+    def timeout_for(self, searches: List[Dict]) -> float:
+        """
+        Délai global d'un lot de recherches lancé depuis une route synchrone
+
+        Chaque requête est bornée par query_timeout: le lot dure au plus une vague de requêtes
+        par tranche de max_concurrency variantes.
+
+        Args:
+            searches: Recherches du lot (voir find_many)
+
+        Returns:
+            Délai en secondes, marge comprise
+        """
+        queries = sum(len(build_query_variants(search["product_description"], search.get("niche", ""),
+                                               search.get("price_band"))) for search in searches)
+        waves = max(1, -(-queries // self.max_concurrency))
+        return waves * self.query_timeout + SEARCH_TIMEOUT_MARGIN
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats, cached_queries=len(self._cache))
+        stats['cache_hit_rate'] = round(stats['cache_hits'] / stats['queries'], 3) if stats['queries'] else 0.0
+        return stats
+
+    def clear_cache(self) -> None:
+        with self._lock:
+            self._cache.clear()
+
+
+similar_product_search = SimilarProductSearch()
+
+
+def _to_price(value) -> Optional[float]:
+    try:
+        return float(value) if value else None
+    except (TypeError, ValueError):
+        return None
+
+
+def save_similar_products(products_by_campaign: Dict[int, List[Dict]]) -> Dict[int, List[Dict]]:
+    """
+    Enregistre en un seul INSERT multi-lignes les produits similaires de plusieurs campagnes
+
+    Un produit déjà rattaché à la campagne (même product_key) n'est pas inséré une seconde fois.
+
+    Args:
+        products_by_campaign: Produits trouvés par ID de campagne
+
+    Returns:
+        Produits enregistrés (avec leur id) par ID de campagne
+    """
+    from app import db
+    from bulk_ingest import bulk_insert_returning
+    from models import SimilarProduct
+
+    existing = {}
+    campaign_ids = [campaign_id for campaign_id, products in products_by_campaign.items() if products]
+    if campaign_ids:
+        rows = db.session.query(SimilarProduct.campaign_id, SimilarProduct.product_url, SimilarProduct.name).filter(
+            SimilarProduct.campaign_id.in_(campaign_ids)).all()
+        for campaign_id, product_url, name in rows:
+            existing.setdefault(campaign_id, set()).add(product_key({"product_url": product_url, "name": name}))
+
+    mappings = []
+    for campaign_id, products in products_by_campaign.items():
+        for product in products:
+            key = product_key(product)
+            if key in existing.setdefault(campaign_id, set()):
+                continue
+            existing[campaign_id].add(key)
+            mappings.append({
+                "name": (product.get("name") or "Unknown Product")[:255],
+                "description": product.get("description", ""),
+                "price": _to_price(product.get("price")),
+                "image_url": product.get("image_url", ""),
+                "product_url": product.get("product_url", ""),
+                "similarity_score": product.get("similarity_score", 0.8),
+                "relevance_notes": product.get("relevance_notes", ""),
+                "campaign_id": campaign_id,
+            })
+
+    saved: Dict[int, List[Dict]] = {campaign_id: [] for campaign_id in products_by_campaign}
+    if not mappings:
+        return saved
+    try:
+        ids = bulk_insert_returning(SimilarProduct, mappings)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    for product_id, mapping in zip(ids, mappings):
+        row = {key: value for key, value in mapping.items() if key != "campaign_id"}
+        saved[mapping["campaign_id"]].append(dict(row, id=product_id))
+    return saved
+
+
 async def find_similar_products(
     product_description: str, 
     campaign_id: int,
     niche: str = "", 
-    max_results: int = 3
+    max_results: int = 3,
+    price_band: Optional[Tuple[float, float]] = None
 ) -> List[Dict]:
     """
     Recherche des produits similaires sur AliExpress et les enregistre dans la base de données.
@@ -105,82 +481,64 @@ async def find_similar_products(
         campaign_id: ID de la campagne associée
         niche: Créneau de marché pour affiner la recherche
         max_results: Nombre maximum de résultats à retourner
+        price_band: Fourchette de prix (min, max) en USD (optionnel)
         
     Returns:
         Liste des produits similaires trouvés
     """
-    from app import db
-    from models import SimilarProduct
-    
     try:
-        # Construire une requête plus pertinente en combinant la description et le créneau
-        search_query = f"{product_description} {niche}" if niche else product_description
-        
-        # Récupérer les produits similaires via Grok
-        products = await web_search_with_grok(search_query, max_results)
-        
-        # Enregistrer les produits trouvés dans la base de données
-        saved_products = []
-        for product in products:
-            similar_product = SimilarProduct(
-                name=product.get("name", "Unknown Product"),
-                description=product.get("description", ""),
-                price=float(product.get("price", 0.0)) if product.get("price") else None,
-                image_url=product.get("image_url", ""),
-                product_url=product.get("product_url", ""),
-                similarity_score=product.get("similarity_score", 0.8),  # Valeur par défaut
-                relevance_notes=product.get("relevance_notes", ""),
-                campaign_id=campaign_id
-            )
-            
-            db.session.add(similar_product)
-            saved_products.append(similar_product)
-        
-        # Sauvegarder les changements
-        db.session.commit()
-        
-        return [
-            {
-                "id": p.id,
-                "name": p.name,
-                "description": p.description,
-                "price": p.price,
-                "image_url": p.image_url,
-                "product_url": p.product_url,
-                "similarity_score": p.similarity_score,
-                "relevance_notes": p.relevance_notes
-            }
-            for p in saved_products
-        ]
-        
+        products = await similar_product_search.find(product_description, niche, max_results, price_band)
+        return save_similar_products({campaign_id: products})[campaign_id]
     except Exception as e:
-        # En cas d'erreur, annuler la transaction
-        db.session.rollback()
         logger.error(f"Error finding similar products: {e}")
         return []
 
 
-def search_similar_products(product_description: str, campaign_id: int, niche: str = "", max_results: int = 3) -> List[Dict]:
+def search_similar_products(product_description: str, campaign_id: int, niche: str = "", max_results: int = 3,
+                            price_band: Optional[Tuple[float, float]] = None) -> List[Dict]:
     """
     Wrapper synchrone pour la fonction de recherche de produits similaires.
-    """
-    import logging
-    
-    # Créer une nouvelle boucle d'événements
-    loop = asyncio.new_event_loop()
-    asyncio.set_event_loop(loop)
     
+    Les recherches s'exécutent sur la boucle partagée (async_runner), l'enregistrement dans le
+    thread appelant.
+    """
     try:
-        # Exécuter la fonction asynchrone avec un timeout pour éviter les blocages
-        return loop.run_until_complete(asyncio.wait_for(
-            find_similar_products(product_description, campaign_id, niche, max_results),
-            timeout=30.0
-        ))
-    except asyncio.TimeoutError:
-        logging.error(f"Timeout lors de la recherche de produits similaires pour la campagne {campaign_id}")
+        search = {"product_description": product_description, "niche": niche, "price_band": price_band}
+        products = run_async(
+            similar_product_search.find(product_description, niche, max_results, price_band),
+            timeout=similar_product_search.timeout_for([search])
+        )
+        return save_similar_products({campaign_id: products})[campaign_id]
+    except TimeoutError:
+        logger.error(f"Timeout lors de la recherche de produits similaires pour la campagne {campaign_id}")
         return []
     except Exception as e:
-        logging.error(f"Erreur lors de la recherche de produits similaires: {str(e)}")
+        logger.error(f"Erreur lors de la recherche de produits similaires: {str(e)}")
         return []
-    finally:
-        loop.close()
\ No newline at end of file
+
+
+def search_similar_products_many(searches: List[Dict], max_results: int = 3) -> Dict[int, List[Dict]]:
+    """
+    Recherche et enregistre les produits similaires de plusieurs campagnes (création en lot)
+    
+    Args:
+        searches: Dictionnaires campaign_id, product_description, niche (optionnel),
+            price_band (optionnel)
+        max_results: Nombre maximum de produits par campagne
+        
+    Returns:
+        Produits enregistrés par ID de campagne (liste vide pour une campagne dont toutes les
+        requêtes ont échoué ou dépassé SEARCH_TIMEOUT, pour toutes en cas d'erreur)
+    """
+    try:
+        results = run_async(similar_product_search.find_many(searches, max_results),
+                            timeout=similar_product_search.timeout_for(searches))
+        products_by_campaign: Dict[int, List[Dict]] = {}
+        for search, products in zip(searches, results):
+            products_by_campaign.setdefault(search["campaign_id"], []).extend(products)
+        return save_similar_products(products_by_campaign)
+    except TimeoutError:
+        logger.error(f"Timeout lors de la recherche de produits similaires pour {len(searches)} campagnes")
+    except Exception as e:
+        logger.error(f"Erreur lors de la recherche de produits similaires: {str(e)}")
+    return {search["campaign_id"]: [] for search in searches}
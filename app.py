@@ -166,6 +166,14 @@ app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET", "dev-secret-key-please-change-in-production")
 app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
 
+# Bundles CSS/JS précompilés (python asset_optimizer.py): helpers Jinja et variantes .br/.gz
+from asset_optimizer import init_assets
+init_assets(app)
+
+# CSS critique en ligne par template (calculé au premier rendu, voir critical_css)
+from critical_css import init_critical_css
+init_critical_css(app)
+
 # Initialize monitoring with provided DSN
 init_sentry()
 
@@ -886,7 +894,7 @@ def nl2br_filter(s):
     return Markup(s.replace('\n', '<br>'))
 
 # Function to log metrics to the database
-def log_metric(metric_name, data, category=None, status=None, response_time=None, customer_id=None):
+def log_metric(metric_name, data, category=None, status=None, response_time=None, customer_id=None, campaign_id=None):
     """
     Fonction améliorée pour enregistrer des métriques dans la base de données
     
@@ -897,6 +905,7 @@ def log_metric(metric_name, data, category=None, status=None, response_time=None
         status: État (success, error, warning, info)
         response_time: Temps de réponse en ms (pour les appels API)
         customer_id: ID du client associé (si pertinent)
+        campaign_id: ID de la campagne associée (par défaut data['campaign_id'] si présent)
     
     Returns:
         Métrique créée ou None en cas d'erreur
@@ -938,6 +947,9 @@ def log_metric(metric_name, data, category=None, status=None, response_time=None
         metric.response_time = response_time
         metric.created_at = datetime.datetime.now()
         metric.customer_id = customer_id
+        if campaign_id is None and isinstance(data, dict) and isinstance(data.get('campaign_id'), int):
+            campaign_id = data['campaign_id']
+        metric.campaign_id = campaign_id
         
         # Utilisation de l'ID numérique pour la compatibilité
         if current_user and current_user.is_authenticated and hasattr(current_user, 'numeric_id'):
@@ -1216,14 +1228,10 @@ def profiles(page=1):
                 
                 # If requested, persist profiles to the database
                 if persist_to_db:
-                    saved_profiles = 0
-                    for profile_dict in customer_profiles:
-                        # Create Customer objects and save to database
-                        customer = Customer.from_profile_dict(profile_dict, niche_id)
-                        db.session.add(customer)
-                        saved_profiles += 1
-                    
-                    db.session.commit()
+                    # Insertion en lot (clients, personas et associations) avec déduplication
+                    from bulk_ingest import bulk_ingest_profiles
+                    ingest_stats = bulk_ingest_profiles(customer_profiles, niche_market_id=niche_id)
+                    saved_profiles = ingest_stats['customers_inserted']
                     flash(f'Successfully generated and saved {saved_profiles} customer profiles', 'success')
                 else:
                     flash('Successfully generated customer profiles (not saved to database)', 'success')
@@ -1644,6 +1652,7 @@ def generate_customer_persona_db(customer_id):
     import asyncio
     import traceback
     import persona_manager  # Importer le module de gestion des personas
+    import persona_similarity
     from models import CustomerPersona, CustomerPersonaAssociation
     
     customer = Customer.query.get_or_404(customer_id)
@@ -1669,12 +1678,42 @@ def generate_customer_persona_db(customer_id):
         if customer.niche_market:
             niche_name = customer.niche_market.name
         
-        # Récupérer les personas existants pour éviter la répétition
-        existing_personas = []
-        other_customers = Customer.query.filter(Customer.id != customer_id, Customer.persona != None).order_by(Customer.created_at.desc()).limit(5).all()
-        for other in other_customers:
-            if other.persona:
-                existing_personas.append(other.persona)
+        # Proposer le persona d'un client au profil très proche (sans appel au LLM)
+        profile_text = persona_similarity.customer_profile_text(customer)
+        if request.args.get('reuse_existing') in ('1', 'true'):
+            suggestion = persona_similarity.suggest_reusable_persona(
+                persona_similarity.profile_inputs_text(customer), customer.niche_market_id,
+                exclude_customer_id=customer.id
+            )
+            if suggestion:
+                reused, similarity = suggestion
+                customer.persona = reused.description
+                customer.niche_attributes = reused.niche_specific_attributes
+                customer.avatar_prompt = reused.avatar_prompt
+                customer.assign_persona(reused.id, is_primary=True, relevance_score=similarity,
+                                        notes="Persona existant réutilisé (similarité)")
+                db.session.commit()
+                log_metric("persona_generation", {
+                    "success": True,
+                    "customer_id": customer.id,
+                    "reused_persona_id": reused.id,
+                    "similarity": round(similarity, 3)
+                })
+                return jsonify({
+                    'success': True,
+                    'reused': True,
+                    'persona_id': reused.id,
+                    'similarity': similarity,
+                    'persona': reused.description,
+                    'niche_attributes': reused.niche_specific_attributes,
+                    'purchased_products': customer.purchased_products,
+                    'avatar_prompt': reused.avatar_prompt
+                })
+        
+        # Montrer au modèle les personas existants les plus proches de ce profil pour éviter la répétition
+        existing_personas = persona_similarity.similar_persona_texts(
+            profile_text, k=3, niche_market_id=customer.niche_market_id, exclude_customer_id=customer.id
+        )
         
         # Utiliser asyncio pour exécuter la génération asynchrone
         async def generate_data():
@@ -1733,6 +1772,19 @@ def generate_customer_persona_db(customer_id):
                 db.session.commit()
                 logging.info(f"Persona existant mis à jour pour le client {customer.id}: {persona.id}")
                 persona_id = persona.id
+            elif (duplicates := persona_similarity.persona_similarity_index.find_duplicates(
+                    enhanced_data["persona"], kinds=[persona_similarity.KIND_PERSONA],
+                    niche_market_id=customer.niche_market_id, limit=1)):
+                # Le persona généré est un quasi-doublon: associer le persona existant
+                (_, persona_id), similarity = duplicates[0]
+                persona_manager.assign_persona_to_customer(
+                    customer_id=customer.id,
+                    persona_id=persona_id,
+                    is_primary=True,
+                    relevance_score=similarity,
+                    notes="Quasi-doublon d'un persona existant"
+                )
+                logging.info(f"Persona généré quasi identique au persona {persona_id} (similarité {similarity:.2f}), réutilisé pour le client {customer.id}")
             else:
                 # Créer un nouveau persona
                 persona_title = f"Persona pour {customer.name}"
@@ -2050,22 +2102,26 @@ def delete_account():
 
 @app.route('/images/<filename>')
 def serve_generated_image(filename):
-    """Sert les images générées par IA stockées localement"""
-    from flask import send_from_directory
-    from pathlib import Path
+    """
+    Sert les images générées par IA stockées localement
+    
+    Le fichier est localisé par l'index en mémoire de image_serving et servi avec des
+    en-têtes de cache immuables (ETag, Last-Modified; 304 sur If-None-Match).
+    Avec ?w=<largeur>, sert la déclinaison WebP/AVIF la plus adaptée au navigateur
+    (en-tête Accept), générée à la première demande si nécessaire.
+    """
+    from image_serving import serve_image
     
     try:
-        # Chemin vers le répertoire de stockage des images
-        image_dir = Path("generated_images")
-        
-        # Vérifier dans les sous-dossiers
-        for subdir in ["avatars", "campaigns", "products", "."]:
-            full_path = image_dir / subdir / filename
-            if full_path.exists():
-                return send_from_directory(str(image_dir / subdir), filename)
-        
-        # Si le fichier n'est pas trouvé
-        return "Image not found", 404
+        response = serve_image(
+            filename,
+            requested_width=request.args.get('w', type=int),
+            accept_header=request.headers.get('Accept'),
+            if_none_match=request.if_none_match
+        )
+        if response is None:
+            return "Image not found", 404
+        return response
         
     except Exception as e:
         logging.error(f"Erreur lors du service d'image {filename}: {str(e)}")
@@ -2104,6 +2160,35 @@ def get_storage_statistics():
     result = integrated_image_service.get_storage_statistics()
     return jsonify(result)
 
+@app.route('/api/images/gc', methods=['POST'])
+@login_required
+def collect_image_garbage():
+    """API du ramasse-miettes des images (dry run par défaut)"""
+    from integrated_image_service import integrated_image_service
+    from image_gc import ImageGCPolicy
+    
+    if current_user.role != 'admin':
+        return jsonify({"success": False, "error": "Accès administrateur requis"}), 403
+    
+    data = request.get_json(silent=True) or {}
+    policy = ImageGCPolicy.from_env()
+    try:
+        for field in ('max_age_days', 'idle_days'):
+            if data.get(field) is not None:
+                setattr(policy, field, float(data[field]))
+        for field in ('user_quota', 'global_quota'):
+            if data.get(f'{field}_mb') is not None:
+                setattr(policy, f'{field}_bytes', int(float(data[f'{field}_mb']) * 1024 * 1024))
+    except (TypeError, ValueError):
+        return jsonify({"success": False, "error": "Paramètres de politique invalides"}), 400
+    if 'reconcile_orphans' in data:
+        policy.reconcile_orphans = bool(data['reconcile_orphans'])
+    if 'delete_orphan_files' in data:
+        policy.delete_orphan_files = bool(data['delete_orphan_files'])
+    
+    result = integrated_image_service.collect_garbage(policy, dry_run=data.get('dry_run', True) is not False)
+    return jsonify(result)
+
 @app.route('/image_generation', methods=['GET', 'POST'])
 def image_generation():
     """Page de génération d'images marketing optimisées avec stockage persistant"""
@@ -3690,7 +3775,8 @@ def generate_value_map():
         industry = industry or ""
         niche_market = niche_market or ""
         
-        # Générer la carte de valeur
+        # Générer la carte de valeur (réutilisée si les mêmes entrées ont déjà été traitées)
+        cache_context = {}
         value_map = generate_product_value_map(
             product_name=product_name,
             product_description=product_description,
@@ -3698,7 +3784,10 @@ def generate_value_map():
             industry=industry,
             niche_market=niche_market,
             key_features=key_features,
-            competitors=competitors
+            competitors=competitors,
+            product_id=product_id,
+            campaign_id=campaign_id,
+            cache_context=cache_context
         )
         
         # Générer le HTML pour l'affichage
@@ -3712,6 +3801,7 @@ def generate_value_map():
                 title=title,
                 content=value_map,  # Stockage des données JSON
                 html_result=value_map_html,  # Stockage du HTML généré
+                input_hash=cache_context.get('input_hash'),
                 product_id=product_id,
                 campaign_id=campaign_id,
                 persona_id=persona_id,
@@ -3727,7 +3817,8 @@ def generate_value_map():
         # Log de la métrique
         log_metric(
             metric_name="osp_value_map_generation",
-            data={"product_name": product_name, "industry": industry, "saved": should_save},
+            data={"product_name": product_name, "industry": industry, "saved": should_save,
+                  "cache": cache_context.get('source')},
             category="marketing",
             status=True,
             response_time=None
@@ -3781,12 +3872,16 @@ def analyze_content():
         target_audience = target_audience or ""
         industry = industry or ""
         
-        # Analyser le contenu
+        # Analyser le contenu (analyse réutilisée si les mêmes entrées ont déjà été traitées)
+        cache_context = {}
         content_analysis = analyze_content_with_osp_guidelines(
             content=content,
             content_type=content_type,
             target_audience=target_audience,
-            industry=industry
+            industry=industry,
+            product_id=product_id,
+            campaign_id=campaign_id,
+            cache_context=cache_context
         )
         
         # Sauvegarder l'analyse si demandé
@@ -3805,6 +3900,7 @@ def analyze_content():
                     'results': content_analysis
                 },
                 html_result=json.dumps(content_analysis, indent=2, ensure_ascii=False),
+                input_hash=cache_context.get('input_hash'),
                 product_id=product_id,
                 campaign_id=campaign_id,
                 persona_id=persona_id,
@@ -3820,7 +3916,8 @@ def analyze_content():
         # Log de la métrique
         log_metric(
             metric_name="osp_content_analysis",
-            data={"content_type": content_type, "length": len(content), "saved": should_save},
+            data={"content_type": content_type, "length": len(content), "saved": should_save,
+                  "cache": cache_context.get('source')},
             category="marketing",
             status=True,
             response_time=None
@@ -3885,11 +3982,15 @@ def optimize_seo():
             "description": description
         }
         
+        cache_context = {}
         seo_optimized = apply_seo_guidelines(
             content=content,
             page_type=page_type,
             locale=locale,
-            is_local_business=is_local_business
+            is_local_business=is_local_business,
+            product_id=product_id,
+            campaign_id=campaign_id,
+            cache_context=cache_context
         )
         
         # Sauvegarder l'analyse si demandé
@@ -3909,6 +4010,7 @@ def optimize_seo():
                     'results': seo_optimized
                 },
                 html_result=json.dumps(seo_optimized, indent=2, ensure_ascii=False),
+                input_hash=cache_context.get('input_hash'),
                 product_id=product_id,
                 campaign_id=campaign_id,
                 persona_id=persona_id,
@@ -3924,7 +4026,8 @@ def optimize_seo():
         # Log de la métrique
         log_metric(
             metric_name="osp_seo_optimization",
-            data={"page_type": page_type, "locale": locale, "saved": should_save},
+            data={"page_type": page_type, "locale": locale, "saved": should_save,
+                  "cache": cache_context.get('source')},
             category="marketing",
             status=True,
             response_time=None
@@ -4162,7 +4265,12 @@ logger.info("Health check routes registered successfully")
 
 # Initialize security enhancements
 try:
+    rate_limiter = limiter
     talisman, limiter = init_security_extensions(app)
+    # Une page de galerie charge des dizaines d'images: pas de limite de débit par défaut,
+    # ni pour le limiteur initial ni pour celui des extensions de sécurité
+    for active_limiter in filter(None, (rate_limiter, limiter)):
+        active_limiter.exempt(serve_generated_image)
     add_security_headers(app)
     setup_error_handlers(app)
     logger.info("Security enhancements initialized successfully")
@@ -4201,11 +4309,85 @@ try:
             return jsonify({'success': True, 'message': 'Sauvegarde créée avec succès'})
         else:
             return jsonify({'success': False, 'message': 'Échec de la sauvegarde'}), 500
+
+    @app.route('/admin/backups/<name>/verify', methods=['POST'])
+    @login_required
+    def verify_backup(name):
+        """Vérifie une sauvegarde (sommes de contrôle et table des matières)"""
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Accès non autorisé'}), 403
+
+        result = backup_manager.verify_backup(name)
+        return jsonify(result), 200 if result['valid'] else 422
+
+    @app.route('/admin/backups/incremental', methods=['POST'])
+    @login_required
+    def run_incremental_backup():
+        """Exporte immédiatement les nouvelles lignes des tables de télémétrie"""
+        if current_user.role != 'admin':
+            return jsonify({'error': 'Accès non autorisé'}), 403
+
+        from incremental_backup import incremental_backup
+        report = incremental_backup.run()
+        failed = any('error' in table for table in report.values())
+        return jsonify({'success': not failed, 'tables': report}), 500 if failed else 200
     
     logger.info("Backup system initialized successfully")
 except Exception as e:
     logger.error(f"Failed to initialize backup system: {str(e)}")
 
+# Initialize incremental telemetry backups (metric, audit_log, user_activities, stored_images)
+if int(os.environ.get("BACKUP_INCREMENTAL_INTERVAL", "0")) > 0:
+    try:
+        from incremental_backup import incremental_backup
+        incremental_backup.start_scheduler(app)
+    except Exception as e:
+        logger.error(f"Failed to start incremental backup scheduler: {str(e)}")
+
+# Initialize campaign counters flusher (vues/clics/conversions écrits par lots)
+if os.environ.get("CAMPAIGN_COUNTERS_FLUSHER", "true").lower() == "true":
+    try:
+        from campaign_counters import campaign_counters
+        campaign_counters.start_flusher(app)
+    except Exception as e:
+        logger.error(f"Failed to start campaign counters flusher: {str(e)}")
+
+# Initialize LLM token accounting (budgets par utilisateur, agrégats d'usage écrits par lots)
+try:
+    from token_accounting import token_accountant, TokenBudgetExceeded
+
+    @app.errorhandler(TokenBudgetExceeded)
+    def token_budget_exceeded(error):
+        """Requête IA refusée avant l'appel: budget de tokens insuffisant"""
+        message = _("Budget de tokens insuffisant pour cette génération (%(remaining)s restants).",
+                    remaining=error.remaining)
+        if request.headers.get('X-Requested-With') == 'XMLHttpRequest' or request.path.startswith('/api/') \
+                or request.is_json:
+            return jsonify({
+                'error': 'Token Budget Exceeded',
+                'message': message,
+                'requested': error.requested,
+                'remaining': error.remaining,
+                'status_code': 402
+            }), 402
+        flash(message, 'warning')
+        return redirect(url_for('user_profile_config'))
+
+    if os.environ.get("LLM_USAGE_FLUSHER", "true").lower() == "true":
+        token_accountant.start_flusher(app)
+except Exception as e:
+    logger.error(f"Failed to initialize LLM token accounting: {str(e)}")
+
+# Initialize image serving (index des fichiers, compteurs d'accès écrits par lots)
+try:
+    from image_serving import image_index, image_access_counter
+    with app.app_context():
+        image_index.load()
+    if os.environ.get("IMAGE_ACCESS_FLUSHER", "true").lower() == "true":
+        image_access_counter.start_flusher(app)
+except Exception as e:
+    logger.error(f"Failed to initialize image serving: {str(e)}")
+
 # Initialize feedback system
 if feedback_system_loaded:
     try:
@@ -4276,9 +4458,10 @@ def run_performance_optimization():
     if performance_modules_loaded:
         try:
             # Optimisation des assets
+            # Les bundles sont construits au déploiement (python asset_optimizer.py), pas pendant une requête
             if asset_optimizer:
-                asset_results = asset_optimizer.optimize_all_assets()
-                results['assets'] = f"Assets optimisés: {asset_results.get('files_processed', 0)} fichiers"
+                asset_stats = asset_optimizer.get_optimization_stats()
+                results['assets'] = f"Bundles d'assets construits: {asset_stats['manifest_entries']}"
             
             # Optimisation de la base de données
             if db_index_optimizer:
@@ -4298,6 +4481,64 @@ def run_performance_optimization():
     
     return jsonify(results)
 
+@app.route('/admin/llm-router', methods=['GET'])
+@login_required
+def llm_router_state():
+    """État du routeur IA: disjoncteurs, latence p95 et taux d'erreur par fournisseur"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Accès non autorisé'}), 403
+    
+    from llm_router import llm_router
+    return jsonify(llm_router.state())
+
+@app.route('/admin/llm-router/<provider>/reset', methods=['POST'])
+@login_required
+def reset_llm_provider(provider):
+    """Referme les disjoncteurs d'un fournisseur IA (ou d'une opération: xai:image) et efface ses statistiques"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Accès non autorisé'}), 403
+    
+    from llm_router import llm_router
+    llm_router.reset(provider)
+    return jsonify({'success': True, 'provider': provider})
+
+@app.route('/admin/llm-usage', methods=['GET'])
+@login_required
+def llm_usage_summary():
+    """Consommation LLM agrégée (appels, tokens, coût), gains de la compaction des prompts, réparations JSON
+    et taux de réutilisation des résultats OSP"""
+    if current_user.role != 'admin':
+        return jsonify({'error': 'Accès non autorisé'}), 403
+    
+    from osp_cache import osp_result_cache
+    from prompt_compaction import prompt_compactor
+    from structured_output import structured_output
+    from token_accounting import token_accountant
+    days = request.args.get('days', 30, type=int)
+    group_by = [column for column in request.args.get('group_by', 'user_id,model,feature').split(',') if column]
+    token_accountant.flush()
+    try:
+        rows = token_accountant.summary(days=days, group_by=group_by, user_id=request.args.get('user_id'))
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify({'days': days, 'group_by': group_by, 'usage': rows, 'compaction': prompt_compactor.stats(),
+                    'structured_output': structured_output.stats(), 'osp_cache': osp_result_cache.stats()})
+
+@app.route('/api/tokens/usage', methods=['GET'])
+@login_required
+def my_token_usage():
+    """Budget de tokens de l'utilisateur connecté et sa consommation par fonctionnalité"""
+    from token_accounting import token_accountant
+    token_accountant.flush()
+    db.session.refresh(current_user)
+    return jsonify({
+        'tokens_total': current_user.tokens_total,
+        'tokens_used': current_user.tokens_used,
+        'tokens_remaining': current_user.tokens_remaining,
+        'usage': token_accountant.summary(days=request.args.get('days', 30, type=int),
+                                          group_by=('model', 'feature'), user_id=current_user.id),
+    })
+
 # Routes API pour le système de feedback utilisateur
 @app.route('/api/contextual-help', methods=['POST'])
 def get_contextual_help():
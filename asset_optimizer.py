@@ -1,6 +1,17 @@
 """
 Module d'optimisation des assets statiques
 Implémente la minification, compression et optimisation des ressources
+
+Les feuilles de style et scripts sont regroupés par page (ASSET_BUNDLES) au moment du
+déploiement, jamais pendant une requête:
+
+    python asset_optimizer.py
+
+Chaque bundle est minifié, nommé d'après le hash de son contenu et accompagné de ses
+variantes précompressées (.br si le module brotli est installé, .gz) dans static/dist,
+avec un manifeste JSON. Les templates résolvent les bundles via asset_tags/asset_url;
+PrecompressedAssetMiddleware sert la variante acceptée par le navigateur avec un cache
+d'un an. Sans build, les fichiers sources sont servis individuellement.
 """
 
 import os
@@ -8,245 +19,633 @@ import json
 import hashlib
 import gzip
 import logging
-from pathlib import Path
-from typing import Dict, List, Optional
 import re
+import threading
+import time
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from markupsafe import Markup, escape
+from werkzeug.http import parse_accept_header, parse_etags, quote_etag
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import wrap_file
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
 
 logger = logging.getLogger(__name__)
 
+STATIC_FOLDER = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+# Bundles par groupe de pages: nom du bundle -> sources (relatives à static/), dans l'ordre de la cascade
+ASSET_BUNDLES: Dict[str, List[str]] = {
+    # Toutes les pages (layout.html)
+    'base.css': [
+        'css/markeasy-theme.css',
+        'css/dashboard-improvements.css',
+        'css/custom.css',
+        'css/table-horizontal-scroll.css',
+        'css/orange-theme.css',
+        'css/brand-ai-fix.css',
+        'css/loading.css',
+        'css/mobile-optimizations.css',
+        'css/global-orange-icons.css',
+        'css/header-banner-responsive.css',
+        'css/mobile-responsive-fix.css',
+        'css/mobile-first-optimization.css',
+        'css/high-contrast-dark.css',
+        'css/auth-pages.css',
+        'css/ninja-theme.css',
+        'css/ninja-icons-orange.css',
+        'css/navbar-orange-theme.css',
+        'css/feedback-mobile-ios.css',
+        'css/high-contrast.css',
+        'css/markeasy-animations.css',
+        'css/theme-switcher.css',
+        'css/theme-colors.css',
+    ],
+    'base.js': [
+        'js/loading-simple.js',
+        'js/app.js',
+        'js/simple-ninja-feedback.js',
+    ],
+    # Fin de page (après l'initialisation de Sentry)
+    'animations.js': [
+        'js/markeasy-animations.js',
+    ],
+    # Pages métriques et administration
+    'icons.css': [
+        'css/icon-system.css',
+    ],
+    'personas.js': [
+        'js/persona-enhancements.js',
+    ],
+}
+
+DIST_DIRNAME = "dist"
+MANIFEST_FILENAME = "manifest.json"
+
+# Les bundles sont nommés d'après leur contenu: cache d'un an
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Intervalle minimal entre deux vérifications du manifeste sur disque (secondes)
+MANIFEST_CHECK_INTERVAL = float(os.environ.get("ASSET_MANIFEST_CHECK_INTERVAL", "5"))
+
+CONTENT_TYPES = {
+    'css': 'text/css; charset=utf-8',
+    'js': 'text/javascript; charset=utf-8',
+}
+
+# Encodages précompressés, par ordre de préférence: (encodage HTTP, extension)
+ENCODINGS = (('br', '.br'), ('gzip', '.gz'))
+
+
+def _scan_string(source: str, start: int) -> int:
+    """Fin (exclue) d'une chaîne entre guillemets commençant à start"""
+    quote = source[start]
+    i = start + 1
+    n = len(source)
+    while i < n:
+        c = source[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == quote or c == '\n':
+            return i + 1
+        i += 1
+    return n
+
+
+_CSS_BLOCK_DELIMITER = re.compile(r'[{};]|$')
+
+
+def minify_css(css_content: str) -> str:
+    """
+    Minifie une feuille de style
+
+    Les chaînes sont conservées telles quelles, les commentaires supprimés (sauf /*! ... */)
+    et les espaces réduits sans toucher à ceux qui portent un sens: combinateur descendant
+    (`a :hover {`), opérateurs de calc(), `and (` des media queries.
+
+    Args:
+        css_content: Source CSS
+
+    Returns:
+        CSS minifié
+    """
+    out: List[str] = []
+    pending_space = False
+    i = 0
+    n = len(css_content)
+    while i < n:
+        c = css_content[i]
+        if c == '/' and css_content.startswith('/*', i):
+            end = css_content.find('*/', i + 2)
+            end = n if end < 0 else end + 2
+            if css_content.startswith('/*!', i):
+                out.append(css_content[i:end])
+            else:
+                pending_space = True
+            i = end
+            continue
+        if c.isspace():
+            pending_space = True
+            i += 1
+            continue
+
+        if pending_space and out:
+            last = out[-1][-1]
+            if last not in '{};,>~:(' and c not in '{};,>~)!':
+                # "a :hover {" (sélecteur) garde l'espace, "color : red;" (déclaration) non
+                if c != ':' or _CSS_BLOCK_DELIMITER.search(css_content, i).group() == '{':
+                    out.append(' ')
+        pending_space = False
+
+        if c == '"' or c == "'":
+            end = _scan_string(css_content, i)
+            out.append(css_content[i:end])
+            i = end
+            continue
+        if c == '}' and out and out[-1] == ';':
+            out.pop()
+        out.append(c)
+        i += 1
+    return ''.join(out)
+
+
+_JS_WORD_CHARS = re.compile(r'[\w$\\]')
+_JS_TRAILING_WORD = re.compile(r'([A-Za-z_$][\w$]*)$')
+# Mots-clés après lesquels "/" ouvre une expression régulière
+_JS_REGEX_KEYWORDS = frozenset((
+    'return', 'typeof', 'instanceof', 'in', 'of', 'new', 'delete', 'void', 'throw',
+    'case', 'do', 'else', 'yield', 'await',
+))
+
+
+def _is_js_word(c: str) -> bool:
+    return bool(_JS_WORD_CHARS.match(c))
+
+
+def _scan_regex(source: str, start: int) -> int:
+    """Fin (exclue) d'une expression régulière littérale, drapeaux compris"""
+    i = start + 1
+    n = len(source)
+    in_class = False
+    while i < n:
+        c = source[i]
+        if c == '\\':
+            i += 2
+            continue
+        if c == '\n':
+            return i
+        if in_class:
+            in_class = c != ']'
+        elif c == '[':
+            in_class = True
+        elif c == '/':
+            i += 1
+            break
+        i += 1
+    while i < n and _is_js_word(source[i]):
+        i += 1
+    return i
+
+
+def _scan_template(source: str, start: int) -> int:
+    """Fin (exclue) d'un gabarit `...`, expressions ${...} imbriquées comprises"""
+    i = start + 1
+    n = len(source)
+    while i < n:
+        c = source[i]
+        if c == '\\':
+            i += 2
+        elif c == '`':
+            return i + 1
+        elif c == '$' and source.startswith('${', i):
+            i = _scan_js_expression(source, i + 2)
+        else:
+            i += 1
+    return n
+
+
+def _scan_js_expression(source: str, start: int) -> int:
+    """Fin (exclue) d'une expression ${...}: jusqu'à l'accolade fermante correspondante"""
+    depth = 1
+    i = start
+    n = len(source)
+    while i < n:
+        c = source[i]
+        if c == '"' or c == "'":
+            i = _scan_string(source, i)
+            continue
+        if c == '`':
+            i = _scan_template(source, i)
+            continue
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return i + 1
+        i += 1
+    return n
+
+
+def _regex_allowed(out: List[str]) -> bool:
+    """Un "/" à cette position ouvre-t-il une expression régulière (et non une division) ?"""
+    tail = ''.join(out[-32:]).rstrip()
+    if not tail:
+        return True
+    last = tail[-1]
+    if last in '(,=:[!&|?{};+-*%<>~^':
+        return True
+    match = _JS_TRAILING_WORD.search(tail)
+    return bool(match) and match.group(1) in _JS_REGEX_KEYWORDS
+
+
+def minify_js(js_content: str) -> str:
+    """
+    Minifie un script sans analyse syntaxique complète
+
+    Les chaînes, gabarits et expressions régulières littérales sont reconnus et conservés
+    (un `//` dans une URL n'est pas un commentaire). Les commentaires sont supprimés et les
+    espaces réduits; les retours à la ligne significatifs pour l'insertion automatique des
+    points-virgules sont conservés. Les identifiants ne sont pas renommés.
+
+    Args:
+        js_content: Source JavaScript
+
+    Returns:
+        JavaScript minifié
+    """
+    out: List[str] = []
+    pending = ''  # '', ' ' ou '\n'
+    i = 0
+    n = len(js_content)
+    while i < n:
+        c = js_content[i]
+
+        if c == '/' and i + 1 < n and js_content[i + 1] in '/*':
+            if js_content[i + 1] == '/':
+                end = js_content.find('\n', i)
+                i = n if end < 0 else end
+                continue
+            end = js_content.find('*/', i + 2)
+            end = n if end < 0 else end + 2
+            if js_content.startswith('/*!', i):
+                out.append(js_content[i:end])
+                pending = '\n'
+            else:
+                pending = '\n' if '\n' in js_content[i:end] or pending == '\n' else (pending or ' ')
+            i = end
+            continue
+        if c.isspace():
+            if c == '\n' or c == '\r':
+                pending = '\n'
+            elif not pending:
+                pending = ' '
+            i += 1
+            continue
+
+        if pending and out:
+            last = out[-1][-1]
+            if pending == '\n':
+                if last not in '{;,(=[:&|' and c not in '});,]:&|.?':
+                    out.append('\n')
+            elif ((_is_js_word(last) and _is_js_word(c))
+                  or (last in '+-' and c in '+-')
+                  or (last == '/' and c in '/*')
+                  or (last.isdigit() and c == '.')):
+                out.append(' ')
+        pending = ''
+
+        if c == '"' or c == "'":
+            end = _scan_string(js_content, i)
+        elif c == '`':
+            end = _scan_template(js_content, i)
+        elif c == '/' and _regex_allowed(out):
+            end = _scan_regex(js_content, i)
+        else:
+            out.append(c)
+            i += 1
+            continue
+        out.append(js_content[i:end])
+        i = end
+    return ''.join(out)
+
+
+class AssetManifest:
+    """Manifeste des bundles construits (static/dist/manifest.json), relu après chaque build"""
+
+    def __init__(self, static_folder: str = STATIC_FOLDER):
+        self.path = os.path.join(static_folder, DIST_DIRNAME, MANIFEST_FILENAME)
+        self._bundles: Dict[str, Dict] = {}
+        self._mtime: Optional[float] = None
+        self._checked_at = 0.0
+        self._lock = threading.Lock()
+
+    def load(self) -> Dict[str, Dict]:
+        """Charge le manifeste (vide si aucun build n'a été fait)"""
+        with self._lock:
+            try:
+                mtime = os.path.getmtime(self.path)
+            except OSError:
+                self._bundles, self._mtime = {}, None
+                return self._bundles
+            if mtime != self._mtime:
+                try:
+                    with open(self.path, 'r', encoding='utf-8') as f:
+                        self._bundles = json.load(f).get('bundles', {})
+                    self._mtime = mtime
+                except Exception as e:
+                    logger.warning(f"Failed to load asset manifest: {e}")
+            self._checked_at = time.monotonic()
+            return self._bundles
+
+    @property
+    def bundles(self) -> Dict[str, Dict]:
+        """Bundles du manifeste, rechargé au plus toutes les MANIFEST_CHECK_INTERVAL secondes"""
+        if time.monotonic() - self._checked_at > MANIFEST_CHECK_INTERVAL:
+            return self.load()
+        return self._bundles
+
+    def get(self, name: str) -> Optional[Dict]:
+        return self.bundles.get(name)
+
+
 class AssetOptimizer:
     """Optimiseur d'assets statiques pour améliorer les performances"""
-    
-    def __init__(self, static_folder: str = "static"):
+
+    def __init__(self, static_folder: str = STATIC_FOLDER, bundles: Optional[Dict[str, List[str]]] = None):
         self.static_folder = static_folder
-        self.cache_manifest = {}
-        self.load_cache_manifest()
-    
-    def load_cache_manifest(self):
-        """Charge le manifeste du cache des assets"""
-        manifest_path = os.path.join(self.static_folder, "manifest.json")
-        if os.path.exists(manifest_path):
-            try:
-                with open(manifest_path, 'r') as f:
-                    self.cache_manifest = json.load(f)
-            except Exception as e:
-                logger.warning(f"Failed to load cache manifest: {e}")
-                self.cache_manifest = {}
-    
-    def save_cache_manifest(self):
-        """Sauvegarde le manifeste du cache des assets"""
-        try:
-            os.makedirs(self.static_folder, exist_ok=True)
-            manifest_path = os.path.join(self.static_folder, "manifest.json")
-            with open(manifest_path, 'w') as f:
-                json.dump(self.cache_manifest, f, indent=2)
-        except Exception as e:
-            logger.error(f"Failed to save cache manifest: {e}")
-    
+        self.bundles = ASSET_BUNDLES if bundles is None else bundles
+        self.manifest = AssetManifest(static_folder)
+        self.manifest.load()
+
+    @property
+    def cache_manifest(self) -> Dict[str, str]:
+        """Correspondance bundle -> fichier construit"""
+        return {name: entry['file'] for name, entry in self.manifest.bundles.items()}
+
     def minify_css(self, css_content: str) -> str:
         """Minifie le contenu CSS"""
-        try:
-            # Supprime les commentaires
-            css_content = re.sub(r'/\*.*?\*/', '', css_content, flags=re.DOTALL)
-            
-            # Supprime les espaces superflus
-            css_content = re.sub(r'\s+', ' ', css_content)
-            css_content = re.sub(r';\s*}', '}', css_content)
-            css_content = re.sub(r'{\s*', '{', css_content)
-            css_content = re.sub(r'}\s*', '}', css_content)
-            css_content = re.sub(r':\s*', ':', css_content)
-            css_content = re.sub(r';\s*', ';', css_content)
-            
-            return css_content.strip()
-        except Exception as e:
-            logger.error(f"CSS minification failed: {e}")
-            return css_content
-    
+        return minify_css(css_content)
+
     def minify_js(self, js_content: str) -> str:
-        """Minifie basiquement le contenu JavaScript"""
-        try:
-            # Supprime les commentaires sur une ligne
-            js_content = re.sub(r'//.*$', '', js_content, flags=re.MULTILINE)
-            
-            # Supprime les commentaires multilignes
-            js_content = re.sub(r'/\*.*?\*/', '', js_content, flags=re.DOTALL)
-            
-            # Supprime les espaces superflus
-            js_content = re.sub(r'\s+', ' ', js_content)
-            js_content = re.sub(r';\s*', ';', js_content)
-            js_content = re.sub(r'{\s*', '{', js_content)
-            js_content = re.sub(r'}\s*', '}', js_content)
-            
-            return js_content.strip()
-        except Exception as e:
-            logger.error(f"JS minification failed: {e}")
-            return js_content
-    
+        """Minifie le contenu JavaScript"""
+        return minify_js(js_content)
+
     def generate_file_hash(self, file_path: str) -> str:
         """Génère un hash pour versioning des fichiers"""
         try:
             with open(file_path, 'rb') as f:
-                content = f.read()
-                return hashlib.md5(content).hexdigest()[:8]
+                return hashlib.sha256(f.read()).hexdigest()[:12]
         except Exception as e:
             logger.error(f"Failed to generate hash for {file_path}: {e}")
             return "default"
-    
-    def compress_file(self, file_path: str) -> bool:
-        """Compresse un fichier avec gzip"""
-        try:
-            with open(file_path, 'rb') as f_in:
-                with gzip.open(f"{file_path}.gz", 'wb') as f_out:
-                    f_out.writelines(f_in)
-            return True
-        except Exception as e:
-            logger.error(f"Failed to compress {file_path}: {e}")
-            return False
-    
-    def optimize_css_files(self) -> Dict[str, str]:
-        """Optimise tous les fichiers CSS"""
-        results = {}
-        css_dir = os.path.join(self.static_folder, "css")
-        
-        if not os.path.exists(css_dir):
-            logger.info("CSS directory not found, creating basic structure")
-            os.makedirs(css_dir, exist_ok=True)
-            return results
-        
-        for css_file in Path(css_dir).glob("*.css"):
-            if css_file.name.endswith(".min.css"):
-                continue
-                
-            try:
-                with open(css_file, 'r', encoding='utf-8') as f:
-                    original_content = f.read()
-                
-                minified_content = self.minify_css(original_content)
-                file_hash = hashlib.md5(minified_content.encode()).hexdigest()[:8]
-                
-                # Nom du fichier minifié avec hash
-                min_filename = f"{css_file.stem}.{file_hash}.min.css"
-                min_filepath = css_file.parent / min_filename
-                
-                with open(min_filepath, 'w', encoding='utf-8') as f:
-                    f.write(minified_content)
-                
-                # Compression gzip
-                self.compress_file(str(min_filepath))
-                
-                # Mise à jour du manifeste
-                self.cache_manifest[str(css_file.name)] = min_filename
-                
-                results[css_file.name] = {
-                    'original_size': len(original_content),
-                    'minified_size': len(minified_content),
-                    'compression_ratio': round((1 - len(minified_content) / len(original_content)) * 100, 2),
-                    'minified_file': min_filename
-                }
-                
-                logger.info(f"Optimized CSS: {css_file.name} -> {min_filename}")
-                
-            except Exception as e:
-                logger.error(f"Failed to optimize CSS file {css_file}: {e}")
-                results[css_file.name] = {'error': str(e)}
-        
-        return results
-    
-    def optimize_js_files(self) -> Dict[str, str]:
-        """Optimise tous les fichiers JavaScript"""
-        results = {}
-        js_dir = os.path.join(self.static_folder, "js")
-        
-        if not os.path.exists(js_dir):
-            logger.info("JS directory not found, creating basic structure")
-            os.makedirs(js_dir, exist_ok=True)
-            return results
-        
-        for js_file in Path(js_dir).glob("*.js"):
-            if js_file.name.endswith(".min.js"):
+
+    @staticmethod
+    def _write_atomic(path: Path, content: bytes) -> None:
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_bytes(content)
+        os.replace(tmp_path, path)
+
+    def _build_bundle(self, name: str, sources: List[str], dist_dir: Path, use_brotli: bool) -> Dict:
+        stem, ext = name.rsplit('.', 1)
+        minify = minify_css if ext == 'css' else minify_js
+        parts = []
+        original_size = 0
+        for source in sources:
+            with open(os.path.join(self.static_folder, source), 'r', encoding='utf-8') as f:
+                text = f.read()
+            original_size += len(text.encode('utf-8'))
+            parts.append(minify(text))
+        # ";" entre scripts: un fichier sans point-virgule final ne doit pas fusionner avec le suivant
+        content = ('\n' if ext == 'css' else ';\n').join(parts).encode('utf-8')
+
+        digest = hashlib.sha256(content).hexdigest()[:12]
+        filename = f"{stem}.{digest}.{ext}"
+        path = dist_dir / filename
+        if not path.exists():
+            self._write_atomic(path, content)
+
+        encodings = {}
+        for encoding, suffix in ENCODINGS:
+            if encoding == 'br':
+                if not use_brotli:
+                    continue
+                compressed = brotli.compress(content, quality=11)
+            else:
+                # mtime=0: build reproductible, même fichier pour le même contenu
+                compressed = gzip.compress(content, compresslevel=9, mtime=0)
+            if len(compressed) >= len(content):
                 continue
-                
-            try:
-                with open(js_file, 'r', encoding='utf-8') as f:
-                    original_content = f.read()
-                
-                minified_content = self.minify_js(original_content)
-                file_hash = hashlib.md5(minified_content.encode()).hexdigest()[:8]
-                
-                # Nom du fichier minifié avec hash
-                min_filename = f"{js_file.stem}.{file_hash}.min.js"
-                min_filepath = js_file.parent / min_filename
-                
-                with open(min_filepath, 'w', encoding='utf-8') as f:
-                    f.write(minified_content)
-                
-                # Compression gzip
-                self.compress_file(str(min_filepath))
-                
-                # Mise à jour du manifeste
-                self.cache_manifest[str(js_file.name)] = min_filename
-                
-                results[js_file.name] = {
-                    'original_size': len(original_content),
-                    'minified_size': len(minified_content),
-                    'compression_ratio': round((1 - len(minified_content) / len(original_content)) * 100, 2),
-                    'minified_file': min_filename
-                }
-                
-                logger.info(f"Optimized JS: {js_file.name} -> {min_filename}")
-                
-            except Exception as e:
-                logger.error(f"Failed to optimize JS file {js_file}: {e}")
-                results[js_file.name] = {'error': str(e)}
-        
-        return results
-    
-    def generate_critical_css(self, html_content: str) -> str:
-        """Génère le CSS critique pour le rendu above-the-fold"""
+            encoded_path = dist_dir / (filename + suffix)
+            if not encoded_path.exists():
+                self._write_atomic(encoded_path, compressed)
+            encodings[encoding] = {'file': f"{DIST_DIRNAME}/{filename}{suffix}", 'size': len(compressed)}
+
+        return {
+            'file': f"{DIST_DIRNAME}/{filename}",
+            'hash': digest,
+            'size': len(content),
+            'original_size': original_size,
+            'encodings': encodings,
+            'sources': list(sources),
+        }
+
+    def build(self, use_brotli: bool = True) -> Dict[str, Dict]:
+        """
+        Construit les bundles, leurs variantes précompressées et le manifeste
+
+        Les fichiers du build précédent restent servis (pages en cache pendant un
+        déploiement); les plus anciens sont supprimés.
+
+        Args:
+            use_brotli: Produit les variantes .br (si le module brotli est installé)
+
+        Returns:
+            Entrées du nouveau manifeste par bundle
+        """
+        if use_brotli and brotli is None:
+            logger.warning("brotli module not installed, only gzip variants will be built")
+            use_brotli = False
+
+        dist_dir = Path(self.static_folder) / DIST_DIRNAME
+        dist_dir.mkdir(parents=True, exist_ok=True)
+        previous = self.manifest.load()
+
+        bundles = {}
+        for name, sources in self.bundles.items():
+            bundles[name] = self._build_bundle(name, sources, dist_dir, use_brotli)
+            entry = bundles[name]
+            logger.info(f"Built {name} -> {entry['file']} ({entry['original_size']} -> {entry['size']} bytes)")
+
+        manifest = {'built_at': datetime.utcnow().isoformat(), 'bundles': bundles}
+        self._write_atomic(dist_dir / MANIFEST_FILENAME, json.dumps(manifest, indent=2).encode('utf-8'))
+        self.manifest.load()
+
+        keep = {MANIFEST_FILENAME}
+        for entry in list(bundles.values()) + list(previous.values()):
+            keep.add(Path(entry['file']).name)
+            keep.update(Path(variant['file']).name for variant in entry.get('encodings', {}).values())
+        for path in dist_dir.iterdir():
+            if path.is_file() and path.name not in keep:
+                path.unlink()
+
+        return bundles
+
+    def optimize_all_assets(self, use_brotli: bool = True) -> Dict[str, any]:
+        """Construit les bundles (étape de build, voir __main__)"""
+        bundles = self.build(use_brotli)
+        return {
+            'files_processed': sum(len(entry['sources']) for entry in bundles.values()),
+            'bundles': bundles,
+        }
+
+    def generate_critical_css(self, html_content: str, bundle_name: str = 'base.css') -> str:
+        """Génère le CSS critique pour le rendu above-the-fold (voir critical_css)"""
+        from critical_css import CriticalCSSManager
+
         try:
-            # CSS de base critique pour NinjaLeads
-            critical_css = """
-            body{margin:0;font-family:-apple-system,BlinkMacSystemFont,"Segoe UI",Roboto,sans-serif}
-            .navbar{background:#fff;box-shadow:0 2px 4px rgba(0,0,0,.1)}
-            .container{max-width:1200px;margin:0 auto;padding:0 15px}
-            .btn{padding:8px 16px;border:none;border-radius:4px;cursor:pointer}
-            .btn-primary{background:#007bff;color:#fff}
-            .hero{padding:60px 0;text-align:center}
-            .card{background:#fff;border-radius:8px;box-shadow:0 2px 10px rgba(0,0,0,.1);margin-bottom:20px}
-            """
-            
-            return critical_css.strip()
+            manager = CriticalCSSManager(self)
+            return manager.extractor.extract(html_content, manager.bundle_css(bundle_name))
         except Exception as e:
             logger.error(f"Failed to generate critical CSS: {e}")
             return ""
-    
-    def optimize_all_assets(self) -> Dict[str, any]:
-        """Optimise tous les assets statiques"""
-        results = {
-            'css_optimization': self.optimize_css_files(),
-            'js_optimization': self.optimize_js_files(),
-            'critical_css': self.generate_critical_css(""),
-            'timestamp': os.path.getmtime(__file__) if os.path.exists(__file__) else 0
-        }
-        
-        # Sauvegarde du manifeste
-        self.save_cache_manifest()
-        
-        return results
-    
+
+    def asset_paths(self, name: str) -> List[str]:
+        """Fichiers (relatifs à static/) à inclure pour un bundle: le bundle construit ou ses sources"""
+        entry = self.manifest.get(name)
+        if entry is not None:
+            return [entry['file']]
+        return list(self.bundles.get(name, [name]))
+
     def get_asset_url(self, asset_name: str) -> str:
-        """Retourne l'URL optimisée d'un asset"""
-        if asset_name in self.cache_manifest:
-            return f"/static/{self.cache_manifest[asset_name]}"
+        """Retourne l'URL optimisée d'un asset (bundle construit, sinon fichier statique)"""
+        entry = self.manifest.get(asset_name)
+        if entry is not None:
+            return f"/static/{entry['file']}"
         return f"/static/{asset_name}"
-    
+
+    def asset_tags(self, name: str) -> Markup:
+        """Balises <link>/<script> d'un bundle pour les templates"""
+        from flask import url_for
+
+        tags = []
+        for path in self.asset_paths(name):
+            url = escape(url_for('static', filename=path))
+            if path.endswith('.css'):
+                tags.append(Markup(f'<link rel="stylesheet" href="{url}">'))
+            else:
+                tags.append(Markup(f'<script src="{url}"></script>'))
+        return Markup('\n    ').join(tags)
+
     def get_optimization_stats(self) -> Dict[str, any]:
         """Retourne les statistiques d'optimisation"""
         return {
-            'manifest_entries': len(self.cache_manifest),
+            'manifest_entries': len(self.manifest.bundles),
             'static_folder': self.static_folder,
+            'brotli_available': brotli is not None,
             'manifest': self.cache_manifest
         }
 
+
+class PrecompressedAssetMiddleware:
+    """
+    Middleware WSGI servant les bundles du manifeste avec leur variante précompressée
+
+    Les requêtes vers un fichier du manifeste reçoivent la variante brotli ou gzip acceptée
+    par le client (Vary: Accept-Encoding), un ETag propre à chaque encodage et un
+    Cache-Control immutable, sans passer par Flask. Les autres requêtes sont transmises.
+    """
+
+    def __init__(self, wsgi_app, manifest: AssetManifest, url_prefix: str = "/static/"):
+        self.wsgi_app = wsgi_app
+        self.manifest = manifest
+        self.url_prefix = url_prefix
+        self.dist_prefix = f"{url_prefix}{DIST_DIRNAME}/"
+        self.static_folder = os.path.dirname(os.path.dirname(manifest.path))
+        self._routes: Dict[str, Dict] = {}
+        self._routes_source = None
+
+    def _lookup(self, path: str) -> Optional[Dict]:
+        bundles = self.manifest.bundles
+        if bundles is not self._routes_source:
+            self._routes = {self.url_prefix + entry['file']: entry for entry in bundles.values()}
+            self._routes_source = bundles
+        return self._routes.get(path)
+
+    def _negotiate(self, entry: Dict, accept_encoding: str) -> Tuple[str, Optional[str], int]:
+        """Fichier (relatif à static/), encodage et taille de la meilleure variante acceptée"""
+        if accept_encoding:
+            accepted = parse_accept_header(accept_encoding)
+            for encoding, _ in ENCODINGS:
+                variant = entry['encodings'].get(encoding)
+                if variant and accepted[encoding] > 0:
+                    return variant['file'], encoding, variant['size']
+        return entry['file'], None, entry['size']
+
+    def __call__(self, environ, start_response):
+        path = environ.get('PATH_INFO', '')
+        if not path.startswith(self.dist_prefix) or environ.get('REQUEST_METHOD') not in ('GET', 'HEAD'):
+            return self.wsgi_app(environ, start_response)
+        entry = self._lookup(path)
+        if entry is None:
+            return self.wsgi_app(environ, start_response)
+
+        relative_path, encoding, size = self._negotiate(entry, environ.get('HTTP_ACCEPT_ENCODING', ''))
+        etag = f"{entry['hash']}-{encoding}" if encoding else entry['hash']
+        headers = [
+            ('Content-Type', CONTENT_TYPES.get(entry['file'].rsplit('.', 1)[-1], 'application/octet-stream')),
+            ('Cache-Control', CACHE_CONTROL),
+            ('Vary', 'Accept-Encoding'),
+            ('ETag', quote_etag(etag)),
+            ('X-Content-Type-Options', 'nosniff'),
+        ]
+
+        if parse_etags(environ.get('HTTP_IF_NONE_MATCH')).contains(etag):
+            return Response(status=304, headers=headers)(environ, start_response)
+
+        try:
+            handle = open(os.path.join(self.static_folder, relative_path), 'rb')
+        except OSError:
+            # Build supprimé sans redémarrage: Flask sert (ou non) le fichier
+            return self.wsgi_app(environ, start_response)
+        if encoding:
+            headers.append(('Content-Encoding', encoding))
+        headers.append(('Content-Length', str(size)))
+        response = Response(wrap_file(environ, handle), headers=headers, direct_passthrough=True)
+        return response(environ, start_response)
+
+
+def init_assets(app, optimizer: Optional['AssetOptimizer'] = None) -> None:
+    """Enregistre les helpers Jinja asset_tags/asset_url et le middleware des bundles précompressés"""
+    optimizer = optimizer or asset_optimizer
+    app.add_template_global(optimizer.asset_tags, 'asset_tags')
+    app.add_template_global(optimizer.get_asset_url, 'asset_url')
+    app.wsgi_app = PrecompressedAssetMiddleware(
+        app.wsgi_app, optimizer.manifest, url_prefix=f"{app.static_url_path}/"
+    )
+
+
 # Instance globale
-asset_optimizer = AssetOptimizer()
\ No newline at end of file
+asset_optimizer = AssetOptimizer()
+
+
+if __name__ == "__main__":
+    import argparse
+
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Construit les bundles CSS/JS et leurs variantes précompressées")
+    parser.add_argument("--static-folder", default=STATIC_FOLDER)
+    parser.add_argument("--no-brotli", action="store_true", help="Ne produit que les variantes gzip")
+    args = parser.parse_args()
+
+    results = AssetOptimizer(args.static_folder).build(use_brotli=not args.no_brotli)
+    for bundle_name, bundle in results.items():
+        variants = ", ".join(f"{enc}: {v['size']}" for enc, v in bundle['encodings'].items())
+        print(f"{bundle_name}: {bundle['file']} ({bundle['original_size']} -> {bundle['size']} bytes; {variants})")
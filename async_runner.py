@@ -0,0 +1,88 @@
+"""
+Boucle d'événements partagée pour exécuter des coroutines depuis du code synchrone
+
+Les routes Flask appelaient les fonctions asynchrones en créant une boucle par appel: les
+clients HTTP asynchrones (AsyncOpenAI...) ne pouvaient pas réutiliser leurs connexions d'une
+boucle à l'autre. run_async soumet la coroutine à une boucle unique, démarrée à la demande
+dans un thread dédié, en lui transmettant le contexte applicatif Flask et l'utilisateur
+facturé (token_accounting) de l'appelant.
+"""
+import asyncio
+import contextlib
+import logging
+import threading
+from typing import Any, Awaitable, Optional
+
+from flask import current_app, has_app_context
+
+from token_accounting import current_user_id, usage_context
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncRunner:
+    """Boucle asyncio persistante dans un thread démon"""
+
+    def __init__(self, name: str = 'async-runner'):
+        self.name = name
+        self._lock = threading.Lock()
+        self._loop: Optional[asyncio.AbstractEventLoop] = None
+        self._thread: Optional[threading.Thread] = None
+
+    def _ensure_loop(self) -> asyncio.AbstractEventLoop:
+        with self._lock:
+            if self._loop is None or self._thread is None or not self._thread.is_alive():
+                self._loop = asyncio.new_event_loop()
+                self._thread = threading.Thread(target=self._loop.run_forever, name=self.name, daemon=True)
+                self._thread.start()
+                logger.debug(f"Event loop thread {self.name} started")
+            return self._loop
+
+    @staticmethod
+    async def _in_caller_context(awaitable: Awaitable, app, user_id: Optional[str]) -> Any:
+        app_context = app.app_context() if app is not None else contextlib.nullcontext()
+        with app_context, usage_context(user_id=user_id):
+            return await awaitable
+
+    def run(self, awaitable: Awaitable, timeout: Optional[float] = None) -> Any:
+        """
+        Exécute une coroutine sur la boucle partagée et attend son résultat
+
+        Args:
+            awaitable: Coroutine à exécuter
+            timeout: Délai maximum en secondes (None: illimité)
+
+        Returns:
+            Résultat de la coroutine
+
+        Raises:
+            TimeoutError: Si le délai est dépassé (la coroutine est alors annulée)
+        """
+        app = current_app._get_current_object() if has_app_context() else None
+        future = asyncio.run_coroutine_threadsafe(
+            self._in_caller_context(awaitable, app, current_user_id()),
+            self._ensure_loop(),
+        )
+        try:
+            return future.result(timeout)
+        except TimeoutError:
+            future.cancel()
+            raise
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._loop is not None:
+                self._loop.call_soon_threadsafe(self._loop.stop)
+                self._thread.join(timeout=5)
+                if not self._thread.is_alive():
+                    self._loop.close()
+            self._loop = None
+            self._thread = None
+
+
+async_runner = AsyncRunner()
+
+
+def run_async(awaitable: Awaitable, timeout: Optional[float] = None) -> Any:
+    """Exécute une coroutine sur la boucle partagée (voir AsyncRunner.run)"""
+    return async_runner.run(awaitable, timeout)
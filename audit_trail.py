@@ -7,7 +7,7 @@ import json
 import datetime
 from enum import Enum
 from typing import Dict, Any, Optional
-from flask import request, g
+from flask import request, g, current_app
 from flask_login import current_user
 from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean
 from sqlalchemy.dialects.postgresql import JSONB
@@ -91,7 +91,8 @@ class AuditLog(db.Model):
     description = Column(Text, nullable=False)
     
     # Données additionnelles
-    metadata = Column(JSONB, nullable=True)
+    # 'metadata' est réservé par SQLAlchemy: attribut renommé, colonne inchangée
+    extra_data = Column('metadata', JSONB, nullable=True)
     
     # Indicateurs
     success = Column(Boolean, default=True, nullable=False)
@@ -116,7 +117,7 @@ class AuditLog(db.Model):
             'description': self.description,
             'success': self.success,
             'requires_attention': self.requires_attention,
-            'metadata': self.metadata
+            'metadata': self.extra_data
         }
 
 class AuditTrail:
@@ -164,7 +165,8 @@ class AuditTrail:
             metadata: Données additionnelles
         """
         
-        if not self.app.config.get('AUDIT_ENABLED', True):
+        app = self.app or current_app
+        if not app.config.get('AUDIT_ENABLED', True):
             return
         
         try:
@@ -212,7 +214,7 @@ class AuditTrail:
                 description=description,
                 success=success,
                 requires_attention=requires_attention,
-                metadata=metadata
+                extra_data=metadata
             )
             
             db.session.add(audit_entry)
@@ -1,21 +1,72 @@
 """
 Système de sauvegarde automatique pour la base de données PostgreSQL
 Utilise APScheduler pour programmer les sauvegardes périodiques
+
+Deux formats de sauvegarde:
+- 'custom' (défaut): pg_dump -Fc est lu en flux et compressé à la volée (zstd si le module
+  zstandard est installé, sinon gzip), sans fichier intermédiaire; la restauration
+  décompresse en flux vers pg_restore.
+- 'directory': pg_dump -Fd -j N (une table par fichier, dump parallèle) et restauration
+  parallèle pg_restore -j N.
+
+Chaque sauvegarde est décrite par un manifeste JSON (sommes SHA-256, taille, durée, nombre
+d'entrées de l'archive) et vérifiée après écriture: sommes de contrôle puis lecture de la
+table des matières (pg_restore --list). Une base SQLite (développement, tests) est
+sauvegardée par un adaptateur équivalent.
+
+Avec BACKUP_EXCLUDE_INCREMENTAL, les données des tables couvertes par une chaîne
+incrémentale (incremental_backup) sont exclues du dump complet, qui n'en garde que le schéma.
 """
 
 import os
 import subprocess
 import logging
-import gzip
-import shlex
+import hashlib
+import json
+import re
+import shutil
+import sqlite3
+import tempfile
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime, timedelta
 from pathlib import Path
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
 from apscheduler.schedulers.background import BackgroundScheduler
 from apscheduler.triggers.cron import CronTrigger
-from urllib.parse import urlparse
+from urllib.parse import unquote, urlparse, urlunparse
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
 
 logger = logging.getLogger(__name__)
 
+# Taille des blocs lus et écrits en flux
+CHUNK_SIZE = 1024 * 1024
+
+# 'custom' (flux compressé) ou 'directory' (dump et restauration parallèles)
+BACKUP_FORMAT = os.environ.get("BACKUP_FORMAT", "custom")
+BACKUP_JOBS = int(os.environ.get("BACKUP_JOBS", str(min(4, os.cpu_count() or 1))))
+BACKUP_COMPRESSION = os.environ.get("BACKUP_COMPRESSION", "zstd" if zstandard else "gzip")
+BACKUP_VERIFY = os.environ.get("BACKUP_VERIFY", "true").lower() == "true"
+# Délai maximal d'une commande pg_dump/pg_restore (secondes)
+BACKUP_TIMEOUT = int(os.environ.get("BACKUP_TIMEOUT", "3600"))
+
+# Exclut du dump complet les données des tables sauvegardées par incremental_backup
+BACKUP_EXCLUDE_INCREMENTAL = os.environ.get("BACKUP_EXCLUDE_INCREMENTAL", "false").lower() == "true"
+
+BACKUP_PREFIX = "ninjalead_backup_"
+# Première version de pg_dump acceptant --compress=zstd (format directory)
+PG_DUMP_ZSTD_VERSION = 16
+COMPRESSION_SUFFIXES = {'zstd': '.zst', 'gzip': '.gz'}
+
+
+class BackupError(Exception):
+    """Échec d'une sauvegarde, d'une vérification ou d'une restauration"""
+
 def validate_database_url(database_url):
     """
     Validates and sanitizes the database URL to prevent command injection
@@ -62,14 +113,419 @@ def validate_database_url(database_url):
         logger.error(f"Error validating database URL: {str(e)}")
         return None
 
+
+
+def resolve_compression(compression: Optional[str] = None) -> str:
+    """Algorithme de compression effectif (gzip si zstandard n'est pas installé)"""
+    compression = (compression or BACKUP_COMPRESSION).lower()
+    if compression == 'zstd' and zstandard is None:
+        logger.warning("zstandard module not installed, falling back to gzip")
+        return 'gzip'
+    if compression not in COMPRESSION_SUFFIXES:
+        raise BackupError(f"Unsupported backup compression: {compression}")
+    return compression
+
+
+def open_compressor(compression: str):
+    """Compresseur en flux (méthodes compress/flush)"""
+    if compression == 'zstd':
+        return zstandard.ZstdCompressor(level=3).compressobj()
+    return zlib.compressobj(6, zlib.DEFLATED, 31)
+
+
+class CompressedWriter:
+    """Fichier compressé écrit en flux (interface write/close, utilisable par COPY ... TO STDOUT)"""
+
+    def __init__(self, path: Path, compression: str):
+        self.path = path
+        self._file = open(path, 'wb')
+        self._compressor = open_compressor(compression)
+        self._digest = hashlib.sha256()
+        self.size = 0
+        self.raw_size = 0
+
+    def _emit(self, data: bytes) -> None:
+        if data:
+            self._file.write(data)
+            self._digest.update(data)
+            self.size += len(data)
+
+    def write(self, chunk) -> int:
+        if isinstance(chunk, str):
+            chunk = chunk.encode('utf-8')
+        self.raw_size += len(chunk)
+        self._emit(self._compressor.compress(chunk))
+        return len(chunk)
+
+    def close(self) -> Dict:
+        """
+        Termine le flux compressé
+
+        Returns:
+            Dictionnaire {size, raw_size, sha256} (somme du fichier compressé)
+        """
+        if not self._file.closed:
+            self._emit(self._compressor.flush())
+            self._file.close()
+        return {'size': self.size, 'raw_size': self.raw_size, 'sha256': self._digest.hexdigest()}
+
+    def abort(self) -> None:
+        """Abandonne l'écriture et supprime le fichier partiel"""
+        self._file.close()
+        self.path.unlink(missing_ok=True)
+
+
+def write_compressed(path: Path, chunks: Iterable[bytes], compression: str) -> Dict:
+    """
+    Compresse un flux dans un fichier, sans le matérialiser en mémoire
+
+    Returns:
+        Dictionnaire {size, raw_size, sha256} (somme du fichier compressé)
+    """
+    writer = CompressedWriter(path, compression)
+    try:
+        for chunk in chunks:
+            writer.write(chunk)
+    except BaseException:
+        writer.abort()
+        raise
+    return writer.close()
+
+
+def read_compressed(path: Path, compression: str) -> Iterator[bytes]:
+    """Décompresse un fichier en flux, par blocs d'au plus CHUNK_SIZE octets"""
+    with open(path, 'rb') as f:
+        if compression == 'zstd':
+            yield from zstandard.ZstdDecompressor().read_to_iter(f, read_size=CHUNK_SIZE, write_size=CHUNK_SIZE)
+            return
+        decompressor = zlib.decompressobj(31)
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            # Taux de compression élevé (SQL, JSON): la sortie est bornée, le reste attend
+            data = decompressor.decompress(chunk, CHUNK_SIZE)
+            while data:
+                yield data
+                data = decompressor.decompress(decompressor.unconsumed_tail, CHUNK_SIZE)
+        data = decompressor.flush()
+        if data:
+            yield data
+
+
+def file_sha256(path: Path) -> str:
+    digest = hashlib.sha256()
+    with open(path, 'rb') as f:
+        for chunk in iter(lambda: f.read(CHUNK_SIZE), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+class PostgresBackupAdapter:
+    """pg_dump/pg_restore: archive au format custom en flux, ou format directory parallèle"""
+
+    name = 'postgresql'
+    # pg_dump compresse lui-même chaque fichier du format directory
+    compresses_directory = True
+
+    def __init__(self, database_url: str):
+        parsed = urlparse(database_url)
+        # Mot de passe transmis par l'environnement plutôt que visible dans la liste des processus
+        netloc = parsed.hostname or ''
+        if parsed.username:
+            netloc = f"{parsed.username}@{netloc}"
+        if parsed.port:
+            netloc = f"{netloc}:{parsed.port}"
+        self.dsn = urlunparse(parsed._replace(netloc=netloc))
+        self.env = dict(os.environ)
+        if parsed.password:
+            self.env['PGPASSWORD'] = unquote(parsed.password)
+        self._pg_dump_version = None
+
+    def pg_dump_version(self) -> Optional[int]:
+        """
+        Version majeure de pg_dump (lue une fois par `pg_dump --version`)
+
+        Returns:
+            Version majeure (ex: 15), ou None si elle ne peut être déterminée
+        """
+        if self._pg_dump_version is None:
+            try:
+                result = subprocess.run(["pg_dump", "--version"], capture_output=True, env=self.env, timeout=30)
+                match = re.search(r'\)\s*(\d+)', result.stdout.decode(errors='replace'))
+                self._pg_dump_version = int(match.group(1)) if match else 0
+            except (OSError, subprocess.SubprocessError) as e:
+                logger.warning(f"pg_dump version detection failed: {e}")
+                self._pg_dump_version = 0
+        return self._pg_dump_version or None
+
+    @staticmethod
+    def _check(process: subprocess.Popen, stderr, command: str) -> None:
+        returncode = process.wait(timeout=BACKUP_TIMEOUT)
+        if returncode != 0:
+            stderr.seek(0)
+            raise BackupError(f"{command} failed ({returncode}): {stderr.read().decode(errors='replace')[-2000:]}")
+
+    @staticmethod
+    def _exclude_options(exclude_data: Iterable[str]) -> List[str]:
+        return [f"--exclude-table-data={table}" for table in exclude_data]
+
+    def dump(self, exclude_data: Iterable[str] = ()) -> Iterator[bytes]:
+        """Archive pg_dump -Fc non compressée, lue en flux"""
+        cmd = ["pg_dump", "--format=custom", "--compress=0", "--no-owner", "--no-acl",
+               "--no-password", f"--dbname={self.dsn}", *self._exclude_options(exclude_data)]
+        with tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=stderr, env=self.env)
+            try:
+                for chunk in iter(lambda: process.stdout.read(CHUNK_SIZE), b''):
+                    yield chunk
+            except GeneratorExit:
+                process.kill()
+                raise
+            finally:
+                process.stdout.close()
+            self._check(process, stderr, "pg_dump")
+
+    def _feed(self, cmd: List[str], chunks: Iterable[bytes], command: str) -> bytes:
+        with tempfile.TemporaryFile() as stdout, tempfile.TemporaryFile() as stderr:
+            process = subprocess.Popen(cmd, stdin=subprocess.PIPE, stdout=stdout, stderr=stderr, env=self.env)
+            try:
+                for chunk in chunks:
+                    process.stdin.write(chunk)
+            except BrokenPipeError:
+                # Le processus s'est arrêté: son code de retour et stderr expliquent pourquoi
+                pass
+            finally:
+                try:
+                    process.stdin.close()
+                except BrokenPipeError:
+                    pass
+            self._check(process, stderr, command)
+            stdout.seek(0)
+            return stdout.read()
+
+    def restore(self, chunks: Iterable[bytes]) -> None:
+        """Restaure une archive custom lue en flux (pg_restore ne parallélise pas depuis stdin)"""
+        self._feed(["pg_restore", "--clean", "--if-exists", "--no-owner", "--no-acl",
+                    "--no-password", f"--dbname={self.dsn}"], chunks, "pg_restore")
+
+    def restore_sql(self, chunks: Iterable[bytes]) -> None:
+        """Restaure un dump SQL texte (anciennes sauvegardes .sql.gz)"""
+        self._feed(["psql", "--quiet", "--no-password", "--set=ON_ERROR_STOP=1",
+                    f"--dbname={self.dsn}"], chunks, "psql")
+
+    @staticmethod
+    def _parse_listing(listing: str) -> List[str]:
+        return [line for line in listing.splitlines() if line and not line.startswith(';')]
+
+    def list_contents(self, chunks: Iterable[bytes]) -> List[str]:
+        """Table des matières d'une archive custom (pg_restore --list)"""
+        return self._parse_listing(self._feed(["pg_restore", "--list"], chunks, "pg_restore --list").decode())
+
+    def dump_directory(self, path: Path, jobs: int, compression: str, exclude_data: Iterable[str] = ()) -> None:
+        """pg_dump -Fd -j N: une table par fichier, tables exportées en parallèle"""
+        # zstd par fichier à partir de pg_dump 16, gzip sinon (les versions antérieures refusent zstd)
+        compress = "--compress=6"
+        if compression == 'zstd':
+            version = self.pg_dump_version()
+            if version is not None and version >= PG_DUMP_ZSTD_VERSION:
+                compress = "--compress=zstd"
+            else:
+                logger.info(f"pg_dump {version or 'unknown version'} does not support zstd, using gzip")
+        cmd = ["pg_dump", "--format=directory", f"--jobs={jobs}", compress, "--no-owner", "--no-acl",
+               "--no-password", f"--file={path}", f"--dbname={self.dsn}", *self._exclude_options(exclude_data)]
+        result = subprocess.run(cmd, capture_output=True, env=self.env, timeout=BACKUP_TIMEOUT)
+        if result.returncode != 0:
+            raise BackupError(f"pg_dump failed ({result.returncode}): {result.stderr.decode(errors='replace')[-2000:]}")
+
+    def restore_directory(self, path: Path, jobs: int) -> None:
+        """pg_restore -j N depuis une archive directory"""
+        cmd = ["pg_restore", f"--jobs={jobs}", "--clean", "--if-exists", "--no-owner", "--no-acl",
+               "--no-password", f"--dbname={self.dsn}", str(path)]
+        result = subprocess.run(cmd, capture_output=True, env=self.env, timeout=BACKUP_TIMEOUT)
+        if result.returncode != 0:
+            raise BackupError(f"pg_restore failed ({result.returncode}): {result.stderr.decode(errors='replace')[-2000:]}")
+
+    def list_directory(self, path: Path) -> List[str]:
+        result = subprocess.run(["pg_restore", "--list", str(path)], capture_output=True, timeout=BACKUP_TIMEOUT)
+        if result.returncode != 0:
+            raise BackupError(f"pg_restore --list failed: {result.stderr.decode(errors='replace')[-2000:]}")
+        return self._parse_listing(result.stdout.decode())
+
+
+class SQLiteBackupAdapter:
+    """
+    Équivalent de pg_dump/pg_restore pour une base SQLite (développement et tests)
+
+    L'archive custom est le dump SQL de sqlite3 (iterdump), le format directory un fichier
+    d'INSERT compressé par table plus un toc.json portant le schéma.
+    """
+
+    name = 'sqlite'
+    compresses_directory = False
+    _CREATE = re.compile(r'^CREATE (TABLE|INDEX|UNIQUE INDEX|VIEW|TRIGGER) (?:IF NOT EXISTS )?"?([^"\s(]+)"?')
+
+    def __init__(self, database_url: str):
+        self.path = database_url.split(':///', 1)[1] if ':///' in database_url else database_url
+
+    def _connect(self) -> sqlite3.Connection:
+        # Autocommit: les BEGIN/COMMIT du dump sont exécutés tels quels
+        return sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+
+    def dump(self, exclude_data: Iterable[str] = ()) -> Iterator[bytes]:
+        excluded = tuple(f'INSERT INTO "{table}" ' for table in exclude_data)
+        connection = self._connect()
+        try:
+            buffer, size = [], 0
+            for statement in connection.iterdump():
+                if excluded and statement.startswith(excluded):
+                    continue
+                line = (statement + '\n').encode('utf-8')
+                buffer.append(line)
+                size += len(line)
+                if size >= CHUNK_SIZE:
+                    yield b''.join(buffer)
+                    buffer, size = [], 0
+            if buffer:
+                yield b''.join(buffer)
+        finally:
+            connection.close()
+
+    @staticmethod
+    def _statements(chunks: Iterable[bytes]) -> Iterator[str]:
+        """Instructions SQL complètes d'un flux, ligne par ligne"""
+        pending = ''
+        remainder = b''
+        for chunk in chunks:
+            data = remainder + chunk
+            cut = data.rfind(b'\n') + 1
+            text, remainder = data[:cut].decode('utf-8'), data[cut:]
+            for line in text.splitlines(keepends=True):
+                pending += line
+                if sqlite3.complete_statement(pending):
+                    yield pending
+                    pending = ''
+        pending += remainder.decode('utf-8')
+        if pending.strip():
+            yield pending
+
+    def _execute(self, connection: sqlite3.Connection, statements: Iterable[str]) -> None:
+        for statement in statements:
+            match = self._CREATE.match(statement)
+            if match and match.group(1) == 'TABLE':
+                # Équivalent de pg_restore --clean
+                connection.execute(f'DROP TABLE IF EXISTS "{match.group(2)}"')
+            connection.execute(statement)
+
+    def restore(self, chunks: Iterable[bytes]) -> None:
+        connection = self._connect()
+        try:
+            self._execute(connection, self._statements(chunks))
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise BackupError(f"SQLite restore failed: {e}")
+        finally:
+            connection.close()
+
+    restore_sql = restore
+
+    def list_contents(self, chunks: Iterable[bytes]) -> List[str]:
+        entries = []
+        for statement in self._statements(chunks):
+            match = self._CREATE.match(statement)
+            if match:
+                entries.append(f"{match.group(1)} {match.group(2)}")
+        return entries
+
+    def _tables(self, connection: sqlite3.Connection) -> List[Tuple[str, str]]:
+        return connection.execute(
+            "SELECT name, sql FROM sqlite_master WHERE type = 'table' AND name NOT LIKE 'sqlite_%' ORDER BY name"
+        ).fetchall()
+
+    def _table_inserts(self, table: str) -> Iterator[bytes]:
+        connection = self._connect()
+        try:
+            columns = [row[1] for row in connection.execute(f'PRAGMA table_info("{table}")')]
+            values = " || ',' || ".join(f'quote("{column}")' for column in columns)
+            query = f"""SELECT 'INSERT INTO "{table}" VALUES(' || {values} || ');' FROM "{table}" """
+            cursor = connection.execute(query)
+            while True:
+                rows = cursor.fetchmany(5000)
+                if not rows:
+                    break
+                yield ('\n'.join(row[0] for row in rows) + '\n').encode('utf-8')
+        finally:
+            connection.close()
+
+    def dump_directory(self, path: Path, jobs: int, compression: str, exclude_data: Iterable[str] = ()) -> None:
+        connection = self._connect()
+        try:
+            tables = self._tables(connection)
+            others = connection.execute(
+                "SELECT sql FROM sqlite_master WHERE type IN ('index', 'view', 'trigger') AND sql IS NOT NULL"
+            ).fetchall()
+        finally:
+            connection.close()
+
+        suffix = COMPRESSION_SUFFIXES[compression]
+        with ThreadPoolExecutor(max_workers=max(1, jobs)) as executor:
+            list(executor.map(
+                lambda table: write_compressed(
+                    path / f"{table}.sql{suffix}",
+                    iter(()) if table in exclude_data else self._table_inserts(table),
+                    compression
+                ),
+                [name for name, _ in tables]
+            ))
+        toc = {
+            'compression': compression,
+            'tables': {name: {'schema': sql, 'file': f"{name}.sql{suffix}"} for name, sql in tables},
+            'post_data': [sql for (sql,) in others],
+        }
+        (path / 'toc.json').write_text(json.dumps(toc, indent=2))
+
+    def restore_directory(self, path: Path, jobs: int) -> None:
+        # SQLite n'accepte qu'un écrivain: les tables sont restaurées l'une après l'autre
+        toc = json.loads((path / 'toc.json').read_text())
+        connection = self._connect()
+        try:
+            for table, entry in toc['tables'].items():
+                connection.execute(f'DROP TABLE IF EXISTS "{table}"')
+                connection.execute(entry['schema'])
+                connection.execute("BEGIN")
+                self._execute(connection, self._statements(read_compressed(path / entry['file'], toc['compression'])))
+                connection.execute("COMMIT")
+            for sql in toc['post_data']:
+                connection.execute(sql)
+        except sqlite3.Error as e:
+            if connection.in_transaction:
+                connection.execute("ROLLBACK")
+            raise BackupError(f"SQLite restore failed: {e}")
+        finally:
+            connection.close()
+
+    def list_directory(self, path: Path) -> List[str]:
+        toc = json.loads((path / 'toc.json').read_text())
+        return [f"TABLE DATA {table}" for table in toc['tables']]
+
+
+def get_backup_adapter(database_url: Optional[str]):
+    """Adaptateur de sauvegarde pour une URL de base de données (None si invalide)"""
+    if database_url and database_url.startswith('sqlite:'):
+        return SQLiteBackupAdapter(database_url)
+    database_url = validate_database_url(database_url)
+    if not database_url:
+        return None
+    return PostgresBackupAdapter(database_url)
+
+
 class BackupManager:
     """Gestionnaire des sauvegardes automatiques de la base de données"""
     
-    def __init__(self, backup_dir="backups"):
+    def __init__(self, backup_dir="backups", database_url=None):
         self.backup_dir = Path(backup_dir)
         self.backup_dir.mkdir(exist_ok=True)
         self.scheduler = None
         self.max_backups = int(os.environ.get("MAX_BACKUPS", "7"))  # Garder 7 jours par défaut
+        self.database_url = database_url
         
     def start_scheduler(self):
         """Démarre le planificateur de sauvegardes"""
@@ -110,103 +566,224 @@ class BackupManager:
             self.scheduler.shutdown()
             self.scheduler = None
             logger.info("Backup scheduler stopped")
-    
-    def create_backup(self):
+
+    def _adapter(self):
+        adapter = get_backup_adapter(self.database_url or os.environ.get("DATABASE_URL"))
+        if adapter is None:
+            raise BackupError("DATABASE_URL not configured or invalid")
+        return adapter
+
+    @staticmethod
+    def _incremental_tables() -> List[str]:
+        # Import différé: incremental_backup dépend de l'application
+        from incremental_backup import incremental_backup
+        return incremental_backup.covered_tables()
+
+    def _manifest_path(self, name: str) -> Path:
+        return self.backup_dir / f"{name}.json"
+
+    def _write_manifest(self, manifest: Dict) -> None:
+        path = self._manifest_path(manifest['name'])
+        tmp_path = path.with_name(f".{path.name}.tmp")
+        tmp_path.write_text(json.dumps(manifest, indent=2))
+        os.replace(tmp_path, path)
+
+    def load_manifest(self, name: str) -> Optional[Dict]:
+        """Manifeste d'une sauvegarde (None pour les anciennes sauvegardes .sql.gz)"""
+        name = name[:-len('.json')] if name.endswith('.json') else name
+        if not name.startswith(BACKUP_PREFIX) or Path(name).name != name:
+            return None
+        try:
+            return json.loads(self._manifest_path(name).read_text())
+        except (OSError, ValueError):
+            return None
+
+    def run_backup(self, backup_format: Optional[str] = None, jobs: Optional[int] = None,
+                   compression: Optional[str] = None, verify: bool = BACKUP_VERIFY,
+                   exclude_data: Optional[List[str]] = None) -> Dict:
+        """
+        Crée une sauvegarde et son manifeste
+
+        Args:
+            backup_format: 'custom' (flux compressé) ou 'directory' (dump parallèle)
+            jobs: Processus pg_dump parallèles (format directory)
+            compression: 'zstd' ou 'gzip'
+            verify: Vérifie la sauvegarde (sommes de contrôle et table des matières) après écriture
+            exclude_data: Tables dont seul le schéma est sauvegardé (par défaut, celles couvertes par
+                une chaîne incrémentale lorsque BACKUP_EXCLUDE_INCREMENTAL est actif)
+
+        Returns:
+            Manifeste de la sauvegarde
+
+        Raises:
+            BackupError: si la sauvegarde ou sa vérification échoue
+        """
+        adapter = self._adapter()
+        backup_format = backup_format or BACKUP_FORMAT
+        jobs = jobs or BACKUP_JOBS
+        compression = resolve_compression(compression)
+        if exclude_data is None:
+            exclude_data = self._incremental_tables() if BACKUP_EXCLUDE_INCREMENTAL else []
+        name = f"{BACKUP_PREFIX}{datetime.now().strftime('%Y%m%d_%H%M%S_%f')}"
+        started = time.monotonic()
+        logger.info(f"Starting {backup_format} database backup {name}")
+
+        if backup_format == 'custom':
+            artifact = f"{name}.dump{COMPRESSION_SUFFIXES[compression]}"
+            partial = self.backup_dir / f".{artifact}.partial"
+            try:
+                stats = write_compressed(partial, adapter.dump(exclude_data), compression)
+                os.replace(partial, self.backup_dir / artifact)
+            finally:
+                partial.unlink(missing_ok=True)
+            files = {artifact: stats['sha256']}
+            size, raw_size = stats['size'], stats['raw_size']
+        elif backup_format == 'directory':
+            artifact = f"{name}.dir"
+            partial = self.backup_dir / f".{artifact}.partial"
+            partial.mkdir()
+            try:
+                adapter.dump_directory(partial, jobs, compression, exclude_data)
+                os.replace(partial, self.backup_dir / artifact)
+            finally:
+                shutil.rmtree(partial, ignore_errors=True)
+            directory = self.backup_dir / artifact
+            files = {f"{artifact}/{path.name}": file_sha256(path) for path in sorted(directory.iterdir())}
+            size, raw_size = sum(path.stat().st_size for path in directory.iterdir()), None
+        else:
+            raise BackupError(f"Unsupported backup format: {backup_format}")
+
+        manifest = {
+            'name': name,
+            'format': backup_format,
+            'compression': compression,
+            'adapter': adapter.name,
+            'artifact': artifact,
+            'jobs': jobs if backup_format == 'directory' else 1,
+            'created': datetime.now().isoformat(),
+            'duration': round(time.monotonic() - started, 3),
+            'size': size,
+            'raw_size': raw_size,
+            'files': files,
+            'excluded_data': sorted(exclude_data),
+            'verified': None,
+        }
+        self._write_manifest(manifest)
+
+        if verify:
+            result = self.verify_backup(name)
+            if not result['valid']:
+                raise BackupError(f"Backup verification failed: {'; '.join(result['errors'])}")
+            manifest = self.load_manifest(name)
+
+        logger.info(f"Backup created successfully: {artifact} ({size} bytes in {manifest['duration']}s)")
+        self.cleanup_old_backups()
+        return manifest
+
+    def create_backup(self, backup_format=None, jobs=None):
         """Crée une sauvegarde de la base de données"""
         try:
-            database_url = os.environ.get("DATABASE_URL")
-            database_url = validate_database_url(database_url)
-            if not database_url:
-                logger.error("DATABASE_URL not configured or invalid")
-                return False
-            
-            # Générer le nom du fichier de sauvegarde
-            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-            backup_filename = f"ninjalead_backup_{timestamp}.sql"
-            backup_path = self.backup_dir / backup_filename
-            compressed_path = self.backup_dir / f"{backup_filename}.gz"
-            
-            logger.info(f"Starting database backup to {backup_path}")
-            
-            # Commande pg_dump avec paramètres sécurisés
-            cmd = [
-                "pg_dump",
-                shlex.quote(database_url),
-                "--no-password",
-                "--verbose",
-                "--clean",
-                "--no-acl",
-                "--no-owner",
-                "-f", str(backup_path)
-            ]
-            
-            # Exécuter la sauvegarde
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=300  # 5 minutes timeout
-            )
-            
-            if result.returncode != 0:
-                logger.error(f"pg_dump failed: {result.stderr}")
-                return False
-            
-            # Compresser le fichier
-            with open(backup_path, 'rb') as f_in:
-                with gzip.open(compressed_path, 'wb') as f_out:
-                    f_out.writelines(f_in)
-            
-            # Supprimer le fichier non compressé
-            backup_path.unlink()
-            
-            # Vérifier la taille du fichier compressé
-            file_size = compressed_path.stat().st_size
-            if file_size == 0:
-                logger.error("Backup file is empty")
-                compressed_path.unlink()
-                return False
-            
-            logger.info(f"Backup created successfully: {compressed_path} ({file_size} bytes)")
-            
-            # Nettoyer les anciennes sauvegardes
-            self.cleanup_old_backups()
-            
+            self.run_backup(backup_format, jobs)
             return True
-            
         except subprocess.TimeoutExpired:
-            logger.error("Backup timed out after 5 minutes")
+            logger.error(f"Backup timed out after {BACKUP_TIMEOUT} seconds")
             return False
         except Exception as e:
             logger.error(f"Backup failed with error: {str(e)}")
             return False
-    
+
+    def verify_backup(self, name: str) -> Dict:
+        """
+        Vérifie une sauvegarde: sommes SHA-256 du manifeste puis lecture de sa table des matières
+
+        Args:
+            name: Nom de la sauvegarde (ou de son manifeste)
+
+        Returns:
+            Dictionnaire {valid, errors, entries}
+        """
+        manifest = self.load_manifest(name)
+        if manifest is None:
+            return {'valid': False, 'errors': [f"Manifest not found for {name}"], 'entries': 0}
+
+        errors = []
+        for relative_path, expected in manifest['files'].items():
+            path = self.backup_dir / relative_path
+            if not path.exists():
+                errors.append(f"Missing file {relative_path}")
+            elif file_sha256(path) != expected:
+                errors.append(f"Checksum mismatch for {relative_path}")
+
+        entries = 0
+        if not errors:
+            try:
+                adapter = self._adapter()
+                artifact = self.backup_dir / manifest['artifact']
+                if manifest['format'] == 'directory':
+                    entries = len(adapter.list_directory(artifact))
+                else:
+                    entries = len(adapter.list_contents(read_compressed(artifact, manifest['compression'])))
+                if entries == 0:
+                    errors.append("Archive contains no entries")
+            except Exception as e:
+                errors.append(f"Archive listing failed: {e}")
+
+        manifest['verified'] = datetime.now().isoformat() if not errors else False
+        manifest['entries'] = entries
+        self._write_manifest(manifest)
+        for error in errors:
+            logger.error(f"Backup {manifest['name']} verification: {error}")
+        return {'valid': not errors, 'errors': errors, 'entries': entries}
+
+    def _delete_backup(self, name: str) -> None:
+        manifest = self.load_manifest(name)
+        if manifest is not None:
+            artifact = self.backup_dir / manifest['artifact']
+            if artifact.is_dir():
+                shutil.rmtree(artifact)
+            else:
+                artifact.unlink(missing_ok=True)
+        self._manifest_path(name).unlink(missing_ok=True)
+        (self.backup_dir / name).unlink(missing_ok=True)
+        logger.info(f"Deleted old backup: {name}")
+
     def cleanup_old_backups(self):
         """Supprime les anciennes sauvegardes au-delà de la limite"""
         try:
-            backup_files = list(self.backup_dir.glob("ninjalead_backup_*.sql.gz"))
-            backup_files.sort(key=lambda x: x.stat().st_mtime, reverse=True)
-            
-            if len(backup_files) > self.max_backups:
-                files_to_delete = backup_files[self.max_backups:]
-                for file_path in files_to_delete:
-                    file_path.unlink()
-                    logger.info(f"Deleted old backup: {file_path}")
-                    
+            backups = self.list_backups()
+            for backup in backups[self.max_backups:]:
+                self._delete_backup(backup["filename"])
         except Exception as e:
             logger.error(f"Error cleaning up old backups: {str(e)}")
     
     def list_backups(self):
         """Liste toutes les sauvegardes disponibles"""
-        backup_files = list(self.backup_dir.glob("ninjalead_backup_*.sql.gz"))
         backups = []
-        
-        for backup_file in backup_files:
+
+        for manifest_file in self.backup_dir.glob(f"{BACKUP_PREFIX}*.json"):
+            manifest = self.load_manifest(manifest_file.stem)
+            if manifest is None:
+                continue
+            created = datetime.fromisoformat(manifest['created'])
+            backups.append({
+                "filename": manifest['name'],
+                "path": str(self.backup_dir / manifest['artifact']),
+                "size": manifest['size'],
+                "format": manifest['format'],
+                "verified": bool(manifest.get('verified')),
+                "created": created,
+                "age_days": (datetime.now() - created).days
+            })
+
+        # Anciennes sauvegardes SQL texte compressées, sans manifeste
+        for backup_file in self.backup_dir.glob(f"{BACKUP_PREFIX}*.sql.gz"):
             stat = backup_file.stat()
             backups.append({
                 "filename": backup_file.name,
                 "path": str(backup_file),
                 "size": stat.st_size,
+                "format": "sql",
+                "verified": False,
                 "created": datetime.fromtimestamp(stat.st_mtime),
                 "age_days": (datetime.now() - datetime.fromtimestamp(stat.st_mtime)).days
             })
@@ -214,55 +791,43 @@ class BackupManager:
         # Trier par date de création (plus récent en premier)
         backups.sort(key=lambda x: x["created"], reverse=True)
         return backups
-    
-    def restore_backup(self, backup_filename):
+
+    def run_restore(self, name: str, jobs: Optional[int] = None) -> None:
+        """
+        Restaure une sauvegarde, vérifiée au préalable
+
+        Les archives custom sont décompressées en flux vers pg_restore; les archives
+        directory sont restaurées avec pg_restore -j N.
+
+        Raises:
+            BackupError: si la sauvegarde est introuvable, corrompue ou si la restauration échoue
+        """
+        adapter = self._adapter()
+        if name.endswith('.sql.gz'):
+            path = self.backup_dir / name
+            if not path.exists():
+                raise BackupError(f"Backup file not found: {path}")
+            adapter.restore_sql(read_compressed(path, 'gzip'))
+            return
+
+        result = self.verify_backup(name)
+        if not result['valid']:
+            raise BackupError(f"Backup {name} is not valid: {'; '.join(result['errors'])}")
+        manifest = self.load_manifest(name)
+        artifact = self.backup_dir / manifest['artifact']
+
+        logger.info(f"Starting database restore from {manifest['artifact']}")
+        if manifest['format'] == 'directory':
+            adapter.restore_directory(artifact, jobs or BACKUP_JOBS)
+        else:
+            adapter.restore(read_compressed(artifact, manifest['compression']))
+
+    def restore_backup(self, backup_filename, jobs=None):
         """Restaure une sauvegarde spécifique"""
         try:
-            backup_path = self.backup_dir / backup_filename
-            if not backup_path.exists():
-                logger.error(f"Backup file not found: {backup_path}")
-                return False
-            
-            database_url = os.environ.get("DATABASE_URL")
-            database_url = validate_database_url(database_url)
-            if not database_url:
-                logger.error("DATABASE_URL not configured or invalid")
-                return False
-            
-            # Décompresser temporairement
-            temp_sql_path = backup_path.with_suffix('')  # Enlever .gz
-            
-            with gzip.open(backup_path, 'rb') as f_in:
-                with open(temp_sql_path, 'wb') as f_out:
-                    f_out.writelines(f_in)
-            
-            logger.info(f"Starting database restore from {backup_filename}")
-            
-            # Commande psql pour restaurer avec paramètres sécurisés
-            cmd = [
-                "psql",
-                shlex.quote(database_url),
-                "--quiet",
-                "-f", str(temp_sql_path)
-            ]
-            
-            result = subprocess.run(
-                cmd,
-                capture_output=True,
-                text=True,
-                timeout=600  # 10 minutes timeout
-            )
-            
-            # Nettoyer le fichier temporaire
-            temp_sql_path.unlink()
-            
-            if result.returncode != 0:
-                logger.error(f"Database restore failed: {result.stderr}")
-                return False
-            
+            self.run_restore(backup_filename, jobs)
             logger.info("Database restore completed successfully")
             return True
-            
         except Exception as e:
             logger.error(f"Restore failed with error: {str(e)}")
             return False
@@ -275,6 +840,9 @@ class BackupManager:
             "enabled": self.scheduler is not None and self.scheduler.running,
             "backup_directory": str(self.backup_dir),
             "max_backups": self.max_backups,
+            "format": BACKUP_FORMAT,
+            "compression": resolve_compression(),
+            "exclude_incremental": BACKUP_EXCLUDE_INCREMENTAL,
             "total_backups": len(backups),
             "last_backup": None,
             "next_backup": None,
@@ -289,9 +857,16 @@ class BackupManager:
                 "filename": backups[0]["filename"],
                 "created": backups[0]["created"].isoformat(),
                 "size": backups[0]["size"],
+                "verified": backups[0]["verified"],
                 "age_hours": (datetime.now() - backups[0]["created"]).total_seconds() / 3600
             }
         
+        try:
+            from incremental_backup import incremental_backup
+            status["incremental"] = incremental_backup.status()
+        except Exception as e:
+            logger.debug(f"Incremental backup status unavailable: {e}")
+
         if self.scheduler and self.scheduler.running:
             job = self.scheduler.get_job('daily_backup')
             if job:
@@ -6,7 +6,7 @@ from enum import Enum
 from typing import List, Dict, Optional, Union
 import random
 import time
-from flask import session, current_app
+from flask import session, current_app, has_request_context
 from flask_babel import gettext as _
 
 # Configure logging
@@ -27,6 +27,11 @@ except ImportError:
         pass
     Field = lambda *args, **kwargs: None
 
+from llm_router import llm_router, InvalidProviderResponse, ProviderUnavailableError, CLIENT_MAX_RETRIES
+from prompt_compaction import prompt_compactor
+from prompt_registry import prompt_registry
+from token_accounting import token_accountant
+
 # Load environment variables if dotenv is available
 try:
     from dotenv import load_dotenv
@@ -45,11 +50,11 @@ def get_prompt_language():
     Returns:
         Code de langue (fr, en, etc.) ou 'en' par défaut
     """
+    # Hors requête (tâches planifiées, scripts), pas de session à consulter
+    if not has_request_context():
+        return 'en'
     try:
-        # Récupérer la langue de la session si disponible
-        if session and 'language' in session:
-            return session['language']
-        return 'en'  # Langue par défaut
+        return session.get('language', 'en')
     except Exception as e:
         logger.warning(f"Erreur lors de la récupération de la langue: {e}")
         return 'en'  # Fallback à l'anglais en cas d'erreur
@@ -441,6 +446,9 @@ PROMPT_TRANSLATIONS = {
     }
 }
 
+# Templates compilés et validés une fois au chargement du module
+prompt_registry.register_many(PROMPT_TRANSLATIONS)
+
 def get_translated_prompt(prompt_key, language=None, **kwargs):
     """
     Récupère un prompt traduit dans la langue spécifiée
@@ -451,39 +459,25 @@ def get_translated_prompt(prompt_key, language=None, **kwargs):
         **kwargs: Variables à formater dans le template du prompt
         
     Returns:
-        Prompt traduit et formaté
+        Prompt traduit et formaté (anglais si la langue n'est pas traduite)
+        
+    Raises:
+        MissingPromptVariables: Si une variable du template n'est pas fournie
     """
     if language is None:
         language = get_prompt_language()
-    
-    # Fallback à l'anglais si la langue n'est pas supportée
-    if language not in PROMPT_TRANSLATIONS.get(prompt_key, {}):
-        language = 'en'
-    
-    prompt_template = PROMPT_TRANSLATIONS.get(prompt_key, {}).get(language, "")
-    
-    if not prompt_template:
-        logger.warning(f"No translation found for prompt {prompt_key} in language {language}")
-        # Fallback à l'anglais si aucune traduction n'est trouvée
-        prompt_template = PROMPT_TRANSLATIONS.get(prompt_key, {}).get('en', "")
-    
-    # Formater le template avec les variables fournies
-    try:
-        return prompt_template.format(**kwargs)
-    except KeyError as e:
-        logger.error(f"Missing key in prompt formatting: {e}")
-        return prompt_template
+    return prompt_registry.render(prompt_key, language, **kwargs)
 
-# Initialize Grok client
-grok_client = AsyncOpenAI(
+# Initialize Grok client (complétions comptabilisées sur le budget de l'utilisateur)
+grok_client = token_accountant.metered(AsyncOpenAI(
     base_url="https://api.x.ai/v1", 
     api_key=os.environ.get("XAI_API_KEY")
-)
+), 'boutique_ai')
 
 # Initialize OpenAI client
-openai_client = OpenAI(
+openai_client = token_accountant.metered(OpenAI(
     api_key=os.environ.get("OPENAI_API_KEY")
-)
+), 'boutique_ai')
 
 def get_openai_client(api_key=None):
     """
@@ -496,7 +490,7 @@ def get_openai_client(api_key=None):
         OpenAI client instance
     """
     if api_key:
-        return OpenAI(api_key=api_key)
+        return token_accountant.metered(OpenAI(api_key=api_key), 'boutique_ai')
     return openai_client
 
 def get_grok_client(api_key=None):
@@ -510,7 +504,7 @@ def get_grok_client(api_key=None):
         AsyncOpenAI client instance configured for X.AI API
     """
     if api_key:
-        return AsyncOpenAI(base_url="https://api.x.ai/v1", api_key=api_key)
+        return token_accountant.metered(AsyncOpenAI(base_url="https://api.x.ai/v1", api_key=api_key), 'boutique_ai')
     return grok_client
 
 # Define data models for structured outputs
@@ -719,8 +713,9 @@ async def generate_enhanced_customer_data_async(
     existing_personas_summary = ""
     if existing_personas and len(existing_personas) > 0:
         existing_personas_summary = "ALREADY CREATED PERSONAS TO AVOID DUPLICATING (MAKE SURE TO CREATE SOMETHING COMPLETELY DIFFERENT):\n\n"
-        for i, persona in enumerate(existing_personas[:3]):  # Limiter à 3 pour éviter un prompt trop long
-            existing_personas_summary += f"Persona {i+1}:\n{persona[:200]}...\n\n"
+        # 3 personas au plus, se partageant le budget de tokens 'persona_history'
+        for i, persona in enumerate(prompt_compactor.texts('persona_history', existing_personas[:3])):
+            existing_personas_summary += f"Persona {i+1}:\n{persona}\n\n"
     
     # Intégrer les informations de la boutique si disponibles
     boutique_context = ""
@@ -1202,177 +1197,39 @@ async def generate_boutique_image_async(
         model: Grok model to use
         image_data: Optional base64 encoded image data to use as a starting point
         style: Optional style to apply to the image (e.g., 'watercolor', 'photorealistic')
-        max_retries: Maximum number of retry attempts for transient errors
+        max_retries: Kept for compatibility; providers are no longer retried in turn, llm_router
+            skips degraded providers and falls back to the next one
         timeout: Timeout in seconds for API calls
     
     Returns:
         URL of the generated image
     """
-    import asyncio
-    import time
-    import random
-    from functools import wraps
-    
-    # Fonction décorateur pour implémentation de retry avec backoff exponentiel 
-    def async_retry_with_backoff(max_retries=3, base_delay=1, max_delay=60):
-        def decorator(func):
-            @wraps(func)
-            async def wrapper(*args, **kwargs):
-                retries = 0
-                while retries < max_retries:
-                    try:
-                        return await func(*args, **kwargs)
-                    except asyncio.TimeoutError:
-                        retries += 1
-                        if retries >= max_retries:
-                            logger.error(f"Operation timed out after {max_retries} retries")
-                            raise
-                        
-                        # Calcul du délai avec jitter pour éviter les tempêtes de requêtes
-                        delay = min(max_delay, base_delay * (2 ** retries))
-                        jitter = random.uniform(0, 0.1 * delay)  # 10% de jitter
-                        total_delay = delay + jitter
-                        
-                        logger.warning(f"Request timed out, retrying in {total_delay:.2f}s (attempt {retries}/{max_retries})")
-                        await asyncio.sleep(total_delay)
-                    except Exception as e:
-                        retries += 1
-                        if retries >= max_retries:
-                            logger.error(f"Operation failed after {max_retries} retries: {e}")
-                            raise
-                        
-                        # Vérifier si l'erreur est transitoire (429, 500, etc.)
-                        if is_transient_error(e):
-                            delay = min(max_delay, base_delay * (2 ** retries))
-                            jitter = random.uniform(0, 0.1 * delay)
-                            total_delay = delay + jitter
-                            
-                            logger.warning(f"Transient error occurred, retrying in {total_delay:.2f}s (attempt {retries}/{max_retries}): {e}")
-                            await asyncio.sleep(total_delay)
-                        else:
-                            # Erreur non transitoire, on arrête les tentatives
-                            logger.error(f"Non-transient error occurred: {e}")
-                            raise
-                            
-                # Ne devrait jamais arriver ici, mais au cas où
-                raise Exception(f"All retry attempts failed after {max_retries} tries")
-            return wrapper
-        return decorator
-    
-    # Fonction pour déterminer si une erreur est transitoire
-    def is_transient_error(error):
-        # Liste des erreurs qui peuvent être considérées comme transitoires
-        transient_errors = [
-            "timeout", "rate limit", "too many requests", "server error",
-            "internal server error", "service unavailable", "gateway timeout",
-            "retry", "connection", "socket", "network", "429", "500", "502", "503", "504"
-        ]
-        
-        error_str = str(error).lower()
-        for term in transient_errors:
-            if term in error_str:
-                return True
-        return False
-    
-    # Fonction pour générer une image avec xAI (Grok) avec timeout
-    @async_retry_with_backoff(max_retries=max_retries)
-    async def generate_xai_image():
-        # Préparer le client et les paramètres
-        XAI_API_KEY = os.environ.get("XAI_API_KEY")
-        xai_client = OpenAI(base_url="https://api.x.ai/v1", api_key=XAI_API_KEY)
-        
-        start_time = time.time()
-        logger.info(f"Starting Grok image generation with model {model}, timeout {timeout}s")
-        
-        try:
-            # Exécuter l'appel API directement avec un timeout
-            # Note : nous n'utilisons pas asyncio.to_thread car cela crée une coroutine intermédiaire
-            # ce qui complique l'accès aux attributs de la réponse
-            response = await asyncio.wait_for(
-                asyncio.sleep(0),  # Juste pour conserver la structure await
-                timeout=timeout
-            )
-            
-            # Maintenant faire l'appel de façon synchrone
-            response = xai_client.images.generate(
-                model="grok-2-image",  # Modèle d'image xAI (Grok)
-                prompt=final_prompt,
-                n=1
-                # Suppression du paramètre size qui n'est pas supporté par xAI
-            )
-            
-            # Mesurer le temps d'exécution
-            elapsed_time = time.time() - start_time
-            logger.info(f"Grok image generation completed in {elapsed_time:.2f}s")
-            
-            # Extraire l'URL de l'image de la réponse
-            if hasattr(response, 'data') and response.data and len(response.data) > 0:
-                if hasattr(response.data[0], 'url'):
-                    image_url = response.data[0].url
-                    if image_url:
-                        logger.info("Successfully generated image with Grok")
-                        return image_url
-            
-            # Si nous arrivons ici, Grok n'a pas produit d'URL d'image valide
-            logger.warning("Grok didn't return a valid image URL")
-            return None
-        except asyncio.TimeoutError:
-            elapsed_time = time.time() - start_time
-            logger.warning(f"Grok image generation timed out after {elapsed_time:.2f}s (timeout set to {timeout}s)")
-            raise
-        except Exception as e:
-            elapsed_time = time.time() - start_time
-            logger.error(f"Grok image generation failed after {elapsed_time:.2f}s: {e}")
-            raise
-    
-    # Fonction pour générer une image avec OpenAI (fallback) avec timeout
-    @async_retry_with_backoff(max_retries=max_retries)
-    async def generate_openai_image(openai_model="dall-e-2", prompt=None):
-        # Préparer le client et les paramètres
-        openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"))
-        current_prompt = prompt or final_prompt
-        
-        start_time = time.time()
-        logger.info(f"Starting OpenAI image generation with model {openai_model}, timeout {timeout}s")
-        
-        try:
-            # Exécuter l'appel API directement avec un timeout
-            # Note : nous n'utilisons pas asyncio.to_thread car cela crée une coroutine intermédiaire
-            # ce qui complique l'accès aux attributs de la réponse
-            response = await asyncio.wait_for(
-                asyncio.sleep(0),  # Juste pour conserver la structure await
-                timeout=timeout
-            )
-            
-            # Maintenant faire l'appel de façon synchrone
-            response = openai_client.images.generate(
-                model=openai_model,
-                prompt=current_prompt,
-                n=1,
-                size="1024x1024"
-            )
-            
-            # Mesurer le temps d'exécution
-            elapsed_time = time.time() - start_time
-            logger.info(f"OpenAI image generation completed in {elapsed_time:.2f}s")
-            
-            # Extract the URL from the response
-            if hasattr(response, 'data') and response.data and len(response.data) > 0:
-                if hasattr(response.data[0], 'url'):
-                    image_url = response.data[0].url
-                    logger.info(f"Successfully generated image with OpenAI {openai_model}")
-                    return image_url
-            
-            logger.warning(f"OpenAI {openai_model} didn't return a valid image URL")
-            return None
-        except asyncio.TimeoutError:
-            elapsed_time = time.time() - start_time
-            logger.warning(f"OpenAI image generation timed out after {elapsed_time:.2f}s (timeout set to {timeout}s)")
-            raise
-        except Exception as e:
-            elapsed_time = time.time() - start_time
-            logger.error(f"OpenAI image generation failed after {elapsed_time:.2f}s: {e}")
-            raise
+    def image_url(response, provider):
+        if hasattr(response, 'data') and response.data and len(response.data) > 0:
+            url = getattr(response.data[0], 'url', None)
+            if url:
+                return url
+        raise InvalidProviderResponse(f"{provider} didn't return a valid image URL")
+    
+    # Appels par fournisseur: le routeur choisit l'ordre (disjoncteurs, latence) et gère le repli
+    def xai_image(prompt):
+        def call():
+            xai_client = OpenAI(base_url="https://api.x.ai/v1", api_key=os.environ.get("XAI_API_KEY"),
+                                timeout=timeout, max_retries=CLIENT_MAX_RETRIES)
+            logger.info(f"Starting Grok image generation with model {model}, timeout {timeout}s")
+            # Le paramètre size n'est pas supporté par xAI
+            response = xai_client.images.generate(model="grok-2-image", prompt=prompt, n=1)
+            return image_url(response, "Grok")
+        return call
+    
+    def openai_image(prompt, openai_model="dall-e-2"):
+        def call():
+            openai_client = OpenAI(api_key=os.environ.get("OPENAI_API_KEY"), timeout=timeout,
+                                   max_retries=CLIENT_MAX_RETRIES)
+            logger.info(f"Starting OpenAI image generation with model {openai_model}, timeout {timeout}s")
+            response = openai_client.images.generate(model=openai_model, prompt=prompt, n=1, size="1024x1024")
+            return image_url(response, f"OpenAI {openai_model}")
+        return call
     
     try:
         # Nettoyer et limiter le prompt
@@ -1424,47 +1281,21 @@ async def generate_boutique_image_async(
         
         logger.info(f"Final image prompt: {final_prompt[:100]}...")
         
-        # Processus complet avec mécanisme de fallback intelligent
+        # Grok puis DALL-E 2, dans l'ordre de santé des fournisseurs
         try:
-            # Essayer d'abord avec xAI (Grok)
-            logger.info(f"Attempting to generate image with Grok model: {model}")
-            grok_image_url = await generate_xai_image()
-            
-            if grok_image_url:
-                return grok_image_url
-            else:
-                logger.warning("Grok image generation didn't return valid URL, falling back to OpenAI")
-        except Exception as grok_error:
-            logger.error(f"Grok image generation failed: {grok_error}")
-            logger.warning("Falling back to OpenAI for image generation")
-        
-        # Fallback à OpenAI DALL-E 2 (premier niveau)
-        try:
-            logger.info("Attempting to generate image with OpenAI DALL-E 2")
-            dalle_image_url = await generate_openai_image(openai_model="dall-e-2")
-            
-            if dalle_image_url:
-                return dalle_image_url
-            else:
-                logger.warning("OpenAI DALL-E 2 didn't return valid URL, trying with simplified prompt")
-        except Exception as dalle_error:
-            logger.error(f"OpenAI DALL-E 2 image generation failed: {dalle_error}")
-            logger.warning("Trying with simplified prompt as final fallback")
+            return await asyncio.to_thread(
+                llm_router.execute, [('xai', xai_image(final_prompt)), ('openai', openai_image(final_prompt))],
+                operation='image'
+            )
+        except ProviderUnavailableError as routing_error:
+            logger.warning(f"Image generation failed on all providers ({routing_error}), trying with simplified prompt")
         
         # Dernier fallback : prompt simplifié avec DALL-E 2
         try:
             simple_prompt = f"A simple professional image of {image_prompt}"
             logger.info(f"Final attempt: Generating image with simplified prompt: {simple_prompt[:50]}...")
-            
-            simple_image_url = await generate_openai_image(
-                openai_model="dall-e-2", 
-                prompt=simple_prompt
-            )
-            
-            if simple_image_url:
-                return simple_image_url
-            else:
-                raise ValueError("No image generated from OpenAI API with simplified prompt (final attempt)")
+            return await asyncio.to_thread(llm_router.execute, [('openai', openai_image(simple_prompt))],
+                                           operation='image')
         except Exception as final_error:
             logger.error(f"Final image generation attempt failed: {final_error}")
             raise Exception(f"All image generation attempts failed. Last error: {final_error}")
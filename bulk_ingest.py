@@ -0,0 +1,424 @@
+"""
+Module d'ingestion en lot des profils clients, personas et associations
+
+Remplace les boucles db.session.add() + commit par ligne par des INSERT multi-lignes
+avec RETURNING id, une déduplication par clé naturelle et l'écriture des associations
+client <-> persona dans la même transaction que les lignes qu'elles relient.
+"""
+import hashlib
+import logging
+import time
+from typing import Callable, Dict, List, Optional, Tuple
+
+from sqlalchemy import insert, update, tuple_
+
+from app import db
+from models import Customer, CustomerPersona, CustomerPersonaAssociation
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_BATCH_SIZE = 1000
+
+
+def _normalize(value) -> str:
+    """Normalise une valeur textuelle pour la comparaison de clés naturelles"""
+    if value is None:
+        return ''
+    return ' '.join(str(value).split()).lower()
+
+
+def customer_natural_key(mapping: Dict) -> Tuple:
+    """
+    Clé naturelle d'un client: deux profils de la même niche/boutique avec
+    le même nom, âge et lieu désignent le même client
+    """
+    return (
+        mapping.get('niche_market_id'),
+        mapping.get('boutique_id'),
+        _normalize(mapping.get('name')),
+        mapping.get('age'),
+        _normalize(mapping.get('location')),
+    )
+
+
+def persona_natural_key(mapping: Dict) -> Tuple:
+    """
+    Clé naturelle d'un persona: titre et empreinte de la description dans une niche/boutique
+    """
+    description_hash = hashlib.md5(_normalize(mapping.get('description')).encode('utf-8')).hexdigest()
+    return (
+        mapping.get('niche_market_id'),
+        mapping.get('boutique_id'),
+        _normalize(mapping.get('title')),
+        description_hash,
+    )
+
+
+def bulk_insert_returning(model_class, data_list: List[Dict], batch_size: int = DEFAULT_BATCH_SIZE) -> List[int]:
+    """
+    Insertion en lot avec récupération des identifiants générés
+
+    Variante de db_optimizer.bulk_insert_optimized: chaque lot part en un seul
+    INSERT ... VALUES (...), (...) RETURNING id (mode "insertmanyvalues" de SQLAlchemy 2.x).
+    Le commit est laissé à l'appelant pour écrire les lignes dépendantes dans la même transaction.
+
+    Args:
+        model_class: Modèle SQLAlchemy cible
+        data_list: Liste de dictionnaires colonne -> valeur
+        batch_size: Nombre de lignes par instruction INSERT
+
+    Returns:
+        Liste des identifiants insérés, dans l'ordre de data_list
+    """
+    inserted_ids = []
+    stmt = insert(model_class).returning(model_class.id, sort_by_parameter_order=True)
+    for i in range(0, len(data_list), batch_size):
+        batch = data_list[i:i + batch_size]
+        inserted_ids.extend(db.session.scalars(stmt, batch).all())
+    return inserted_ids
+
+
+def _existing_customer_ids(mappings: List[Dict]) -> Dict[Tuple, int]:
+    """Récupère en une requête les clients déjà en base portant les noms du lot"""
+    names = {m.get('name') for m in mappings if m.get('name')}
+    if not names:
+        return {}
+
+    rows = db.session.query(
+        Customer.id, Customer.niche_market_id, Customer.boutique_id,
+        Customer.name, Customer.age, Customer.location
+    ).filter(Customer.name.in_(names)).all()
+
+    existing = {}
+    for row in rows:
+        existing.setdefault(customer_natural_key(row._asdict()), row.id)
+    return existing
+
+
+def _existing_persona_ids(mappings: List[Dict]) -> Dict[Tuple, int]:
+    """Récupère en une requête les personas déjà en base portant les titres du lot"""
+    titles = {m.get('title') for m in mappings if m.get('title')}
+    if not titles:
+        return {}
+
+    rows = db.session.query(
+        CustomerPersona.id, CustomerPersona.niche_market_id, CustomerPersona.boutique_id,
+        CustomerPersona.title, CustomerPersona.description
+    ).filter(CustomerPersona.title.in_(titles)).all()
+
+    existing = {}
+    for row in rows:
+        existing.setdefault(persona_natural_key(row._asdict()), row.id)
+    return existing
+
+
+def _insert_missing(
+    model_class,
+    mappings: List[Dict],
+    key_func: Callable[[Dict], Tuple],
+    existing_lookup: Callable[[List[Dict]], Dict[Tuple, int]],
+    batch_size: int
+) -> Tuple[List[int], int]:
+    """
+    Insère les lignes absentes de la base (dédupliquées par clé naturelle, y compris
+    à l'intérieur du lot) et résout l'identifiant de chaque mapping
+
+    Returns:
+        Tuple (identifiants dans l'ordre des mappings, nombre de lignes insérées)
+    """
+    keys = [key_func(m) for m in mappings]
+    ids_by_key = existing_lookup(mappings)
+
+    new_keys = []
+    new_rows = []
+    seen = set(ids_by_key)
+    for key, mapping in zip(keys, mappings):
+        if key in seen:
+            continue
+        seen.add(key)
+        new_keys.append(key)
+        new_rows.append(mapping)
+
+    new_ids = bulk_insert_returning(model_class, new_rows, batch_size)
+    ids_by_key.update(zip(new_keys, new_ids))
+
+    return [ids_by_key[key] for key in keys], len(new_ids)
+
+
+def _write_associations(associations: List[Dict], batch_size: int) -> Dict[str, int]:
+    """
+    Écrit des associations client <-> persona sans commit
+
+    Mêmes règles que Customer.assign_persona: une association existante est mise à jour,
+    et un nouveau persona principal désactive l'ancien persona principal du client.
+    """
+    # Dédupliquer par (customer_id, persona_id), la dernière occurrence l'emporte
+    by_pair = {}
+    for assoc in associations:
+        by_pair[(assoc['customer_id'], assoc['persona_id'])] = assoc
+    if not by_pair:
+        return {'inserted': 0, 'updated': 0}
+
+    existing = {}
+    pairs = list(by_pair)
+    for i in range(0, len(pairs), batch_size):
+        chunk = pairs[i:i + batch_size]
+        rows = db.session.query(
+            CustomerPersonaAssociation.id,
+            CustomerPersonaAssociation.customer_id,
+            CustomerPersonaAssociation.persona_id
+        ).filter(
+            tuple_(CustomerPersonaAssociation.customer_id, CustomerPersonaAssociation.persona_id).in_(chunk)
+        ).all()
+        existing.update({(row.customer_id, row.persona_id): row.id for row in rows})
+
+    # Un seul persona principal par client
+    primary_customers = {pair[0] for pair, assoc in by_pair.items() if assoc.get('is_primary')}
+    primary_list = list(primary_customers)
+    for i in range(0, len(primary_list), batch_size):
+        db.session.execute(
+            update(CustomerPersonaAssociation)
+            .where(CustomerPersonaAssociation.customer_id.in_(primary_list[i:i + batch_size]))
+            .where(CustomerPersonaAssociation.is_primary.is_(True))
+            .values(is_primary=False)
+        )
+
+    to_insert = []
+    to_update = []
+    for pair, assoc in by_pair.items():
+        values = {
+            'is_primary': bool(assoc.get('is_primary', False)),
+        }
+        if assoc.get('relevance_score') is not None:
+            values['relevance_score'] = assoc['relevance_score']
+        if assoc.get('notes'):
+            values['notes'] = assoc['notes']
+
+        if pair in existing:
+            values['id'] = existing[pair]
+            to_update.append(values)
+        else:
+            values.update(customer_id=pair[0], persona_id=pair[1])
+            values.setdefault('relevance_score', None)
+            values.setdefault('notes', None)
+            to_insert.append(values)
+
+    for i in range(0, len(to_insert), batch_size):
+        db.session.execute(insert(CustomerPersonaAssociation), to_insert[i:i + batch_size])
+    if to_update:
+        db.session.execute(update(CustomerPersonaAssociation), to_update)
+
+    return {'inserted': len(to_insert), 'updated': len(to_update)}
+
+
+def persona_mapping_from_customer(customer_mapping: Dict, title: Optional[str] = None) -> Dict:
+    """
+    Construit le mapping d'un persona structuré à partir d'un client (ou de son mapping)
+    contenant un persona textuel, comme persona_manager.convert_legacy_personas
+
+    Args:
+        customer_mapping: Colonnes du client (dict) avec au moins name et persona
+        title: Titre du persona (optionnel, "Persona pour <nom>" par défaut)
+
+    Returns:
+        Mapping de colonnes CustomerPersona
+    """
+    name = customer_mapping.get('name')
+    age = customer_mapping.get('age')
+
+    # Pour éviter les erreurs d'âge négatif
+    age_range = None
+    if age:
+        age_range = f"{max(18, age - 5)}-{age + 5}"
+
+    return CustomerPersona.mapping_from_dict({
+        'title': title or f"Persona pour {name}",
+        'description': customer_mapping.get('persona') or f"Profil de {name}",
+        'age_range': age_range,
+        'gender_affinity': customer_mapping.get('gender'),
+        'income_bracket': customer_mapping.get('income_level'),
+        'education_level': customer_mapping.get('education'),
+        'avatar_url': customer_mapping.get('avatar_url'),
+        'avatar_prompt': customer_mapping.get('avatar_prompt'),
+    }, customer_mapping.get('niche_market_id'), customer_mapping.get('boutique_id'))
+
+
+def attach_personas(
+    customers: List[Tuple[int, Dict]],
+    notes: Optional[str] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE
+) -> Dict[str, int]:
+    """
+    Crée le persona structuré de chaque client et l'assigne comme persona principal,
+    sans commit (l'appelant garde la main sur la transaction)
+
+    Args:
+        customers: Liste de tuples (customer_id, colonnes du client avec name/persona/...)
+        notes: Notes enregistrées sur les associations (optionnel)
+        batch_size: Nombre de lignes par instruction
+
+    Returns:
+        Dictionnaire {personas_inserted, associations_inserted, associations_updated}
+    """
+    persona_rows = [persona_mapping_from_customer(mapping) for _, mapping in customers]
+    persona_ids, personas_inserted = _insert_missing(
+        CustomerPersona, persona_rows, persona_natural_key, _existing_persona_ids, batch_size
+    )
+    assoc_result = _write_associations([
+        {
+            'customer_id': customer_id,
+            'persona_id': persona_id,
+            'is_primary': True,
+            'relevance_score': 1.0,
+            'notes': notes
+        }
+        for (customer_id, _), persona_id in zip(customers, persona_ids)
+    ], batch_size)
+
+    return {
+        'personas_inserted': personas_inserted,
+        'associations_inserted': assoc_result['inserted'],
+        'associations_updated': assoc_result['updated'],
+    }
+
+
+def bulk_insert_personas(
+    persona_dicts: List[Dict],
+    niche_market_id: Optional[int] = None,
+    boutique_id: Optional[int] = None,
+    batch_size: int = DEFAULT_BATCH_SIZE
+) -> Dict:
+    """
+    Insère des personas en lot (dédupliqués par titre + description dans la niche/boutique)
+
+    Args:
+        persona_dicts: Données des personas (même format que CustomerPersona.create_from_dict)
+        niche_market_id: ID de la niche de marché appliqué à tous les personas (optionnel)
+        boutique_id: ID de la boutique appliqué à tous les personas (optionnel)
+        batch_size: Nombre de lignes par INSERT et par transaction
+
+    Returns:
+        Dictionnaire {persona_ids, inserted, duplicates} avec les identifiants dans l'ordre d'entrée
+    """
+    persona_ids = []
+    inserted = 0
+    try:
+        for i in range(0, len(persona_dicts), batch_size):
+            chunk = [
+                CustomerPersona.mapping_from_dict(
+                    data,
+                    data.get('niche_market_id', niche_market_id),
+                    data.get('boutique_id', boutique_id)
+                )
+                for data in persona_dicts[i:i + batch_size]
+            ]
+            ids, count = _insert_missing(
+                CustomerPersona, chunk, persona_natural_key, _existing_persona_ids, batch_size
+            )
+            db.session.commit()
+            persona_ids.extend(ids)
+            inserted += count
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Bulk persona insert error after {inserted} rows: {e}")
+        raise
+
+    return {
+        'persona_ids': persona_ids,
+        'inserted': inserted,
+        'duplicates': len(persona_ids) - inserted,
+    }
+
+
+def bulk_assign_personas(associations: List[Dict], batch_size: int = DEFAULT_BATCH_SIZE) -> Dict[str, int]:
+    """
+    Assigne des personas à des clients en lot
+
+    Args:
+        associations: Liste de dicts {customer_id, persona_id, is_primary, relevance_score, notes}
+        batch_size: Nombre de lignes par instruction
+
+    Returns:
+        Dictionnaire {inserted, updated}
+    """
+    try:
+        result = _write_associations(associations, batch_size)
+        db.session.commit()
+        return result
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Bulk persona assignment error: {e}")
+        raise
+
+
+def bulk_ingest_profiles(
+    profiles: List[Dict],
+    niche_market_id: Optional[int] = None,
+    boutique_id: Optional[int] = None,
+    with_personas: bool = True,
+    batch_size: int = DEFAULT_BATCH_SIZE
+) -> Dict:
+    """
+    Persiste des profils clients générés, leurs personas et les associations en lot
+
+    Chaque tranche de batch_size profils est écrite dans une seule transaction:
+    clients (INSERT ... RETURNING id), personas issus du champ texte 'persona' du profil,
+    puis associations persona principal <-> client.
+
+    Args:
+        profiles: Profils clients (format de boutique_ai.generate_customers)
+        niche_market_id: ID de la niche de marché des profils (optionnel)
+        boutique_id: ID de la boutique des profils (optionnel)
+        with_personas: Créer et associer un CustomerPersona pour les profils ayant un persona
+        batch_size: Nombre de profils par transaction
+
+    Returns:
+        Dictionnaire de statistiques: customer_ids (ordre d'entrée), customers_inserted,
+        customers_duplicates, personas_inserted, associations_inserted, duration_ms
+    """
+    start_time = time.time()
+    stats = {
+        'customer_ids': [],
+        'customers_inserted': 0,
+        'customers_duplicates': 0,
+        'personas_inserted': 0,
+        'associations_inserted': 0,
+    }
+
+    try:
+        for i in range(0, len(profiles), batch_size):
+            customer_rows = []
+            for profile_dict in profiles[i:i + batch_size]:
+                mapping = Customer.mapping_from_profile_dict(profile_dict, niche_market_id)
+                mapping['boutique_id'] = boutique_id
+                customer_rows.append(mapping)
+
+            customer_ids, inserted = _insert_missing(
+                Customer, customer_rows, customer_natural_key, _existing_customer_ids, batch_size
+            )
+            stats['customer_ids'].extend(customer_ids)
+            stats['customers_inserted'] += inserted
+            stats['customers_duplicates'] += len(customer_rows) - inserted
+
+            if with_personas:
+                persona_result = attach_personas(
+                    [(customer_id, row) for customer_id, row in zip(customer_ids, customer_rows) if row.get('persona')],
+                    notes="Persona créé lors de l'import en lot des profils.",
+                    batch_size=batch_size
+                )
+                stats['personas_inserted'] += persona_result['personas_inserted']
+                stats['associations_inserted'] += persona_result['associations_inserted']
+
+            db.session.commit()
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Bulk profile ingest error after {stats['customers_inserted']} customers: {e}")
+        raise
+
+    stats['duration_ms'] = round((time.time() - start_time) * 1000, 2)
+    logger.info(
+        f"Bulk ingest: {stats['customers_inserted']} customers "
+        f"({stats['customers_duplicates']} duplicates), {stats['personas_inserted']} personas "
+        f"in {stats['duration_ms']}ms"
+    )
+    return stats
@@ -0,0 +1,243 @@
+"""
+Moteur d'analyse des campagnes marketing
+
+Les agrégats (vues, clics, conversions, répartition par type, séries temporelles) sont
+calculés par la base de données avec GROUP BY: seules quelques lignes agrégées remontent
+en Python, où les taux sont calculés en une passe sur des colonnes NumPy.
+
+Les métriques d'API sont rattachées aux campagnes par la colonne indexée Metric.campaign_id
+(index (name, campaign_id), voir add_metric_campaign_id.py) et une semi-jointure, au lieu d'un
+cast JSONB et d'une liste IN non bornée.
+"""
+import logging
+from typing import Dict, List, Optional, Sequence, Tuple
+
+import numpy as np
+from sqlalchemy import func, select
+
+from app import db
+from models import Campaign, Metric
+
+logger = logging.getLogger(__name__)
+
+# Métriques d'appels d'API rattachées aux campagnes (les régénérations ne sont pas comptées)
+API_METRIC_NAMES = ('campaign_content_generation',)
+
+# Granularités supportées pour les séries temporelles
+TIME_SERIES_INTERVALS = ('hour', 'day', 'week', 'month')
+
+_SQLITE_BUCKET_FORMATS = {
+    'hour': '%Y-%m-%d %H:00:00',
+    'day': '%Y-%m-%d',
+    'week': '%Y-%W',
+    'month': '%Y-%m',
+}
+
+
+def compute_rates(views, clicks, conversions) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Calcule les taux d'engagement et de conversion sur des colonnes de compteurs
+
+    Args:
+        views: Vues (séquence ou tableau NumPy)
+        clicks: Clics
+        conversions: Conversions
+
+    Returns:
+        Tuple (engagement_rate, conversion_rate) en pourcentage, 0 quand le dénominateur est nul
+    """
+    views = np.asarray(views, dtype=np.float64)
+    clicks = np.asarray(clicks, dtype=np.float64)
+    conversions = np.asarray(conversions, dtype=np.float64)
+
+    engagement = np.divide(clicks * 100, views, out=np.zeros_like(clicks), where=views > 0)
+    conversion = np.divide(conversions * 100, clicks, out=np.zeros_like(conversions), where=clicks > 0)
+    return engagement, conversion
+
+
+def campaign_filters(campaign_id: Optional[int] = None, campaign_type: Optional[str] = None,
+                     date_range: Optional[Tuple] = None) -> List:
+    """
+    Construit les conditions SQL de filtrage des campagnes
+
+    Args:
+        campaign_id: ID spécifique d'une campagne (optionnel)
+        campaign_type: Type de campagne (optionnel)
+        date_range: Tuple (date_debut, date_fin) sur created_at (optionnel)
+
+    Returns:
+        Liste de conditions SQLAlchemy
+    """
+    conditions = []
+    if campaign_id:
+        conditions.append(Campaign.id == campaign_id)
+    if campaign_type:
+        conditions.append(Campaign.campaign_type == campaign_type)
+    if date_range:
+        start_date, end_date = date_range
+        conditions.append(Campaign.created_at >= start_date)
+        conditions.append(Campaign.created_at <= end_date)
+    return conditions
+
+
+def _time_bucket(column, interval: str):
+    """Expression SQL tronquant une date à la granularité demandée"""
+    if interval not in TIME_SERIES_INTERVALS:
+        raise ValueError(f"Intervalle non supporté: {interval}")
+    if db.engine.dialect.name == 'postgresql':
+        return func.date_trunc(interval, column)
+    return func.strftime(_SQLITE_BUCKET_FORMATS[interval], column)
+
+
+def type_breakdown(conditions: Sequence) -> Dict[str, Dict]:
+    """
+    Agrège les compteurs par type de campagne en une seule requête GROUP BY
+
+    Args:
+        conditions: Conditions de filtrage (voir campaign_filters)
+
+    Returns:
+        Dictionnaire {type: {campaigns, views, clicks, conversions, engagement_rate, conversion_rate}}
+    """
+    rows = db.session.query(
+        Campaign.campaign_type,
+        func.count(Campaign.id),
+        func.coalesce(func.sum(Campaign.view_count), 0),
+        func.coalesce(func.sum(Campaign.click_count), 0),
+        func.coalesce(func.sum(Campaign.conversion_count), 0)
+    ).filter(*conditions).group_by(Campaign.campaign_type).all()
+
+    if not rows:
+        return {}
+
+    types = [row[0] for row in rows]
+    counters = np.array([row[1:] for row in rows], dtype=np.int64)
+    engagement, conversion = compute_rates(counters[:, 1], counters[:, 2], counters[:, 3])
+
+    return {
+        campaign_type: {
+            'campaigns': int(counters[i, 0]),
+            'views': int(counters[i, 1]),
+            'clicks': int(counters[i, 2]),
+            'conversions': int(counters[i, 3]),
+            'engagement_rate': float(engagement[i]),
+            'conversion_rate': float(conversion[i]),
+        }
+        for i, campaign_type in enumerate(types)
+    }
+
+
+def time_series(conditions: Sequence, interval: str = 'day') -> List[Dict]:
+    """
+    Série temporelle des campagnes créées et de leurs compteurs par période
+
+    Args:
+        conditions: Conditions de filtrage (voir campaign_filters)
+        interval: Granularité ('hour', 'day', 'week', 'month')
+
+    Returns:
+        Liste de points {period, campaigns, views, clicks, conversions, engagement_rate, conversion_rate}
+        triés par période
+    """
+    bucket = _time_bucket(Campaign.created_at, interval).label('period')
+    rows = db.session.query(
+        bucket,
+        func.count(Campaign.id),
+        func.coalesce(func.sum(Campaign.view_count), 0),
+        func.coalesce(func.sum(Campaign.click_count), 0),
+        func.coalesce(func.sum(Campaign.conversion_count), 0)
+    ).filter(*conditions).group_by(bucket).order_by(bucket).all()
+
+    if not rows:
+        return []
+
+    counters = np.array([row[1:] for row in rows], dtype=np.int64)
+    engagement, conversion = compute_rates(counters[:, 1], counters[:, 2], counters[:, 3])
+
+    return [
+        {
+            'period': row[0].isoformat() if hasattr(row[0], 'isoformat') else row[0],
+            'campaigns': int(counters[i, 0]),
+            'views': int(counters[i, 1]),
+            'clicks': int(counters[i, 2]),
+            'conversions': int(counters[i, 3]),
+            'engagement_rate': float(engagement[i]),
+            'conversion_rate': float(conversion[i]),
+        }
+        for i, row in enumerate(rows)
+    ]
+
+
+def api_metrics(conditions: Sequence, metric_names: Sequence[str] = API_METRIC_NAMES) -> Dict:
+    """
+    Agrège les métriques d'appels d'API des campagnes filtrées
+
+    Le rattachement Metric.campaign_id -> Campaign.id utilise l'index (name, campaign_id).
+
+    Args:
+        conditions: Conditions de filtrage des campagnes (voir campaign_filters)
+        metric_names: Noms des métriques d'API à agréger
+
+    Returns:
+        Dictionnaire {total_api_calls, avg_response_time_ms}
+    """
+    query = db.session.query(
+        func.count(Metric.id).label('total_count'),
+        func.avg(Metric.response_time).label('avg_response_time')
+    ).filter(Metric.name.in_(metric_names))
+
+    if conditions:
+        # Semi-jointure: les campagnes filtrées pilotent l'accès à l'index (name, campaign_id)
+        campaign_ids = select(Campaign.id).where(*conditions)
+        query = query.filter(Metric.campaign_id.in_(campaign_ids))
+    else:
+        query = query.filter(Metric.campaign_id.isnot(None))
+
+    result = query.one()
+    return {
+        'total_api_calls': result.total_count or 0,
+        'avg_response_time_ms': float(result.avg_response_time or 0)
+    }
+
+
+def get_campaign_analytics(campaign_id: Optional[int] = None, campaign_type: Optional[str] = None,
+                           date_range: Optional[Tuple] = None,
+                           interval: Optional[str] = None) -> Dict:
+    """
+    Calcule les métriques agrégées des campagnes
+
+    Args:
+        campaign_id: ID spécifique d'une campagne (optionnel)
+        campaign_type: Type de campagne (optionnel)
+        date_range: Tuple (date_debut, date_fin) pour filtrer (optionnel)
+        interval: Granularité de la série temporelle à inclure (optionnel)
+
+    Returns:
+        Dictionnaire de métriques et statistiques (format de CampaignManager.get_campaign_metrics,
+        complété par 'type_breakdown' et éventuellement 'time_series')
+    """
+    conditions = campaign_filters(campaign_id, campaign_type, date_range)
+    breakdown = type_breakdown(conditions)
+
+    campaigns_count = sum(values['campaigns'] for values in breakdown.values())
+    total_views = sum(values['views'] for values in breakdown.values())
+    total_clicks = sum(values['clicks'] for values in breakdown.values())
+    total_conversions = sum(values['conversions'] for values in breakdown.values())
+    engagement, conversion = compute_rates([total_views], [total_clicks], [total_conversions])
+
+    analytics = {
+        'campaigns_count': campaigns_count,
+        'total_views': total_views,
+        'total_clicks': total_clicks,
+        'total_conversions': total_conversions,
+        'engagement_rate': float(engagement[0]),
+        'conversion_rate': float(conversion[0]),
+        'campaigns_by_type': {campaign_type: values['campaigns'] for campaign_type, values in breakdown.items()},
+        'type_breakdown': breakdown,
+        'api_metrics': api_metrics(conditions) if campaigns_count else None
+    }
+
+    if interval:
+        analytics['time_series'] = time_series(conditions, interval)
+
+    return analytics
@@ -0,0 +1,326 @@
+"""
+Compteurs d'événements des campagnes (vues, clics, conversions) avec écriture différée
+
+Les incréments sont accumulés dans Redis (HINCRBY, atomique entre processus) ou, si Redis
+n'est pas disponible, dans un tampon local au processus. Un job périodique les applique en
+base avec un seul UPDATE par campagne (view_count = view_count + :n): plus de
+lecture-modification-écriture ni de transaction par événement.
+
+Les comptes restent exacts: un lot n'est retiré du tampon qu'après le commit de la base,
+et il y est réinjecté si l'écriture échoue. Chaque lot Redis est enregistré dans
+campaign_counter_batches dans la même transaction que ses UPDATE: un lot repris après un
+arrêt entre le commit et sa suppression de Redis n'est pas appliqué deux fois.
+"""
+import atexit
+import logging
+import os
+import threading
+import uuid
+from collections import defaultdict
+from datetime import datetime, timedelta
+from typing import Dict, Optional, Tuple
+
+import redis
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import bindparam, delete, func, insert, update
+from sqlalchemy.exc import IntegrityError
+
+from app import db
+from models import Campaign, CampaignCounterBatch
+
+logger = logging.getLogger(__name__)
+
+# Compteur logique -> colonne de Campaign
+COUNTER_COLUMNS = {
+    'view': 'view_count',
+    'click': 'click_count',
+    'conversion': 'conversion_count',
+}
+
+# Intervalle entre deux écritures en base (secondes)
+FLUSH_INTERVAL = float(os.environ.get("CAMPAIGN_COUNTERS_FLUSH_INTERVAL", "5"))
+# Durée de réservation d'un lot par un processus: passé ce délai, un lot non acquitté est repris
+LEASE_SECONDS = int(os.environ.get("CAMPAIGN_COUNTERS_LEASE_SECONDS", "300"))
+# Conservation des lots appliqués (doit dépasser LEASE_SECONDS)
+APPLIED_BATCH_RETENTION = timedelta(days=1)
+
+# Clés Redis
+REDIS_PENDING_KEY = 'campaign_counters:pending'
+REDIS_FLUSHING_PREFIX = 'campaign_counters:flushing:'
+REDIS_LEASE_PREFIX = 'campaign_counters:lease:'
+
+Deltas = Dict[int, Dict[str, int]]
+
+
+class LocalCounterStore:
+    """Tampon d'incréments local au processus (utilisé sans Redis)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pending: Dict[Tuple[int, str], int] = defaultdict(int)
+
+    def increment(self, campaign_id: int, counter: str, amount: int = 1) -> None:
+        with self._lock:
+            self._pending[(campaign_id, counter)] += amount
+
+    def pending(self, campaign_id: int) -> Dict[str, int]:
+        with self._lock:
+            return {
+                counter: self._pending.get((campaign_id, counter), 0)
+                for counter in COUNTER_COLUMNS
+            }
+
+    def drain(self) -> Tuple[Optional[str], Deltas]:
+        """Retire atomiquement tous les incréments en attente"""
+        with self._lock:
+            pending, self._pending = self._pending, defaultdict(int)
+        deltas: Deltas = defaultdict(dict)
+        for (campaign_id, counter), amount in pending.items():
+            if amount:
+                deltas[campaign_id][counter] = amount
+        return None, deltas
+
+    def acknowledge(self, token: Optional[str]) -> None:
+        """Rien à faire: les incréments ont déjà été retirés du tampon"""
+
+    def restore(self, token: Optional[str], deltas: Deltas) -> None:
+        """Réinjecte un lot dont l'écriture en base a échoué"""
+        with self._lock:
+            for campaign_id, counters in deltas.items():
+                for counter, amount in counters.items():
+                    self._pending[(campaign_id, counter)] += amount
+
+
+class RedisCounterStore:
+    """
+    Tampon d'incréments partagé dans un hash Redis (champ "<campaign_id>:<compteur>")
+
+    Pour écrire un lot, le hash est renommé atomiquement en clé "flushing" propre au lot:
+    les nouveaux incréments repartent dans un hash vide. Le processus qui écrit le lot le
+    réserve (SET NX avec expiration) avant le renommage; la clé n'est supprimée qu'après le
+    commit en base. Une clé orpheline (processus arrêté en cours d'écriture) est reprise
+    par un seul processus, une fois sa réservation expirée.
+    """
+
+    def __init__(self, client, lease_seconds: int = LEASE_SECONDS):
+        self.client = client
+        self.lease_seconds = lease_seconds
+        self.worker_id = f'{os.getpid()}:{uuid.uuid4().hex[:8]}'
+
+    def _lease(self, flushing_key: str) -> bool:
+        """Réserve un lot pour ce processus (False s'il est déjà réservé)"""
+        lease_key = REDIS_LEASE_PREFIX + flushing_key[len(REDIS_FLUSHING_PREFIX):]
+        return bool(self.client.set(lease_key, self.worker_id, nx=True, ex=self.lease_seconds))
+
+    def _release(self, pipeline, flushing_key: str) -> None:
+        pipeline.delete(flushing_key)
+        pipeline.delete(REDIS_LEASE_PREFIX + flushing_key[len(REDIS_FLUSHING_PREFIX):])
+
+    def increment(self, campaign_id: int, counter: str, amount: int = 1) -> None:
+        self.client.hincrby(REDIS_PENDING_KEY, f'{campaign_id}:{counter}', amount)
+
+    def pending(self, campaign_id: int) -> Dict[str, int]:
+        values = self.client.hmget(REDIS_PENDING_KEY, [f'{campaign_id}:{counter}' for counter in COUNTER_COLUMNS])
+        return {counter: int(value or 0) for counter, value in zip(COUNTER_COLUMNS, values)}
+
+    def drain(self) -> Tuple[Optional[str], Deltas]:
+        flushing_key = None
+        for key in self.client.scan_iter(match=f'{REDIS_FLUSHING_PREFIX}*', count=100):
+            if isinstance(key, bytes):
+                key = key.decode()
+            if self._lease(key):
+                flushing_key = key
+                logger.warning(f"Resuming interrupted campaign counters flush: {flushing_key}")
+                break
+        if flushing_key is None:
+            flushing_key = f'{REDIS_FLUSHING_PREFIX}{uuid.uuid4().hex}'
+            self._lease(flushing_key)
+            try:
+                self.client.rename(REDIS_PENDING_KEY, flushing_key)
+            except redis.ResponseError:
+                # Aucun incrément en attente
+                self.acknowledge(flushing_key)
+                return None, {}
+
+        deltas: Deltas = defaultdict(dict)
+        for field, value in self.client.hgetall(flushing_key).items():
+            if isinstance(field, bytes):
+                field = field.decode()
+            campaign_id, counter = field.split(':', 1)
+            if int(value):
+                deltas[int(campaign_id)][counter] = int(value)
+        return flushing_key, deltas
+
+    def acknowledge(self, token: Optional[str]) -> None:
+        if token:
+            pipeline = self.client.pipeline(transaction=True)
+            self._release(pipeline, token)
+            pipeline.execute()
+
+    def restore(self, token: Optional[str], deltas: Deltas) -> None:
+        pipeline = self.client.pipeline(transaction=True)
+        for campaign_id, counters in deltas.items():
+            for counter, amount in counters.items():
+                pipeline.hincrby(REDIS_PENDING_KEY, f'{campaign_id}:{counter}', amount)
+        if token:
+            self._release(pipeline, token)
+        pipeline.execute()
+
+
+def _create_store():
+    """Utilise Redis si REDIS_URL répond, sinon le tampon local"""
+    redis_url = os.environ.get('REDIS_URL')
+    if redis_url:
+        try:
+            client = redis.from_url(redis_url, decode_responses=True, socket_connect_timeout=2, socket_timeout=2)
+            client.ping()
+            logger.info("Campaign counters buffered in Redis")
+            return RedisCounterStore(client)
+        except Exception as e:
+            logger.warning(f"Redis unavailable for campaign counters, using local buffer: {e}")
+    return LocalCounterStore()
+
+
+class CampaignCounterBuffer:
+    """Accumule les événements des campagnes et les applique en base par lots"""
+
+    def __init__(self, store=None):
+        self.store = store if store is not None else _create_store()
+        self.scheduler = None
+        self._app = None
+        self._flush_lock = threading.Lock()
+
+    def increment(self, campaign_id: int, counter: str, amount: int = 1) -> None:
+        """
+        Enregistre un événement (sans accès à la base)
+
+        Args:
+            campaign_id: ID de la campagne
+            counter: 'view', 'click' ou 'conversion'
+            amount: Nombre d'événements
+        """
+        if counter not in COUNTER_COLUMNS:
+            raise ValueError(f"Compteur inconnu: {counter}")
+        self.store.increment(campaign_id, counter, amount)
+
+    def pending(self, campaign_id: int) -> Dict[str, int]:
+        """Incréments pas encore écrits en base pour une campagne"""
+        return self.store.pending(campaign_id)
+
+    def current_counts(self, campaign: Campaign) -> Dict[str, int]:
+        """
+        Compteurs exacts d'une campagne (valeur en base + incréments en attente)
+
+        Returns:
+            Dictionnaire {view_count, click_count, conversion_count}
+        """
+        pending = self.pending(campaign.id)
+        return {
+            column: (getattr(campaign, column) or 0) + pending[counter]
+            for counter, column in COUNTER_COLUMNS.items()
+        }
+
+    @staticmethod
+    def _mark_applied(token: str, campaigns: int) -> bool:
+        """
+        Enregistre un lot dans la transaction en cours
+
+        Returns:
+            False si le lot a déjà été appliqué (la transaction est alors annulée)
+        """
+        try:
+            db.session.execute(insert(CampaignCounterBatch).values(
+                batch_id=token, campaigns=campaigns, applied_at=datetime.utcnow()))
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        db.session.execute(delete(CampaignCounterBatch).where(
+            CampaignCounterBatch.applied_at < datetime.utcnow() - APPLIED_BATCH_RETENTION))
+        return True
+
+    def flush(self) -> int:
+        """
+        Applique les incréments en attente: un UPDATE par campagne, une seule transaction
+
+        Returns:
+            Nombre de campagnes mises à jour
+        """
+        with self._flush_lock:
+            token, deltas = self.store.drain()
+            if not deltas:
+                return 0
+
+            rows = [
+                {
+                    'campaign_id': campaign_id,
+                    'views': counters.get('view', 0),
+                    'clicks': counters.get('click', 0),
+                    'conversions': counters.get('conversion', 0),
+                }
+                for campaign_id, counters in sorted(deltas.items())
+            ]
+            table = Campaign.__table__
+            stmt = update(table).where(table.c.id == bindparam('campaign_id')).values(
+                view_count=func.coalesce(table.c.view_count, 0) + bindparam('views'),
+                click_count=func.coalesce(table.c.click_count, 0) + bindparam('clicks'),
+                conversion_count=func.coalesce(table.c.conversion_count, 0) + bindparam('conversions')
+            )
+
+            try:
+                applied = token is None or self._mark_applied(token, len(rows))
+                if applied:
+                    db.session.execute(stmt, rows)
+                    db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                self.store.restore(token, deltas)
+                logger.error(f"Campaign counters flush failed, {len(rows)} campaigns kept pending: {e}")
+                raise
+
+            self.store.acknowledge(token)
+            if not applied:
+                # Lot repris après un arrêt entre le commit et son acquittement
+                logger.warning(f"Campaign counters batch {token} already applied, discarded")
+                return 0
+            logger.debug(f"Campaign counters flushed for {len(rows)} campaigns")
+            return len(rows)
+
+    def _scheduled_flush(self) -> None:
+        try:
+            with self._app.app_context():
+                self.flush()
+        except Exception as e:
+            logger.error(f"Scheduled campaign counters flush failed: {e}")
+
+    def start_flusher(self, app, interval: float = FLUSH_INTERVAL) -> None:
+        """Démarre l'écriture périodique en base (et une dernière écriture à l'arrêt)"""
+        if self.scheduler is not None:
+            logger.warning("Campaign counters flusher already running")
+            return
+
+        self._app = app
+        self.scheduler = BackgroundScheduler()
+        self.scheduler.add_job(
+            func=self._scheduled_flush,
+            trigger='interval',
+            seconds=interval,
+            id='campaign_counters_flush',
+            name='Campaign Counters Flush',
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
+        self.scheduler.start()
+        atexit.register(self.stop_flusher)
+        logger.info(f"Campaign counters flusher started (every {interval}s)")
+
+    def stop_flusher(self) -> None:
+        """Arrête le job périodique et écrit les derniers incréments"""
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+            self._scheduled_flush()
+            logger.info("Campaign counters flusher stopped")
+
+
+campaign_counters = CampaignCounterBuffer()
@@ -2,17 +2,148 @@
 Module de gestion des campagnes marketing avec métriques intégrées
 """
 import os
+import re
+import json
 import time
+import uuid
+import asyncio
 import logging
 import datetime
-from typing import Dict, List, Optional, Union, Any
+import tempfile
+from pathlib import Path
+from typing import Dict, List, Optional, Union, Any, Sequence, Tuple
 
-from flask import current_app
-from sqlalchemy import func
+from flask import current_app, has_request_context
+from flask_login import current_user
+from sqlalchemy import func, insert
 
 from app import db, log_metric
 from models import Campaign, Customer, CustomerPersona, Boutique, Metric
 from ai_utils import AIManager
+from async_runner import run_async
+from bulk_ingest import bulk_insert_returning
+from prompt_registry import prompt_registry
+
+# Générations de contenu simultanées maximum dans un lot de campagnes
+CAMPAIGN_BATCH_CONCURRENCY = int(os.environ.get("CAMPAIGN_BATCH_CONCURRENCY", "4"))
+# Campagnes d'un lot enregistrées par transaction (une tranche = un point de reprise)
+CAMPAIGN_BATCH_CHUNK_SIZE = int(os.environ.get("CAMPAIGN_BATCH_CHUNK_SIZE", "25"))
+# Répertoire des points de reprise des lots de campagnes
+CAMPAIGN_BATCH_CHECKPOINT_DIR = Path(os.environ.get("CAMPAIGN_BATCH_CHECKPOINT_DIR", "cache/campaign_batches"))
+
+# Instructions de base selon le type de campagne
+CAMPAIGN_INSTRUCTIONS = {
+    "email": (
+        "Créez un email marketing personnalisé qui s'adresse directement au client. "
+        "L'email doit inclure : objet, salutation, introduction, corps avec bénéfices clés, "
+        "appel à l'action clair, et signature. Utilisez un ton chaleureux et professionnel."
+    ),
+    "social": (
+        "Créez une publication pour réseau social percutante et engageante. "
+        "Elle doit être concise (max 280 caractères pour Twitter), inclure des hashtags pertinents, "
+        "un appel à l'action et être rédigée dans un style conversationnel."
+    ),
+    "ad": (
+        "Rédigez une publicité texte persuasive avec un titre accrocheur (max 30 caractères), "
+        "un corps concis mettant en avant les bénéfices clés (max 90 caractères), "
+        "et un appel à l'action fort (max 15 caractères)."
+    ),
+    "sms": (
+        "Créez un SMS marketing court et efficace (max 160 caractères) avec un message clair, "
+        "une proposition de valeur et un appel à l'action concis. Incluez la possibilité de "
+        "désabonnement conformément aux réglementations."
+    ),
+    "product_description": (
+        "Rédigez une description de produit optimisée pour le e-commerce. "
+        "Elle doit inclure : un titre accrocheur, une introduction captivante, "
+        "les caractéristiques principales avec leurs bénéfices, des détails techniques "
+        "si pertinents, et pourquoi le client devrait acheter maintenant."
+    )
+}
+
+# Sections du prompt de campagne (compilées au chargement par prompt_registry)
+prompt_registry.register_many({
+    'campaign_header': """
+        Titre de la campagne: {title}
+
+        Type de campagne: {campaign_type_name}
+
+        Instructions: {instructions}
+    """,
+    'campaign_profile': """
+        Profil client:
+        - Nom: {name}
+        - Âge: {age}
+        - Localisation: {location}
+        - Genre: {gender}
+        - Langue: {language}{interests_line}{persona_block}
+    """,
+    'campaign_persona': """
+        Persona détaillé:
+        - Titre: {title}
+        - Description: {description}{optional_lines}
+    """,
+    'campaign_boutique': """
+        Boutique:
+        - Nom: {name}
+        - Description: {description}{optional_lines}
+    """,
+    'campaign_audience': "Audience cible: {target_audience}",
+    'campaign_guidelines': """
+        Consignes générales:
+        1. Adopter un ton correspondant à la marque et à la cible
+        2. Utiliser un langage clair, concis et accrocheur
+        3. Adapter le contenu aux caractéristiques et intérêts du client
+        4. Intégrer une proposition de valeur unique et convaincante
+        5. Inclure un appel à l'action clair et incitant à l'engagement
+    """,
+})
+
+
+def _optional_lines(*fields) -> str:
+    """Lignes '- libellé: valeur' des champs renseignés, chacune précédée d'un saut de ligne"""
+    return ''.join(f"\n- {label}: {value}" for label, value in fields if value)
+
+
+class CampaignBatchCheckpoint:
+    """
+    Point de reprise d'un lot de campagnes (fichier JSON réécrit après chaque tranche)
+    
+    done associe chaque paire 'client:type' à la campagne créée, failed à la dernière erreur:
+    relancer un lot avec le même batch_id ne régénère que les paires absentes ou en échec.
+    """
+    
+    def __init__(self, batch_id: str, directory: Optional[Path] = None):
+        self.batch_id = batch_id
+        self.directory = Path(directory or CAMPAIGN_BATCH_CHECKPOINT_DIR)
+        self.path = self.directory / f"{re.sub(r'[^A-Za-z0-9_.-]', '_', batch_id)}.json"
+        self.done: Dict[str, int] = {}
+        self.failed: Dict[str, str] = {}
+        try:
+            state = json.loads(self.path.read_text(encoding='utf-8'))
+            self.done = state.get('done', {})
+            self.failed = state.get('failed', {})
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            logging.warning(f"Unreadable campaign batch checkpoint {self.path.name}, starting over: {e}")
+    
+    @staticmethod
+    def key(customer_id: int, campaign_type: str) -> str:
+        return f"{customer_id}:{campaign_type}"
+    
+    def save(self) -> None:
+        """Écrit le point de reprise (fichier temporaire puis renommage atomique)"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'w', encoding='utf-8') as handle:
+                json.dump({'batch_id': self.batch_id, 'done': self.done, 'failed': self.failed}, handle)
+            os.replace(tmp_path, self.path)
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
 
 class CampaignManager:
     """
@@ -83,16 +214,7 @@ class CampaignManager:
             
             # Si profile_data non fourni, l'extraire du client
             if not profile_data:
-                profile_data = customer.profile_data if customer.profile_data else {
-                    'name': customer.name,
-                    'age': customer.age,
-                    'location': customer.location,
-                    'gender': customer.gender,
-                    'language': customer.language,
-                    'interests': customer.get_interests_list(),
-                    'preferred_device': customer.preferred_device,
-                    'persona': customer.persona
-                }
+                profile_data = self._customer_profile(customer)
         
         if persona_id:
             persona = CustomerPersona.query.get(persona_id)
@@ -112,19 +234,21 @@ class CampaignManager:
                 campaign_type=campaign_type,
                 profile_data=profile_data,
                 customer=customer,
-                campaign_persona=persona,
-                campaign_boutique=boutique,
+                persona=persona,
+                boutique=boutique,
                 target_audience=target_audience
             )
             
             # Calculer le temps de génération du prompt
             prompt_time = (time.time() - generation_start) * 1000
             
-            # Générer le contenu
+            # Générer le contenu (la métrique est rattachée à la campagne une fois créée)
+            generation_metric = {}
             content = self.ai_manager.generate_text(
                 prompt=prompt,
                 metric_name="campaign_content_generation",
-                customer_id=customer_id if customer else None
+                customer_id=customer_id if customer else None,
+                metric_context=generation_metric
             )
             
             # Calculer le temps de génération du contenu
@@ -184,6 +308,9 @@ class CampaignManager:
             
             # Enregistrer la campagne
             db.session.add(campaign)
+            db.session.flush()
+            if generation_metric.get('metric_id'):
+                Metric.query.filter_by(id=generation_metric['metric_id']).update({'campaign_id': campaign.id})
             db.session.commit()
             
             # Journaliser la métrique
@@ -228,182 +355,374 @@ class CampaignManager:
             # Ré-lever l'exception
             raise
             
+    def create_campaigns_batch(self,
+                               items: Sequence[Tuple[Union[int, Customer], str]],
+                               title: str = None,
+                               persona_id: int = None,
+                               boutique_id: int = None,
+                               target_audience: str = None,
+                               platforms: List[str] = None,
+                               scheduled_at: datetime.datetime = None,
+                               batch_id: str = None,
+                               max_concurrency: int = CAMPAIGN_BATCH_CONCURRENCY,
+                               chunk_size: int = CAMPAIGN_BATCH_CHUNK_SIZE) -> Dict[str, Any]:
+        """
+        Crée une campagne par paire (client, type de campagne)
+        
+        Le contexte commun (persona, boutique, audience, consignes) est rendu une seule fois et
+        les clients sont chargés en une requête. Les contenus sont générés en parallèle
+        (max_concurrency appels simultanés); chaque tranche de chunk_size campagnes est
+        enregistrée en une transaction (INSERT groupés des campagnes et de leurs métriques),
+        puis consignée dans le point de reprise du lot.
+        
+        Args:
+            items: Paires (client ou ID client, type de campagne)
+            title: Titre des campagnes (par défaut le nom du type de campagne)
+            persona_id: ID du persona commun (optionnel)
+            boutique_id: ID de la boutique commune (optionnel)
+            target_audience: Description de l'audience cible
+            platforms: Liste des plateformes de publication
+            scheduled_at: Date planifiée de publication
+            batch_id: Identifiant du lot; réutiliser celui d'un lot interrompu le reprend
+            max_concurrency: Générations simultanées maximum
+            chunk_size: Campagnes enregistrées par transaction
+            
+        Returns:
+            Rapport {batch_id, created: [{customer_id, campaign_type, campaign_id}],
+            failed: [{customer_id, campaign_type, error}], skipped, total_time_ms}
+            (skipped: paires déjà créées lors d'une exécution précédente du lot)
+            
+        Raises:
+            ValueError: Si le persona ou la boutique commune est introuvable
+        """
+        start_time = time.time()
+        batch_id = batch_id or uuid.uuid4().hex
+        checkpoint = CampaignBatchCheckpoint(batch_id)
+        
+        persona = None
+        boutique = None
+        if persona_id:
+            persona = CustomerPersona.query.get(persona_id)
+            if not persona:
+                raise ValueError(f"Persona introuvable: ID {persona_id}")
+        if boutique_id:
+            boutique = Boutique.query.get(boutique_id)
+            if not boutique:
+                raise ValueError(f"Boutique introuvable: ID {boutique_id}")
+        
+        # Contexte commun rendu une fois pour tout le lot
+        shared_sections = self._shared_campaign_sections(persona, boutique, target_audience)
+        
+        pairs = []
+        seen = set()
+        for customer, campaign_type in items:
+            customer_id = customer.id if isinstance(customer, Customer) else customer
+            key = CampaignBatchCheckpoint.key(customer_id, campaign_type)
+            if key not in seen:
+                seen.add(key)
+                pairs.append((customer_id, campaign_type, key))
+        customer_ids = {customer_id for customer_id, _, _ in pairs}
+        customers = {c.id: c for c in Customer.query.filter(Customer.id.in_(customer_ids))} if customer_ids else {}
+        
+        report = {'batch_id': batch_id, 'created': [], 'failed': [], 'skipped': 0}
+        jobs = []
+        for customer_id, campaign_type, key in pairs:
+            if key in checkpoint.done:
+                report['skipped'] += 1
+            elif campaign_type not in self.campaign_types:
+                report['failed'].append({'customer_id': customer_id, 'campaign_type': campaign_type,
+                                         'error': f"Type de campagne non supporté: {campaign_type}"})
+            elif customer_id not in customers:
+                report['failed'].append({'customer_id': customer_id, 'campaign_type': campaign_type,
+                                         'error': f"Client introuvable: ID {customer_id}"})
+            else:
+                profile_data = self._customer_profile(customers[customer_id])
+                campaign_title = title or self.campaign_types[campaign_type]['name']
+                jobs.append({
+                    'key': key,
+                    'customer_id': customer_id,
+                    'campaign_type': campaign_type,
+                    'title': campaign_title,
+                    'profile_data': profile_data,
+                    'prompt': self._build_campaign_prompt(
+                        title=campaign_title,
+                        campaign_type=campaign_type,
+                        profile_data=profile_data,
+                        shared_sections=shared_sections
+                    ),
+                })
+        
+        # Rattachement des métriques à l'utilisateur connecté (comme log_metric)
+        user_id = None
+        if has_request_context() and current_user and current_user.is_authenticated:
+            numeric_id = getattr(current_user, 'numeric_id', None)
+            user_id = str(numeric_id) if numeric_id is not None else None
+        common = {
+            'persona_id': persona_id,
+            'boutique_id': boutique_id,
+            'platforms': platforms,
+            'scheduled_at': scheduled_at,
+            'target_audience': target_audience,
+        }
+        
+        for offset in range(0, len(jobs), chunk_size):
+            chunk = jobs[offset:offset + chunk_size]
+            results = run_async(self._generate_batch_contents(chunk, max_concurrency))
+            self._save_batch_chunk(chunk, results, common, batch_id, user_id, checkpoint, report)
+            checkpoint.save()
+        
+        report['total_time_ms'] = (time.time() - start_time) * 1000
+        log_metric(
+            metric_name="campaign_batch_creation",
+            category="generation",
+            status="success" if not report['failed'] else "error",
+            data={
+                "batch_id": batch_id,
+                "requested": len(pairs),
+                "created": len(report['created']),
+                "failed": len(report['failed']),
+                "skipped": report['skipped'],
+                "boutique_id": boutique_id,
+                "persona_id": persona_id,
+                "total_time_ms": report['total_time_ms']
+            },
+            response_time=report['total_time_ms']
+        )
+        return report
+    
+    async def _generate_batch_contents(self, jobs: List[Dict], max_concurrency: int) -> List[Dict]:
+        """
+        Génère les contenus d'une tranche, au plus max_concurrency appels simultanés
+        
+        Les appels (synchrones) passent dans des threads; leurs métriques sont collectées
+        (metric_sink) pour être insérées avec les campagnes.
+        
+        Returns:
+            Par job, dans l'ordre: {content, error, metrics, generation_time_ms}
+        """
+        semaphore = asyncio.Semaphore(max_concurrency)
+        
+        async def generate(job):
+            metrics = []
+            async with semaphore:
+                started = time.time()
+                try:
+                    content = await asyncio.to_thread(
+                        self.ai_manager.generate_text,
+                        prompt=job['prompt'],
+                        metric_name="campaign_content_generation",
+                        customer_id=job['customer_id'],
+                        metric_sink=metrics
+                    )
+                    error = None
+                    if not content or content.startswith("Error:"):
+                        error, content = content or "Contenu vide", None
+                except Exception as e:
+                    content, error = None, str(e)
+            return {'content': content, 'error': error, 'metrics': metrics,
+                    'generation_time_ms': (time.time() - started) * 1000}
+        
+        return await asyncio.gather(*(generate(job) for job in jobs))
+    
+    def _save_batch_chunk(self, chunk, results, common, batch_id, user_id, checkpoint, report) -> None:
+        """Enregistre une tranche (campagnes et métriques) en une transaction et met à jour le rapport"""
+        created_at = datetime.datetime.now()
+        succeeded = [(job, result) for job, result in zip(chunk, results) if result['error'] is None]
+        campaign_rows = [dict(
+            common,
+            title=job['title'],
+            content=result['content'],
+            campaign_type=job['campaign_type'],
+            profile_data=job['profile_data'],
+            customer_id=job['customer_id'],
+            prompt_used=job['prompt'],
+            ai_model_used=self.ai_manager.grok_client and "grok" or "openai",
+            status="draft",
+            generation_params={
+                "batch_id": batch_id,
+                "content_generation_time_ms": result['generation_time_ms']
+            }
+        ) for job, result in succeeded]
+        
+        try:
+            campaign_ids = bulk_insert_returning(Campaign, campaign_rows) if campaign_rows else []
+            campaign_by_key = {job['key']: campaign_id for (job, _), campaign_id in zip(succeeded, campaign_ids)}
+            
+            metric_rows = []
+            for job, result in zip(chunk, results):
+                campaign_id = campaign_by_key.get(job['key'])
+                for metric in result['metrics']:
+                    metric_rows.append(dict(metric, campaign_id=campaign_id, user_id=user_id))
+                data = {
+                    "batch_id": batch_id,
+                    "campaign_type": job['campaign_type'],
+                    "title": job['title'],
+                    "customer_id": job['customer_id'],
+                    "persona_id": common['persona_id'],
+                    "boutique_id": common['boutique_id'],
+                    "total_time_ms": result['generation_time_ms']
+                }
+                if campaign_id is None:
+                    data["error"] = result['error']
+                else:
+                    data["campaign_id"] = campaign_id
+                metric_rows.append({
+                    'name': "campaign_creation",
+                    'category': "generation",
+                    'status': campaign_id is not None,
+                    'data': data,
+                    'response_time': result['generation_time_ms'],
+                    'created_at': created_at,
+                    'customer_id': job['customer_id'],
+                    'campaign_id': campaign_id,
+                    'user_id': user_id,
+                })
+            if metric_rows:
+                db.session.execute(insert(Metric), metric_rows)
+            db.session.commit()
+        except Exception as e:
+            db.session.rollback()
+            logging.error(f"Error saving campaign batch {batch_id} chunk: {str(e)}")
+            for job in chunk:
+                checkpoint.failed[job['key']] = str(e)
+                report['failed'].append({'customer_id': job['customer_id'], 'campaign_type': job['campaign_type'],
+                                         'error': str(e)})
+            return
+        
+        for job, result in zip(chunk, results):
+            campaign_id = campaign_by_key.get(job['key'])
+            if campaign_id is None:
+                checkpoint.failed[job['key']] = result['error']
+                report['failed'].append({'customer_id': job['customer_id'], 'campaign_type': job['campaign_type'],
+                                         'error': result['error']})
+            else:
+                checkpoint.done[job['key']] = campaign_id
+                checkpoint.failed.pop(job['key'], None)
+                report['created'].append({'customer_id': job['customer_id'], 'campaign_type': job['campaign_type'],
+                                          'campaign_id': campaign_id})
+    
+    @staticmethod
+    def _customer_profile(customer: Customer) -> Dict:
+        """Profil d'un client pour le prompt (profile_data enregistré ou colonnes du client)"""
+        return customer.profile_data if customer.profile_data else {
+            'name': customer.name,
+            'age': customer.age,
+            'location': customer.location,
+            'gender': customer.gender,
+            'language': customer.language,
+            'interests': customer.get_interests_list(),
+            'preferred_device': customer.preferred_device,
+            'persona': customer.persona
+        }
+    
     def _build_campaign_prompt(self, title, campaign_type, profile_data=None, 
                               customer=None, persona=None, boutique=None,
-                              target_audience=None) -> str:
+                              target_audience=None, shared_sections=None) -> str:
         """
         Construit un prompt optimisé pour générer le contenu de la campagne
         
+        Les sections sont rendues à partir des templates de prompt_registry (campaign_*).
+        
+        Args:
+            shared_sections: Sections communes déjà rendues (_shared_campaign_sections), pour
+                ne pas les reconstruire à chaque campagne d'un lot
+        
         Returns:
             Prompt optimisé pour l'IA
         """
-        # Instructions de base selon le type de campagne
-        campaign_instructions = {
-            "email": (
-                "Créez un email marketing personnalisé qui s'adresse directement au client. "
-                "L'email doit inclure : objet, salutation, introduction, corps avec bénéfices clés, "
-                "appel à l'action clair, et signature. Utilisez un ton chaleureux et professionnel."
-            ),
-            "social": (
-                "Créez une publication pour réseau social percutante et engageante. "
-                "Elle doit être concise (max 280 caractères pour Twitter), inclure des hashtags pertinents, "
-                "un appel à l'action et être rédigée dans un style conversationnel."
-            ),
-            "ad": (
-                "Rédigez une publicité texte persuasive avec un titre accrocheur (max 30 caractères), "
-                "un corps concis mettant en avant les bénéfices clés (max 90 caractères), "
-                "et un appel à l'action fort (max 15 caractères)."
-            ),
-            "sms": (
-                "Créez un SMS marketing court et efficace (max 160 caractères) avec un message clair, "
-                "une proposition de valeur et un appel à l'action concis. Incluez la possibilité de "
-                "désabonnement conformément aux réglementations."
-            ),
-            "product_description": (
-                "Rédigez une description de produit optimisée pour le e-commerce. "
-                "Elle doit inclure : un titre accrocheur, une introduction captivante, "
-                "les caractéristiques principales avec leurs bénéfices, des détails techniques "
-                "si pertinents, et pourquoi le client devrait acheter maintenant."
-            )
-        }
-        
-        # Construire le prompt de base
-        prompt = f"Titre de la campagne: {title}\n\n"
-        prompt += f"Type de campagne: {self.campaign_types[campaign_type]['name']}\n\n"
-        prompt += f"Instructions: {campaign_instructions[campaign_type]}\n\n"
+        sections = [prompt_registry.render(
+            'campaign_header',
+            title=title,
+            campaign_type_name=self.campaign_types[campaign_type]['name'],
+            instructions=CAMPAIGN_INSTRUCTIONS[campaign_type],
+        )]
         
         # Ajouter les informations du client/persona
         if profile_data:
-            prompt += "Profil client:\n"
-            prompt += f"- Nom: {profile_data.get('name', 'Non spécifié')}\n"
-            prompt += f"- Âge: {profile_data.get('age', 'Non spécifié')}\n"
-            prompt += f"- Localisation: {profile_data.get('location', 'Non spécifiée')}\n"
-            prompt += f"- Genre: {profile_data.get('gender', 'Non spécifié')}\n"
-            prompt += f"- Langue: {profile_data.get('language', 'Non spécifiée')}\n"
-            
-            # Intérêts
             interests = profile_data.get('interests', [])
-            if interests:
-                if isinstance(interests, list):
-                    prompt += f"- Intérêts: {', '.join(interests)}\n"
-                else:
-                    prompt += f"- Intérêts: {interests}\n"
-            
-            # Persona
+            if isinstance(interests, list):
+                interests = ', '.join(interests)
             persona_text = profile_data.get('persona')
-            if persona_text:
-                prompt += f"\nPersona du client:\n{persona_text}\n"
+            sections.append(prompt_registry.render(
+                'campaign_profile',
+                name=profile_data.get('name', 'Non spécifié'),
+                age=profile_data.get('age', 'Non spécifié'),
+                location=profile_data.get('location', 'Non spécifiée'),
+                gender=profile_data.get('gender', 'Non spécifié'),
+                language=profile_data.get('language', 'Non spécifiée'),
+                interests_line=f"\n- Intérêts: {interests}" if interests else '',
+                persona_block=f"\n\nPersona du client:\n{persona_text}" if persona_text else '',
+            ))
+        
+        if shared_sections is None:
+            shared_sections = self._shared_campaign_sections(persona, boutique, target_audience)
+        sections.extend(shared_sections)
+        
+        return '\n\n'.join(sections) + '\n'
+    
+    def _shared_campaign_sections(self, persona=None, boutique=None, target_audience=None) -> List[str]:
+        """
+        Sections du prompt indépendantes du client: persona, boutique, audience et consignes
+        
+        Returns:
+            Sections rendues, dans l'ordre du prompt
+        """
+        sections = []
         
         # Ajouter les informations du persona (depuis la base de données)
         if persona:
-            prompt += f"\nPersona détaillé:\n"
-            prompt += f"- Titre: {persona.title}\n"
-            prompt += f"- Description: {persona.description}\n"
-            
-            if persona.primary_goal:
-                prompt += f"- Objectif principal: {persona.primary_goal}\n"
-            
-            if persona.pain_points:
-                prompt += f"- Points douloureux: {persona.pain_points}\n"
-            
-            if persona.buying_habits:
-                prompt += f"- Habitudes d'achat: {persona.buying_habits}\n"
+            sections.append(prompt_registry.render(
+                'campaign_persona',
+                title=persona.title,
+                description=persona.description,
+                optional_lines=_optional_lines(
+                    ("Objectif principal", persona.primary_goal),
+                    ("Points douloureux", persona.pain_points),
+                    ("Habitudes d'achat", persona.buying_habits),
+                ),
+            ))
         
         # Ajouter les informations de la boutique
         if boutique:
-            prompt += f"\nBoutique:\n"
-            prompt += f"- Nom: {boutique.name}\n"
-            prompt += f"- Description: {boutique.description}\n"
-            
-            if boutique.target_demographic:
-                prompt += f"- Cible démographique: {boutique.target_demographic}\n"
+            sections.append(prompt_registry.render(
+                'campaign_boutique',
+                name=boutique.name,
+                description=boutique.description,
+                optional_lines=_optional_lines(("Cible démographique", boutique.target_demographic)),
+            ))
         
         # Ajouter l'audience cible si spécifiée
         if target_audience:
-            prompt += f"\nAudience cible: {target_audience}\n"
+            sections.append(prompt_registry.render('campaign_audience', target_audience=target_audience))
         
         # Instructions finales
-        prompt += "\nConsignes générales:\n"
-        prompt += "1. Adopter un ton correspondant à la marque et à la cible\n"
-        prompt += "2. Utiliser un langage clair, concis et accrocheur\n"
-        prompt += "3. Adapter le contenu aux caractéristiques et intérêts du client\n"
-        prompt += "4. Intégrer une proposition de valeur unique et convaincante\n"
-        prompt += "5. Inclure un appel à l'action clair et incitant à l'engagement\n"
+        sections.append(prompt_registry.render('campaign_guidelines'))
         
-        return prompt
+        return sections
         
-    def get_campaign_metrics(self, campaign_id=None, campaign_type=None, date_range=None):
+    def get_campaign_metrics(self, campaign_id=None, campaign_type=None, date_range=None, interval=None):
         """
         Récupère les métriques des campagnes avec filtres optionnels
         
+        Les agrégats sont calculés en SQL par campaign_analytics (aucune campagne n'est chargée).
+        
         Args:
             campaign_id: ID spécifique d'une campagne (optionnel)
             campaign_type: Type de campagne (optionnel)
             date_range: Tuple (date_debut, date_fin) pour filtrer (optionnel)
+            interval: Granularité d'une série temporelle à inclure ('day', 'week', ...) (optionnel)
             
         Returns:
             Dictionnaire de métriques et statistiques
         """
-        # Base de la requête
-        query = Campaign.query
-        
-        # Appliquer les filtres
-        if campaign_id:
-            query = query.filter_by(id=campaign_id)
-        if campaign_type:
-            query = query.filter_by(campaign_type=campaign_type)
-        if date_range:
-            start_date, end_date = date_range
-            query = query.filter(Campaign.created_at >= start_date, Campaign.created_at <= end_date)
-            
-        # Récupérer les données
-        campaigns = query.all()
-        
-        # Métriques d'engagement
-        total_views = sum(campaign.view_count for campaign in campaigns)
-        total_clicks = sum(campaign.click_count for campaign in campaigns)
-        total_conversions = sum(campaign.conversion_count for campaign in campaigns)
-        
-        # Calcul des taux
-        engagement_rate = (total_clicks / total_views * 100) if total_views > 0 else 0
-        conversion_rate = (total_conversions / total_clicks * 100) if total_clicks > 0 else 0
-        
-        # Regrouper par type de campagne
-        campaigns_by_type = {}
-        for c in campaigns:
-            if c.campaign_type not in campaigns_by_type:
-                campaigns_by_type[c.campaign_type] = 0
-            campaigns_by_type[c.campaign_type] += 1
-            
-        # Métriques liées aux appels d'API pour ces campagnes
-        campaign_ids = [c.id for c in campaigns]
-        api_metrics = None
-        
-        if campaign_ids:
-            metrics_query = db.session.query(
-                func.count(Metric.id).label('total_count'),
-                func.sum(Metric.response_time).label('total_response_time'),
-                func.avg(Metric.response_time).label('avg_response_time')
-            ).filter(
-                Metric.name == 'campaign_content_generation',
-                Metric.data['campaign_id'].astext.cast(db.Integer).in_(campaign_ids)
-            ).first()
-            
-            api_metrics = {
-                'total_api_calls': metrics_query.total_count or 0,
-                'avg_response_time_ms': metrics_query.avg_response_time or 0
-            }
+        from campaign_analytics import get_campaign_analytics
         
-        return {
-            'campaigns_count': len(campaigns),
-            'total_views': total_views,
-            'total_clicks': total_clicks,
-            'total_conversions': total_conversions,
-            'engagement_rate': engagement_rate,
-            'conversion_rate': conversion_rate,
-            'campaigns_by_type': campaigns_by_type,
-            'api_metrics': api_metrics
-        }
+        return get_campaign_analytics(
+            campaign_id=campaign_id,
+            campaign_type=campaign_type,
+            date_range=date_range,
+            interval=interval
+        )
         
     def regenerate_campaign_content(self, campaign_id, new_prompt=None):
         """
@@ -432,7 +751,8 @@ class CampaignManager:
             new_content = self.ai_manager.generate_text(
                 prompt=prompt,
                 metric_name="campaign_content_regeneration",
-                customer_id=campaign.customer_id
+                customer_id=campaign.customer_id,
+                campaign_id=campaign.id
             )
             
             # Mettre à jour la campagne
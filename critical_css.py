@@ -0,0 +1,566 @@
+"""
+Extraction du CSS critique par template
+
+Le HTML rendu d'un template est analysé (html.parser, sans navigateur): les éléments du
+début du <body>, jusqu'à FOLD_ELEMENT_LIMIT, approximent la partie visible au premier
+affichage. Les règles du bundle CSS (voir asset_optimizer) dont un sélecteur correspond à
+l'un de ces éléments forment le CSS critique, inséré dans un <style>; le bundle complet
+est alors chargé sans bloquer le rendu (rel=preload).
+
+Le CSS critique est calculé au premier rendu de chaque template puis mis en cache, en
+mémoire et dans static/dist/critical, par template et hash du bundle: un nouveau build
+l'invalide. Les rendus suivants l'utilisent sans analyse.
+"""
+import logging
+import os
+import re
+import threading
+from functools import lru_cache
+from html.parser import HTMLParser
+from pathlib import Path
+from typing import Dict, List, Optional, Tuple
+
+from flask import before_render_template, g, url_for
+from markupsafe import Markup, escape
+
+from asset_optimizer import DIST_DIRNAME, AssetOptimizer, asset_optimizer, minify_css
+
+logger = logging.getLogger(__name__)
+
+CRITICAL_CSS_ENABLED = os.environ.get("CRITICAL_CSS_ENABLED", "true").lower() == "true"
+
+# Nombre d'éléments du <body> considérés au-dessus de la ligne de flottaison
+FOLD_ELEMENT_LIMIT = int(os.environ.get("CRITICAL_CSS_FOLD_ELEMENTS", "150"))
+
+CRITICAL_DIRNAME = "critical"
+
+VOID_ELEMENTS = frozenset((
+    'area', 'base', 'br', 'col', 'embed', 'hr', 'img', 'input', 'link', 'meta',
+    'param', 'source', 'track', 'wbr',
+))
+# Éléments dont le contenu n'est pas affiché (ou pas stylé par nos feuilles)
+OPAQUE_ELEMENTS = frozenset(('script', 'style', 'template', 'noscript', 'svg'))
+
+# Pseudo-classes jamais vraies au premier affichage
+DYNAMIC_PSEUDO_CLASSES = frozenset((
+    'hover', 'focus', 'active', 'focus-within', 'focus-visible', 'visited', 'target',
+))
+# At-rules dont le contenu est filtré règle par règle
+CONDITIONAL_AT_RULES = frozenset(('media', 'supports', 'layer', 'container'))
+
+
+class Element:
+    """Élément du DOM au-dessus de la ligne de flottaison"""
+
+    __slots__ = ('tag', 'id', 'classes', 'attrs', 'parent', 'children')
+
+    def __init__(self, tag: str, attrs: Dict[str, str], parent: Optional['Element']):
+        self.tag = tag
+        self.attrs = attrs
+        self.id = attrs.get('id')
+        self.classes = frozenset((attrs.get('class') or '').split())
+        self.parent = parent
+        self.children: List['Element'] = []
+        if parent is not None:
+            parent.children.append(self)
+
+
+class _FoldReached(Exception):
+    pass
+
+
+class _FoldParser(HTMLParser):
+    """Construit l'arbre des premiers éléments du document"""
+
+    def __init__(self, limit: int):
+        super().__init__(convert_charrefs=True)
+        self.limit = limit
+        self.elements: List[Element] = []
+        self._stack: List[Element] = []
+        self._opaque_depth: Optional[int] = None
+        self._in_body = False
+        self._body_count = 0
+
+    def handle_starttag(self, tag, attrs):
+        if self._opaque_depth is not None:
+            if tag not in VOID_ELEMENTS:
+                self._stack.append(None)
+            return
+        if self._in_body:
+            self._body_count += 1
+            if self._body_count > self.limit:
+                raise _FoldReached()
+
+        parent = self._stack[-1] if self._stack else None
+        element = Element(tag, {name: value or '' for name, value in attrs}, parent)
+        self.elements.append(element)
+        if tag == 'body':
+            self._in_body = True
+        if tag in VOID_ELEMENTS:
+            return
+        if tag in OPAQUE_ELEMENTS:
+            self._opaque_depth = len(self._stack)
+        self._stack.append(element)
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in VOID_ELEMENTS:
+            self.handle_endtag(tag)
+
+    def handle_endtag(self, tag):
+        # HTML non équilibré (<p>, <li> non fermés): on remonte jusqu'à la balise ouvrante
+        for position in range(len(self._stack) - 1, -1, -1):
+            element = self._stack[position]
+            if element is not None and element.tag == tag:
+                del self._stack[position:]
+                if self._opaque_depth is not None and position <= self._opaque_depth:
+                    self._opaque_depth = None
+                return
+
+
+class FoldDOM:
+    """Éléments au-dessus de la ligne de flottaison, indexés pour la correspondance des sélecteurs"""
+
+    def __init__(self, html: str, limit: int = FOLD_ELEMENT_LIMIT):
+        parser = _FoldParser(limit)
+        try:
+            parser.feed(html)
+            parser.close()
+        except _FoldReached:
+            pass
+        self.elements = parser.elements
+        self.by_id: Dict[str, List[Element]] = {}
+        self.by_class: Dict[str, List[Element]] = {}
+        self.by_tag: Dict[str, List[Element]] = {}
+        for element in self.elements:
+            if element.id:
+                self.by_id.setdefault(element.id, []).append(element)
+            for name in element.classes:
+                self.by_class.setdefault(name, []).append(element)
+            self.by_tag.setdefault(element.tag, []).append(element)
+
+    def _candidates(self, compound) -> List[Element]:
+        tag, ids, classes, _, _ = compound
+        if ids:
+            return self.by_id.get(ids[0], [])
+        if classes:
+            return self.by_class.get(classes[0], [])
+        if tag:
+            return self.by_tag.get(tag, [])
+        return self.elements
+
+    def matches(self, selector: str) -> bool:
+        """Un sélecteur (complexe) correspond-il à au moins un élément ?"""
+        parts = _parse_selector(selector)
+        if parts is None:
+            # Sélecteur non reconnu: conservé par prudence
+            return True
+        _, compound = parts[-1]
+        return any(_match_from(parts, len(parts) - 1, element) for element in self._candidates(compound))
+
+
+_UNESCAPE = re.compile(r'\\(.)')
+_COMPOUND_TOKEN = re.compile(r'''
+    (?P<tag>\*|[a-zA-Z][\w-]*)
+  | \#(?P<id>(?:[\w-]|\\.)+)
+  | \.(?P<cls>(?:[\w-]|\\.)+)
+  | \[(?P<attr>[^\]]+)\]
+  | ::?(?P<pseudo>[\w-]+)(?P<arg>\((?:[^()]|\([^()]*\))*\))?
+''', re.X)
+_ATTRIBUTE = re.compile(r'''^\s*([\w:-]+)\s*(?:([~|^$*]?=)\s*("[^"]*"|'[^']*'|[^\s\]]+)\s*[iIsS]?)?\s*$''')
+
+# Compound: (tag, ids, classes, attributs (nom, opérateur, valeur), pseudo-classes)
+Compound = Tuple[Optional[str], Tuple[str, ...], Tuple[str, ...], Tuple, Tuple[str, ...]]
+
+
+def _parse_compound(text: str) -> Optional[Compound]:
+    tag, ids, classes, attrs, pseudos = None, [], [], [], []
+    position = 0
+    while position < len(text):
+        match = _COMPOUND_TOKEN.match(text, position)
+        if match is None:
+            return None
+        position = match.end()
+        if match.group('tag'):
+            if match.start() != 0:
+                return None
+            tag = None if match.group('tag') == '*' else match.group('tag').lower()
+        elif match.group('id'):
+            ids.append(_UNESCAPE.sub(r'\1', match.group('id')))
+        elif match.group('cls'):
+            classes.append(_UNESCAPE.sub(r'\1', match.group('cls')))
+        elif match.group('attr'):
+            attribute = _ATTRIBUTE.match(match.group('attr'))
+            if attribute is None:
+                return None
+            name, operator, value = attribute.groups()
+            if value and value[0] in '"\'':
+                value = value[1:-1]
+            attrs.append((name.lower(), operator, value))
+        else:
+            pseudos.append(match.group('pseudo').lower())
+    return tag, tuple(ids), tuple(classes), tuple(attrs), tuple(pseudos)
+
+
+@lru_cache(maxsize=20000)
+def _parse_selector(selector: str) -> Optional[Tuple[Tuple[Optional[str], Compound], ...]]:
+    """
+    Découpe un sélecteur complexe en compounds et combinateurs
+
+    Returns:
+        Tuple de (combinateur vers le compound précédent, compound), ou None si non reconnu
+    """
+    parts = []
+    buffer = ''
+    combinator = None
+    explicit = None
+    depth = 0
+    quote = None
+    for c in selector.strip():
+        if quote:
+            buffer += c
+            if c == quote:
+                quote = None
+            continue
+        if depth == 0 and (c.isspace() or c in '>+~'):
+            if buffer:
+                parts.append((combinator, buffer))
+                buffer = ''
+            if c in '>+~':
+                explicit = c
+            continue
+        if c in '"\'':
+            quote = c
+        elif c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        if not buffer:
+            combinator = (explicit or ' ') if parts else None
+            explicit = None
+        buffer += c
+    if not buffer:
+        return None
+    parts.append((combinator, buffer))
+
+    parsed = []
+    for combinator, text in parts:
+        compound = _parse_compound(text)
+        if compound is None:
+            return None
+        parsed.append((combinator, compound))
+    return tuple(parsed)
+
+
+def _match_attribute(element: Element, name: str, operator: Optional[str], value: Optional[str]) -> bool:
+    actual = element.attrs.get(name)
+    if actual is None:
+        return False
+    if operator is None:
+        return True
+    if operator == '=':
+        return actual == value
+    if operator == '~=':
+        return value in actual.split()
+    if operator == '|=':
+        return actual == value or actual.startswith(value + '-')
+    if operator == '^=':
+        return bool(value) and actual.startswith(value)
+    if operator == '$=':
+        return bool(value) and actual.endswith(value)
+    return bool(value) and value in actual
+
+
+def _match_compound(compound: Compound, element: Element) -> bool:
+    tag, ids, classes, attrs, pseudos = compound
+    if tag is not None and element.tag != tag:
+        return False
+    if ids and (element.id is None or any(value != element.id for value in ids)):
+        return False
+    if classes and not element.classes.issuperset(classes):
+        return False
+    for name, operator, value in attrs:
+        if not _match_attribute(element, name, operator, value):
+            return False
+    for pseudo in pseudos:
+        if pseudo in DYNAMIC_PSEUDO_CLASSES:
+            return False
+        if pseudo == 'root' and element.tag != 'html':
+            return False
+        if pseudo in ('link', 'any-link') and 'href' not in element.attrs:
+            return False
+        if pseudo in ('checked', 'disabled', 'selected') and pseudo not in element.attrs:
+            return False
+        # :not(), :nth-child(), pseudo-éléments...: on suppose la correspondance
+    return True
+
+
+def _match_from(parts, index: int, element: Element) -> bool:
+    combinator, compound = parts[index]
+    if not _match_compound(compound, element):
+        return False
+    if index == 0:
+        return True
+    parent = element.parent
+    if combinator == '>':
+        return parent is not None and _match_from(parts, index - 1, parent)
+    if combinator in ('+', '~'):
+        if parent is None:
+            return False
+        siblings = parent.children[:parent.children.index(element)]
+        if combinator == '+':
+            siblings = siblings[-1:]
+        return any(_match_from(parts, index - 1, sibling) for sibling in siblings)
+    while parent is not None:
+        if _match_from(parts, index - 1, parent):
+            return True
+        parent = parent.parent
+    return False
+
+
+def split_selector_list(prelude: str) -> List[str]:
+    """Sépare une liste de sélecteurs sur les virgules de premier niveau"""
+    selectors = []
+    depth = 0
+    quote = None
+    start = 0
+    for position, c in enumerate(prelude):
+        if quote:
+            if c == quote:
+                quote = None
+        elif c in '"\'':
+            quote = c
+        elif c in '([':
+            depth += 1
+        elif c in ')]':
+            depth -= 1
+        elif c == ',' and depth == 0:
+            selectors.append(prelude[start:position].strip())
+            start = position + 1
+    selectors.append(prelude[start:].strip())
+    return [selector for selector in selectors if selector]
+
+
+def _find_block_end(css: str, start: int) -> int:
+    """Position de l'accolade fermant le bloc ouvert juste avant start"""
+    depth = 1
+    position = start
+    n = len(css)
+    while position < n:
+        c = css[position]
+        if c == '"' or c == "'":
+            end = css.find(c, position + 1)
+            position = n if end < 0 else end + 1
+            continue
+        if c == '{':
+            depth += 1
+        elif c == '}':
+            depth -= 1
+            if depth == 0:
+                return position
+        position += 1
+    return n
+
+
+def parse_stylesheet(css: str) -> List[Tuple[str, Optional[object]]]:
+    """
+    Découpe une feuille de style (minifiée) en règles
+
+    Returns:
+        Liste de (prélude, corps): corps est une chaîne de déclarations, une liste de règles
+        pour les at-rules conditionnelles, ou None pour les at-rules sans bloc
+    """
+    rules = []
+    position = 0
+    n = len(css)
+    while position < n:
+        brace = css.find('{', position)
+        semicolon = css.find(';', position)
+        if brace < 0:
+            break
+        if 0 <= semicolon < brace and css[position:semicolon].lstrip().startswith('@'):
+            # @import, @charset...
+            rules.append((css[position:semicolon].strip(), None))
+            position = semicolon + 1
+            continue
+        end = _find_block_end(css, brace + 1)
+        prelude = css[position:brace].strip().lstrip('};').strip()
+        body = css[brace + 1:end]
+        if prelude.startswith('@') and prelude[1:].split('(')[0].split()[0].lower() in CONDITIONAL_AT_RULES:
+            rules.append((prelude, parse_stylesheet(body)))
+        else:
+            rules.append((prelude, body))
+        position = end + 1
+    return rules
+
+
+@lru_cache(maxsize=8)
+def _parsed_bundle(css: str) -> List[Tuple[str, Optional[object]]]:
+    return parse_stylesheet(minify_css(css))
+
+
+class CriticalCSSExtractor:
+    """Sélectionne les règles d'une feuille de style utiles au premier affichage d'une page"""
+
+    def __init__(self, fold_limit: int = FOLD_ELEMENT_LIMIT):
+        self.fold_limit = fold_limit
+
+    def _critical_rules(self, rules, dom: FoldDOM) -> List[str]:
+        output = []
+        for prelude, body in rules:
+            if body is None:
+                continue
+            if isinstance(body, list):
+                if prelude.lower().replace(' ', '') == '@mediaprint':
+                    continue
+                inner = self._critical_rules(body, dom)
+                if inner:
+                    output.append(prelude + '{' + ''.join(inner) + '}')
+            elif prelude.startswith('@'):
+                # Les polices sont déclarées tôt; @keyframes, @page... arrivent avec la feuille complète
+                if prelude.lower() == '@font-face':
+                    output.append(prelude + '{' + body + '}')
+            else:
+                selectors = [selector for selector in split_selector_list(prelude) if dom.matches(selector)]
+                if selectors:
+                    output.append(','.join(selectors) + '{' + body + '}')
+        return output
+
+    def extract(self, html: str, css: str) -> str:
+        """
+        Calcule le CSS critique d'une page
+
+        Args:
+            html: HTML rendu de la page
+            css: Feuille de style complète (bundle)
+
+        Returns:
+            CSS minifié limité aux règles des éléments au-dessus de la ligne de flottaison
+        """
+        dom = FoldDOM(html, self.fold_limit)
+        return ''.join(self._critical_rules(_parsed_bundle(css), dom))
+
+
+class CriticalCSSManager:
+    """CSS critique par template, mis en cache par template et hash du bundle"""
+
+    def __init__(self, optimizer: AssetOptimizer = asset_optimizer, extractor: Optional[CriticalCSSExtractor] = None):
+        self.optimizer = optimizer
+        self.extractor = extractor or CriticalCSSExtractor()
+        self._cache: Dict[Tuple[str, str], str] = {}
+        self._lock = threading.Lock()
+
+    @property
+    def directory(self) -> Path:
+        return Path(self.optimizer.static_folder) / DIST_DIRNAME / CRITICAL_DIRNAME
+
+    @staticmethod
+    def _template_key(template: str) -> str:
+        return re.sub(r'[^\w.-]', '_', template)
+
+    def _path(self, template: str, bundle_hash: str) -> Path:
+        return self.directory / f"{self._template_key(template)}.{bundle_hash}.css"
+
+    def bundle_css(self, bundle_name: str) -> str:
+        """Contenu du bundle construit, ou de ses sources minifiées à défaut de build"""
+        entry = self.optimizer.manifest.get(bundle_name)
+        if entry is not None:
+            return (Path(self.optimizer.static_folder) / entry['file']).read_text(encoding='utf-8')
+        return '\n'.join(
+            minify_css((Path(self.optimizer.static_folder) / source).read_text(encoding='utf-8'))
+            for source in self.optimizer.asset_paths(bundle_name)
+        )
+
+    def get(self, template: str, bundle_name: str) -> Optional[str]:
+        """CSS critique en cache pour un template (None s'il reste à calculer)"""
+        entry = self.optimizer.manifest.get(bundle_name)
+        if entry is None:
+            return None
+        key = (template, entry['hash'])
+        css = self._cache.get(key)
+        if css is None:
+            try:
+                css = self._path(template, entry['hash']).read_text(encoding='utf-8')
+            except OSError:
+                return None
+            self._cache[key] = css
+        return css
+
+    def generate(self, template: str, bundle_name: str, html: str) -> Optional[str]:
+        """
+        Calcule et met en cache le CSS critique d'un template à partir de son HTML rendu
+
+        Returns:
+            CSS critique, ou None si le bundle n'est pas construit
+        """
+        entry = self.optimizer.manifest.get(bundle_name)
+        if entry is None:
+            return None
+        css = self.extractor.extract(html, self.bundle_css(bundle_name))
+
+        path = self._path(template, entry['hash'])
+        with self._lock:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            tmp_path = path.with_name(f".{path.name}.tmp")
+            tmp_path.write_text(css, encoding='utf-8')
+            os.replace(tmp_path, path)
+            # Versions calculées pour les builds précédents
+            for stale in self.directory.glob(f"{self._template_key(template)}.*.css"):
+                if stale != path:
+                    stale.unlink(missing_ok=True)
+            self._cache[(template, entry['hash'])] = css
+        logger.info(f"Critical CSS generated for {template} ({len(css)} bytes)")
+        return css
+
+    def styles(self, bundle_name: str) -> Markup:
+        """
+        Helper Jinja: CSS critique en ligne et bundle chargé sans bloquer le rendu
+
+        Au premier rendu d'un template (ou sans build), le bundle est inclus normalement
+        et le CSS critique est calculé après la réponse (voir init_critical_css).
+        """
+        template = g.get('critical_template')
+        entry = self.optimizer.manifest.get(bundle_name)
+        if not CRITICAL_CSS_ENABLED or template is None or entry is None:
+            return self.optimizer.asset_tags(bundle_name)
+
+        css = self.get(template, bundle_name)
+        if css is None:
+            g.critical_pending = (template, bundle_name)
+            return self.optimizer.asset_tags(bundle_name)
+
+        url = escape(url_for('static', filename=entry['file']))
+        # "</" ne peut apparaître que dans une chaîne CSS, où "\/" vaut "/"
+        inline_css = css.replace('</', '<\\/')
+        return Markup(
+            f'<style>{inline_css}</style>\n'
+            f'    <link rel="preload" href="{url}" as="style" onload="this.onload=null;this.rel=\'stylesheet\'">\n'
+            f'    <noscript><link rel="stylesheet" href="{url}"></noscript>'
+        )
+
+
+critical_css_manager = CriticalCSSManager()
+
+
+def init_critical_css(app, manager: Optional[CriticalCSSManager] = None) -> None:
+    """Enregistre le helper Jinja critical_styles et le calcul au premier rendu des templates"""
+    manager = manager or critical_css_manager
+
+    def remember_template(sender, template, context, **extra):
+        # Template de la page (les includes/imports ne déclenchent pas le signal)
+        if 'critical_template' not in g:
+            g.critical_template = template.name
+
+    before_render_template.connect(remember_template, app, weak=False)
+    app.add_template_global(manager.styles, 'critical_styles')
+
+    @app.after_request
+    def generate_critical_css(response):
+        pending = g.pop('critical_pending', None)
+        if pending and response.status_code == 200 and response.mimetype == 'text/html' \
+                and not response.direct_passthrough:
+            try:
+                manager.generate(*pending, response.get_data(as_text=True))
+            except Exception as e:
+                logger.warning(f"Critical CSS generation failed for {pending[0]}: {e}")
+        return response
@@ -5,12 +5,20 @@ Gestion des données personnelles, droits des utilisateurs et conformité régle
 
 import json
 import datetime
-from typing import Dict, List, Any, Optional
+import logging
+import threading
+from concurrent.futures import Future, ThreadPoolExecutor
+from typing import Dict, Iterator, List, Any, Optional
 from flask import request, current_app
 from sqlalchemy import Column, Integer, String, DateTime, Text, Boolean
 from sqlalchemy.dialects.postgresql import JSONB
 from sqlalchemy.orm import DeclarativeBase
 from flask_sqlalchemy import SQLAlchemy
+from models import db, User
+from audit_trail import audit_action, AuditAction, AuditSeverity
+from gdpr_export import EXPORT_DIR, EXPORT_FORMATS, gdpr_exporter
+
+logger = logging.getLogger(__name__)
 
 class DataProcessingPurpose:
     """Finalités de traitement des données personnelles"""
@@ -26,7 +34,7 @@ class GDPRRequest(db.Model):
     __tablename__ = 'gdpr_request'
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = Column(String, db.ForeignKey('users.id'), nullable=False)
     request_type = Column(String(50), nullable=False)  # access, rectification, erasure, portability, restriction
     status = Column(String(20), default='pending', nullable=False)  # pending, processing, completed, rejected
     
@@ -56,7 +64,7 @@ class ConsentRecord(db.Model):
     __tablename__ = 'consent_record'
     
     id = Column(Integer, primary_key=True)
-    user_id = Column(Integer, db.ForeignKey('user.id'), nullable=False)
+    user_id = Column(String, db.ForeignKey('users.id'), nullable=False)
     
     # Type de consentement
     purpose = Column(String(50), nullable=False)
@@ -96,6 +104,8 @@ class GDPRCompliance:
     
     def __init__(self, app=None):
         self.app = app
+        self._executor = None
+        self._executor_lock = threading.Lock()
         if app is not None:
             self.init_app(app)
     
@@ -106,9 +116,15 @@ class GDPRCompliance:
         app.config.setdefault('GDPR_RESPONSE_DELAY_DAYS', 30)
         app.config.setdefault('GDPR_DATA_RETENTION_DEFAULT', 365)
         
-        # Initialiser les politiques de rétention par défaut
+        self.app = app
+        
+        # Initialiser les politiques de rétention par défaut (tables créées par add_gdpr_tables)
         with app.app_context():
-            self._initialize_retention_policies()
+            try:
+                self._initialize_retention_policies()
+            except Exception as e:
+                db.session.rollback()
+                logger.warning(f"GDPR retention policies not initialized: {e}")
     
     def _initialize_retention_policies(self):
         """Initialise les politiques de rétention par défaut"""
@@ -252,78 +268,130 @@ class GDPRCompliance:
         
         return gdpr_request
     
-    def process_data_access_request(self, user_id: int) -> Dict[str, Any]:
-        """Traite une demande d'accès aux données (Article 15 GDPR)"""
-        user = User.query.get(user_id)
-        if not user:
-            return None
-        
-        # Collecter toutes les données personnelles
-        user_data = {
-            "personal_info": {
-                "id": user.id,
-                "username": user.username,
-                "email": user.email,
-                "created_at": user.created_at.isoformat() if user.created_at else None,
-                "last_login": user.last_login.isoformat() if hasattr(user, 'last_login') and user.last_login else None
-            },
-            "consents": self._get_consent_history(user_id),
-            "gdpr_requests": self._get_gdpr_request_history(user_id),
+    def _personal_info(self, user) -> Dict[str, Any]:
+        return {
+            "id": user.id,
+            "username": user.username,
+            "email": user.email,
+            "created_at": user.created_at.isoformat() if getattr(user, 'created_at', None) else None,
+            "last_login": user.last_login.isoformat() if getattr(user, 'last_login', None) else None
+        }
+    
+    def _access_header(self, user) -> Dict[str, Any]:
+        """Sections de l'export d'accès précédant les données métier"""
+        return {
+            "export_date": datetime.datetime.utcnow().isoformat(),
+            "gdpr_article": "Article 15 - Right of access",
+            "personal_info": self._personal_info(user),
+            "consents": self._get_consent_history(user.id),
+            "gdpr_requests": self._get_gdpr_request_history(user.id),
             "processing_purposes": self._get_processing_purposes(),
             "data_retention": self._get_retention_info(),
             "third_party_sharing": self._get_third_party_info()
         }
+    
+    def _portability_header(self, user) -> Dict[str, Any]:
+        """Sections de l'export de portabilité (données fournies par l'utilisateur)"""
+        return {
+            "export_date": datetime.datetime.utcnow().isoformat(),
+            "gdpr_article": "Article 20 - Right to data portability",
+            "account": self._personal_info(user),
+            "consents": self._get_consent_history(user.id)
+        }
+    
+    def process_data_access_request(self, user_id, export_format: str = 'json',
+                                    counts: Optional[Dict[str, int]] = None) -> Optional[Iterator]:
+        """
+        Traite une demande d'accès aux données (Article 15 GDPR)
         
-        # Ajouter les données métier si disponibles
-        try:
-            from models import Customer, Campaign, Product
-            
-            # Clients/personas
-            customers = Customer.query.filter_by(owner_id=user_id).all()
-            user_data["customers"] = [
-                {
-                    "id": c.id,
-                    "name": c.name,
-                    "created_at": c.created_at.isoformat() if c.created_at else None
-                } for c in customers
-            ]
-            
-            # Campagnes
-            campaigns = Campaign.query.filter_by(owner_id=user_id).all()
-            user_data["campaigns"] = [
-                {
-                    "id": c.id,
-                    "title": c.title,
-                    "created_at": c.created_at.isoformat() if c.created_at else None
-                } for c in campaigns
-            ]
+        Les données sont produites en flux (pages keyset), sans être chargées en mémoire.
+        
+        Args:
+            user_id: Utilisateur concerné
+            export_format: 'json' (document unique) ou 'ndjson.zip' (un fichier par entité)
+            counts: Dictionnaire complété avec le nombre de lignes exportées par entité
             
-        except Exception:
-            pass  # Ignorer si les modèles n'existent pas
+        Returns:
+            Itérateur de fragments de l'export, ou None si l'utilisateur n'existe pas
+        """
+        user = User.query.get(user_id)
+        if not user:
+            return None
+        return gdpr_exporter.stream(user, self._access_header(user), export_format, counts=counts)
+    
+    def process_data_portability_request(self, user_id, export_format: str = 'json',
+                                         counts: Optional[Dict[str, int]] = None) -> Optional[Iterator]:
+        """
+        Traite une demande de portabilité des données (Article 20 GDPR)
+        
+        Seules les données fournies ou créées par l'utilisateur sont exportées (ni métriques,
+        ni journaux d'activité ou d'audit).
         
-        return user_data
+        Returns:
+            Itérateur de fragments de l'export, ou None si l'utilisateur n'existe pas
+        """
+        user = User.query.get(user_id)
+        if not user:
+            return None
+        return gdpr_exporter.stream(user, self._portability_header(user), export_format, portable=True,
+                                    counts=counts)
     
-    def process_data_portability_request(self, user_id: int) -> Dict[str, Any]:
-        """Traite une demande de portabilité des données (Article 20 GDPR)"""
-        # Récupérer uniquement les données fournies par l'utilisateur
-        user_data = self.process_data_access_request(user_id)
+    def build_export_archive(self, request_id: int, export_format: str = 'ndjson.zip') -> Optional[Dict[str, Any]]:
+        """
+        Construit l'archive d'une demande d'accès ou de portabilité et la rattache à la demande
         
-        # Filtrer pour ne garder que les données "portables"
-        portable_data = {
-            "export_date": datetime.datetime.utcnow().isoformat(),
-            "user_provided_data": {
-                "account": user_data.get("personal_info", {}),
-                "consents": user_data.get("consents", {}),
-                "created_content": {
-                    "customers": user_data.get("customers", []),
-                    "campaigns": user_data.get("campaigns", [])
-                }
-            },
-            "format": "JSON",
-            "gdpr_article": "Article 20 - Right to data portability"
-        }
+        Returns:
+            Résumé de l'archive (fichier, taille, lignes par entité), None si la demande n'existe pas
+        """
+        gdpr_request = GDPRRequest.query.get(request_id)
+        if not gdpr_request:
+            return None
+        user = User.query.get(gdpr_request.user_id)
+        if not user:
+            gdpr_request.status = 'rejected'
+            gdpr_request.rejection_reason = "Utilisateur introuvable"
+            db.session.commit()
+            return None
+        
+        portable = gdpr_request.request_type == 'portability'
+        header = self._portability_header(user) if portable else self._access_header(user)
+        timestamp = datetime.datetime.utcnow().strftime('%Y%m%d_%H%M%S')
+        path = EXPORT_DIR / f"gdpr_{gdpr_request.request_type}_{request_id}_{timestamp}.{export_format}"
+        
+        gdpr_request.status = 'processing'
+        gdpr_request.processed_at = datetime.datetime.utcnow()
+        db.session.commit()
+        try:
+            summary = gdpr_exporter.write_archive(path, user, header, export_format, portable=portable)
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"GDPR export for request {request_id} failed: {e}")
+            gdpr_request.status = 'pending'
+            gdpr_request.response_data = {"error": str(e)}
+            db.session.commit()
+            raise
         
-        return portable_data
+        gdpr_request.response_file_path = summary['file']
+        gdpr_request.response_data = summary
+        gdpr_request.status = 'completed'
+        gdpr_request.completed_at = datetime.datetime.utcnow()
+        db.session.commit()
+        return summary
+    
+    def _build_in_background(self, app, request_id: int, export_format: str) -> Optional[Dict[str, Any]]:
+        with app.app_context():
+            return self.build_export_archive(request_id, export_format)
+    
+    def submit_export_archive(self, request_id: int, export_format: str = 'ndjson.zip') -> Future:
+        """Construit l'archive d'une demande en arrière-plan (un export à la fois)"""
+        if export_format not in EXPORT_FORMATS:
+            raise ValueError(f"Unsupported export format: {export_format}")
+        if self._executor is None:
+            with self._executor_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='gdpr-export')
+        app = self.app or current_app._get_current_object()
+        return self._executor.submit(self._build_in_background, app, request_id, export_format)
     
     def process_erasure_request(self, user_id: int, specific_data: List[str] = None) -> Dict[str, Any]:
         """Traite une demande d'effacement (Article 17 GDPR)"""
@@ -0,0 +1,225 @@
+"""
+Export GDPR en flux (droit d'accès, article 15, et portabilité, article 20)
+
+Les entités d'un utilisateur (boutiques, clients, personas, campagnes, produits, images,
+métriques, activités, journal d'audit) sont lues par pages en keyset (id > dernier id) et
+sérialisées au fil de l'eau: la mémoire utilisée dépend de la taille d'une page, pas du
+volume de données de l'utilisateur.
+
+Deux formats:
+- 'json': un document JSON unique produit par morceaux (réponse HTTP chunked)
+- 'ndjson.zip': une archive ZIP écrite en flux, un fichier NDJSON par entité plus
+  account.json (informations du compte) et manifest.json (nombre de lignes par entité)
+"""
+import json
+import logging
+import os
+import zipfile
+from datetime import date, datetime
+from decimal import Decimal
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, NamedTuple, Optional
+
+from sqlalchemy import Table, or_, select
+
+from models import (
+    db, Boutique, Campaign, Customer, CustomerPersona, Metric, NicheMarket, Product, StoredImage, UserActivity
+)
+
+logger = logging.getLogger(__name__)
+
+# Lignes lues par requête (mémoire bornée par page)
+EXPORT_PAGE_SIZE = int(os.environ.get("GDPR_EXPORT_PAGE_SIZE", "500"))
+# Répertoire des archives construites en arrière-plan
+EXPORT_DIR = Path(os.environ.get("GDPR_EXPORT_DIR", "exports/gdpr"))
+
+EXPORT_FORMATS = {'json': 'application/json', 'ndjson.zip': 'application/zip'}
+
+
+class ExportEntity(NamedTuple):
+    """Entité exportée: table, condition d'appartenance à l'utilisateur, portabilité (article 20)"""
+    name: str
+    table: Table
+    condition: Any
+    portable: bool
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, Decimal):
+        return float(value)
+    if isinstance(value, (bytes, memoryview)):
+        return bytes(value).hex()
+    return str(value)
+
+
+def dumps(value) -> str:
+    return json.dumps(value, ensure_ascii=False, default=_json_default)
+
+
+class _ZipStream:
+    """Sortie non seekable de zipfile: les octets écrits sont récupérés par drain()"""
+
+    def __init__(self):
+        self._chunks: List[bytes] = []
+
+    def write(self, data) -> int:
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def flush(self) -> None:
+        pass
+
+    def drain(self) -> bytes:
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+
+class GDPRDataExporter:
+    """Export en flux des données personnelles d'un utilisateur"""
+
+    def __init__(self, page_size: int = EXPORT_PAGE_SIZE):
+        self.page_size = page_size
+
+    def entities(self, user) -> List[ExportEntity]:
+        """Entités appartenant à l'utilisateur, dans l'ordre de l'export"""
+        boutiques = select(Boutique.id).where(Boutique.owner_id == user.id)
+        niches = select(NicheMarket.id).where(NicheMarket.owner_id == user.id)
+        personas = select(CustomerPersona.id).where(CustomerPersona.owner_id == user.id)
+
+        entities = [
+            ExportEntity('boutiques', Boutique.__table__, Boutique.owner_id == user.id, True),
+            ExportEntity('niche_markets', NicheMarket.__table__, NicheMarket.owner_id == user.id, True),
+            ExportEntity('customers', Customer.__table__,
+                         or_(Customer.boutique_id.in_(boutiques), Customer.niche_market_id.in_(niches)), True),
+            ExportEntity('personas', CustomerPersona.__table__, CustomerPersona.owner_id == user.id, True),
+            ExportEntity('campaigns', Campaign.__table__,
+                         or_(Campaign.boutique_id.in_(boutiques), Campaign.persona_id.in_(personas)), True),
+            ExportEntity('products', Product.__table__, Product.boutique_id.in_(boutiques), True),
+            ExportEntity('images', StoredImage.__table__, StoredImage.user_id == user.id, True),
+            ExportEntity('metrics', Metric.__table__, Metric.user_id == str(user.id), False),
+            ExportEntity('activities', UserActivity.__table__, UserActivity.user_id == user.id, False),
+        ]
+
+        # Journal d'audit (audit_trail): identifiant numérique ou nom d'utilisateur
+        audit_log = db.metadata.tables.get('audit_log')
+        if audit_log is not None:
+            conditions = []
+            if getattr(user, 'numeric_id', None) is not None:
+                conditions.append(audit_log.c.user_id == user.numeric_id)
+            if getattr(user, 'username', None):
+                conditions.append(audit_log.c.username == user.username)
+            if conditions:
+                entities.append(ExportEntity('audit_logs', audit_log, or_(*conditions), False))
+        return entities
+
+    def _selected(self, user, portable: bool) -> List[ExportEntity]:
+        return [entity for entity in self.entities(user) if entity.portable or not portable]
+
+    def iter_pages(self, entity: ExportEntity) -> Iterator[List[Dict]]:
+        """Lignes de l'entité par pages keyset (ordre des ids)"""
+        id_column = entity.table.c.id
+        last_id = None
+        while True:
+            query = select(entity.table).where(entity.condition)
+            if last_id is not None:
+                query = query.where(id_column > last_id)
+            rows = db.session.execute(query.order_by(id_column).limit(self.page_size)).mappings().all()
+            if not rows:
+                return
+            yield [dict(row) for row in rows]
+            if len(rows) < self.page_size:
+                return
+            last_id = rows[-1]['id']
+
+    def stream_json(self, user, header: Dict[str, Any], portable: bool = False,
+                    counts: Optional[Dict[str, int]] = None) -> Iterator[str]:
+        """
+        Document JSON produit par morceaux: les sections de l'en-tête puis une liste par entité
+
+        Args:
+            user: Utilisateur exporté
+            header: Sections de petite taille (compte, consentements, finalités...)
+            portable: Limite l'export aux données fournies par l'utilisateur (article 20)
+            counts: Dictionnaire complété avec le nombre de lignes exportées par entité
+
+        Returns:
+            Itérateur de fragments JSON
+        """
+        counts = {} if counts is None else counts
+        yield '{' + dumps(header)[1:-1]
+        separator = ', ' if header else ''
+        for entity in self._selected(user, portable):
+            yield f'{separator}{dumps(entity.name)}: ['
+            separator = ', '
+            total = 0
+            for page in self.iter_pages(entity):
+                yield (',\n' if total else '\n') + ',\n'.join(dumps(row) for row in page)
+                total += len(page)
+            counts[entity.name] = total
+            yield '\n]'
+        yield '}'
+
+    def stream_ndjson_zip(self, user, header: Dict[str, Any], portable: bool = False,
+                          counts: Optional[Dict[str, int]] = None) -> Iterator[bytes]:
+        """
+        Archive ZIP produite par morceaux: account.json, un NDJSON par entité, manifest.json
+
+        L'archive est écrite sans retour en arrière (descripteurs de données ZIP): chaque page
+        compressée est émise immédiatement.
+
+        Returns:
+            Itérateur d'octets de l'archive
+        """
+        counts = {} if counts is None else counts
+        stream = _ZipStream()
+        with zipfile.ZipFile(stream, 'w', compression=zipfile.ZIP_DEFLATED) as archive:
+            archive.writestr('account.json', json.dumps(header, ensure_ascii=False, indent=2, default=_json_default))
+            yield stream.drain()
+            for entity in self._selected(user, portable):
+                total = 0
+                with archive.open(f'{entity.name}.ndjson', 'w', force_zip64=True) as member:
+                    for page in self.iter_pages(entity):
+                        member.write(''.join(dumps(row) + '\n' for row in page).encode('utf-8'))
+                        total += len(page)
+                        yield stream.drain()
+                counts[entity.name] = total
+                yield stream.drain()
+            archive.writestr('manifest.json', json.dumps({'entities': counts}, indent=2))
+        yield stream.drain()
+
+    def stream(self, user, header: Dict[str, Any], export_format: str = 'json', portable: bool = False,
+               counts: Optional[Dict[str, int]] = None) -> Iterator:
+        """Flux de l'export au format demandé ('json' ou 'ndjson.zip')"""
+        if export_format == 'json':
+            return self.stream_json(user, header, portable, counts)
+        if export_format == 'ndjson.zip':
+            return self.stream_ndjson_zip(user, header, portable, counts)
+        raise ValueError(f"Unsupported export format: {export_format}")
+
+    def write_archive(self, path: Path, user, header: Dict[str, Any], export_format: str = 'ndjson.zip',
+                      portable: bool = False) -> Dict[str, Any]:
+        """
+        Écrit l'export dans un fichier (renommé atomiquement une fois complet)
+
+        Returns:
+            Résumé {file, format, size, entities}
+        """
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(f".{path.name}.partial")
+        counts: Dict[str, int] = {}
+        try:
+            with open(partial, 'wb') as f:
+                for chunk in self.stream(user, header, export_format, portable, counts):
+                    f.write(chunk.encode('utf-8') if isinstance(chunk, str) else chunk)
+            os.replace(partial, path)
+        finally:
+            partial.unlink(missing_ok=True)
+        summary = {'file': str(path), 'format': export_format, 'size': path.stat().st_size, 'entities': counts}
+        logger.info(f"GDPR export written to {path} ({summary['size']} bytes, {sum(counts.values())} rows)")
+        return summary
+
+
+gdpr_exporter = GDPRDataExporter()
@@ -5,9 +5,11 @@ Interface utilisateur pour les droits GDPR et gestion des données personnelles
 
 import json
 import datetime
-from flask import Blueprint, render_template, request, redirect, url_for, flash, jsonify, send_file
+from flask import (Blueprint, Response, abort, render_template, request, redirect, url_for, flash, jsonify, send_file,
+                   stream_with_context)
 from flask_login import login_required, current_user
 from gdpr_compliance import gdpr_compliance, GDPRRequest, ConsentRecord, DataProcessingPurpose
+from gdpr_export import EXPORT_FORMATS
 from models import db
 import tempfile
 import os
@@ -118,32 +120,39 @@ def request_data_erasure():
 @gdpr_bp.route('/download-my-data')
 @login_required
 def download_my_data():
-    """Téléchargement immédiat des données utilisateur"""
-    try:
-        user_data = gdpr_compliance.process_data_access_request(current_user.id)
-        
-        # Créer un fichier temporaire
-        temp_file = tempfile.NamedTemporaryFile(mode='w', suffix='.json', delete=False)
-        json.dump(user_data, temp_file, indent=2, ensure_ascii=False, default=str)
-        temp_file.close()
-        
-        filename = f"ninjaleads_data_{current_user.username}_{datetime.datetime.now().strftime('%Y%m%d')}.json"
-        
-        def remove_file(response):
-            try:
-                os.unlink(temp_file.name)
-            except Exception:
-                pass
-            return response
-        
-        return send_file(temp_file.name, 
-                        as_attachment=True, 
-                        download_name=filename,
-                        mimetype='application/json')
+    """Téléchargement immédiat des données utilisateur (réponse en flux)"""
+    export_format = request.args.get('format', 'json')
+    if export_format not in EXPORT_FORMATS:
+        abort(400)
     
-    except Exception as e:
+    stream = gdpr_compliance.process_data_access_request(current_user.id, export_format)
+    if stream is None:
         flash('Erreur lors de la génération du fichier de données', 'error')
         return redirect(url_for('gdpr.privacy_dashboard'))
+    
+    filename = f"ninjaleads_data_{current_user.username}_{datetime.datetime.now().strftime('%Y%m%d')}.{export_format}"
+    return Response(stream_with_context(stream),
+                    mimetype=EXPORT_FORMATS[export_format],
+                    headers={'Content-Disposition': f'attachment; filename="{filename}"',
+                             'Cache-Control': 'no-store'})
+
+@gdpr_bp.route('/exports/<int:request_id>')
+@login_required
+def download_export(request_id):
+    """Téléchargement de l'archive construite pour une demande d'accès ou de portabilité"""
+    gdpr_request = GDPRRequest.query.get_or_404(request_id)
+    is_admin = getattr(current_user, 'is_admin', False)
+    if gdpr_request.user_id != current_user.id and not is_admin:
+        abort(403)
+    if gdpr_request.status != 'completed' or not gdpr_request.response_file_path \
+            or not os.path.exists(gdpr_request.response_file_path):
+        abort(404)
+    
+    export_format = (gdpr_request.response_data or {}).get('format', 'ndjson.zip')
+    return send_file(os.path.abspath(gdpr_request.response_file_path),
+                     as_attachment=True,
+                     download_name=os.path.basename(gdpr_request.response_file_path),
+                     mimetype=EXPORT_FORMATS.get(export_format, 'application/octet-stream'))
 
 @gdpr_bp.route('/privacy-policy')
 def privacy_policy():
@@ -225,13 +234,14 @@ def admin_process_request(request_id):
         gdpr_request.processed_at = datetime.datetime.utcnow()
         
         # Traiter selon le type de demande
-        if gdpr_request.request_type == 'access':
-            user_data = gdpr_compliance.process_data_access_request(gdpr_request.user_id)
-            gdpr_request.response_data = user_data
-        
-        elif gdpr_request.request_type == 'portability':
-            portable_data = gdpr_compliance.process_data_portability_request(gdpr_request.user_id)
-            gdpr_request.response_data = portable_data
+        if gdpr_request.request_type in ('access', 'portability'):
+            # Archive construite en arrière-plan, la demande passe à 'completed' une fois écrite
+            db.session.commit()
+            export_format = request.form.get('format', 'ndjson.zip')
+            gdpr_compliance.submit_export_archive(gdpr_request.id,
+                                                  export_format if export_format in EXPORT_FORMATS else 'ndjson.zip')
+            flash('Export GDPR en cours de génération', 'success')
+            return redirect(url_for('gdpr.admin_gdpr_requests'))
         
         elif gdpr_request.request_type == 'erasure':
             specific_data = gdpr_request.specific_data.get('specific_data', []) if gdpr_request.specific_data else []
@@ -102,57 +102,65 @@ def assign_persona(customer_id, persona_id, is_primary=True, relevance_score=Non
     return association
 
 def generate_personas_for_niches():
-    """Génère des personas pour chaque niche de marché"""
+    """Génère des personas pour chaque niche de marché (insertion en lot)"""
+    from bulk_ingest import bulk_insert_personas, bulk_assign_personas
+
     with app.app_context():
         # Récupérer toutes les niches
         niches = NicheMarket.query.all()
         print(f"Génération de personas pour {len(niches)} niches de marché")
-        
+
+        persona_dicts = []
         for niche in niches:
-            print(f"Traitement de la niche: {niche.name}")
-            
             # Créer un persona générique pour cette niche
-            title = f"Client idéal pour {niche.name}"
-            description = f"Persona représentant le client idéal pour la niche {niche.name}."
-            
-            # Attributs spécifiques à la niche
             characteristics = niche.get_characteristics_list()
-            
-            try:
-                persona = create_persona(
-                    title=title,
-                    description=description,
-                    niche_market_id=niche.id,
-                    additional_data={
-                        'interests': characteristics,
-                        'niche_specific_attributes': {
-                            'niche_name': niche.name,
-                            'key_characteristics': characteristics
-                        }
-                    }
-                )
-                
-                print(f"Persona créé: {persona.title} (ID: {persona.id})")
-                
-                # Associer ce persona à quelques clients de cette niche
-                customers = Customer.query.filter_by(niche_market_id=niche.id).limit(3).all()
-                for customer in customers:
-                    try:
-                        assign_persona(
-                            customer_id=customer.id,
-                            persona_id=persona.id,
-                            is_primary=True,
-                            notes=f"Persona générique pour la niche {niche.name}"
-                        )
-                        print(f"Persona assigné au client: {customer.name}")
-                    except Exception as e:
-                        print(f"Erreur lors de l'assignation du persona au client {customer.id}: {e}")
-                        db.session.rollback()
-                
-            except Exception as e:
-                print(f"Erreur lors de la création du persona pour la niche {niche.id}: {e}")
-                db.session.rollback()
-        
+            persona_data = {
+                'title': f"Client idéal pour {niche.name}",
+                'description': f"Persona représentant le client idéal pour la niche {niche.name}.",
+                'primary_goal': "Trouver des produits de qualité et adaptés à ses besoins",
+                'pain_points': "Difficulté à trouver des produits authentiques et de qualité",
+                'buying_triggers': "Recommandations, avis positifs, offres spéciales",
+                'values': ["qualité", "authenticité", "durabilité"],
+                'lifestyle': "Mode de vie actif, intérêt pour les nouvelles tendances",
+                # Attributs spécifiques à la niche
+                'interests': characteristics,
+                'niche_specific_attributes': {
+                    'niche_name': niche.name,
+                    'key_characteristics': characteristics
+                },
+                'niche_market_id': niche.id
+            }
+            persona_dicts.append(persona_data)
+
+        try:
+            result = bulk_insert_personas(persona_dicts)
+        except Exception as e:
+            print(f"Erreur lors de la création des personas de niche: {e}")
+            return
+
+        print(f"{result['inserted']} personas créés ({result['duplicates']} déjà existants)")
+
+        # Associer chaque persona à quelques clients de sa niche
+        associations = []
+        for niche, persona_id in zip(niches, result['persona_ids']):
+            customer_ids = [
+                row.id for row in
+                db.session.query(Customer.id).filter_by(niche_market_id=niche.id).limit(3).all()
+            ]
+            associations.extend({
+                'customer_id': customer_id,
+                'persona_id': persona_id,
+                'is_primary': True,
+                'relevance_score': 1.0,
+                'notes': f"Persona générique pour la niche {niche.name}"
+            } for customer_id in customer_ids)
+
+        try:
+            assigned = bulk_assign_personas(associations)
+            print(f"Personas assignés: {assigned['inserted']} nouveaux, {assigned['updated']} mis à jour")
+        except Exception as e:
+            print(f"Erreur lors de l'assignation des personas de niche: {e}")
+
         print("Génération de personas terminée.")
 
 def generate_common_personas():
@@ -0,0 +1,313 @@
+"""
+Déduplication des images générées par empreinte perceptuelle
+
+Le hash de stockage (prompt, modèle, taille) ne reconnaît pas deux rendus quasi identiques
+issus de prompts voisins. À l'ingestion, chaque image reçoit deux empreintes de 64 bits
+(dHash: gradients horizontaux, aHash: luminance moyenne) calculées avec Pillow et NumPy.
+Une image à faible distance de Hamming d'une image déjà stockée n'est pas conservée: sa
+ligne StoredImage pointe vers le fichier de l'image canonique (canonical_id) dont le
+compteur de références (ref_count) est incrémenté. Le ramasse-miettes (image_gc) ne
+supprime un fichier partagé qu'une fois toutes ses références supprimées.
+
+La recherche utilise un index multi-tables (multi-index hashing) sur les images canoniques.
+"""
+import logging
+import os
+import threading
+from collections import defaultdict
+from typing import Dict, List, Optional, Set, Tuple
+
+import numpy as np
+from PIL import Image
+from sqlalchemy import event, func, update
+
+from app import db
+from models import StoredImage
+
+logger = logging.getLogger(__name__)
+
+# Déduplication à l'ingestion
+DEDUP_ENABLED = os.environ.get("IMAGE_DEDUP_ENABLED", "true").lower() == "true"
+
+# Distance de Hamming maximale (sur 64 bits) entre deux quasi-doublons, pour chaque empreinte
+DEDUP_MAX_DISTANCE = int(os.environ.get("IMAGE_DEDUP_MAX_DISTANCE", "4"))
+
+HASH_BITS = 64
+_SIGN_BIT = 1 << (HASH_BITS - 1)
+
+
+def _bits_to_int(bits: np.ndarray) -> int:
+    return int.from_bytes(np.packbits(bits.ravel()).tobytes(), 'big')
+
+
+def compute_perceptual_hashes(path) -> Tuple[int, int]:
+    """
+    Calcule les empreintes perceptuelles d'une image
+
+    Args:
+        path: Chemin de l'image
+
+    Returns:
+        Tuple (dhash, ahash), entiers non signés de 64 bits
+    """
+    with Image.open(path) as image:
+        # Décodage JPEG réduit: seule une vignette est nécessaire
+        image.draft('L', (64, 64))
+        gray = image.convert('L')
+
+    gradient = np.asarray(gray.resize((9, 8), Image.Resampling.BOX), dtype=np.int16)
+    mean = np.asarray(gray.resize((8, 8), Image.Resampling.BOX), dtype=np.float32)
+
+    dhash = _bits_to_int(gradient[:, 1:] > gradient[:, :-1])
+    ahash = _bits_to_int(mean > mean.mean())
+    return dhash, ahash
+
+
+def hamming_distance(a: int, b: int) -> int:
+    """Nombre de bits différents entre deux empreintes"""
+    return (a ^ b).bit_count()
+
+
+def to_signed(value: int) -> int:
+    """Empreinte non signée -> BIGINT"""
+    return value - (1 << HASH_BITS) if value & _SIGN_BIT else value
+
+
+def to_unsigned(value: int) -> int:
+    """BIGINT -> empreinte non signée"""
+    return value & ((1 << HASH_BITS) - 1)
+
+
+class MultiIndexHashTable:
+    """
+    Index d'empreintes pour la recherche par distance de Hamming
+
+    L'empreinte est découpée en max_distance + 1 segments, chacun indexé dans sa table:
+    deux empreintes à distance <= max_distance ont au moins un segment identique (principe
+    des tiroirs). Seules les empreintes partageant un segment sont comparées.
+    """
+
+    def __init__(self, max_distance: int = DEDUP_MAX_DISTANCE, bits: int = HASH_BITS):
+        self.max_distance = max_distance
+        count = max_distance + 1
+        widths = [bits // count + (1 if i < bits % count else 0) for i in range(count)]
+        self._segments = []
+        shift = bits
+        for width in widths:
+            shift -= width
+            self._segments.append((shift, (1 << width) - 1))
+        self._tables: List[Dict[int, Set[int]]] = [defaultdict(set) for _ in self._segments]
+        self._hashes: Dict[int, Tuple[int, int]] = {}
+        self._lock = threading.Lock()
+
+    def add(self, item_id: int, dhash: int, ahash: int) -> None:
+        """Indexe (ou réindexe) les empreintes d'un élément"""
+        with self._lock:
+            self._discard(item_id)
+            self._hashes[item_id] = (dhash, ahash)
+            for table, (shift, mask) in zip(self._tables, self._segments):
+                table[(dhash >> shift) & mask].add(item_id)
+
+    def remove(self, item_id: int) -> None:
+        with self._lock:
+            self._discard(item_id)
+
+    def _discard(self, item_id: int) -> None:
+        hashes = self._hashes.pop(item_id, None)
+        if hashes is None:
+            return
+        for table, (shift, mask) in zip(self._tables, self._segments):
+            key = (hashes[0] >> shift) & mask
+            bucket = table.get(key)
+            if bucket is not None:
+                bucket.discard(item_id)
+                if not bucket:
+                    del table[key]
+
+    def search(self, dhash: int, ahash: Optional[int] = None,
+               max_distance: Optional[int] = None) -> List[Tuple[int, int]]:
+        """
+        Recherche les éléments proches
+
+        Args:
+            dhash: Empreinte dHash recherchée
+            ahash: Empreinte aHash (si fournie, doit aussi être à distance <= max_distance)
+            max_distance: Distance maximale (au plus celle de l'index)
+
+        Returns:
+            Liste de tuples (distance dHash, id) triée par distance croissante
+        """
+        if max_distance is None:
+            max_distance = self.max_distance
+        if max_distance > self.max_distance:
+            raise ValueError(f"Distance maximale de l'index: {self.max_distance}")
+
+        with self._lock:
+            candidates = set()
+            for table, (shift, mask) in zip(self._tables, self._segments):
+                bucket = table.get((dhash >> shift) & mask)
+                if bucket:
+                    candidates.update(bucket)
+            hashes = [(item_id, self._hashes[item_id]) for item_id in candidates]
+
+        matches = []
+        for item_id, (candidate_dhash, candidate_ahash) in hashes:
+            distance = hamming_distance(dhash, candidate_dhash)
+            if distance > max_distance:
+                continue
+            if ahash is not None and hamming_distance(ahash, candidate_ahash) > max_distance:
+                continue
+            matches.append((distance, item_id))
+        matches.sort()
+        return matches
+
+    def __len__(self) -> int:
+        return len(self._hashes)
+
+
+class ImageDeduplicator:
+    """Retrouve les quasi-doublons parmi les images canoniques stockées"""
+
+    def __init__(self, max_distance: int = DEDUP_MAX_DISTANCE):
+        self.index = MultiIndexHashTable(max_distance)
+        self._loaded = False
+        self._load_lock = threading.Lock()
+
+    def load(self) -> int:
+        """
+        Charge les empreintes des images canoniques depuis la base
+
+        Returns:
+            Nombre d'images indexées
+        """
+        with self._load_lock:
+            rows = db.session.query(StoredImage.id, StoredImage.dhash, StoredImage.ahash).filter(
+                StoredImage.canonical_id.is_(None), StoredImage.dhash.isnot(None)
+            ).yield_per(5000)
+            for image_id, dhash, ahash in rows:
+                self.index.add(image_id, to_unsigned(dhash), to_unsigned(ahash or 0))
+            self._loaded = True
+        logger.info(f"Perceptual hash index loaded ({len(self.index)} images)")
+        return len(self.index)
+
+    def find_duplicate(self, dhash: int, ahash: int) -> Optional[StoredImage]:
+        """
+        Image canonique quasi identique à des empreintes
+
+        Args:
+            dhash: Empreinte dHash non signée
+            ahash: Empreinte aHash non signée
+
+        Returns:
+            StoredImage canonique la plus proche dont le fichier existe, ou None
+        """
+        if not self._loaded:
+            self.load()
+        for _, image_id in self.index.search(dhash, ahash):
+            canonical = db.session.get(StoredImage, image_id)
+            if canonical is not None and canonical.canonical_id is None and os.path.exists(canonical.local_path):
+                return canonical
+            # Image supprimée ou fichier disparu depuis l'indexation
+            self.index.remove(image_id)
+        return None
+
+    def similar_images(self, path, max_distance: Optional[int] = None, limit: int = 10) -> List[Dict]:
+        """
+        Images stockées visuellement proches d'un fichier (réutilisation avant une nouvelle génération)
+
+        Args:
+            path: Chemin de l'image de référence
+            max_distance: Distance de Hamming maximale
+            limit: Nombre maximum de résultats
+
+        Returns:
+            Liste de dictionnaires StoredImage.to_dict() complétés par 'distance'
+        """
+        if not self._loaded:
+            self.load()
+        dhash, ahash = compute_perceptual_hashes(path)
+        results = []
+        for distance, image_id in self.index.search(dhash, ahash, max_distance)[:limit]:
+            stored_image = db.session.get(StoredImage, image_id)
+            if stored_image is not None:
+                results.append(dict(stored_image.to_dict(), distance=distance))
+        return results
+
+    @staticmethod
+    def link(stored_image: StoredImage, canonical: StoredImage) -> None:
+        """
+        Fait pointer une image vers le fichier d'une image canonique (sans commit)
+
+        Le compteur de références de l'image canonique est incrémenté dans la même
+        transaction par un UPDATE atomique.
+        """
+        stored_image.canonical_id = canonical.id
+        stored_image.local_path = canonical.local_path
+        stored_image.filename = canonical.filename
+        stored_image.file_size = canonical.file_size
+        stored_image.content_type = canonical.content_type
+        stored_image.variants = canonical.variants
+        stored_image.dhash = canonical.dhash
+        stored_image.ahash = canonical.ahash
+        stored_image.ref_count = 0
+        db.session.execute(
+            update(StoredImage).where(StoredImage.id == canonical.id).values(
+                ref_count=func.coalesce(StoredImage.ref_count, 1) + 1
+            )
+        )
+
+    def backfill(self, batch_size: int = 500) -> int:
+        """
+        Calcule les empreintes des images stockées avant la déduplication
+
+        Les images existantes ne sont pas regroupées (leurs URLs restent valides), mais les
+        nouvelles images quasi identiques partageront leur fichier.
+
+        Args:
+            batch_size: Images traitées par transaction
+
+        Returns:
+            Nombre d'images indexées
+        """
+        hashed = 0
+        last_id = 0
+        while True:
+            images = StoredImage.query.filter(
+                StoredImage.id > last_id,
+                StoredImage.dhash.is_(None),
+                StoredImage.canonical_id.is_(None)
+            ).order_by(StoredImage.id).limit(batch_size).all()
+            if not images:
+                return hashed
+            last_id = images[-1].id
+
+            for stored_image in images:
+                if not os.path.exists(stored_image.local_path):
+                    continue
+                try:
+                    dhash, ahash = compute_perceptual_hashes(stored_image.local_path)
+                except Exception as e:
+                    logger.warning(f"Empreinte impossible pour {stored_image.filename}: {e}")
+                    continue
+                stored_image.dhash, stored_image.ahash = to_signed(dhash), to_signed(ahash)
+                self.index.add(stored_image.id, dhash, ahash)
+                hashed += 1
+            db.session.commit()
+
+    def forget(self, image_id: int) -> None:
+        """Retire une image de l'index (suppression hors ORM)"""
+        self.index.remove(image_id)
+
+
+image_deduplicator = ImageDeduplicator()
+
+
+@event.listens_for(StoredImage, 'after_insert')
+def _stored_image_inserted(mapper, connection, target):
+    if target.dhash is not None and target.canonical_id is None:
+        image_deduplicator.index.add(target.id, to_unsigned(target.dhash), to_unsigned(target.ahash or 0))
+
+
+@event.listens_for(StoredImage, 'after_delete')
+def _stored_image_deleted(mapper, connection, target):
+    image_deduplicator.forget(target.id)
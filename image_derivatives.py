@@ -0,0 +1,199 @@
+"""
+Déclinaisons responsives des images générées (miniature, taille moyenne) en WebP / AVIF
+
+Les images des fournisseurs (PNG 1024x1024) sont redimensionnées avec Pillow dans un pool
+de processus (l'encodage est coûteux en CPU et libérerait mal le GIL). Les déclinaisons sont
+enregistrées dans StoredImage.variants et servies par /images/<filename> selon le paramètre
+?w= et l'en-tête Accept.
+"""
+import logging
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Dict, Optional
+
+from PIL import Image, features
+
+logger = logging.getLogger(__name__)
+
+# Largeurs générées (pixels)
+DERIVATIVE_WIDTHS = (256, 640)
+
+# Qualité d'encodage par format
+ENCODING_OPTIONS = {
+    'webp': {'quality': 80, 'method': 4},
+    'avif': {'quality': 60, 'speed': 8},
+}
+
+MIME_TYPES = {
+    'webp': 'image/webp',
+    'avif': 'image/avif',
+}
+
+# AVIF: ~20 % plus léger que WebP mais bien plus lent à encoder, désactivé par défaut
+AVIF_ENABLED = os.environ.get("IMAGE_DERIVATIVE_AVIF", "false").lower() == "true" and features.check('avif')
+
+# Processus d'encodage
+DERIVATIVE_WORKERS = int(os.environ.get("IMAGE_DERIVATIVE_WORKERS", "2"))
+
+# Sous-dossier de stockage des déclinaisons
+DERIVATIVES_DIRNAME = "derivatives"
+
+
+def enabled_formats():
+    """Formats de déclinaison produits, du plus compact au moins compact"""
+    return ('avif', 'webp') if AVIF_ENABLED else ('webp',)
+
+
+def variant_key(width: int, image_format: str) -> str:
+    """Clé d'une déclinaison dans StoredImage.variants (ex: 'w256.webp')"""
+    return f"w{width}.{image_format}"
+
+
+def render_derivatives(source_path: str, output_dir: str, stem: str,
+                       widths=DERIVATIVE_WIDTHS, formats=('webp',)) -> Dict[str, Dict]:
+    """
+    Produit les déclinaisons d'une image (exécuté dans un processus du pool)
+
+    Une largeur supérieure ou égale à celle de l'original n'est pas générée.
+
+    Args:
+        source_path: Chemin de l'image originale
+        output_dir: Répertoire des déclinaisons
+        stem: Préfixe des noms de fichiers produits
+        widths: Largeurs cibles
+        formats: Formats cibles ('webp', 'avif')
+
+    Returns:
+        Dictionnaire {clé: {filename, width, height, file_size, content_type}}
+    """
+    variants = {}
+    output = Path(output_dir)
+    output.mkdir(parents=True, exist_ok=True)
+
+    with Image.open(source_path) as original:
+        original.load()
+        if original.mode not in ('RGB', 'RGBA'):
+            original = original.convert('RGBA' if 'transparency' in original.info else 'RGB')
+
+        # Du plus grand au plus petit: chaque réduction part de la précédente
+        current = original
+        for width in sorted(widths, reverse=True):
+            if width >= original.width:
+                continue
+            height = max(1, round(original.height * width / original.width))
+            current = current.resize((width, height), Image.LANCZOS, reducing_gap=2.0)
+            for image_format in formats:
+                key = variant_key(width, image_format)
+                filename = f"{stem}_{key.replace('.', '_')}.{image_format}"
+                target = output / filename
+                temp_target = output / f".{filename}.part"
+                current.save(temp_target, format=image_format.upper(), **ENCODING_OPTIONS[image_format])
+                os.replace(temp_target, target)
+                variants[key] = {
+                    'filename': filename,
+                    'width': width,
+                    'height': height,
+                    'file_size': target.stat().st_size,
+                    'content_type': MIME_TYPES[image_format],
+                }
+    return variants
+
+
+def select_variant(variants: Optional[Dict[str, Dict]], accept_header: Optional[str],
+                   requested_width: Optional[int]) -> Optional[Dict]:
+    """
+    Choisit la déclinaison à servir
+
+    Retient la plus petite largeur >= à la largeur demandée, dans le format le plus compact
+    accepté par le navigateur. Les déclinaisons étant plus étroites que l'original, une
+    largeur demandée qu'aucune n'atteint est servie par l'original.
+
+    Args:
+        variants: StoredImage.variants
+        accept_header: En-tête Accept de la requête
+        requested_width: Paramètre ?w= (None: pas de redimensionnement demandé)
+
+    Returns:
+        Déclinaison choisie, ou None pour servir l'original
+    """
+    if not variants or not requested_width:
+        return None
+
+    accept_header = accept_header or ''
+    by_format = {}
+    for image_format in ('avif', 'webp'):
+        if MIME_TYPES[image_format] in accept_header:
+            by_format[image_format] = sorted(
+                (variant for key, variant in variants.items()
+                 if key.startswith('w') and key.endswith(f'.{image_format}')),
+                key=lambda variant: variant['width']
+            )
+
+    # Une largeur suffisante prime sur le format
+    for candidates in by_format.values():
+        for variant in candidates:
+            if variant['width'] >= requested_width:
+                return variant
+    return None
+
+
+class DerivativeManager:
+    """Planifie la génération des déclinaisons dans un pool de processus"""
+
+    def __init__(self, workers: int = DERIVATIVE_WORKERS):
+        self.workers = workers
+        self._pool = None
+        self._lock = threading.Lock()
+
+    @property
+    def pool(self) -> ProcessPoolExecutor:
+        if self._pool is None:
+            with self._lock:
+                if self._pool is None:
+                    self._pool = ProcessPoolExecutor(max_workers=self.workers)
+        return self._pool
+
+    def ensure_variants(self, stored_image, timeout: float = 30) -> Dict[str, Dict]:
+        """
+        Génère (si nécessaire) et enregistre les déclinaisons d'une image
+
+        Args:
+            stored_image: Instance StoredImage (session ouverte)
+            timeout: Délai maximal d'encodage (secondes)
+
+        Returns:
+            StoredImage.variants à jour ({} si l'original est introuvable)
+        """
+        from app import db
+
+        formats = enabled_formats()
+        current = stored_image.variants or {}
+        if set(formats) <= set(current.get('_formats', ())):
+            return current
+
+        source = Path(stored_image.local_path)
+        if not source.exists():
+            logger.warning(f"Original introuvable pour les déclinaisons: {source}")
+            return current
+
+        output_dir = source.parent / DERIVATIVES_DIRNAME
+        variants = self.pool.submit(
+            render_derivatives, str(source), str(output_dir), source.stem, DERIVATIVE_WIDTHS, formats
+        ).result(timeout=timeout)
+        # Formats traités (une image plus petite que les largeurs cibles n'a aucune déclinaison)
+        variants['_formats'] = list(formats)
+
+        stored_image.variants = variants
+        db.session.commit()
+        logger.info(f"{len(variants) - 1} déclinaisons générées pour {stored_image.filename}")
+        return variants
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+
+derivative_manager = DerivativeManager()
@@ -0,0 +1,412 @@
+"""
+Ramasse-miettes du stockage des images générées
+
+Les images sont parcourues par lots avec une pagination par clé ((clé de tri, id) > dernier
+vu, sur les index de add_stored_image_gc_indexes.py): la mémoire reste bornée quel que soit
+le nombre de lignes et chaque lot est supprimé dans sa propre transaction (un DELETE par
+lot), les fichiers n'étant retirés du disque qu'après le commit.
+
+Règles appliquées dans l'ordre, les images is_permanent et les images canoniques encore
+partagées par des quasi-doublons (ref_count > 1) n'étant jamais supprimées:
+lignes dont le fichier a disparu, âge (created_at), inactivité (dernier accès), quota
+d'octets par utilisateur puis quota global (éviction des moins récemment utilisées),
+et enfin fichiers présents sur le disque sans ligne en base. Ces derniers sont seulement
+signalés par défaut: les anciens téléversements, servis par image_serving, n'ont pas de
+ligne (IMAGE_GC_DELETE_ORPHAN_FILES=true pour les supprimer).
+
+Les quotas mesurent les octets comme la suppression les libère: original et déclinaisons,
+rien pour un quasi-doublon (fichier de l'image canonique).
+
+En mode dry_run rien n'est supprimé: le rapport indique ce qui le serait et les octets
+récupérables.
+"""
+import logging
+import os
+import re
+import threading
+import time
+from collections import Counter, defaultdict
+from datetime import datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from sqlalchemy import bindparam, delete, func, or_, update
+
+from app import db
+from image_dedup import image_deduplicator
+from image_derivatives import DERIVATIVES_DIRNAME
+from image_serving import IMAGE_ROOT, image_access_counter, image_index
+from image_storage_manager import ALLOWED_CONTENT_TYPES
+from models import StoredImage
+
+logger = logging.getLogger(__name__)
+
+# Lignes lues (et supprimées) par transaction
+GC_CHUNK_SIZE = int(os.environ.get("IMAGE_GC_CHUNK_SIZE", "1000"))
+
+# Suppression des fichiers sans ligne en base (false: ils sont seulement signalés)
+DELETE_ORPHAN_FILES = os.environ.get("IMAGE_GC_DELETE_ORPHAN_FILES", "false").lower() == "true"
+
+# Un fichier plus récent n'est jamais considéré comme orphelin (téléchargement en cours)
+ORPHAN_GRACE_SECONDS = int(os.environ.get("IMAGE_GC_ORPHAN_GRACE_SECONDS", "3600"))
+
+# Motifs de suppression, dans l'ordre d'application
+GC_REASONS = ('missing_file', 'age', 'idle', 'user_quota', 'global_quota', 'orphan_file')
+
+# Extensions possibles d'une image stockée (voir sniff_image_extension)
+IMAGE_EXTENSIONS = tuple(sorted(set(ALLOWED_CONTENT_TYPES.values())))
+
+# Nom d'une déclinaison: <stem>_w<largeur>_<format>.<format> (voir render_derivatives)
+DERIVATIVE_NAME_PATTERN = re.compile(r'^(?P<stem>.+)_w\d+_[a-z0-9]+\.[a-z0-9]+$')
+
+# Dernier usage d'une image: dernier accès, ou création si elle n'a jamais été servie
+LAST_USED = func.coalesce(StoredImage.last_accessed, StoredImage.created_at)
+
+_SIZE_COLUMNS = (StoredImage.user_id, StoredImage.file_size, StoredImage.variants, StoredImage.canonical_id)
+
+_GC_COLUMNS = (
+    StoredImage.id,
+    StoredImage.filename,
+    StoredImage.local_path,
+    StoredImage.file_size,
+    StoredImage.variants,
+    StoredImage.user_id,
+    StoredImage.canonical_id,
+)
+
+# Une image canonique encore référencée par des quasi-doublons n'est pas supprimable (voir image_dedup)
+_RECLAIMABLE = func.coalesce(StoredImage.ref_count, 1) <= 1
+
+
+def _env_bytes(name: str) -> Optional[int]:
+    """Quota en mégaoctets lu dans l'environnement (None si absent ou nul)"""
+    value = float(os.environ.get(name, "0") or 0)
+    return int(value * 1024 * 1024) if value > 0 else None
+
+
+class ImageGCPolicy:
+    """Règles du ramasse-miettes (None: règle désactivée)"""
+
+    def __init__(self, max_age_days: Optional[float] = None, idle_days: Optional[float] = None,
+                 user_quota_bytes: Optional[int] = None, global_quota_bytes: Optional[int] = None,
+                 reconcile_orphans: bool = True, delete_orphan_files: bool = DELETE_ORPHAN_FILES):
+        """
+        Args:
+            max_age_days: Supprimer les images créées il y a plus de N jours
+            idle_days: Supprimer les images non servies depuis N jours
+            user_quota_bytes: Octets maximum par utilisateur (éviction LRU au-delà)
+            global_quota_bytes: Octets maximum pour tout le stockage (éviction LRU au-delà)
+            reconcile_orphans: Supprimer les lignes sans fichier et signaler les fichiers sans ligne
+            delete_orphan_files: Supprimer aussi les fichiers sans ligne
+        """
+        self.max_age_days = max_age_days
+        self.idle_days = idle_days
+        self.user_quota_bytes = user_quota_bytes
+        self.global_quota_bytes = global_quota_bytes
+        self.reconcile_orphans = reconcile_orphans
+        self.delete_orphan_files = delete_orphan_files
+
+    @classmethod
+    def from_env(cls) -> 'ImageGCPolicy':
+        """Politique configurée par IMAGE_GC_MAX_AGE_DAYS, IMAGE_GC_IDLE_DAYS, IMAGE_GC_USER_QUOTA_MB, IMAGE_GC_GLOBAL_QUOTA_MB"""
+        max_age = os.environ.get("IMAGE_GC_MAX_AGE_DAYS")
+        idle = os.environ.get("IMAGE_GC_IDLE_DAYS")
+        return cls(
+            max_age_days=float(max_age) if max_age else None,
+            idle_days=float(idle) if idle else None,
+            user_quota_bytes=_env_bytes("IMAGE_GC_USER_QUOTA_MB"),
+            global_quota_bytes=_env_bytes("IMAGE_GC_GLOBAL_QUOTA_MB"),
+        )
+
+    def to_dict(self) -> Dict:
+        return dict(vars(self))
+
+
+class ImageGarbageCollector:
+    """Applique une ImageGCPolicy au stockage des images, par lots"""
+
+    def __init__(self, storage_dir: Path = IMAGE_ROOT, chunk_size: int = GC_CHUNK_SIZE):
+        self.storage_dir = Path(storage_dir)
+        self.chunk_size = chunk_size
+        # Suppressions simulées en dry_run (ids, octets par utilisateur, octets totaux)
+        self._planned = set()
+        self._planned_user_bytes: Dict[Optional[str], int] = defaultdict(int)
+        self._planned_bytes = 0
+        self._lock = threading.Lock()
+
+    def run(self, policy: ImageGCPolicy, dry_run: bool = False) -> Dict:
+        """
+        Exécute un passage du ramasse-miettes
+
+        Args:
+            policy: Règles à appliquer
+            dry_run: Ne rien supprimer, seulement évaluer
+
+        Returns:
+            Rapport {dry_run, deleted_images, orphan_files, reclaimed_bytes,
+            by_reason: {motif: {count, bytes}}, policy, duration_seconds}
+        """
+        with self._lock:
+            return self._run(policy, dry_run)
+
+    def _run(self, policy: ImageGCPolicy, dry_run: bool) -> Dict:
+        started = time.perf_counter()
+        self._planned = set()
+        self._planned_user_bytes = defaultdict(int)
+        self._planned_bytes = 0
+        report = {
+            'dry_run': dry_run,
+            'deleted_images': 0,
+            'orphan_files': 0,
+            'reclaimed_bytes': 0,
+            'by_reason': {reason: {'count': 0, 'bytes': 0} for reason in GC_REASONS},
+            'policy': policy.to_dict(),
+        }
+
+        # Les accès encore en mémoire comptent pour l'éviction LRU
+        try:
+            image_access_counter.flush()
+        except Exception as e:
+            logger.warning(f"Image access counters not flushed before GC: {e}")
+
+        now = datetime.utcnow()
+        if policy.reconcile_orphans:
+            self._reconcile_missing_files(report, dry_run)
+        if policy.max_age_days is not None:
+            cutoff = now - timedelta(days=policy.max_age_days)
+            for rows in self._chunks([StoredImage.created_at < cutoff], StoredImage.created_at):
+                self._evict(rows, 'age', report, dry_run)
+        if policy.idle_days is not None:
+            cutoff = now - timedelta(days=policy.idle_days)
+            for rows in self._chunks([LAST_USED < cutoff], LAST_USED):
+                self._evict(rows, 'idle', report, dry_run)
+        if policy.user_quota_bytes is not None:
+            self._enforce_user_quota(policy.user_quota_bytes, report, dry_run)
+        if policy.global_quota_bytes is not None:
+            self._enforce_global_quota(policy.global_quota_bytes, report, dry_run)
+        if policy.reconcile_orphans:
+            self._reconcile_orphan_files(report, dry_run, policy.delete_orphan_files)
+
+        report['duration_seconds'] = round(time.perf_counter() - started, 3)
+        logger.info(
+            f"Image GC {'(dry run) ' if dry_run else ''}: {report['deleted_images']} images, "
+            f"{report['orphan_files']} orphan files, {report['reclaimed_bytes']} bytes "
+            f"in {report['duration_seconds']}s"
+        )
+        return report
+
+    def _chunks(self, conditions: List, sort_key=None) -> Iterator[List]:
+        """
+        Parcourt les images non permanentes par lots, pagination par clé
+
+        Args:
+            conditions: Conditions SQLAlchemy supplémentaires
+            sort_key: Expression de tri (None: ordre des ids)
+
+        Yields:
+            Lots de lignes (id, filename, local_path, file_size, variants, user_id)
+        """
+        columns = _GC_COLUMNS if sort_key is None else _GC_COLUMNS + (sort_key.label('sort_key'),)
+        last = None
+        while True:
+            query = db.session.query(*columns).filter(
+                StoredImage.is_permanent.isnot(True), _RECLAIMABLE, *conditions
+            )
+            if sort_key is None:
+                if last is not None:
+                    query = query.filter(StoredImage.id > last)
+                query = query.order_by(StoredImage.id)
+            else:
+                if last is not None:
+                    # Équivalent à (sort_key, id) > last, avec une borne basse exploitable par l'index
+                    query = query.filter(sort_key >= last[0], or_(sort_key > last[0], StoredImage.id > last[1]))
+                query = query.order_by(sort_key, StoredImage.id)
+
+            rows = query.limit(self.chunk_size).all()
+            if not rows:
+                return
+            last = rows[-1].id if sort_key is None else (rows[-1].sort_key, rows[-1].id)
+
+            rows = [row for row in rows if row.id not in self._planned]
+            if rows:
+                yield rows
+
+    @staticmethod
+    def _row_bytes(row) -> int:
+        """Octets libérés sur le disque par la suppression d'une image (original et déclinaisons)"""
+        if row.canonical_id:
+            # Quasi-doublon: le fichier appartient à l'image canonique
+            return 0
+        variants = row.variants or {}
+        return (row.file_size or 0) + sum(
+            variant.get('file_size') or 0 for key, variant in variants.items() if not key.startswith('_')
+        )
+
+    @staticmethod
+    def _row_paths(row) -> List[str]:
+        """Fichiers d'une image (original et déclinaisons)"""
+        paths = [row.local_path]
+        derivatives_dir = os.path.join(os.path.dirname(row.local_path), DERIVATIVES_DIRNAME)
+        for key, variant in (row.variants or {}).items():
+            if not key.startswith('_'):
+                paths.append(os.path.join(derivatives_dir, variant['filename']))
+        return paths
+
+    def _evict(self, rows: List, reason: str, report: Dict, dry_run: bool, files_exist: bool = True) -> None:
+        """Supprime un lot d'images (une transaction), puis leurs fichiers"""
+        reclaimed = sum(self._row_bytes(row) for row in rows) if files_exist else 0
+        report['by_reason'][reason]['count'] += len(rows)
+        report['by_reason'][reason]['bytes'] += reclaimed
+        report['deleted_images'] += len(rows)
+        report['reclaimed_bytes'] += reclaimed
+
+        if dry_run:
+            for row in rows:
+                self._planned.add(row.id)
+                self._planned_user_bytes[row.user_id] += self._row_bytes(row)
+                self._planned_bytes += self._row_bytes(row)
+            return
+
+        released = Counter(row.canonical_id for row in rows if row.canonical_id)
+        try:
+            db.session.execute(delete(StoredImage).where(StoredImage.id.in_([row.id for row in rows])))
+            if released:
+                # Références rendues aux images canoniques, dans la même transaction
+                table = StoredImage.__table__
+                db.session.execute(
+                    update(table).where(table.c.id == bindparam('canonical')).values(
+                        ref_count=func.coalesce(table.c.ref_count, 1) - bindparam('released')
+                    ),
+                    [{'canonical': canonical_id, 'released': count} for canonical_id, count in released.items()]
+                )
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+        # Après le commit: un fichier resté sur le disque sera repris comme orphelin
+        for row in rows:
+            if row.canonical_id:
+                continue
+            image_index.forget(row.filename)
+            image_deduplicator.forget(row.id)
+            for path in self._row_paths(row):
+                try:
+                    os.unlink(path)
+                except FileNotFoundError:
+                    pass
+                except OSError as e:
+                    logger.warning(f"Could not delete image file {path}: {e}")
+
+    def _evict_lru(self, conditions: List, excess: int, reason: str, report: Dict, dry_run: bool) -> None:
+        """Supprime les images les moins récemment utilisées jusqu'à libérer excess octets"""
+        for rows in self._chunks(conditions, LAST_USED):
+            selected = []
+            for row in rows:
+                if excess <= 0:
+                    break
+                selected.append(row)
+                excess -= self._row_bytes(row)
+            if selected:
+                self._evict(selected, reason, report, dry_run)
+            if excess <= 0:
+                return
+
+    def _usage_by_user(self, conditions: List) -> Dict[Optional[str], int]:
+        """Octets occupés par utilisateur, mesurés comme _row_bytes (lecture par lots)"""
+        usage: Dict[Optional[str], int] = defaultdict(int)
+        for row in db.session.query(*_SIZE_COLUMNS).filter(*conditions).yield_per(self.chunk_size):
+            usage[row.user_id] += self._row_bytes(row)
+        return usage
+
+    def _enforce_user_quota(self, quota: int, report: Dict, dry_run: bool) -> None:
+        usage = self._usage_by_user([StoredImage.user_id.isnot(None)])
+        for user_id, used in usage.items():
+            excess = used - self._planned_user_bytes.get(user_id, 0) - quota
+            if excess > 0:
+                self._evict_lru([StoredImage.user_id == user_id], excess, 'user_quota', report, dry_run)
+
+    def _enforce_global_quota(self, quota: int, report: Dict, dry_run: bool) -> None:
+        # Occupation du disque: les quasi-doublons ne comptent pas (fichier partagé)
+        used = sum(self._usage_by_user([StoredImage.canonical_id.is_(None)]).values())
+        excess = used - self._planned_bytes - quota
+        if excess > 0:
+            self._evict_lru([StoredImage.canonical_id.is_(None)], excess, 'global_quota', report, dry_run)
+
+    def _reconcile_missing_files(self, report: Dict, dry_run: bool) -> None:
+        """Supprime les lignes dont le fichier original n'existe plus"""
+        for rows in self._chunks([]):
+            missing = [row for row in rows if not os.path.exists(row.local_path)]
+            if missing:
+                self._evict(missing, 'missing_file', report, dry_run, files_exist=False)
+
+    def _walk_files(self, directory: Path) -> Iterator[os.DirEntry]:
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_dir(follow_symlinks=False):
+                        yield from self._walk_files(Path(entry.path))
+                    elif entry.is_file(follow_symlinks=False):
+                        yield entry
+        except FileNotFoundError:
+            return
+
+    def _reconcile_orphan_files(self, report: Dict, dry_run: bool, delete: bool) -> None:
+        """Signale, et si delete supprime, les fichiers (et déclinaisons) qui ne correspondent à aucune ligne"""
+        cutoff = time.time() - ORPHAN_GRACE_SECONDS
+        batch = []
+        for entry in self._walk_files(self.storage_dir):
+            try:
+                stat = entry.stat(follow_symlinks=False)
+            except OSError:
+                continue
+            if stat.st_mtime > cutoff:
+                continue
+            batch.append((entry, stat.st_size))
+            if len(batch) >= self.chunk_size:
+                self._sweep_orphans(batch, report, dry_run, delete)
+                batch = []
+        if batch:
+            self._sweep_orphans(batch, report, dry_run, delete)
+        if report['orphan_files'] and not delete:
+            logger.info(f"Image GC: {report['orphan_files']} files without StoredImage row kept "
+                        f"(IMAGE_GC_DELETE_ORPHAN_FILES=false)")
+
+    def _sweep_orphans(self, batch: List[Tuple[os.DirEntry, int]], report: Dict, dry_run: bool,
+                       delete: bool) -> None:
+        # Noms de fichier StoredImage possibles pour chaque fichier du lot
+        owners = {}
+        for entry, _ in batch:
+            if entry.name.startswith('.'):
+                # Fichier temporaire d'un téléchargement interrompu
+                owners[entry.path] = ()
+            elif os.path.basename(os.path.dirname(entry.path)) == DERIVATIVES_DIRNAME:
+                match = DERIVATIVE_NAME_PATTERN.match(entry.name)
+                owners[entry.path] = tuple(
+                    match.group('stem') + extension for extension in IMAGE_EXTENSIONS
+                ) if match else ()
+            else:
+                owners[entry.path] = (entry.name,)
+
+        names = {name for candidates in owners.values() for name in candidates}
+        known = set()
+        if names:
+            known = {name for (name,) in db.session.query(StoredImage.filename).filter(StoredImage.filename.in_(names))}
+
+        for entry, size in batch:
+            if known.intersection(owners[entry.path]):
+                continue
+            report['orphan_files'] += 1
+            report['by_reason']['orphan_file']['count'] += 1
+            report['by_reason']['orphan_file']['bytes'] += size
+            if not delete:
+                continue
+            report['reclaimed_bytes'] += size
+            if not dry_run:
+                try:
+                    os.unlink(entry.path)
+                except OSError as e:
+                    logger.warning(f"Could not delete orphan file {entry.path}: {e}")
+
+
+image_gc = ImageGarbageCollector()
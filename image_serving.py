@@ -0,0 +1,352 @@
+"""
+Service des images générées: index en mémoire, cache HTTP et comptage d'accès différé
+
+Les fichiers sont localisés par un index filename -> chemin chargé une fois depuis
+StoredImage puis tenu à jour par les événements ORM: plus de sondage des sous-dossiers
+ni de requête SQL à chaque affichage. Les fichiers stockés ne sont jamais réécrits (nom
+dérivé du hash du contenu), ils sont donc servis avec ETag, Last-Modified et
+Cache-Control immutable; une requête conditionnelle reçoit un 304 sans lecture du disque.
+
+Derrière nginx ou Apache, l'envoi du fichier peut être délégué au serveur web
+(IMAGE_ACCEL_MODE=nginx|apache). Les compteurs d'accès sont accumulés en mémoire et
+écrits en base par lots, comme les compteurs des campagnes (voir campaign_counters).
+"""
+import atexit
+import logging
+import os
+import threading
+from collections import defaultdict
+from datetime import datetime
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from flask import Response, send_file
+from sqlalchemy import bindparam, event, func, update
+from werkzeug.http import http_date
+from werkzeug.security import safe_join
+
+from app import db
+from image_derivatives import DERIVATIVES_DIRNAME
+from models import StoredImage
+
+logger = logging.getLogger(__name__)
+
+# Racine du stockage (voir ImageStorageManager) et sous-dossiers sondés pour les fichiers non indexés
+IMAGE_ROOT = Path("generated_images")
+IMAGE_SUBDIRS = ("avatars", "campaigns", "products", ".")
+
+# Les fichiers ne changent jamais une fois écrits: cache d'un an
+CACHE_CONTROL = "public, max-age=31536000, immutable"
+
+# Délégation de l'envoi au serveur web: '' (Flask), 'nginx' (X-Accel-Redirect), 'apache' (X-Sendfile)
+ACCEL_MODE = os.environ.get("IMAGE_ACCEL_MODE", "").lower()
+# Location interne nginx pointant sur IMAGE_ROOT
+ACCEL_PREFIX = os.environ.get("IMAGE_ACCEL_PREFIX", "/protected-images/")
+
+# Intervalle entre deux écritures des compteurs d'accès (secondes)
+ACCESS_FLUSH_INTERVAL = float(os.environ.get("IMAGE_ACCESS_FLUSH_INTERVAL", "30"))
+
+# Entrée d'index: (répertoire, id StoredImage ou None, déclinaisons)
+IndexEntry = Tuple[Path, Optional[int], Optional[Dict]]
+# Métadonnées HTTP d'un fichier: (taille, mtime, etag non quoté)
+FileMeta = Tuple[int, float, str]
+
+
+class ImagePathIndex:
+    """Index filename -> répertoire des images stockées"""
+
+    def __init__(self, root: Path = IMAGE_ROOT):
+        self.root = root
+        self._entries: Dict[str, IndexEntry] = {}
+        self._file_meta: Dict[str, FileMeta] = {}
+        self._loaded = False
+        self._lock = threading.Lock()
+
+    def load(self) -> int:
+        """
+        Charge l'index depuis StoredImage (une requête, colonnes utiles uniquement)
+
+        Returns:
+            Nombre d'images indexées
+        """
+        rows = db.session.query(
+            StoredImage.id, StoredImage.filename, StoredImage.local_path, StoredImage.variants
+        ).yield_per(5000)
+        entries = {
+            filename: (Path(local_path).parent, image_id, variants)
+            for image_id, filename, local_path, variants in rows
+        }
+        with self._lock:
+            # Les entrées ajoutées par les événements pendant le chargement sont conservées
+            entries.update(self._entries)
+            self._entries = entries
+            self._loaded = True
+        logger.info(f"Image path index loaded ({len(entries)} images)")
+        return len(entries)
+
+    def add(self, stored_image) -> None:
+        """Indexe (ou met à jour) une image stockée"""
+        if getattr(stored_image, 'canonical_id', None):
+            # Quasi-doublon: le fichier et son entrée sont ceux de l'image canonique
+            return
+        directory = Path(stored_image.local_path).parent
+        self._entries[stored_image.filename] = (directory, stored_image.id, stored_image.variants)
+        # Déclinaisons éventuellement régénérées: leurs métadonnées seront relues
+        for key, variant in (stored_image.variants or {}).items():
+            if not key.startswith('_'):
+                self._file_meta.pop(str(directory / DERIVATIVES_DIRNAME / variant['filename']), None)
+
+    def forget(self, filename: str) -> None:
+        """Retire une image de l'index"""
+        entry = self._entries.pop(filename, None)
+        if entry is not None:
+            self._file_meta.pop(str(entry[0] / filename), None)
+
+    def resolve(self, filename: str) -> Optional[IndexEntry]:
+        """
+        Localise une image
+
+        Une image absente de l'index (enregistrée par un autre worker) est cherchée dans
+        StoredImage puis indexée. Les fichiers antérieurs à StoredImage (sans ligne en base)
+        sont cherchés dans les sous-dossiers de IMAGE_ROOT sans être mémorisés: leur ligne
+        peut apparaître plus tard et apporter id et déclinaisons.
+
+        Args:
+            filename: Nom du fichier demandé
+
+        Returns:
+            Tuple (répertoire, id StoredImage ou None, déclinaisons) ou None si introuvable
+        """
+        entry = self._entries.get(filename)
+        if entry is not None:
+            return entry
+        if not self._loaded:
+            self.load()
+            entry = self._entries.get(filename)
+            if entry is not None:
+                return entry
+
+        stored_image = StoredImage.query.filter_by(filename=filename, canonical_id=None).first()
+        if stored_image is not None:
+            self.add(stored_image)
+            return self._entries[filename]
+
+        for subdir in IMAGE_SUBDIRS:
+            candidate = safe_join(str(self.root / subdir), filename)
+            if candidate and os.path.isfile(candidate):
+                return (Path(candidate).parent, None, None)
+        return None
+
+    def file_meta(self, path: Path) -> Optional[FileMeta]:
+        """
+        Taille, date de modification et ETag d'un fichier (un seul stat par fichier)
+
+        Returns:
+            Tuple (taille, mtime, etag) ou None si le fichier n'existe plus
+        """
+        key = str(path)
+        meta = self._file_meta.get(key)
+        if meta is None:
+            try:
+                stat = path.stat()
+            except OSError:
+                return None
+            meta = (stat.st_size, stat.st_mtime, f'{int(stat.st_mtime):x}-{stat.st_size:x}')
+            self._file_meta[key] = meta
+        return meta
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+class ImageAccessCounter:
+    """Accumule les accès aux images et les écrit en base par lots"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[int, int] = defaultdict(int)
+        self._last_seen: Dict[int, datetime] = {}
+        self.scheduler = None
+        self._app = None
+
+    def hit(self, image_id: int) -> None:
+        """Enregistre un accès (sans accès à la base)"""
+        now = datetime.utcnow()
+        with self._lock:
+            self._pending[image_id] += 1
+            self._last_seen[image_id] = now
+
+    def pending(self, image_id: int) -> int:
+        """Accès pas encore écrits en base pour une image"""
+        with self._lock:
+            return self._pending.get(image_id, 0)
+
+    def flush(self) -> int:
+        """
+        Écrit les accès en attente: un UPDATE par image, une seule transaction
+
+        Returns:
+            Nombre d'images mises à jour
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, defaultdict(int)
+                last_seen, self._last_seen = self._last_seen, {}
+            if not pending:
+                return 0
+
+            rows = [
+                {'image_id': image_id, 'hits': hits, 'seen_at': last_seen[image_id]}
+                for image_id, hits in sorted(pending.items())
+            ]
+            table = StoredImage.__table__
+            stmt = update(table).where(table.c.id == bindparam('image_id')).values(
+                access_count=func.coalesce(table.c.access_count, 0) + bindparam('hits'),
+                last_accessed=bindparam('seen_at')
+            )
+
+            try:
+                db.session.execute(stmt, rows)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                with self._lock:
+                    for image_id, hits in pending.items():
+                        self._pending[image_id] += hits
+                        self._last_seen.setdefault(image_id, last_seen[image_id])
+                logger.error(f"Image access counters flush failed, {len(rows)} images kept pending: {e}")
+                raise
+
+            logger.debug(f"Image access counters flushed for {len(rows)} images")
+            return len(rows)
+
+    def _scheduled_flush(self) -> None:
+        try:
+            with self._app.app_context():
+                self.flush()
+        except Exception as e:
+            logger.error(f"Scheduled image access counters flush failed: {e}")
+
+    def start_flusher(self, app, interval: float = ACCESS_FLUSH_INTERVAL) -> None:
+        """Démarre l'écriture périodique en base (et une dernière écriture à l'arrêt)"""
+        if self.scheduler is not None:
+            logger.warning("Image access counters flusher already running")
+            return
+
+        self._app = app
+        self.scheduler = BackgroundScheduler()
+        self.scheduler.add_job(
+            func=self._scheduled_flush,
+            trigger='interval',
+            seconds=interval,
+            id='image_access_counters_flush',
+            name='Image Access Counters Flush',
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
+        self.scheduler.start()
+        atexit.register(self.stop_flusher)
+        logger.info(f"Image access counters flusher started (every {interval}s)")
+
+    def stop_flusher(self) -> None:
+        """Arrête le job périodique et écrit les derniers accès"""
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+            self._scheduled_flush()
+            logger.info("Image access counters flusher stopped")
+
+
+image_index = ImagePathIndex()
+image_access_counter = ImageAccessCounter()
+
+
+def _file_response(path: Path, meta: FileMeta, mimetype: Optional[str], if_none_match) -> Response:
+    """Réponse 200 (fichier ou délégation au serveur web) ou 304, avec en-têtes de cache"""
+    size, mtime, etag = meta
+
+    if if_none_match and if_none_match.contains_weak(etag):
+        response = Response(status=304)
+    elif ACCEL_MODE == 'nginx':
+        response = Response(mimetype=mimetype)
+        response.headers['X-Accel-Redirect'] = ACCEL_PREFIX + path.relative_to(IMAGE_ROOT).as_posix()
+    elif ACCEL_MODE == 'apache':
+        response = Response(mimetype=mimetype)
+        response.headers['X-Sendfile'] = str(path.resolve())
+    else:
+        response = send_file(path, mimetype=mimetype, conditional=False, etag=False)
+        response.content_length = size
+
+    response.set_etag(etag)
+    response.headers['Last-Modified'] = http_date(mtime)
+    response.headers['Cache-Control'] = CACHE_CONTROL
+    return response
+
+
+def serve_image(filename: str, requested_width: Optional[int] = None,
+                accept_header: Optional[str] = None, if_none_match=None):
+    """
+    Construit la réponse HTTP d'une image générée
+
+    Args:
+        filename: Nom du fichier demandé
+        requested_width: Paramètre ?w= (déclinaison WebP/AVIF, voir image_derivatives)
+        accept_header: En-tête Accept de la requête
+        if_none_match: En-tête If-None-Match analysé (request.if_none_match)
+
+    Returns:
+        Réponse Flask, ou None si l'image est introuvable
+    """
+    from image_derivatives import derivative_manager, select_variant
+
+    entry = image_index.resolve(filename)
+    if entry is None:
+        return None
+    directory, image_id, variants = entry
+
+    path, mimetype = directory / filename, None
+    if requested_width and image_id is not None:
+        if not variants or '_formats' not in variants:
+            stored_image = db.session.get(StoredImage, image_id)
+            if stored_image is not None:
+                try:
+                    variants = derivative_manager.ensure_variants(stored_image)
+                    image_index.add(stored_image)
+                except Exception as e:
+                    logger.error(f"Déclinaisons indisponibles pour {filename}: {e}")
+        variant = select_variant(variants, accept_header, requested_width)
+        if variant:
+            path, mimetype = directory / DERIVATIVES_DIRNAME / variant['filename'], variant['content_type']
+
+    meta = image_index.file_meta(path)
+    if meta is None and mimetype is not None:
+        # Déclinaison supprimée: l'original reste servi
+        path, mimetype = directory / filename, None
+        meta = image_index.file_meta(path)
+    if meta is None:
+        # Fichier supprimé depuis l'indexation
+        image_index.forget(filename)
+        return None
+
+    if image_id is not None:
+        image_access_counter.hit(image_id)
+
+    response = _file_response(path, meta, mimetype, if_none_match)
+    if requested_width:
+        response.headers['Vary'] = 'Accept'
+    return response
+
+
+@event.listens_for(StoredImage, 'after_insert')
+@event.listens_for(StoredImage, 'after_update')
+def _stored_image_written(mapper, connection, target):
+    image_index.add(target)
+
+
+@event.listens_for(StoredImage, 'after_delete')
+def _stored_image_deleted(mapper, connection, target):
+    if not target.canonical_id:
+        image_index.forget(target.filename)
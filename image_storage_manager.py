@@ -6,17 +6,76 @@ Combine base de données, cache Redis et stockage fichier pour une gestion robus
 import os
 import hashlib
 import logging
+import tempfile
+import threading
 import requests
+from concurrent.futures import Future, ThreadPoolExecutor
 from pathlib import Path
 from datetime import datetime, timedelta
-from typing import Optional, Dict, List, Any
+from typing import Optional, Dict, List, Any, Tuple
 from urllib.parse import urlparse
 import uuid
 
+from requests.adapters import HTTPAdapter
+from sqlalchemy.exc import IntegrityError
+from urllib3.util.retry import Retry
+
+from app import app, db
+from image_dedup import DEDUP_ENABLED, compute_perceptual_hashes, image_deduplicator, to_signed
+from models import StoredImage
 from redis_cache_manager import cache_manager
 
 logger = logging.getLogger(__name__)
 
+# Taille maximale acceptée pour une image téléchargée
+MAX_IMAGE_BYTES = int(os.environ.get("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+
+# Taille des blocs lus sur le réseau et écrits sur disque
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Nombre de téléchargements simultanés (pool de connexions et workers)
+DOWNLOAD_WORKERS = int(os.environ.get("IMAGE_DOWNLOAD_WORKERS", "4"))
+
+# Délais (connexion, lecture entre deux blocs) en secondes
+DOWNLOAD_TIMEOUT = (5, 30)
+
+# Droits des fichiers stockés: ceux d'un fichier créé normalement (0o666 moins l'umask), pour
+# que nginx ou Apache puissent les lire (X-Accel-Redirect, X-Sendfile); NamedTemporaryFile crée en 0o600
+_UMASK = os.umask(0)
+os.umask(_UMASK)
+STORED_FILE_MODE = 0o666 & ~_UMASK
+
+# Types acceptés -> extension
+ALLOWED_CONTENT_TYPES = {
+    'image/png': '.png',
+    'image/jpeg': '.jpg',
+    'image/jpg': '.jpg',
+    'image/webp': '.webp',
+}
+
+
+class ImageValidationError(ValueError):
+    """Image refusée (type ou taille invalide)"""
+
+
+def sniff_image_extension(head: bytes) -> Optional[str]:
+    """
+    Détermine l'extension d'une image d'après ses premiers octets (signature)
+
+    Args:
+        head: Premiers octets du fichier (au moins 12)
+
+    Returns:
+        '.png', '.jpg', '.webp' ou None si la signature n'est pas reconnue
+    """
+    if head.startswith(b'\x89PNG\r\n\x1a\n'):
+        return '.png'
+    if head.startswith(b'\xff\xd8\xff'):
+        return '.jpg'
+    if len(head) >= 12 and head[:4] == b'RIFF' and head[8:12] == b'WEBP':
+        return '.webp'
+    return None
+
 class ImageStorageManager:
     """Gestionnaire centralisé pour le stockage d'images IA"""
     
@@ -31,6 +90,114 @@ class ImageStorageManager:
         
         for dir_path in [self.avatar_dir, self.campaign_dir, self.product_dir]:
             dir_path.mkdir(exist_ok=True)
+        
+        self._session = None
+        self._session_lock = threading.Lock()
+        self._executor = None
+    
+    @property
+    def session(self) -> requests.Session:
+        """Session HTTP partagée: connexions keep-alive réutilisées entre les téléchargements"""
+        if self._session is None:
+            with self._session_lock:
+                if self._session is None:
+                    session = requests.Session()
+                    adapter = HTTPAdapter(
+                        pool_connections=DOWNLOAD_WORKERS,
+                        pool_maxsize=DOWNLOAD_WORKERS,
+                        max_retries=Retry(total=2, backoff_factor=0.5,
+                                          status_forcelist=(502, 503, 504),
+                                          allowed_methods=frozenset(['GET']))
+                    )
+                    session.mount('http://', adapter)
+                    session.mount('https://', adapter)
+                    self._session = session
+        return self._session
+    
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Workers de téléchargement en arrière-plan"""
+        if self._executor is None:
+            with self._session_lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS,
+                                                        thread_name_prefix='image-download')
+        return self._executor
+    
+    def _directory_for(self, image_type: str) -> Path:
+        """Répertoire de stockage d'un type d'image"""
+        if image_type == "avatar":
+            return self.avatar_dir
+        elif image_type == "campaign":
+            return self.campaign_dir
+        elif image_type == "product":
+            return self.product_dir
+        return self.storage_dir
+    
+    def stream_to_file(self, url: str, target_dir: Path, name_prefix: str) -> Tuple[Path, int, str, str]:
+        """
+        Télécharge une image par blocs vers un fichier temporaire puis la renomme atomiquement
+        
+        Le contenu n'est jamais entièrement en mémoire: chaque bloc est haché (SHA-256) et
+        écrit au fil de l'eau. Le type est vérifié sur l'en-tête Content-Type et sur la
+        signature des premiers octets, la taille sur Content-Length et pendant la lecture.
+        
+        Args:
+            url: URL de l'image
+            target_dir: Répertoire de destination
+            name_prefix: Début du nom de fichier final (l'extension est ajoutée)
+            
+        Returns:
+            Tuple (chemin final, taille en octets, type MIME, SHA-256 du contenu)
+            
+        Raises:
+            ImageValidationError: type ou taille invalide
+            requests.RequestException: erreur réseau ou statut HTTP en erreur
+        """
+        with self.session.get(url, stream=True, timeout=DOWNLOAD_TIMEOUT) as response:
+            response.raise_for_status()
+            
+            content_type = response.headers.get('content-type', '').split(';')[0].strip().lower()
+            if content_type and content_type not in ALLOWED_CONTENT_TYPES and content_type != 'application/octet-stream':
+                raise ImageValidationError(f"Type de contenu non supporté: {content_type}")
+            
+            declared_size = response.headers.get('content-length')
+            if declared_size and declared_size.isdigit() and int(declared_size) > MAX_IMAGE_BYTES:
+                raise ImageValidationError(f"Image trop volumineuse: {declared_size} octets")
+            
+            digest = hashlib.sha256()
+            size = 0
+            extension = None
+            temp_file = tempfile.NamedTemporaryFile(dir=target_dir, prefix='.download-', suffix='.part', delete=False)
+            try:
+                with temp_file:
+                    for chunk in response.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+                        if not chunk:
+                            continue
+                        if extension is None:
+                            extension = sniff_image_extension(chunk[:16])
+                            if extension is None:
+                                raise ImageValidationError("Le contenu téléchargé n'est pas une image PNG, JPEG ou WebP")
+                        size += len(chunk)
+                        if size > MAX_IMAGE_BYTES:
+                            raise ImageValidationError(f"Image trop volumineuse: plus de {MAX_IMAGE_BYTES} octets")
+                        digest.update(chunk)
+                        temp_file.write(chunk)
+                    temp_file.flush()
+                    os.fsync(temp_file.fileno())
+                
+                if extension is None:
+                    raise ImageValidationError("Réponse vide")
+                
+                final_path = target_dir / f"{name_prefix}{extension}"
+                os.chmod(temp_file.name, STORED_FILE_MODE)
+                os.replace(temp_file.name, final_path)
+            except BaseException:
+                Path(temp_file.name).unlink(missing_ok=True)
+                raise
+        
+        mime_type = next(mime for mime, ext in ALLOWED_CONTENT_TYPES.items() if ext == extension)
+        return final_path, size, mime_type, digest.hexdigest()
             
     def generate_image_hash(self, prompt: str, model: str, size: str = "1024x1024") -> str:
         """Génère un hash unique pour une combinaison prompt/modèle/taille"""
@@ -60,76 +227,150 @@ class ImageStorageManager:
         Returns:
             Dict contenant les informations de l'image stockée
         """
+        stored_path = None
         try:
-            # Vérifier si l'image existe déjà en cache
+            # Vérifier si l'image existe déjà (cache puis base)
             image_hash = self.generate_image_hash(prompt, model, size)
-            cached_image = self.get_cached_image(image_hash)
+            cached_image = self.get_image_by_hash(image_hash)
             if cached_image:
                 logger.info(f"Image trouvée en cache: {image_hash}")
                 return cached_image
             
-            # Télécharger l'image
-            response = requests.get(url, timeout=30)
-            response.raise_for_status()
+            # Télécharger l'image en flux vers son emplacement définitif
+            name_prefix = f"{image_hash}_{datetime.now().strftime('%Y%m%d_%H%M%S')}"
+            stored_path, file_size, content_type, content_sha256 = self.stream_to_file(
+                url, self._directory_for(image_type), name_prefix
+            )
             
-            # Déterminer l'extension du fichier
-            content_type = response.headers.get('content-type', '')
-            if 'png' in content_type:
-                extension = '.png'
-            elif 'jpeg' in content_type or 'jpg' in content_type:
-                extension = '.jpg'
-            elif 'webp' in content_type:
-                extension = '.webp'
-            else:
-                extension = '.png'  # Par défaut
-            
-            # Générer le nom de fichier unique
-            filename = f"{image_hash}_{datetime.now().strftime('%Y%m%d_%H%M%S')}{extension}"
-            
-            # Déterminer le répertoire de stockage
-            if image_type == "avatar":
-                storage_path = self.avatar_dir / filename
-            elif image_type == "campaign":
-                storage_path = self.campaign_dir / filename
-            elif image_type == "product":
-                storage_path = self.product_dir / filename
-            else:
-                storage_path = self.storage_dir / filename
-            
-            # Sauvegarder le fichier
-            with open(storage_path, 'wb') as f:
-                f.write(response.content)
+            # Empreinte perceptuelle: une image quasi identique déjà stockée est réutilisée
+            canonical = None
+            perceptual_hashes = None
+            if DEDUP_ENABLED:
+                try:
+                    perceptual_hashes = compute_perceptual_hashes(stored_path)
+                    canonical = image_deduplicator.find_duplicate(*perceptual_hashes)
+                except Exception as dedup_error:
+                    logger.warning(f"Déduplication impossible pour {stored_path.name}: {dedup_error}")
             
             # Créer l'entrée en base de données
             stored_image = StoredImage(
                 hash=image_hash,
                 original_url=url,
-                local_path=str(storage_path),
-                filename=filename,
+                local_path=str(stored_path),
+                filename=stored_path.name,
                 prompt=prompt,
                 model=model,
                 size=size,
                 image_type=image_type,
                 user_id=user_id,
                 entity_id=entity_id,
-                file_size=len(response.content),
+                file_size=file_size,
                 content_type=content_type
             )
+            if canonical is not None:
+                # Fichier partagé avec l'image canonique (ref_count incrémenté)
+                image_deduplicator.link(stored_image, canonical)
+            elif perceptual_hashes is not None:
+                stored_image.dhash, stored_image.ahash = (to_signed(value) for value in perceptual_hashes)
             
             db.session.add(stored_image)
-            db.session.commit()
+            try:
+                db.session.commit()
+            except IntegrityError:
+                # Même image stockée entre-temps par un autre worker: garder la première
+                db.session.rollback()
+                stored_path.unlink(missing_ok=True)
+                stored_path = None
+                return self.get_image_by_hash(image_hash)
+            
+            if canonical is not None:
+                stored_path.unlink(missing_ok=True)
+                stored_path = None
+                logger.info(f"Quasi-doublon de {canonical.filename}: fichier partagé ({file_size} bytes économisés)")
             
             # Mettre en cache
             image_data = stored_image.to_dict()
+            image_data['content_sha256'] = content_sha256
             self.cache_image(image_hash, image_data)
             
-            logger.info(f"Image stockée avec succès: {filename} ({len(response.content)} bytes)")
+            # Déclinaisons responsives générées hors de la requête (celles d'un doublon sont partagées)
+            if canonical is None:
+                self.executor.submit(self._derivatives_in_app_context, stored_image.id)
+            
+            logger.info(f"Image stockée avec succès: {stored_image.filename} ({stored_image.file_size} bytes)")
             return image_data
             
         except Exception as e:
+            db.session.rollback()
+            if stored_path is not None:
+                stored_path.unlink(missing_ok=True)
             logger.error(f"Erreur lors du stockage de l'image: {str(e)}")
             return None
     
+    def _download_in_app_context(self, kwargs: Dict) -> Optional[Dict]:
+        """Exécute download_and_store_image dans un worker (contexte d'application dédié)"""
+        with app.app_context():
+            try:
+                return self.download_and_store_image(**kwargs)
+            finally:
+                db.session.remove()
+    
+    def _derivatives_in_app_context(self, stored_image_id: int) -> None:
+        """Génère les déclinaisons d'une image stockée (worker)"""
+        from image_derivatives import derivative_manager
+        
+        with app.app_context():
+            try:
+                stored_image = db.session.get(StoredImage, stored_image_id)
+                if stored_image:
+                    derivative_manager.ensure_variants(stored_image)
+                    # Le cache contient encore la version sans déclinaisons
+                    self.cache_image(stored_image.hash, stored_image.to_dict())
+            except Exception as e:
+                logger.error(f"Erreur lors de la génération des déclinaisons de l'image {stored_image_id}: {str(e)}")
+            finally:
+                db.session.remove()
+    
+    def submit_download(self, url: str, prompt: str, model: str, **kwargs) -> Future:
+        """
+        Planifie le téléchargement et le stockage d'une image en arrière-plan
+        
+        Le téléchargement, l'écriture en base et la mise en cache s'exécutent dans un
+        worker: la requête qui a généré l'image n'attend pas.
+        
+        Args:
+            url, prompt, model: voir download_and_store_image
+            **kwargs: image_type, user_id, entity_id, size
+            
+        Returns:
+            Future dont le résultat est le dictionnaire de l'image stockée (ou None)
+        """
+        return self.executor.submit(
+            self._download_in_app_context,
+            dict(url=url, prompt=prompt, model=model, **kwargs)
+        )
+    
+    def download_many(self, images: List[Dict], timeout: Optional[float] = None) -> List[Optional[Dict]]:
+        """
+        Télécharge et stocke plusieurs images en parallèle
+        
+        Args:
+            images: Liste de dictionnaires d'arguments de download_and_store_image
+            timeout: Délai maximal d'attente par image (secondes)
+            
+        Returns:
+            Résultats dans l'ordre des entrées (None pour une image en échec)
+        """
+        futures = [self.submit_download(**image) for image in images]
+        results = []
+        for future in futures:
+            try:
+                results.append(future.result(timeout=timeout))
+            except Exception as e:
+                logger.error(f"Téléchargement d'image en échec: {str(e)}")
+                results.append(None)
+        return results
+    
     def get_cached_image(self, image_hash: str) -> Optional[Dict]:
         """Récupère une image depuis le cache Redis"""
         cache_key = f"stored_image:{image_hash}"
@@ -167,34 +408,23 @@ class ImageStorageManager:
         return [img.to_dict() for img in images]
     
     def cleanup_old_images(self, days_old: int = 30) -> int:
-        """Nettoie les images anciennes non utilisées"""
-        cutoff_date = datetime.utcnow() - timedelta(days=days_old)
-        
-        old_images = StoredImage.query.filter(
-            StoredImage.created_at < cutoff_date,
-            StoredImage.is_permanent == False
-        ).all()
+        """
+        Nettoie les images anciennes non permanentes
         
-        deleted_count = 0
-        for image in old_images:
-            try:
-                # Supprimer le fichier
-                file_path = Path(image.local_path)
-                if file_path.exists():
-                    file_path.unlink()
-                
-                # Supprimer de la base
-                db.session.delete(image)
-                deleted_count += 1
-                
-            except Exception as e:
-                logger.error(f"Erreur lors de la suppression de l'image {image.filename}: {str(e)}")
+        Délègue au ramasse-miettes (suppression par lots, voir image_gc).
         
-        if deleted_count > 0:
-            db.session.commit()
-            logger.info(f"{deleted_count} images anciennes supprimées")
+        Args:
+            days_old: Âge minimal des images supprimées (jours)
+            
+        Returns:
+            Nombre d'images supprimées
+        """
+        from image_gc import ImageGCPolicy, image_gc
         
-        return deleted_count
+        report = image_gc.run(ImageGCPolicy(max_age_days=days_old, reconcile_orphans=False))
+        if report['deleted_images'] > 0:
+            logger.info(f"{report['deleted_images']} images anciennes supprimées")
+        return report['deleted_images']
     
     def mark_as_permanent(self, image_hash: str) -> bool:
         """Marque une image comme permanente (ne sera pas supprimée)"""
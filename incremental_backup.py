@@ -0,0 +1,395 @@
+"""
+Sauvegardes logiques incrémentales des tables de télémétrie
+
+Metric, AuditLog et UserActivity ne font que grossir et dominent la taille et la durée des
+dumps complets. Pour chacune, un point de reprise (high-water mark sur l'id)
+est conservé: chaque exécution n'exporte que les nouvelles lignes, par plages d'ids
+(COPY ... TO STDOUT sous PostgreSQL), dans un fichier NDJSON compressé. La première
+exécution produit la base de la chaîne, les suivantes ses incréments.
+
+Une ligne n'est exportée qu'une fois sa date de création plus ancienne que
+INCREMENTAL_SETTLE_SECONDS: les ids alloués par des transactions encore en cours ne sont pas
+dépassés. Les tables sont traitées comme append-only: les mises à jour et suppressions
+postérieures à l'export ne sont pas rejouées. Les tables modifiées après insertion (ex:
+stored_images, dont ref_count, variantes et lignes supprimées par image_gc) restent donc
+dans le dump complet.
+
+La restauration rejoue la base puis les incréments, dans l'ordre, après restauration du
+dump complet (qui peut alors exclure les données de ces tables, voir backup_manager).
+"""
+import atexit
+import json
+import logging
+import os
+import time
+from datetime import date, datetime, timedelta
+from pathlib import Path
+from typing import Dict, Iterator, List, Optional, Tuple
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from sqlalchemy import DateTime, Date, MetaData, Table, func, select, text
+
+from app import db
+from backup_manager import (
+    COMPRESSION_SUFFIXES, CompressedWriter, BackupError, file_sha256, read_compressed, resolve_compression
+)
+
+logger = logging.getLogger(__name__)
+
+# Table -> (colonne du point de reprise, colonne de date de création)
+INCREMENTAL_TABLES: Dict[str, Tuple[str, str]] = {
+    'metric': ('id', 'created_at'),
+    'audit_log': ('id', 'timestamp'),
+    'user_activities': ('id', 'created_at'),
+}
+
+INCREMENTAL_DIR = Path(os.environ.get("BACKUP_INCREMENTAL_DIR", "backups/incremental"))
+# Intervalle entre deux exports incrémentaux (minutes, 0 = désactivé)
+INCREMENTAL_INTERVAL = int(os.environ.get("BACKUP_INCREMENTAL_INTERVAL", "0"))
+# Ancienneté minimale d'une ligne avant export (transactions en cours)
+INCREMENTAL_SETTLE_SECONDS = int(os.environ.get("BACKUP_INCREMENTAL_SETTLE_SECONDS", "60"))
+# Largeur d'une plage d'ids exportée par requête
+INCREMENTAL_CHUNK_IDS = int(os.environ.get("BACKUP_INCREMENTAL_CHUNK_IDS", "50000"))
+# Lignes insérées par requête lors du rejeu
+REPLAY_BATCH_SIZE = 5000
+
+STATE_FILENAME = "state.json"
+
+
+def _json_default(value):
+    if isinstance(value, (datetime, date)):
+        return value.isoformat()
+    if isinstance(value, (bytes, memoryview)):
+        return bytes(value).hex()
+    return str(value)
+
+
+class IncrementalBackup:
+    """Exports incrémentaux par table et rejeu base + incréments"""
+
+    def __init__(self, directory: Path = INCREMENTAL_DIR, tables: Optional[Dict[str, Tuple[str, str]]] = None,
+                 compression: Optional[str] = None, settle_seconds: int = INCREMENTAL_SETTLE_SECONDS):
+        self.directory = Path(directory)
+        self.settle_seconds = settle_seconds
+        self.tables = INCREMENTAL_TABLES if tables is None else tables
+        self.compression = compression
+        self.scheduler = None
+        self._app = None
+        self._reflected: Dict[str, Table] = {}
+
+    # --- État -------------------------------------------------------------
+
+    @property
+    def state_path(self) -> Path:
+        return self.directory / STATE_FILENAME
+
+    def load_state(self) -> Dict[str, Dict]:
+        """Point de reprise et fichiers de la chaîne, par table"""
+        try:
+            return json.loads(self.state_path.read_text())
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, state: Dict[str, Dict]) -> None:
+        self.directory.mkdir(parents=True, exist_ok=True)
+        tmp_path = self.state_path.with_name(f".{STATE_FILENAME}.tmp")
+        tmp_path.write_text(json.dumps(state, indent=2))
+        os.replace(tmp_path, self.state_path)
+
+    def covered_tables(self) -> List[str]:
+        """Tables dont la chaîne incrémentale existe (leurs données peuvent être exclues du dump complet)"""
+        return [table for table, entry in self.load_state().items() if table in self.tables and entry.get('files')]
+
+    def reset_chain(self, table: str) -> None:
+        """Supprime la chaîne d'une table: la prochaine exécution repart d'une nouvelle base"""
+        state = self.load_state()
+        for entry in state.pop(table, {}).get('files', []):
+            (self.directory / entry['file']).unlink(missing_ok=True)
+        self._save_state(state)
+
+    # --- Export -----------------------------------------------------------
+
+    def _table(self, name: str) -> Table:
+        table = self._reflected.get(name)
+        if table is None:
+            table = Table(name, MetaData(), autoload_with=db.engine)
+            self._reflected[name] = table
+        return table
+
+    def _upper_bound(self, table: Table, id_column: str, time_column: str, high_water_mark: int) -> int:
+        """Dernier id exportable: avant la première ligne trop récente, sinon le plus grand id"""
+        id_col, time_col = table.c[id_column], table.c[time_column]
+        cutoff = datetime.utcnow() - timedelta(seconds=self.settle_seconds)
+        first_recent = db.session.execute(
+            select(func.min(id_col)).where(id_col > high_water_mark, time_col >= cutoff)
+        ).scalar()
+        if first_recent is not None:
+            return first_recent - 1
+        return db.session.execute(select(func.max(id_col))).scalar() or 0
+
+    def _copy_range(self, table: Table, id_column: str, low: int, high: int, writer: CompressedWriter) -> None:
+        """Écrit les lignes low < id <= high en NDJSON"""
+        if db.engine.dialect.name == 'postgresql':
+            # COPY en flux: une ligne JSON par enregistrement, sérialisée par PostgreSQL. Le format
+            # texte échapperait les antislashs du JSON; en CSV, avec guillemet et séparateur absents
+            # de tout JSON (caractères de contrôle), chaque ligne est écrite telle quelle
+            query = (
+                f'COPY (SELECT row_to_json(t) FROM "{table.name}" t '
+                f'WHERE t."{id_column}" > {int(low)} AND t."{id_column}" <= {int(high)} '
+                f'ORDER BY t."{id_column}") TO STDOUT '
+                "(FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')"
+            )
+            connection = db.engine.raw_connection()
+            try:
+                with connection.cursor() as cursor:
+                    cursor.copy_expert(query, writer)
+                connection.commit()
+            finally:
+                connection.close()
+            return
+
+        id_col = table.c[id_column]
+        with db.engine.connect() as connection:
+            result = connection.execution_options(stream_results=True).execute(
+                select(table).where(id_col > low, id_col <= high).order_by(id_col)
+            )
+            for rows in result.mappings().partitions(REPLAY_BATCH_SIZE):
+                writer.write(''.join(json.dumps(dict(row), default=_json_default) + '\n' for row in rows))
+
+    def _count_lines(self, path: Path, compression: str) -> int:
+        return sum(chunk.count(b'\n') for chunk in read_compressed(path, compression))
+
+    def export_table(self, name: str, state: Dict[str, Dict]) -> Dict:
+        """
+        Exporte les nouvelles lignes d'une table et avance son point de reprise
+
+        Returns:
+            Rapport {rows, bytes, raw_bytes, duration, from_id, to_id, file}
+        """
+        id_column, time_column = self.tables[name]
+        compression = resolve_compression(self.compression)
+        entry = state.setdefault(name, {'high_water_mark': 0, 'files': []})
+        started = time.monotonic()
+
+        table = self._table(name)
+        low = entry['high_water_mark']
+        upper = self._upper_bound(table, id_column, time_column, low)
+        report = {'rows': 0, 'bytes': 0, 'raw_bytes': 0, 'from_id': low, 'to_id': low, 'file': None}
+        if upper <= low:
+            report['duration'] = round(time.monotonic() - started, 3)
+            return report
+
+        sequence = len(entry['files'])
+        filename = f"{name}/{sequence:06d}_{low + 1}_{upper}.ndjson{COMPRESSION_SUFFIXES[compression]}"
+        path = self.directory / filename
+        path.parent.mkdir(parents=True, exist_ok=True)
+        partial = path.with_name(f".{path.name}.partial")
+
+        writer = CompressedWriter(partial, compression)
+        try:
+            position = low
+            while position < upper:
+                chunk_end = min(position + INCREMENTAL_CHUNK_IDS, upper)
+                self._copy_range(table, id_column, position, chunk_end, writer)
+                position = chunk_end
+            stats = writer.close()
+            os.replace(partial, path)
+        except BaseException:
+            writer.abort()
+            raise
+
+        rows = self._count_lines(path, compression)
+        entry['files'].append({
+            'file': filename,
+            'from_id': low + 1,
+            'to_id': upper,
+            'rows': rows,
+            'size': stats['size'],
+            'sha256': stats['sha256'],
+            'compression': compression,
+            'created': datetime.utcnow().isoformat(),
+        })
+        entry['high_water_mark'] = upper
+        report.update(rows=rows, bytes=stats['size'], raw_bytes=stats['raw_size'], to_id=upper, file=filename,
+                      duration=round(time.monotonic() - started, 3))
+        return report
+
+    def run(self, tables: Optional[List[str]] = None) -> Dict[str, Dict]:
+        """
+        Exporte les nouvelles lignes des tables suivies
+
+        L'état est enregistré après chaque table: une exécution interrompue reprend au
+        dernier fichier complet.
+
+        Args:
+            tables: Sous-ensemble des tables suivies (toutes par défaut)
+
+        Returns:
+            Rapport par table (lignes, octets compressés et bruts, durée)
+        """
+        state = self.load_state()
+        reports = {}
+        for name in tables or list(self.tables):
+            try:
+                reports[name] = self.export_table(name, state)
+                self._save_state(state)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"Incremental backup of {name} failed: {e}")
+                reports[name] = {'error': str(e)}
+                continue
+            report = reports[name]
+            logger.info(f"Incremental backup {name}: {report['rows']} rows, {report['bytes']} bytes "
+                        f"in {report['duration']}s (ids {report['from_id']} -> {report['to_id']})")
+        return reports
+
+    # --- Rejeu ------------------------------------------------------------
+
+    def verify_chain(self, name: str) -> List[str]:
+        """Erreurs de la chaîne d'une table (fichiers manquants, sommes, continuité des ids)"""
+        errors = []
+        expected_from = 1
+        for entry in self.load_state().get(name, {}).get('files', []):
+            path = self.directory / entry['file']
+            if not path.exists():
+                errors.append(f"Missing file {entry['file']}")
+            elif file_sha256(path) != entry['sha256']:
+                errors.append(f"Checksum mismatch for {entry['file']}")
+            if entry['from_id'] != expected_from:
+                errors.append(f"Gap before {entry['file']} (expected id {expected_from})")
+            expected_from = entry['to_id'] + 1
+        return errors
+
+    def _iter_batches(self, path: Path, compression: str) -> Iterator[List[Dict]]:
+        batch = []
+        remainder = b''
+        for chunk in read_compressed(path, compression):
+            lines = (remainder + chunk).split(b'\n')
+            remainder = lines.pop()
+            for line in lines:
+                if line:
+                    batch.append(json.loads(line))
+                    if len(batch) >= REPLAY_BATCH_SIZE:
+                        yield batch
+                        batch = []
+        if remainder.strip():
+            batch.append(json.loads(remainder))
+        if batch:
+            yield batch
+
+    def _insert_batch(self, connection, table: Table, rows: List[Dict]) -> None:
+        if connection.dialect.name == 'postgresql':
+            # Conversion des types (jsonb, timestamp...) côté serveur
+            connection.execute(
+                text(f'INSERT INTO "{table.name}" SELECT * FROM json_populate_recordset(NULL::"{table.name}", :rows)'),
+                {'rows': json.dumps(rows)}
+            )
+            return
+        converters = {}
+        for column in table.columns:
+            if isinstance(column.type, DateTime):
+                converters[column.name] = datetime.fromisoformat
+            elif isinstance(column.type, Date):
+                converters[column.name] = date.fromisoformat
+        for row in rows:
+            for column_name, convert in converters.items():
+                if row.get(column_name) is not None:
+                    row[column_name] = convert(row[column_name])
+        connection.execute(table.insert(), rows)
+
+    def replay(self, tables: Optional[List[str]] = None, truncate: bool = True) -> Dict[str, Dict]:
+        """
+        Reconstruit les tables en rejouant la base puis les incréments
+
+        Args:
+            tables: Tables à reconstruire (toutes celles de l'état par défaut)
+            truncate: Vide chaque table avant le rejeu
+
+        Returns:
+            Rapport par table {rows, files, duration}
+
+        Raises:
+            BackupError: si une chaîne est incomplète ou altérée (aucune table n'est alors modifiée)
+        """
+        state = self.load_state()
+        names = tables or [name for name in self.tables if name in state]
+        for name in names:
+            errors = self.verify_chain(name)
+            if errors:
+                raise BackupError(f"Incremental chain of {name} is not valid: {'; '.join(errors)}")
+
+        reports = {}
+        for name in names:
+            started = time.monotonic()
+            table = self._table(name)
+            id_column = self.tables[name][0]
+            rows = 0
+            with db.engine.begin() as connection:
+                if truncate:
+                    connection.execute(table.delete())
+                for entry in state[name]['files']:
+                    for batch in self._iter_batches(self.directory / entry['file'], entry['compression']):
+                        self._insert_batch(connection, table, batch)
+                        rows += len(batch)
+                if connection.dialect.name == 'postgresql':
+                    connection.execute(text(
+                        f"SELECT setval(pg_get_serial_sequence('\"{name}\"', '{id_column}'), "
+                        f"COALESCE((SELECT MAX(\"{id_column}\") FROM \"{name}\"), 1))"
+                    ))
+            reports[name] = {'rows': rows, 'files': len(state[name]['files']),
+                             'duration': round(time.monotonic() - started, 3)}
+            logger.info(f"Replayed {name}: {rows} rows from {reports[name]['files']} files")
+        return reports
+
+    def status(self) -> Dict[str, Dict]:
+        """Taille, nombre de lignes et point de reprise de chaque chaîne"""
+        return {
+            name: {
+                'high_water_mark': entry['high_water_mark'],
+                'files': len(entry['files']),
+                'rows': sum(item['rows'] for item in entry['files']),
+                'bytes': sum(item['size'] for item in entry['files']),
+                'last_export': entry['files'][-1]['created'] if entry['files'] else None,
+            }
+            for name, entry in self.load_state().items()
+        }
+
+    # --- Planification ----------------------------------------------------
+
+    def _scheduled_run(self) -> None:
+        try:
+            with self._app.app_context():
+                self.run()
+        except Exception as e:
+            logger.error(f"Scheduled incremental backup failed: {e}")
+
+    def start_scheduler(self, app, interval_minutes: int = INCREMENTAL_INTERVAL) -> None:
+        """Démarre les exports incrémentaux périodiques"""
+        if self.scheduler is not None:
+            logger.warning("Incremental backup scheduler already running")
+            return
+
+        self._app = app
+        self.scheduler = BackgroundScheduler()
+        self.scheduler.add_job(
+            func=self._scheduled_run,
+            trigger='interval',
+            minutes=interval_minutes,
+            id='incremental_backup',
+            name='Incremental Telemetry Backup',
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
+        self.scheduler.start()
+        atexit.register(self.stop_scheduler)
+        logger.info(f"Incremental backup scheduler started (every {interval_minutes} min)")
+
+    def stop_scheduler(self) -> None:
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+            logger.info("Incremental backup scheduler stopped")
+
+
+incremental_backup = IncrementalBackup()
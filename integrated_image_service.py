@@ -32,7 +32,8 @@ class IntegratedImageService:
                                user_id: str = None,
                                entity_id: int = None,
                                model: str = "dall-e-3",
-                               size: str = "1024x1024") -> Dict[str, Any]:
+                               size: str = "1024x1024",
+                               background: bool = False) -> Dict[str, Any]:
         """
         Génère une image avec l'IA et la stocke de manière persistante
         
@@ -43,6 +44,7 @@ class IntegratedImageService:
             entity_id: ID de l'entité associée (optionnel)
             model: Modèle IA à utiliser
             size: Taille de l'image
+            background: Stocker l'image en arrière-plan et retourner immédiatement l'URL d'origine
             
         Returns:
             Dict contenant les informations de l'image générée et stockée
@@ -78,6 +80,26 @@ class IntegratedImageService:
                     "prompt": prompt
                 }
             
+            if background:
+                # Téléchargement, base et cache dans un worker: l'URL locale sera disponible plus tard
+                self.storage_manager.submit_download(
+                    url=image_url,
+                    prompt=prompt,
+                    model=model,
+                    image_type=image_type,
+                    user_id=user_id,
+                    entity_id=entity_id,
+                    size=size
+                )
+                return {
+                    "success": True,
+                    "from_cache": False,
+                    "pending": True,
+                    "image_hash": image_hash,
+                    "original_url": image_url,
+                    "prompt": prompt
+                }
+            
             # Stocker l'image localement
             stored_image = self.storage_manager.download_and_store_image(
                 url=image_url,
@@ -129,9 +151,14 @@ class IntegratedImageService:
         try:
             images = self.storage_manager.get_user_images(user_id, image_type, limit)
             
-            # Enrichir avec des URLs locales
+            # Enrichir avec des URLs locales: miniature pour la galerie, srcset pour les tailles supérieures
+            from image_derivatives import DERIVATIVE_WIDTHS
             for image in images:
                 image['local_url'] = f"/images/{image['filename']}"
+                image['thumbnail_url'] = f"/images/{image['filename']}?w={DERIVATIVE_WIDTHS[0]}"
+                image['srcset'] = ", ".join(
+                    f"/images/{image['filename']}?w={width} {width}w" for width in DERIVATIVE_WIDTHS
+                )
             
             return {
                 "success": True,
@@ -178,5 +205,28 @@ class IntegratedImageService:
                 "error": str(e)
             }
 
+    def collect_garbage(self, policy=None, dry_run: bool = True) -> Dict[str, Any]:
+        """
+        Passage du ramasse-miettes du stockage (âge, inactivité, quotas, orphelins)
+        
+        Args:
+            policy: ImageGCPolicy (défaut: configuration IMAGE_GC_* de l'environnement)
+            dry_run: Évaluer seulement les octets récupérables
+        """
+        from image_gc import ImageGCPolicy, image_gc
+        
+        try:
+            report = image_gc.run(policy or ImageGCPolicy.from_env(), dry_run=dry_run)
+            return {
+                "success": True,
+                "report": report
+            }
+        except Exception as e:
+            logger.error(f"Erreur lors du ramasse-miettes: {str(e)}")
+            return {
+                "success": False,
+                "error": str(e)
+            }
+
 # Instance globale du service
 integrated_image_service = IntegratedImageService()
\ No newline at end of file
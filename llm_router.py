@@ -0,0 +1,394 @@
+"""
+Routage adaptatif entre fournisseurs d'IA (xAI, OpenAI)
+
+Chaque fournisseur a, par opération (texte 'chat', 'image'), un disjoncteur (fermé / ouvert /
+semi-ouvert) et une fenêtre glissante de ses derniers appels (latence p95, taux d'erreur): des
+échecs de génération d'images ne coupent pas la génération de texte du même fournisseur.
+Une réponse reçue mais inutilisable (InvalidProviderResponse) déclenche le repli sans compter
+comme une panne du fournisseur. Pour une requête, les fournisseurs
+candidats sont classés par santé: un fournisseur dégradé est ouvert après des échecs
+répétés et n'est plus essayé avant la fin de son délai de refroidissement, où un appel test
+(semi-ouvert) décide de sa réouverture. La requête ne paie donc plus le timeout complet du
+fournisseur principal avant chaque repli.
+
+Optionnellement, une requête couverte (hedged) est envoyée au fournisseur suivant si le
+premier n'a pas répondu après LLM_HEDGE_AFTER secondes; la première réponse valide l'emporte.
+
+Les appelants (ai_utils, boutique_ai) fournissent les appels de chaque fournisseur; l'état
+de santé est partagé par l'instance globale llm_router.
+"""
+import contextvars
+import logging
+import math
+import os
+import threading
+import time
+from collections import deque
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Any, Callable, Deque, Dict, List, Optional, Sequence, Tuple
+
+logger = logging.getLogger(__name__)
+
+# Échecs consécutifs ouvrant le disjoncteur
+BREAKER_FAILURE_THRESHOLD = int(os.environ.get("LLM_BREAKER_FAILURES", "5"))
+# Taux d'erreur ouvrant le disjoncteur (sur au moins BREAKER_MIN_CALLS appels de la fenêtre)
+BREAKER_ERROR_RATE = float(os.environ.get("LLM_BREAKER_ERROR_RATE", "0.5"))
+BREAKER_MIN_CALLS = int(os.environ.get("LLM_BREAKER_MIN_CALLS", "10"))
+# Délai avant l'appel test d'un fournisseur ouvert (secondes)
+BREAKER_COOLDOWN = float(os.environ.get("LLM_BREAKER_COOLDOWN", "30"))
+# Fenêtre glissante: nombre d'appels et ancienneté maximale (secondes)
+WINDOW_SIZE = int(os.environ.get("LLM_WINDOW_SIZE", "100"))
+WINDOW_SECONDS = float(os.environ.get("LLM_WINDOW_SECONDS", "300"))
+# Délai avant la requête couverte vers le fournisseur suivant (secondes, 0 = désactivé)
+HEDGE_AFTER = float(os.environ.get("LLM_HEDGE_AFTER", "0"))
+# Timeout d'un appel et reprises internes du SDK OpenAI (le repli est assuré par le routeur)
+REQUEST_TIMEOUT = float(os.environ.get("LLM_REQUEST_TIMEOUT", "60"))
+CLIENT_MAX_RETRIES = int(os.environ.get("LLM_CLIENT_MAX_RETRIES", "1"))
+# Poids par fournisseur, ex: "xai=1,openai=0.8"
+PROVIDER_WEIGHTS = {
+    name.strip(): float(weight)
+    for name, weight in (item.split('=', 1) for item in os.environ.get("LLM_PROVIDER_WEIGHTS", "").split(',') if '=' in item)
+}
+# Bonus du fournisseur demandé par l'appelant: il n'est délaissé que pour un fournisseur nettement plus sain
+PREFERENCE_BONUS = 2.0
+# Latence supposée d'un fournisseur sans historique (secondes)
+DEFAULT_LATENCY = 1.0
+# Opération des appels sans précision (complétion de chat)
+DEFAULT_OPERATION = 'chat'
+
+CLOSED = 'closed'
+OPEN = 'open'
+HALF_OPEN = 'half_open'
+
+
+class ProviderUnavailableError(Exception):
+    """Aucun fournisseur candidat n'a pu traiter la requête"""
+
+    def __init__(self, message: str, errors: Optional[Dict[str, str]] = None):
+        super().__init__(message)
+        self.errors = errors or {}
+
+
+class InvalidProviderResponse(Exception):
+    """Réponse reçue mais inutilisable (ex: pas d'URL d'image): repli sans échec enregistré"""
+
+
+class ProviderHealth:
+    """Disjoncteur et statistiques glissantes d'un fournisseur pour une opération"""
+
+    def __init__(self, name: str, failure_threshold: int = BREAKER_FAILURE_THRESHOLD,
+                 error_rate_threshold: float = BREAKER_ERROR_RATE, min_calls: int = BREAKER_MIN_CALLS,
+                 cooldown: float = BREAKER_COOLDOWN, window_size: int = WINDOW_SIZE,
+                 window_seconds: float = WINDOW_SECONDS, clock: Callable[[], float] = time.monotonic):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.error_rate_threshold = error_rate_threshold
+        self.min_calls = min_calls
+        self.cooldown = cooldown
+        self.window_seconds = window_seconds
+        self._clock = clock
+        self._lock = threading.Lock()
+        self._calls: Deque[Tuple[float, float, bool]] = deque(maxlen=window_size)
+        self.state = CLOSED
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._probe_in_flight = False
+        self.total_calls = 0
+        self.total_failures = 0
+        self.invalid_responses = 0
+        self.last_error: Optional[str] = None
+
+    def _prune(self, now: float) -> None:
+        while self._calls and now - self._calls[0][0] > self.window_seconds:
+            self._calls.popleft()
+
+    def allow(self) -> bool:
+        """Autorise un appel (un seul appel test à la fois en semi-ouvert)"""
+        with self._lock:
+            if self.state == OPEN:
+                if self._clock() - self.opened_at < self.cooldown:
+                    return False
+                self.state = HALF_OPEN
+                self._probe_in_flight = False
+                logger.info(f"LLM provider {self.name} half-open, probing")
+            if self.state == HALF_OPEN:
+                if self._probe_in_flight:
+                    return False
+                self._probe_in_flight = True
+            return True
+
+    def _open(self, now: float) -> None:
+        if self.state != OPEN:
+            logger.warning(f"LLM provider {self.name} circuit opened "
+                           f"({self.consecutive_failures} consecutive failures, last error: {self.last_error})")
+        self.state = OPEN
+        self.opened_at = now
+        self._probe_in_flight = False
+
+    def record_success(self, latency: float) -> None:
+        with self._lock:
+            now = self._clock()
+            self._calls.append((now, latency, True))
+            self.total_calls += 1
+            self.consecutive_failures = 0
+            if self.state != CLOSED:
+                logger.info(f"LLM provider {self.name} circuit closed")
+            self.state = CLOSED
+            self._probe_in_flight = False
+
+    def release(self) -> None:
+        """Libère l'appel test d'un appel terminé sans verdict sur le fournisseur (erreur de l'appelant)"""
+        with self._lock:
+            self._probe_in_flight = False
+
+    def record_invalid(self, error: BaseException) -> None:
+        """Compte une réponse inutilisable sans la traiter comme une panne (l'appel test est libéré)"""
+        with self._lock:
+            self.invalid_responses += 1
+            self.last_error = f"{type(error).__name__}: {error}"[:300]
+            self._probe_in_flight = False
+
+    def record_failure(self, latency: float, error: BaseException) -> None:
+        with self._lock:
+            now = self._clock()
+            self._calls.append((now, latency, False))
+            self.total_calls += 1
+            self.total_failures += 1
+            self.consecutive_failures += 1
+            self.last_error = f"{type(error).__name__}: {error}"[:300]
+            if self.state == HALF_OPEN:
+                self._open(now)
+                return
+            self._prune(now)
+            failures = sum(1 for _, _, ok in self._calls if not ok)
+            if self.consecutive_failures >= self.failure_threshold or (
+                    len(self._calls) >= self.min_calls and failures / len(self._calls) >= self.error_rate_threshold):
+                self._open(now)
+
+    def error_rate(self) -> float:
+        with self._lock:
+            self._prune(self._clock())
+            if not self._calls:
+                return 0.0
+            return sum(1 for _, _, ok in self._calls if not ok) / len(self._calls)
+
+    def latency_p95(self) -> Optional[float]:
+        """Latence p95 des appels réussis de la fenêtre (secondes)"""
+        with self._lock:
+            self._prune(self._clock())
+            latencies = sorted(latency for _, latency, ok in self._calls if ok)
+        if not latencies:
+            return None
+        return latencies[min(len(latencies) - 1, math.ceil(0.95 * len(latencies)) - 1)]
+
+    def score(self, weight: float = 1.0) -> float:
+        """Santé relative: poids / (p95 x pénalité d'erreurs); 0 si le disjoncteur est ouvert"""
+        if self.state == OPEN and self._clock() - self.opened_at < self.cooldown:
+            return 0.0
+        latency = self.latency_p95() or DEFAULT_LATENCY
+        return weight / (max(latency, 0.01) * (1 + 4 * self.error_rate()))
+
+    def snapshot(self) -> Dict[str, Any]:
+        p95 = self.latency_p95()
+        with self._lock:
+            window_calls = len(self._calls)
+            retry_in = None
+            if self.state == OPEN:
+                retry_in = round(max(0.0, self.cooldown - (self._clock() - self.opened_at)), 1)
+        return {
+            'state': self.state,
+            'consecutive_failures': self.consecutive_failures,
+            'error_rate': round(self.error_rate(), 3),
+            'latency_p95_ms': round(p95 * 1000, 1) if p95 is not None else None,
+            'window_calls': window_calls,
+            'total_calls': self.total_calls,
+            'total_failures': self.total_failures,
+            'invalid_responses': self.invalid_responses,
+            'last_error': self.last_error,
+            'retry_in_seconds': retry_in,
+        }
+
+
+class LLMRouter:
+    """Choix du fournisseur, disjoncteurs et requêtes couvertes"""
+
+    def __init__(self, hedge_after: float = HEDGE_AFTER, weights: Optional[Dict[str, float]] = None,
+                 health_factory: Callable[[str], ProviderHealth] = ProviderHealth, max_workers: int = 8):
+        self.hedge_after = hedge_after
+        self.weights = PROVIDER_WEIGHTS if weights is None else weights
+        self._health_factory = health_factory
+        self._health: Dict[str, ProviderHealth] = {}
+        self._lock = threading.Lock()
+        self._max_workers = max_workers
+        self._executor: Optional[ThreadPoolExecutor] = None
+
+    def health(self, name: str, operation: str = DEFAULT_OPERATION) -> ProviderHealth:
+        """Santé d'un fournisseur pour une opération (clé 'fournisseur:opération')"""
+        key = f"{name}:{operation}"
+        provider = self._health.get(key)
+        if provider is None:
+            with self._lock:
+                provider = self._health.get(key)
+                if provider is None:
+                    provider = self._health.setdefault(key, self._health_factory(key))
+        return provider
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        """Workers des requêtes couvertes"""
+        if self._executor is None:
+            with self._lock:
+                if self._executor is None:
+                    self._executor = ThreadPoolExecutor(max_workers=self._max_workers, thread_name_prefix='llm-hedge')
+        return self._executor
+
+    def rank(self, names: Sequence[str], operation: str = DEFAULT_OPERATION) -> List[str]:
+        """Fournisseurs du plus sain au moins sain pour une opération (le premier demandé reçoit un bonus)"""
+        scores = {}
+        for position, name in enumerate(names):
+            weight = self.weights.get(name, 1.0) * (PREFERENCE_BONUS if position == 0 else 1.0)
+            scores[name] = self.health(name, operation).score(weight)
+        return sorted(names, key=lambda name: -scores[name])
+
+    def _attempt(self, health: ProviderHealth, call: Callable[[], Any],
+                 validate: Optional[Callable[[Any], bool]]) -> Any:
+        started = time.monotonic()
+        try:
+            result = call()
+            if validate is not None and not validate(result):
+                raise InvalidProviderResponse(f"Invalid response from {health.name}")
+        except InvalidProviderResponse as e:
+            # Le fournisseur a répondu: repli sans dégrader sa santé
+            health.record_invalid(e)
+            raise
+        except BaseException as e:
+            # Une erreur de l'appelant (ex: budget de tokens épuisé) ne dégrade pas le fournisseur
+            if getattr(e, 'provider_fault', True):
+                health.record_failure(time.monotonic() - started, e)
+            else:
+                health.release()
+            raise
+        health.record_success(time.monotonic() - started)
+        return result
+
+    def execute(self, candidates: Sequence[Tuple[str, Callable[[], Any]]],
+                validate: Optional[Callable[[Any], bool]] = None, hedge_after: Optional[float] = None,
+                operation: str = DEFAULT_OPERATION) -> Any:
+        """
+        Exécute la requête sur le fournisseur le plus sain, avec repli sur les suivants
+
+        Args:
+            candidates: Paires (fournisseur, appel sans argument), par ordre de préférence
+            validate: Prédicat sur le résultat; un résultat refusé déclenche le repli sans compter comme un échec
+            hedge_after: Délai avant la requête couverte (secondes, 0 = désactivé, défaut: LLM_HEDGE_AFTER)
+            operation: Opération dont la santé est suivie ('chat', 'image')
+
+        Returns:
+            Résultat du premier appel réussi
+
+        Raises:
+            ProviderUnavailableError: si tous les fournisseurs ont échoué ou sont ouverts
+            Exception: une erreur marquée provider_fault = False est propagée sans repli
+        """
+        calls = dict(candidates)
+        order = self.rank([name for name, _ in candidates], operation)
+        hedge_after = self.hedge_after if hedge_after is None else hedge_after
+        errors: Dict[str, str] = {}
+
+        if hedge_after and len(order) > 1:
+            result = self._execute_hedged(order, calls, validate, hedge_after, errors, operation)
+            if result is not _NO_RESULT:
+                return result
+        else:
+            for name in order:
+                health = self.health(name, operation)
+                if not health.allow():
+                    errors[name] = 'circuit open'
+                    continue
+                try:
+                    return self._attempt(health, calls[name], validate)
+                except Exception as e:
+                    if not getattr(e, 'provider_fault', True):
+                        raise
+                    errors[name] = f"{type(e).__name__}: {e}"
+                    logger.warning(f"LLM provider {name} failed, trying next provider: {e}")
+
+        raise ProviderUnavailableError(
+            "All LLM providers failed: " + "; ".join(f"{name}: {error}" for name, error in errors.items()), errors
+        )
+
+    def _execute_hedged(self, order: List[str], calls: Dict[str, Callable[[], Any]],
+                        validate: Optional[Callable[[Any], bool]], hedge_after: float, errors: Dict[str, str],
+                        operation: str = DEFAULT_OPERATION) -> Any:
+        """Lance le fournisseur suivant si le précédent n'a pas répondu après hedge_after secondes"""
+        pending: Dict[Any, str] = {}
+        remaining = list(order)
+
+        def launch_next() -> bool:
+            while remaining:
+                name = remaining.pop(0)
+                health = self.health(name, operation)
+                if not health.allow():
+                    errors[name] = 'circuit open'
+                    continue
+                # Le contexte (requête Flask, utilisateur facturé) suit l'appel dans le worker
+                context = contextvars.copy_context()
+                pending[self.executor.submit(context.run, self._attempt, health, calls[name], validate)] = name
+                return True
+            return False
+
+        launch_next()
+        while pending:
+            done, _ = wait(list(pending), timeout=hedge_after if remaining else None, return_when=FIRST_COMPLETED)
+            if not done:
+                logger.info(f"LLM hedging: {', '.join(pending.values())} slower than {hedge_after}s")
+                launch_next()
+                continue
+            for future in done:
+                name = pending.pop(future)
+                try:
+                    result = future.result()
+                except Exception as e:
+                    if not getattr(e, 'provider_fault', True):
+                        raise
+                    errors[name] = f"{type(e).__name__}: {e}"
+                    logger.warning(f"LLM provider {name} failed: {e}")
+                    continue
+                # Les requêtes perdantes s'achèvent en arrière-plan et alimentent les statistiques
+                for other in pending.values():
+                    errors.pop(other, None)
+                return result
+            if not pending:
+                launch_next()
+        return _NO_RESULT
+
+    def reset(self, name: Optional[str] = None) -> None:
+        """Réinitialise la santé d'un fournisseur pour une opération ('xai:image'), toutes ('xai') ou de tous"""
+        with self._lock:
+            if name is None:
+                self._health.clear()
+            elif ':' in name:
+                self._health.pop(name, None)
+            else:
+                for key in [key for key in self._health if key.split(':', 1)[0] == name]:
+                    del self._health[key]
+
+    def state(self) -> Dict[str, Any]:
+        """État des disjoncteurs et statistiques par fournisseur et opération"""
+        keys = list(self._health)
+        operations: Dict[str, List[str]] = {}
+        for key in keys:
+            name, operation = key.split(':', 1)
+            operations.setdefault(operation, []).append(name)
+        return {
+            'hedge_after_seconds': self.hedge_after,
+            'ranking': {operation: self.rank(names, operation) for operation, names in operations.items()},
+            'providers': {key: dict(self._health[key].snapshot(), weight=self.weights.get(key.split(':', 1)[0], 1.0))
+                          for key in keys},
+        }
+
+
+_NO_RESULT = object()
+
+# Instance globale (santé partagée par tous les appelants)
+llm_router = LLMRouter()
@@ -297,7 +297,12 @@ class CustomerPersona(db.Model):
     @classmethod
     def create_from_dict(cls, persona_data, niche_market_id=None, boutique_id=None):
         """Create a CustomerPersona instance from dictionary data"""
-        return cls(
+        return cls(**cls.mapping_from_dict(persona_data, niche_market_id, boutique_id))
+
+    @staticmethod
+    def mapping_from_dict(persona_data, niche_market_id=None, boutique_id=None):
+        """Build the column mapping of a persona from dictionary data (used by bulk inserts)"""
+        return dict(
             title=persona_data.get('title'),
             description=persona_data.get('description'),
             primary_goal=persona_data.get('primary_goal'),
@@ -420,6 +425,11 @@ class Customer(db.Model):
     @classmethod
     def from_profile_dict(cls, profile_dict, niche_market_id=None):
         """Create a Customer instance from a profile dictionary"""
+        return cls(**cls.mapping_from_profile_dict(profile_dict, niche_market_id))
+
+    @staticmethod
+    def mapping_from_profile_dict(profile_dict, niche_market_id=None):
+        """Build the column mapping of a customer from a profile dictionary (used by bulk inserts)"""
         interests = profile_dict.get('interests', [])
         interests_str = ', '.join(interests) if interests else None
 
@@ -452,7 +462,7 @@ class Customer(db.Model):
         avatar_url = profile_dict.get('avatar_url')
         avatar_prompt = profile_dict.get('avatar_prompt')
 
-        return cls(
+        return dict(
             name=profile_dict.get('name'),
             age=profile_dict.get('age'),
             location=profile_dict.get('location'),
@@ -549,19 +559,24 @@ class Campaign(db.Model):
         return (self.conversion_count / self.click_count) * 100
 
     def log_view(self):
-        """Incrémente le compteur de vues"""
-        self.view_count += 1
-        db.session.commit()
+        """Incrémente le compteur de vues (écriture différée, voir campaign_counters)"""
+        from campaign_counters import campaign_counters
+        campaign_counters.increment(self.id, 'view')
 
     def log_click(self):
-        """Incrémente le compteur de clics"""
-        self.click_count += 1
-        db.session.commit()
+        """Incrémente le compteur de clics (écriture différée, voir campaign_counters)"""
+        from campaign_counters import campaign_counters
+        campaign_counters.increment(self.id, 'click')
 
     def log_conversion(self):
-        """Incrémente le compteur de conversions"""
-        self.conversion_count += 1
-        db.session.commit()
+        """Incrémente le compteur de conversions (écriture différée, voir campaign_counters)"""
+        from campaign_counters import campaign_counters
+        campaign_counters.increment(self.id, 'conversion')
+
+    def get_counters(self):
+        """Compteurs exacts: valeurs en base + événements pas encore écrits"""
+        from campaign_counters import campaign_counters
+        return campaign_counters.current_counts(self)
 
     def publish(self):
         """Publie la campagne"""
@@ -796,6 +811,8 @@ class OSPAnalysis(db.Model):
     # Input data and results - utilisant la colonne 'content' existante dans la base
     content = db.Column(JSONB, nullable=True)  # Stored as JSON with the analysis results
     html_result = db.Column(db.Text, nullable=True, name="html_result")  # Optional HTML rendering of results
+    # Empreinte des entrées (osp_cache): analyse réutilisée tant qu'elle correspond, effacée si la source est modifiée
+    input_hash = db.Column(db.String(100), nullable=True, index=True)
 
     # Timestamps
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
@@ -831,10 +848,16 @@ class Metric(db.Model):
     # Foreign keys optionnels
     user_id = db.Column(db.String, nullable=True)       # ID utilisateur associé (si pertinent) - Accepte UUID ou Integer sous forme de chaîne
     customer_id = db.Column(db.Integer, db.ForeignKey('customer.id', ondelete='SET NULL'), nullable=True)
+    campaign_id = db.Column(db.Integer, db.ForeignKey('campaign.id', ondelete='SET NULL'), nullable=True)
 
     # Relation avec Customer (optionnelle)
     customer = db.relationship('Customer', backref=db.backref('metrics', lazy=True))
 
+    __table_args__ = (
+        # Jointure métriques d'API -> campagnes (voir campaign_analytics)
+        db.Index('idx_metric_name_campaign', 'name', 'campaign_id'),
+    )
+
     def __repr__(self):
         return f'<Metric {self.name} ({self.category})>'
 
@@ -894,7 +917,16 @@ class StoredImage(db.Model):
     # URLs et chemins
     original_url = db.Column(db.Text, nullable=False)  # URL originale de l'IA
     local_path = db.Column(db.Text, nullable=False)    # Chemin local du fichier
-    filename = db.Column(db.String(255), nullable=False)
+    filename = db.Column(db.String(255), nullable=False, index=True)
+    
+    # Déclinaisons responsives {'w256.webp': {filename, width, height, file_size, content_type}, ...}
+    variants = db.Column(JSONB, nullable=True)
+    
+    # Empreintes perceptuelles 64 bits (signées) et partage du fichier entre quasi-doublons (voir image_dedup)
+    dhash = db.Column(db.BigInteger, nullable=True)
+    ahash = db.Column(db.BigInteger, nullable=True)
+    canonical_id = db.Column(db.Integer, db.ForeignKey('stored_images.id'), nullable=True, index=True)
+    ref_count = db.Column(db.Integer, default=1)
     
     # Métadonnées de génération
     prompt = db.Column(db.Text, nullable=False)
@@ -922,6 +954,13 @@ class StoredImage(db.Model):
     # Relations
     user = db.relationship('User', backref=db.backref('stored_images', lazy=True))
     
+    __table_args__ = (
+        # Parcours du ramasse-miettes par date de création et par dernier usage (voir image_gc)
+        db.Index('idx_stored_images_created', 'created_at', 'id'),
+        db.Index('idx_stored_images_last_used', db.func.coalesce(last_accessed, created_at), id),
+        db.Index('idx_stored_images_user_last_used', user_id, db.func.coalesce(last_accessed, created_at)),
+    )
+    
     def to_dict(self):
         """Convertit l'objet en dictionnaire pour le cache et l'API"""
         return {
@@ -939,6 +978,8 @@ class StoredImage(db.Model):
             'user_id': self.user_id,
             'entity_id': self.entity_id,
             'is_permanent': self.is_permanent,
+            'variants': {key: value for key, value in (self.variants or {}).items() if not key.startswith('_')},
+            'canonical_id': self.canonical_id,
             'access_count': self.access_count,
             'last_accessed': self.last_accessed.isoformat() if self.last_accessed else None,
             'created_at': self.created_at.isoformat(),
@@ -946,10 +987,14 @@ class StoredImage(db.Model):
         }
     
     def mark_accessed(self):
-        """Marque l'image comme récemment accédée"""
-        self.access_count += 1
-        self.last_accessed = datetime.utcnow()
-        db.session.commit()
+        """
+        Marque l'image comme récemment accédée
+        
+        L'accès est compté en mémoire et écrit en base par lots (voir image_serving),
+        sans commit par affichage.
+        """
+        from image_serving import image_access_counter
+        image_access_counter.hit(self.id)
     
     def __repr__(self):
         return f'<StoredImage {self.filename} ({self.image_type})>'
@@ -1072,6 +1117,36 @@ class UserActivity(db.Model):
         """Récupère les activités récentes d'un utilisateur"""
         return UserActivity.query.filter_by(user_id=user_id).order_by(UserActivity.created_at.desc()).limit(limit).all()
 
+class LLMUsage(db.Model):
+    """Consommation agrégée des appels LLM par jour, utilisateur, modèle et fonctionnalité (voir token_accounting)"""
+    __tablename__ = 'llm_usage'
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    user_id = db.Column(db.String(64), nullable=False, default='')  # '' = appels hors session utilisateur (tâches de fond)
+    model = db.Column(db.String(100), nullable=False)
+    feature = db.Column(db.String(100), nullable=False)
+    calls = db.Column(db.Integer, nullable=False, default=0)
+    prompt_tokens = db.Column(db.BigInteger, nullable=False, default=0)
+    completion_tokens = db.Column(db.BigInteger, nullable=False, default=0)
+    cost_usd = db.Column(db.Float, nullable=False, default=0.0)
+
+    __table_args__ = (
+        UniqueConstraint('day', 'user_id', 'model', 'feature', name='uq_llm_usage_key'),
+    )
+
+    def __repr__(self):
+        return f'<LLMUsage {self.day} {self.user_id or "-"} {self.model} {self.feature}>'
+
+class CampaignCounterBatch(db.Model):
+    """Lots de compteurs de campagnes déjà appliqués en base (voir campaign_counters)"""
+    __tablename__ = 'campaign_counter_batches'
+    batch_id = db.Column(db.String(100), primary_key=True)
+    campaigns = db.Column(db.Integer, nullable=False, default=0)
+    applied_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+
+    def __repr__(self):
+        return f'<CampaignCounterBatch {self.batch_id}>'
+
 # Ajouter d'autres modèles selon les besoins
 
 # Classe OSPAnalysisType est déjà définie plus haut dans le fichier
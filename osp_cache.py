@@ -0,0 +1,202 @@
+"""
+Mémoïsation des résultats des outils OSP (carte de valeur, analyse de contenu, SEO)
+
+La clé d'un résultat est l'empreinte de ses entrées, calculée par prompt_registry.cache_key
+(nom et version du template, variables de rendu, paramètres de génération): modifier le
+texte d'un prompt change toutes ses clés. Un appel au modèle n'est fait qu'en l'absence:
+- d'un résultat récent en mémoire (résultats non sauvegardés, OSP_CACHE_SIZE entrées)
+- d'une analyse OSPAnalysis enregistrée avec la même empreinte (colonne input_hash)
+
+Modifier un Product ou une Campaign efface l'empreinte des analyses qui lui sont rattachées
+et retire ses résultats de la mémoire: ils ne sont plus réutilisés.
+"""
+import logging
+import os
+import threading
+from collections import OrderedDict
+from typing import Any, Callable, Dict, FrozenSet, Mapping, Optional, Tuple
+
+from sqlalchemy import event, inspect, update
+
+from app import db
+from models import Campaign, OSPAnalysis, OSPAnalysisType, Product
+from prompt_registry import prompt_registry
+
+logger = logging.getLogger(__name__)
+
+# Résultats non sauvegardés gardés en mémoire (les analyses enregistrées sont relues en base)
+OSP_CACHE_SIZE = int(os.environ.get("OSP_CACHE_SIZE", "256"))
+
+# Template de prompt de chaque type d'analyse
+ANALYSIS_PROMPTS = {
+    OSPAnalysisType.VALUE_MAP: 'osp_value_map',
+    OSPAnalysisType.CONTENT_ANALYSIS: 'osp_content_analysis',
+    OSPAnalysisType.SEO_OPTIMIZATION: 'osp_seo_guidelines',
+}
+
+# Colonnes dont la modification n'invalide pas les analyses d'une source (compteurs, horodatage)
+IGNORED_SOURCE_COLUMNS = frozenset({'updated_at', 'view_count', 'click_count', 'conversion_count'})
+
+Source = Tuple[str, int]
+
+
+def stored_result(analysis_type: OSPAnalysisType, content: Any) -> Any:
+    """
+    Résultat de l'outil tel que les routes /osp-tools/* l'enregistrent dans OSPAnalysis.content
+
+    Carte de valeur: le résultat lui-même; analyse de contenu: content['results'];
+    SEO: la clé 'seo' du contenu optimisé content['results'].
+    """
+    if analysis_type == OSPAnalysisType.VALUE_MAP:
+        return content
+    results = (content or {}).get('results')
+    if analysis_type == OSPAnalysisType.SEO_OPTIMIZATION:
+        return (results or {}).get('seo')
+    return results
+
+
+class OSPResultCache:
+    """Résultats OSP par empreinte des entrées, en mémoire puis dans les analyses enregistrées"""
+
+    def __init__(self, max_entries: int = OSP_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._lock = threading.Lock()
+        self._memory: "OrderedDict[str, Tuple[Any, FrozenSet[Source]]]" = OrderedDict()
+        self._stats = {'memory_hits': 0, 'database_hits': 0, 'misses': 0, 'invalidated_analyses': 0,
+                       'invalidated_entries': 0}
+
+    def _count(self, **increments: int) -> None:
+        with self._lock:
+            for name, increment in increments.items():
+                self._stats[name] += increment
+
+    @staticmethod
+    def input_hash(analysis_type: OSPAnalysisType, inputs: Mapping[str, Any]) -> str:
+        """Empreinte des entrées d'une analyse (voir PromptRegistry.cache_key)"""
+        return prompt_registry.cache_key(ANALYSIS_PROMPTS[analysis_type], None, inputs)
+
+    def _remember(self, key: str, result: Any, sources: FrozenSet[Source]) -> None:
+        with self._lock:
+            self._memory[key] = (result, sources)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.max_entries:
+                self._memory.popitem(last=False)
+
+    def get_or_compute(self, analysis_type: OSPAnalysisType, inputs: Mapping[str, Any],
+                       compute: Callable[[], Any], product_id: Optional[int] = None,
+                       campaign_id: Optional[int] = None,
+                       cache_context: Optional[Dict[str, Any]] = None) -> Any:
+        """
+        Résultat mémoïsé d'une analyse OSP
+
+        Args:
+            analysis_type: Type d'analyse
+            inputs: Entrées de l'analyse (variables du prompt et paramètres de génération)
+            compute: Génération du résultat (appel au modèle); une exception n'est pas mise en cache
+            product_id: Produit source (invalidation à sa modification)
+            campaign_id: Campagne source (invalidation à sa modification)
+            cache_context: Dictionnaire complété avec input_hash et source ('memory',
+                'database' ou 'model'), par exemple pour enregistrer l'analyse avec son empreinte
+
+        Returns:
+            Résultat de l'analyse
+        """
+        key = self.input_hash(analysis_type, inputs)
+        sources = frozenset(source for source in (('product', product_id), ('campaign', campaign_id)) if source[1])
+        if cache_context is not None:
+            cache_context['input_hash'] = key
+
+        with self._lock:
+            entry = self._memory.get(key)
+            if entry is not None:
+                self._memory.move_to_end(key)
+        if entry is not None:
+            self._count(memory_hits=1)
+            origin, result = 'memory', entry[0]
+        else:
+            row = (OSPAnalysis.query
+                   .filter(OSPAnalysis.input_hash == key, OSPAnalysis.analysis_type == analysis_type)
+                   .order_by(OSPAnalysis.updated_at.desc())
+                   .first())
+            result = stored_result(analysis_type, row.content) if row is not None else None
+            if result is not None:
+                self._count(database_hits=1)
+                origin = 'database'
+            else:
+                result = compute()
+                self._count(misses=1)
+                origin = 'model'
+            if result is not None:
+                self._remember(key, result, sources)
+
+        if cache_context is not None:
+            cache_context['source'] = origin
+        logger.debug(f"OSP {analysis_type.value} {key}: {origin}")
+        return result
+
+    def invalidate(self, source_type: str, source_id: int, connection=None) -> int:
+        """
+        Invalide les résultats issus d'un produit ou d'une campagne
+
+        Args:
+            source_type: 'product' ou 'campaign'
+            source_id: ID de la source
+            connection: Connexion à utiliser (celle du flush dans un événement ORM)
+
+        Returns:
+            Nombre d'analyses enregistrées dont l'empreinte a été effacée
+        """
+        source = (source_type, source_id)
+        with self._lock:
+            stale = [key for key, (_, sources) in self._memory.items() if source in sources]
+            for key in stale:
+                del self._memory[key]
+
+        column = OSPAnalysis.__table__.c[f"{source_type}_id"]
+        stmt = (update(OSPAnalysis.__table__)
+                .where(column == source_id, OSPAnalysis.__table__.c.input_hash.isnot(None))
+                .values(input_hash=None))
+        if connection is None:
+            rowcount = db.session.execute(stmt).rowcount
+        else:
+            rowcount = connection.execute(stmt).rowcount
+        self._count(invalidated_analyses=rowcount, invalidated_entries=len(stale))
+        if rowcount or stale:
+            logger.info(f"OSP cache: {source_type} {source_id} modified, {rowcount} analyses and "
+                        f"{len(stale)} cached results invalidated")
+        return rowcount
+
+    def clear(self) -> None:
+        with self._lock:
+            self._memory.clear()
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+            stats['entries'] = len(self._memory)
+        hits = stats['memory_hits'] + stats['database_hits']
+        lookups = hits + stats['misses']
+        stats['lookups'] = lookups
+        stats['hit_rate'] = round(hits / lookups, 3) if lookups else 0.0
+        return stats
+
+
+osp_result_cache = OSPResultCache()
+
+
+def _content_changed(target) -> bool:
+    state = inspect(target)
+    return any(state.attrs[prop.key].history.has_changes()
+               for prop in state.mapper.column_attrs if prop.key not in IGNORED_SOURCE_COLUMNS)
+
+
+@event.listens_for(Product, 'after_update')
+def _product_updated(mapper, connection, target):
+    if _content_changed(target):
+        osp_result_cache.invalidate('product', target.id, connection)
+
+
+@event.listens_for(Campaign, 'after_update')
+def _campaign_updated(mapper, connection, target):
+    if _content_changed(target):
+        osp_result_cache.invalidate('campaign', target.id, connection)
@@ -8,6 +8,9 @@ import os
 from flask import render_template
 
 from ai_utils import AIManager
+from models import OSPAnalysisType
+from osp_cache import osp_result_cache
+from prompt_registry import prompt_registry
 
 # Initialisation du gestionnaire d'IA
 ai_manager = AIManager(
@@ -15,6 +18,97 @@ ai_manager = AIManager(
     xai_api_key=os.environ.get("XAI_API_KEY")
 )
 
+# Templates des prompts OSP (compilés au chargement par prompt_registry)
+prompt_registry.register_many({
+    'osp_value_map': """
+        Crée une carte de valeur complète pour le produit suivant selon la méthodologie OSP.
+
+        ## Informations sur le produit
+        - Nom du produit: {product_name}
+        - Description: {product_description}
+        - Audience cible: {target_audience}
+        - Secteur: {industry}{optional_lines}
+
+        ## Structure de la carte de valeur requise
+        Renvoie un objet JSON structuré contenant:
+
+        1. taglines: Liste de 3 phrases d'accroche percutantes (max 15 mots chacune)
+        2. position_statements: Liste de 2 déclarations de positionnement complètes (format "Pour [audience], [nom du produit] est [avantage clé] qui [différenciation]."
+        3. value_propositions: Liste de 4-6 propositions de valeur avec pour chacune:
+           - title: Titre court (3-5 mots)
+           - description: Description de la proposition de valeur (1-2 phrases)
+           - benefits: Liste de 2-3 avantages spécifiques
+        4. unique_selling_points: Liste de 3-4 points de vente uniques, chacun avec:
+           - title: Titre court du point de vente unique
+           - comparative_advantage: Avantage par rapport à la concurrence
+        5. audiences: Liste de 2-3 segments d'audience, chacun avec:
+           - segment: Nom du segment (ex: "Propriétaires de boutiques en ligne")
+           - needs: Liste de 2-3 besoins spécifiques
+           - pain_points: Liste de 2-3 points de douleur
+           - journey_stage: Étape du parcours client qui correspond le mieux à ce segment
+        6. keywords: Liste de 8-10 mots-clés pertinents pour le SEO, classés par priorité
+
+        Réponds uniquement avec l'objet JSON, sans texte supplémentaire.
+    """,
+    'osp_content_analysis': """
+        Analyse le contenu suivant selon les directives OSP et fournit des recommandations d'amélioration.
+
+        ## Contenu à analyser ({content_type})
+        {content}{context_sections}
+
+        ## Directives d'analyse OSP
+        Analyse le contenu selon les critères suivants et fournit des recommandations précises:
+
+        1. Clarté et concision: Le message est-il clair et direct?
+        2. Structure et organisation: Le contenu est-il bien structuré?
+        3. Tonalité et voix: Le ton est-il approprié pour l'audience?
+        4. Positionnement: Le contenu positionne-t-il correctement le produit/service?
+        5. Appel à l'action: Les actions souhaitées sont-elles clairement définies?
+        6. SEO optimisation: Le contenu utilise-t-il efficacement les mots-clés?
+        7. Adaptation à l'audience: Le contenu répond-il aux besoins spécifiques de l'audience?
+
+        Pour chaque point, noter de 1-5 et fournir des suggestions d'amélioration avec exemples concrets.
+
+        Réponds avec un objet JSON contenant:
+
+        1. scores: Objet avec les notes pour chaque critère
+        2. strengths: Liste des points forts du contenu (3-5 éléments)
+        3. weaknesses: Liste des points à améliorer (3-5 éléments)
+        4. recommendations: Liste de recommandations spécifiques (4-6 éléments)
+        5. improved_examples: Exemples de passages améliorés (2-3 exemples)
+    """,
+    'osp_seo_guidelines': """
+        Optimise les métadonnées SEO pour le contenu suivant selon les directives OSP.
+
+        ## Contenu
+        - Titre: {title}
+        - Description: {description}
+        - Type de page: {page_type}
+        - Locale: {locale}
+        - Entreprise locale: {local_business}
+
+        ## Directives SEO OSP
+        Génère un objet JSON contenant les éléments suivants optimisés pour le SEO:
+
+        1. meta_title: Titre meta optimisé (max 60 caractères)
+        2. meta_description: Description meta (max 160 caractères)
+        3. h1: Titre principal optimisé
+        4. schema_markup: Structure de données schema.org appropriée pour ce type de page
+        5. alt_text_suggestions: Suggestions de texte alternatif pour les images
+        6. structured_data: Données structurées supplémentaires si nécessaires
+        7. url_slug: Slug d'URL optimisé pour le SEO
+        8. keywords: Liste de mots-clés pertinents (primaires et secondaires)
+        9. local_seo: Optimisations spécifiques pour le SEO local (si applicable)
+
+        Réponds uniquement avec l'objet JSON, sans texte supplémentaire.
+    """,
+})
+
+
+def _optional_lines(*fields) -> str:
+    """Lignes '- libellé: valeur' des champs renseignés, chacune précédée d'un saut de ligne"""
+    return ''.join(f"\n- {label}: {value}" for label, value in fields if value)
+
 def generate_product_value_map(
     product_name: str,
     product_description: str,
@@ -23,10 +117,16 @@ def generate_product_value_map(
     niche_market: Optional[str] = None,
     key_features: Optional[List[str]] = None,
     competitors: Optional[List[str]] = None,
+    product_id: Optional[int] = None,
+    campaign_id: Optional[int] = None,
+    cache_context: Optional[Dict] = None,
 ) -> Dict:
     """
     Génère une carte de valeur produit selon la méthodologie OSP
     
+    Le résultat est mémoïsé par osp_cache: des entrées identiques réutilisent la carte
+    déjà générée ou enregistrée sans appeler le modèle.
+    
     Args:
         product_name: Nom du produit
         product_description: Description détaillée du produit
@@ -35,63 +135,43 @@ def generate_product_value_map(
         niche_market: Créneau de marché spécifique (optionnel)
         key_features: Liste des fonctionnalités clés (optionnel)
         competitors: Liste des concurrents principaux (optionnel)
+        product_id: Produit source (le résultat est invalidé à sa modification)
+        campaign_id: Campagne source (le résultat est invalidé à sa modification)
+        cache_context: Dictionnaire complété avec l'empreinte des entrées et l'origine du
+            résultat (voir OSPResultCache.get_or_compute)
     
     Returns:
         Dictionnaire contenant la carte de valeur complète
     """
-    # Construction du prompt
-    prompt = f"""
-    Crée une carte de valeur complète pour le produit suivant selon la méthodologie OSP.
-    
-    ## Informations sur le produit
-    - Nom du produit: {product_name}
-    - Description: {product_description}
-    - Audience cible: {target_audience}
-    - Secteur: {industry}
-    """
-    
-    if niche_market:
-        prompt += f"- Créneau de marché: {niche_market}\n"
-    if key_features:
-        prompt += f"- Fonctionnalités clés: {', '.join(key_features)}\n"
-    if competitors:
-        prompt += f"- Concurrents: {', '.join(competitors)}\n"
-    
-    prompt += """
-    ## Structure de la carte de valeur requise
-    Renvoie un objet JSON structuré contenant:
-    
-    1. taglines: Liste de 3 phrases d'accroche percutantes (max 15 mots chacune)
-    2. position_statements: Liste de 2 déclarations de positionnement complètes (format "Pour [audience], [nom du produit] est [avantage clé] qui [différenciation]."
-    3. value_propositions: Liste de 4-6 propositions de valeur avec pour chacune:
-       - title: Titre court (3-5 mots)
-       - description: Description de la proposition de valeur (1-2 phrases)
-       - benefits: Liste de 2-3 avantages spécifiques
-    4. unique_selling_points: Liste de 3-4 points de vente uniques, chacun avec:
-       - title: Titre court du point de vente unique
-       - comparative_advantage: Avantage par rapport à la concurrence
-    5. audiences: Liste de 2-3 segments d'audience, chacun avec:
-       - segment: Nom du segment (ex: "Propriétaires de boutiques en ligne")
-       - needs: Liste de 2-3 besoins spécifiques
-       - pain_points: Liste de 2-3 points de douleur
-       - journey_stage: Étape du parcours client qui correspond le mieux à ce segment
-    6. keywords: Liste de 8-10 mots-clés pertinents pour le SEO, classés par priorité
-
-    Réponds uniquement avec l'objet JSON, sans texte supplémentaire.
-    """
-    
-    # Génération du contenu avec l'IA
-    try:
+    values = dict(
+        product_name=product_name,
+        product_description=product_description,
+        target_audience=target_audience,
+        industry=industry,
+        optional_lines=_optional_lines(
+            ("Créneau de marché", niche_market),
+            ("Fonctionnalités clés", ', '.join(key_features) if key_features else None),
+            ("Concurrents", ', '.join(competitors) if competitors else None),
+        ),
+    )
+    
+    def generate():
         value_map = ai_manager.generate_json(
-            prompt=prompt,
+            prompt=prompt_registry.render('osp_value_map', **values),
             metric_name="osp_product_value_map_generation",
             max_tokens=1500
         )
         
-        # Validation de la structure
+        # Validation de la structure (une carte invalide n'est pas mise en cache)
         validate_value_map(value_map)
-        
         return value_map
+    
+    # Génération du contenu avec l'IA
+    try:
+        return osp_result_cache.get_or_compute(
+            OSPAnalysisType.VALUE_MAP, dict(values, max_tokens=1500), generate,
+            product_id=product_id, campaign_id=campaign_id, cache_context=cache_context
+        )
     except Exception as e:
         print(f"Erreur lors de la génération de la carte de valeur: {str(e)}")
         # Renvoyer une structure minimale en cas d'erreur
@@ -152,64 +232,51 @@ def analyze_content_with_osp_guidelines(
     content: str,
     content_type: str = "product_description",
     target_audience: Optional[str] = None,
-    industry: Optional[str] = None
+    industry: Optional[str] = None,
+    product_id: Optional[int] = None,
+    campaign_id: Optional[int] = None,
+    cache_context: Optional[Dict] = None
 ) -> Dict:
     """
     Analyse le contenu selon les directives OSP et fournit des recommandations
     
+    Le résultat est mémoïsé par osp_cache (voir generate_product_value_map).
+    
     Args:
         content: Le contenu à analyser
         content_type: Type de contenu (product_description, landing_page, email, etc.)
         target_audience: Description de l'audience cible (optionnel)
         industry: Secteur d'activité (optionnel)
+        product_id: Produit source (optionnel)
+        campaign_id: Campagne source (optionnel)
+        cache_context: Empreinte des entrées et origine du résultat (optionnel)
         
     Returns:
         Dictionnaire contenant l'analyse et les recommandations
     """
-    prompt = f"""
-    Analyse le contenu suivant selon les directives OSP et fournit des recommandations d'amélioration.
-    
-    ## Contenu à analyser ({content_type})
-    {content}
-    
-    """
-    
-    if target_audience:
-        prompt += f"\n## Audience cible\n{target_audience}\n"
-    if industry:
-        prompt += f"\n## Secteur d'activité\n{industry}\n"
-    
-    prompt += """
-    ## Directives d'analyse OSP
-    Analyse le contenu selon les critères suivants et fournit des recommandations précises:
-    
-    1. Clarté et concision: Le message est-il clair et direct?
-    2. Structure et organisation: Le contenu est-il bien structuré?
-    3. Tonalité et voix: Le ton est-il approprié pour l'audience?
-    4. Positionnement: Le contenu positionne-t-il correctement le produit/service?
-    5. Appel à l'action: Les actions souhaitées sont-elles clairement définies?
-    6. SEO optimisation: Le contenu utilise-t-il efficacement les mots-clés?
-    7. Adaptation à l'audience: Le contenu répond-il aux besoins spécifiques de l'audience?
-    
-    Pour chaque point, noter de 1-5 et fournir des suggestions d'amélioration avec exemples concrets.
-    
-    Réponds avec un objet JSON contenant:
-    
-    1. scores: Objet avec les notes pour chaque critère
-    2. strengths: Liste des points forts du contenu (3-5 éléments)
-    3. weaknesses: Liste des points à améliorer (3-5 éléments)
-    4. recommendations: Liste de recommandations spécifiques (4-6 éléments)
-    5. improved_examples: Exemples de passages améliorés (2-3 exemples)
-    """
-    
-    try:
-        analysis = ai_manager.generate_json(
-            prompt=prompt,
+    context_sections = ''.join(
+        f"\n\n## {title}\n{value}"
+        for title, value in (("Audience cible", target_audience), ("Secteur d'activité", industry))
+        if value
+    )
+    values = dict(
+        content=content,
+        content_type=content_type,
+        context_sections=context_sections,
+    )
+    
+    def generate():
+        return ai_manager.generate_json(
+            prompt=prompt_registry.render('osp_content_analysis', **values),
             metric_name="osp_content_analysis",
             max_tokens=1500
         )
-        
-        return analysis
+    
+    try:
+        return osp_result_cache.get_or_compute(
+            OSPAnalysisType.CONTENT_ANALYSIS, dict(values, max_tokens=1500), generate,
+            product_id=product_id, campaign_id=campaign_id, cache_context=cache_context
+        )
     except Exception as e:
         print(f"Erreur lors de l'analyse du contenu: {str(e)}")
         return {
@@ -224,16 +291,24 @@ def apply_seo_guidelines(
     content: Dict,
     page_type: str = "product",
     locale: str = "fr_FR",
-    is_local_business: bool = True
+    is_local_business: bool = True,
+    product_id: Optional[int] = None,
+    campaign_id: Optional[int] = None,
+    cache_context: Optional[Dict] = None
 ) -> Dict:
     """
     Applique les directives SEO d'OSP au contenu
     
+    Les métadonnées SEO sont mémoïsées par osp_cache (voir generate_product_value_map).
+    
     Args:
         content: Dictionnaire contenant le contenu à optimiser
         page_type: Type de page (product, category, landing, blog, etc.)
         locale: Code de langue et pays (fr_FR, en_US, etc.)
         is_local_business: Indique si l'entreprise est locale
+        product_id: Produit source (optionnel)
+        campaign_id: Campagne source (optionnel)
+        cache_context: Empreinte des entrées et origine du résultat (optionnel)
         
     Returns:
         Dictionnaire contenant le contenu optimisé avec métadonnées SEO
@@ -242,39 +317,26 @@ def apply_seo_guidelines(
     title = content.get("title", "")
     description = content.get("description", "")
     
-    # Construction du prompt
-    prompt = f"""
-    Optimise les métadonnées SEO pour le contenu suivant selon les directives OSP.
-    
-    ## Contenu
-    - Titre: {title}
-    - Description: {description}
-    - Type de page: {page_type}
-    - Locale: {locale}
-    - Entreprise locale: {"Oui" if is_local_business else "Non"}
-    
-    ## Directives SEO OSP
-    Génère un objet JSON contenant les éléments suivants optimisés pour le SEO:
-    
-    1. meta_title: Titre meta optimisé (max 60 caractères)
-    2. meta_description: Description meta (max 160 caractères)
-    3. h1: Titre principal optimisé
-    4. schema_markup: Structure de données schema.org appropriée pour ce type de page
-    5. alt_text_suggestions: Suggestions de texte alternatif pour les images
-    6. structured_data: Données structurées supplémentaires si nécessaires
-    7. url_slug: Slug d'URL optimisé pour le SEO
-    8. keywords: Liste de mots-clés pertinents (primaires et secondaires)
-    9. local_seo: Optimisations spécifiques pour le SEO local (si applicable)
-    
-    Réponds uniquement avec l'objet JSON, sans texte supplémentaire.
-    """
-    
-    try:
-        seo_optimized = ai_manager.generate_json(
-            prompt=prompt,
+    values = dict(
+        title=title,
+        description=description,
+        page_type=page_type,
+        locale=locale,
+        local_business="Oui" if is_local_business else "Non",
+    )
+    
+    def generate():
+        return ai_manager.generate_json(
+            prompt=prompt_registry.render('osp_seo_guidelines', **values),
             metric_name="osp_seo_optimization",
             max_tokens=1000
         )
+    
+    try:
+        seo_optimized = osp_result_cache.get_or_compute(
+            OSPAnalysisType.SEO_OPTIMIZATION, dict(values, max_tokens=1000), generate,
+            product_id=product_id, campaign_id=campaign_id, cache_context=cache_context
+        )
         
         # Fusion avec le contenu original
         optimized_content = content.copy()
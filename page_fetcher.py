@@ -0,0 +1,210 @@
+"""
+Téléchargement des pages produit avec pool de connexions et cache disque
+
+Réimporter ou régénérer un produit ne retélécharge plus sa page:
+- le HTML brut et le texte extrait (trafilatura) sont conservés compressés (gzip) sur disque,
+  sous une clé normalisée (ID produit), pendant PAGE_CACHE_TTL secondes
+- une entrée expirée est revalidée par requête conditionnelle (If-None-Match /
+  If-Modified-Since): un 304 prolonge l'entrée sans retélécharger ni réextraire
+- une erreur réseau sur une entrée expirée sert la version en cache plutôt que d'échouer
+
+Les requêtes passent par une session requests partagée (connexions HTTP réutilisées), hors de
+la boucle d'événements (asyncio.to_thread), avec une limite de requêtes simultanées par hôte.
+"""
+import asyncio
+import gzip
+import json
+import logging
+import os
+import re
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Callable, Dict, Optional
+from urllib.parse import urlparse
+
+import requests
+from requests.adapters import HTTPAdapter
+
+logger = logging.getLogger(__name__)
+
+try:
+    import trafilatura
+except ImportError:
+    logger.warning("trafilatura package not found. Page text extraction disabled.")
+    trafilatura = None
+
+# Répertoire du cache des pages téléchargées
+PAGE_CACHE_DIR = Path(os.environ.get("PAGE_CACHE_DIR", "cache/pages"))
+# Durée (secondes) pendant laquelle une page en cache est servie sans revalidation
+PAGE_CACHE_TTL = int(os.environ.get("PAGE_CACHE_TTL", "86400"))
+# Requêtes simultanées maximum vers un même hôte
+PAGE_FETCH_PER_HOST = int(os.environ.get("PAGE_FETCH_PER_HOST", "4"))
+# Connexions gardées ouvertes par hôte dans le pool
+PAGE_FETCH_POOL_SIZE = int(os.environ.get("PAGE_FETCH_POOL_SIZE", "10"))
+# Délai maximum (secondes) d'un téléchargement
+PAGE_FETCH_TIMEOUT = float(os.environ.get("PAGE_FETCH_TIMEOUT", "15"))
+
+USER_AGENT = "Mozilla/5.0 (X11; Linux x86_64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/124.0 Safari/537.36"
+
+
+class PageFetchError(Exception):
+    """Page impossible à télécharger et absente du cache"""
+
+
+class PageCache:
+    """Entrées {url, html, text, etag, last_modified, fetched_at} compressées, une par fichier"""
+
+    def __init__(self, directory: Path = PAGE_CACHE_DIR, ttl: float = PAGE_CACHE_TTL,
+                 clock: Callable[[], float] = time.time):
+        self.directory = Path(directory)
+        self.ttl = ttl
+        self.clock = clock
+
+    def _path(self, key: str) -> Path:
+        return self.directory / f"{re.sub(r'[^A-Za-z0-9_.-]', '_', key)}.json.gz"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Entrée en cache (fraîche ou expirée), None si absente ou illisible"""
+        path = self._path(key)
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as handle:
+                return json.load(handle)
+        except FileNotFoundError:
+            return None
+        except (OSError, ValueError) as e:
+            logger.warning(f"Unreadable page cache entry {path.name}: {e}")
+            return None
+
+    def put(self, key: str, entry: Dict[str, Any]) -> None:
+        """Écrit une entrée (écriture dans un fichier temporaire puis renommage atomique)"""
+        self.directory.mkdir(parents=True, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as raw, gzip.GzipFile(fileobj=raw, mode='wb') as handle:
+                handle.write(json.dumps(entry, ensure_ascii=False).encode('utf-8'))
+            os.replace(tmp_path, self._path(key))
+        except BaseException:
+            Path(tmp_path).unlink(missing_ok=True)
+            raise
+
+    def is_fresh(self, entry: Dict[str, Any]) -> bool:
+        return self.clock() - entry.get('fetched_at', 0) < self.ttl
+
+    def delete(self, key: str) -> None:
+        self._path(key).unlink(missing_ok=True)
+
+
+class PageFetcher:
+    """Téléchargement de pages via une session partagée, cache disque et revalidation conditionnelle"""
+
+    def __init__(self, cache: Optional[PageCache] = None, session: Optional[requests.Session] = None,
+                 per_host: int = PAGE_FETCH_PER_HOST, timeout: float = PAGE_FETCH_TIMEOUT):
+        self.cache = cache or PageCache()
+        self.session = session or self._build_session()
+        self.per_host = per_host
+        self.timeout = timeout
+        self._lock = threading.Lock()
+        self._host_slots: Dict[str, threading.BoundedSemaphore] = {}
+        self._stats = {'hits': 0, 'misses': 0, 'revalidated': 0, 'stale_served': 0,
+                       'downloads': 0, 'errors': 0, 'bytes': 0}
+
+    @staticmethod
+    def _build_session() -> requests.Session:
+        session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=PAGE_FETCH_POOL_SIZE, pool_maxsize=PAGE_FETCH_POOL_SIZE, max_retries=1)
+        session.mount('http://', adapter)
+        session.mount('https://', adapter)
+        session.headers.update({'User-Agent': USER_AGENT, 'Accept-Language': 'en-US,en;q=0.8,fr;q=0.6'})
+        return session
+
+    def _count(self, **increments: int) -> None:
+        with self._lock:
+            for name, increment in increments.items():
+                self._stats[name] += increment
+
+    def _host_slot(self, url: str) -> threading.BoundedSemaphore:
+        host = urlparse(url).netloc.lower()
+        with self._lock:
+            if host not in self._host_slots:
+                self._host_slots[host] = threading.BoundedSemaphore(self.per_host)
+            return self._host_slots[host]
+
+    @staticmethod
+    def extract_text(html: str) -> str:
+        if trafilatura is None:
+            return ''
+        return trafilatura.extract(html) or ''
+
+    def fetch(self, url: str, key: Optional[str] = None) -> Dict[str, Any]:
+        """
+        Page (HTML brut et texte extrait), depuis le cache si possible
+
+        Args:
+            url: URL à télécharger
+            key: Clé de cache (ex: ID produit normalisé), l'URL par défaut
+
+        Returns:
+            Dictionnaire url, html, text, fetched_at et source ('cache', 'revalidated',
+            'network' ou 'stale')
+
+        Raises:
+            PageFetchError: Si la page ne peut être ni téléchargée ni servie depuis le cache
+        """
+        key = key or url
+        entry = self.cache.get(key)
+        if entry is not None and self.cache.is_fresh(entry):
+            self._count(hits=1)
+            return dict(entry, source='cache')
+
+        headers = {}
+        if entry is not None:
+            if entry.get('etag'):
+                headers['If-None-Match'] = entry['etag']
+            if entry.get('last_modified'):
+                headers['If-Modified-Since'] = entry['last_modified']
+
+        try:
+            with self._host_slot(url):
+                response = self.session.get(url, headers=headers, timeout=self.timeout)
+            if response.status_code == 304 and entry is not None:
+                entry['fetched_at'] = self.cache.clock()
+                self.cache.put(key, entry)
+                self._count(revalidated=1)
+                return dict(entry, source='revalidated')
+            response.raise_for_status()
+        except requests.RequestException as e:
+            self._count(errors=1)
+            if entry is not None:
+                logger.warning(f"Fetching {url} failed ({e}), serving cached copy")
+                self._count(stale_served=1)
+                return dict(entry, source='stale')
+            raise PageFetchError(f"Unable to download {url}: {e}") from e
+
+        html = response.text
+        entry = {
+            'url': url,
+            'html': html,
+            'text': self.extract_text(html),
+            'etag': response.headers.get('ETag'),
+            'last_modified': response.headers.get('Last-Modified'),
+            'fetched_at': self.cache.clock(),
+        }
+        self.cache.put(key, entry)
+        self._count(misses=1, downloads=1, bytes=len(response.content))
+        return dict(entry, source='network')
+
+    async def afetch(self, url: str, key: Optional[str] = None) -> Dict[str, Any]:
+        """Version asynchrone de fetch (téléchargement dans un thread, hors de la boucle)"""
+        return await asyncio.to_thread(self.fetch, url, key)
+
+    def stats(self) -> Dict[str, Any]:
+        with self._lock:
+            stats = dict(self._stats)
+        lookups = stats['hits'] + stats['revalidated'] + stats['misses']
+        stats['hit_rate'] = round((stats['hits'] + stats['revalidated']) / lookups, 3) if lookups else 0.0
+        return stats
+
+
+page_fetcher = PageFetcher()
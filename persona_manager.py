@@ -9,6 +9,7 @@ from sqlalchemy import func
 from app import db
 from models import Customer, CustomerPersona, CustomerPersonaAssociation, NicheMarket, Boutique
 import boutique_ai as ai_module
+from token_accounting import token_accountant
 
 def create_persona_from_text(
     title: str,
@@ -118,7 +119,7 @@ async def enrich_persona_with_ai(
     # Générer l'enrichissement avec l'IA
     try:
         # Si on a un client IA configuré, l'utiliser directement
-        openai_client = ai_module.get_openai_client(api_key)
+        openai_client = token_accountant.metered(ai_module.get_openai_client(api_key), 'persona_manager')
         
         # Construire un prompt spécifique pour enrichir le persona
         prompt = f"""
@@ -313,6 +314,11 @@ def find_matching_personas(
     """
     Recherche des personas correspondant à des critères spécifiques
     
+    Les résultats sont classés par pertinence: score plein texte sur le titre et
+    la description, plus les correspondances sur les attributs structurés
+    (age_range, income_bracket, price_sensitivity, gender_affinity, education_level).
+    Voir persona_search pour les backends (PostgreSQL tsvector/pg_trgm ou index mémoire).
+    
     Args:
         criteria: Dictionnaire de critères de recherche
         limit: Nombre maximum de résultats
@@ -320,45 +326,17 @@ def find_matching_personas(
         boutique_id: Filtrer par boutique (optionnel)
         
     Returns:
-        Liste de personas correspondant aux critères
+        Liste de personas correspondant aux critères, du plus au moins pertinent
     """
-    query = CustomerPersona.query
-    
-    # Appliquer les filtres de base
-    if niche_market_id:
-        query = query.filter_by(niche_market_id=niche_market_id)
-    
-    if boutique_id:
-        query = query.filter_by(boutique_id=boutique_id)
-    
-    # Appliquer les critères de recherche
-    if 'title' in criteria:
-        query = query.filter(CustomerPersona.title.ilike(f"%{criteria['title']}%"))
-    
-    if 'age_range' in criteria:
-        query = query.filter(CustomerPersona.age_range == criteria['age_range'])
-    
-    if 'gender_affinity' in criteria:
-        query = query.filter(CustomerPersona.gender_affinity == criteria['gender_affinity'])
-    
-    if 'income_bracket' in criteria:
-        query = query.filter(CustomerPersona.income_bracket == criteria['income_bracket'])
-    
-    if 'education_level' in criteria:
-        query = query.filter(CustomerPersona.education_level == criteria['education_level'])
-    
-    if 'price_sensitivity' in criteria:
-        query = query.filter(CustomerPersona.price_sensitivity == criteria['price_sensitivity'])
-    
-    # Appliquer une recherche textuelle sur la description
-    if 'description_keywords' in criteria and criteria['description_keywords']:
-        keywords = criteria['description_keywords'].split()
-        for keyword in keywords:
-            query = query.filter(CustomerPersona.description.ilike(f"%{keyword}%"))
+    from persona_search import persona_search_engine
     
-    # Exécuter la requête avec limite
-    personas = query.limit(limit).all()
-    return personas
+    results = persona_search_engine.search(
+        criteria,
+        limit=limit,
+        niche_market_id=niche_market_id,
+        boutique_id=boutique_id
+    )
+    return [persona for persona, _ in results]
 
 def get_personas_stats() -> Dict:
     """
@@ -399,72 +377,65 @@ def get_personas_stats() -> Dict:
         'personas_by_boutique': dict(personas_by_boutique)
     }
 
-def convert_legacy_personas() -> int:
+def convert_legacy_personas(batch_size: int = 500) -> int:
     """
     Convertit les anciens personas (stockés comme texte dans la table Customer) 
     en instances CustomerPersona structurées
     
+    Les clients sont parcourus par pages (pagination par clé sur l'id) et chaque page
+    est convertie en une transaction via bulk_ingest (INSERT multi-lignes + associations).
+    
+    Args:
+        batch_size: Nombre de clients convertis par transaction
+        
     Returns:
         Nombre de personas convertis
     """
-    # Récupérer tous les clients avec un persona défini
-    customers = Customer.query.filter(Customer.persona.isnot(None)).all()
+    from bulk_ingest import attach_personas
+    
+    # Clients ayant déjà un persona principal structuré: ne pas les reconvertir
+    has_primary = db.session.query(CustomerPersonaAssociation.id).filter(
+        CustomerPersonaAssociation.customer_id == Customer.id,
+        CustomerPersonaAssociation.is_primary.is_(True)
+    ).exists()
     
     count = 0
-    for customer in customers:
-        # Vérifier si le client a déjà un persona structuré assigné
-        existing_primary = CustomerPersonaAssociation.query.filter_by(
-            customer_id=customer.id,
-            is_primary=True
-        ).first()
+    last_id = 0
+    while True:
+        customers = Customer.query.filter(
+            Customer.persona.isnot(None),
+            Customer.id > last_id,
+            ~has_primary
+        ).order_by(Customer.id).limit(batch_size).all()
         
-        # Ne pas créer de nouveau persona si le client a déjà un persona principal
-        if existing_primary:
-            continue
+        if not customers:
+            break
+        last_id = customers[-1].id
         
-        print(f"Traitement du client: {customer.name}")
-            
-        # Créer un nouveau persona à partir du texte
         try:
-            # Pour éviter les erreurs d'âge négatif
-            age_range = None
-            if customer.age:
-                min_age = max(18, customer.age - 5)  # Minimum 18 ans
-                max_age = customer.age + 5
-                age_range = f"{min_age}-{max_age}"
-            
-            persona = create_persona_from_text(
-                title=f"Persona pour {customer.name}",
-                description=customer.persona or f"Profil de {customer.name}",
-                niche_market_id=customer.niche_market_id,
-                boutique_id=customer.boutique_id,
-                additional_data={
-                    'age_range': age_range,
-                    'gender_affinity': customer.gender,
-                    'income_bracket': customer.income_level,
-                    'education_level': customer.education,
+            attach_personas([
+                (customer.id, {
+                    'name': customer.name,
+                    'age': customer.age,
+                    'persona': customer.persona,
+                    'gender': customer.gender,
+                    'income_level': customer.income_level,
+                    'education': customer.education,
                     'avatar_url': customer.avatar_url,
-                    'avatar_prompt': customer.avatar_prompt
-                }
-            )
+                    'avatar_prompt': customer.avatar_prompt,
+                    'niche_market_id': customer.niche_market_id,
+                    'boutique_id': customer.boutique_id
+                })
+                for customer in customers
+            ], notes="Persona converti depuis l'ancien format.", batch_size=batch_size)
             
-            # Assigner le persona au client
-            assign_persona_to_customer(
-                customer_id=customer.id,
-                persona_id=persona.id,
-                is_primary=True,
-                relevance_score=1.0,
-                notes="Persona converti depuis l'ancien format."
-            )
-            
-            # Commit après chaque persona pour éviter une longue transaction
+            # Un commit par page pour éviter une longue transaction
             db.session.commit()
-            
-            count += 1
-            print(f"Persona créé et assigné avec succès pour {customer.name}")
+            count += len(customers)
+            print(f"{len(customers)} personas convertis et assignés (jusqu'au client {last_id})")
         except Exception as e:
-            print(f"Erreur lors de la conversion du persona pour le client {customer.id}: {e}")
-            # Continuer malgré l'erreur
+            print(f"Erreur lors de la conversion des personas jusqu'au client {last_id}: {e}")
+            # Continuer malgré l'erreur avec la page suivante
             db.session.rollback()
     
-    return count
\ No newline at end of file
+    return count
@@ -0,0 +1,527 @@
+"""
+Moteur de recherche des personas clients avec classement par pertinence
+
+Deux backends:
+- PostgreSQL: colonne générée search_vector (tsvector, accents supprimés par unaccent)
+  + index GIN, index pg_trgm sur le titre et index lower() sur les attributs
+  (voir add_persona_search_index.py)
+- Mémoire: index inversé local (BM25) utilisé pour SQLite, les tests et tant que
+  la migration n'a pas été appliquée
+
+Le score combine la pertinence textuelle (titre + description) et les correspondances
+sur les attributs structurés (age_range, income_bracket, price_sensitivity, ...).
+"""
+import heapq
+import logging
+import math
+import re
+import threading
+import time
+import unicodedata
+from collections import Counter, defaultdict
+from datetime import datetime
+from typing import Dict, List, Optional, Set, Tuple
+
+from sqlalchemy import event, or_, text
+
+from app import db
+from models import CustomerPersona
+
+logger = logging.getLogger(__name__)
+
+# Poids des correspondances sur les attributs structurés (ajoutés au score textuel)
+ATTRIBUTE_WEIGHTS = {
+    'age_range': 1.0,
+    'income_bracket': 1.0,
+    'price_sensitivity': 1.0,
+    'gender_affinity': 0.5,
+    'education_level': 0.5,
+}
+
+# Un mot du titre compte autant que TITLE_WEIGHT mots de la description
+TITLE_WEIGHT = 3
+
+# Paramètres BM25
+BM25_K1 = 1.2
+BM25_B = 0.75
+
+# Taille de corpus à partir de laquelle les mots trop fréquents sont ignorés
+COMMON_TOKEN_MIN_DOCS = 1000
+
+# Intervalle minimal entre deux synchronisations de l'index mémoire avec la base
+REFRESH_INTERVAL = 2.0
+
+_TOKEN_RE = re.compile(r'\w+', re.UNICODE)
+
+
+def tokenize(value: Optional[str], fold_accents: bool = True) -> List[str]:
+    """
+    Découpe un texte en mots normalisés (minuscules, sans accents par défaut)
+
+    Args:
+        value: Texte à découper
+        fold_accents: Supprimer les accents ("économe" -> "econome")
+
+    Returns:
+        Liste de mots d'au moins 2 caractères
+    """
+    if not value:
+        return []
+    value = value.lower()
+    if fold_accents and not value.isascii():
+        value = ''.join(
+            c for c in unicodedata.normalize('NFKD', value) if not unicodedata.combining(c)
+        )
+    return [token for token in _TOKEN_RE.findall(value) if len(token) > 1]
+
+
+def _normalize_attr(value) -> Optional[str]:
+    """Normalise une valeur d'attribut structuré pour la comparaison"""
+    if value is None or value == '':
+        return None
+    return ' '.join(str(value).split()).lower()
+
+
+def _split_criteria(criteria: Dict) -> Tuple[List[str], List[str], Dict[str, str]]:
+    """Sépare les critères en mots du titre, mots de la description et attributs structurés"""
+    title_tokens = tokenize(criteria.get('title'))
+    keyword_tokens = tokenize(criteria.get('description_keywords'))
+    attributes = {
+        name: _normalize_attr(criteria[name])
+        for name in ATTRIBUTE_WEIGHTS
+        if _normalize_attr(criteria.get(name)) is not None
+    }
+    return title_tokens, keyword_tokens, attributes
+
+
+class InMemoryPersonaIndex:
+    """
+    Index inversé en mémoire des personas
+
+    Les documents sont indexés par mot (titre pondéré + description) et par valeur
+    d'attribut structuré. La recherche est un OU pondéré classé par score BM25
+    auquel s'ajoutent les poids des attributs correspondants.
+    """
+
+    def __init__(self):
+        self._lock = threading.RLock()
+        self._postings: Dict[str, Dict[int, int]] = defaultdict(dict)
+        self._attr_postings: Dict[Tuple[str, str], Set[int]] = defaultdict(set)
+        self._scope_postings: Dict[Tuple[str, int], Set[int]] = defaultdict(set)
+        self._docs: Dict[int, Dict] = {}
+        self._total_length = 0
+
+    def __len__(self):
+        return len(self._docs)
+
+    def add(self, persona_id: int, title: Optional[str], description: Optional[str],
+            niche_market_id: Optional[int] = None, boutique_id: Optional[int] = None,
+            **attributes) -> None:
+        """Ajoute ou remplace un persona dans l'index"""
+        weights = Counter()
+        for token in tokenize(title):
+            weights[token] += TITLE_WEIGHT
+        for token in tokenize(description):
+            weights[token] += 1
+
+        attrs = {
+            name: _normalize_attr(attributes.get(name))
+            for name in ATTRIBUTE_WEIGHTS
+            if _normalize_attr(attributes.get(name)) is not None
+        }
+
+        with self._lock:
+            self.remove(persona_id)
+            for token, weight in weights.items():
+                self._postings[token][persona_id] = weight
+            for name, value in attrs.items():
+                self._attr_postings[(name, value)].add(persona_id)
+            if niche_market_id is not None:
+                self._scope_postings[('niche_market_id', niche_market_id)].add(persona_id)
+            if boutique_id is not None:
+                self._scope_postings[('boutique_id', boutique_id)].add(persona_id)
+            length = sum(weights.values())
+            self._docs[persona_id] = {
+                'niche_market_id': niche_market_id,
+                'boutique_id': boutique_id,
+                'length': length,
+                'tokens': list(weights),
+                'attrs': attrs,
+            }
+            self._total_length += length
+
+    def add_persona(self, persona) -> None:
+        """Ajoute un objet (ou une ligne) CustomerPersona dans l'index"""
+        self.add(
+            persona.id, persona.title, persona.description,
+            niche_market_id=persona.niche_market_id,
+            boutique_id=persona.boutique_id,
+            **{name: getattr(persona, name, None) for name in ATTRIBUTE_WEIGHTS}
+        )
+
+    def remove(self, persona_id: int) -> None:
+        """Retire un persona de l'index (sans effet s'il est absent)"""
+        with self._lock:
+            doc = self._docs.pop(persona_id, None)
+            if doc is None:
+                return
+            for token in doc['tokens']:
+                postings = self._postings.get(token)
+                if postings is not None:
+                    postings.pop(persona_id, None)
+                    if not postings:
+                        del self._postings[token]
+            for name, value in doc['attrs'].items():
+                ids = self._attr_postings.get((name, value))
+                if ids is not None:
+                    ids.discard(persona_id)
+                    if not ids:
+                        del self._attr_postings[(name, value)]
+            for scope in ('niche_market_id', 'boutique_id'):
+                ids = self._scope_postings.get((scope, doc[scope]))
+                if ids is not None:
+                    ids.discard(persona_id)
+                    if not ids:
+                        del self._scope_postings[(scope, doc[scope])]
+            self._total_length -= doc['length']
+
+    def _allowed_ids(self, niche_market_id: Optional[int], boutique_id: Optional[int]) -> Optional[Set[int]]:
+        """Ensemble des personas autorisés par les filtres niche/boutique (None = pas de filtre)"""
+        allowed = None
+        if niche_market_id is not None:
+            allowed = self._scope_postings.get(('niche_market_id', niche_market_id), set())
+        if boutique_id is not None:
+            ids = self._scope_postings.get(('boutique_id', boutique_id), set())
+            allowed = ids if allowed is None else allowed & ids
+        return allowed
+
+    def _attribute_tiers(self, attributes: Dict[str, str], allowed: Optional[Set[int]],
+                         exclude: Set[int], needed: int) -> List[Tuple[int, float]]:
+        """
+        Personas classés uniquement par attributs structurés
+
+        Les combinaisons d'attributs sont parcourues par poids décroissant; les personas
+        correspondant exactement à une combinaison sont obtenus par opérations ensemblistes
+        (intersection des attributs présents, moins l'union des attributs absents).
+        """
+        sets = {
+            name: self._attr_postings.get((name, value), set())
+            for name, value in attributes.items()
+        }
+        names = [name for name in sets if sets[name]]
+        combos = []
+        for mask in range(1, 1 << len(names)):
+            included = [names[i] for i in range(len(names)) if mask & (1 << i)]
+            combos.append((sum(ATTRIBUTE_WEIGHTS[name] for name in included), included))
+        combos.sort(key=lambda combo: -combo[0])
+
+        results = []
+        for score, included in combos:
+            ids = set.intersection(*(sets[name] for name in sorted(included, key=lambda n: len(sets[n]))))
+            for name in names:
+                if name not in included and ids:
+                    ids = ids - sets[name]
+            if allowed is not None:
+                ids &= allowed
+            ids -= exclude
+            for persona_id in heapq.nsmallest(needed - len(results), ids):
+                results.append((persona_id, score))
+            if len(results) >= needed:
+                break
+        return results
+
+    def search(self, criteria: Dict, limit: int = 5, niche_market_id: Optional[int] = None,
+               boutique_id: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        Recherche les personas les plus pertinents
+
+        Les personas correspondant au texte sont classés par score BM25 augmenté des poids
+        des attributs qu'ils partagent avec les critères. Si la page n'est pas complète, elle
+        est complétée par les personas ne correspondant que par leurs attributs.
+
+        Args:
+            criteria: Critères (title, description_keywords, age_range, income_bracket, ...)
+            limit: Nombre maximum de résultats
+            niche_market_id: Filtrer par niche de marché (optionnel)
+            boutique_id: Filtrer par boutique (optionnel)
+
+        Returns:
+            Liste de tuples (persona_id, score) triés par score décroissant
+        """
+        title_tokens, keyword_tokens, attributes = _split_criteria(criteria)
+
+        with self._lock:
+            doc_count = len(self._docs)
+            if not doc_count or limit <= 0:
+                return []
+            avg_length = (self._total_length / doc_count) or 1.0
+            allowed = self._allowed_ids(niche_market_id, boutique_id)
+            docs = self._docs
+
+            # Sur un gros corpus, les mots présents dans plus de la moitié des documents
+            # n'apportent presque rien au classement: on les ignore s'il reste des mots plus rares
+            query_tokens = Counter(title_tokens + keyword_tokens)
+            if doc_count >= COMMON_TOKEN_MIN_DOCS:
+                rare_tokens = {
+                    token: count for token, count in query_tokens.items()
+                    if 0 < len(self._postings.get(token, ())) <= doc_count / 2
+                }
+                if rare_tokens:
+                    query_tokens = rare_tokens
+
+            scores: Dict[int, float] = defaultdict(float)
+            for token, query_count in query_tokens.items():
+                postings = self._postings.get(token)
+                if not postings:
+                    continue
+                df = len(postings)
+                idf = math.log(1 + (doc_count - df + 0.5) / (df + 0.5))
+                for persona_id, weight in postings.items():
+                    if allowed is not None and persona_id not in allowed:
+                        continue
+                    length = docs[persona_id]['length']
+                    norm = weight + BM25_K1 * (1 - BM25_B + BM25_B * length / avg_length)
+                    scores[persona_id] += query_count * idf * weight * (BM25_K1 + 1) / norm
+
+            if attributes:
+                for persona_id in scores:
+                    doc_attrs = docs[persona_id]['attrs']
+                    for name, value in attributes.items():
+                        if doc_attrs.get(name) == value:
+                            scores[persona_id] += ATTRIBUTE_WEIGHTS[name]
+
+            results = heapq.nlargest(limit, scores.items(), key=lambda item: (item[1], -item[0]))
+
+            if attributes and len(results) < limit:
+                results.extend(self._attribute_tiers(attributes, allowed, set(scores), limit - len(results)))
+
+            return results
+
+class PersonaSearchEngine:
+    """
+    Point d'entrée de la recherche de personas
+
+    Utilise la recherche plein texte PostgreSQL quand la colonne search_vector existe,
+    sinon l'index mémoire synchronisé par incréments (id / updated_at) avec la base.
+    """
+
+    def __init__(self):
+        self.memory_index = InMemoryPersonaIndex()
+        self._pg_search_available = None
+        self._sync_lock = threading.Lock()
+        self._max_indexed_id = 0
+        self._last_updated_at = None
+        self._last_sync = 0.0
+        self._dirty = True
+
+    def mark_dirty(self) -> None:
+        """Force une synchronisation de l'index mémoire à la prochaine recherche"""
+        self._dirty = True
+
+    def reset(self) -> None:
+        """Vide l'index mémoire et oublie le backend détecté"""
+        with self._sync_lock:
+            self.memory_index = InMemoryPersonaIndex()
+            self._pg_search_available = None
+            self._max_indexed_id = 0
+            self._last_updated_at = None
+            self._last_sync = 0.0
+            self._dirty = True
+
+    def uses_postgres(self) -> bool:
+        """Indique si la recherche plein texte PostgreSQL est disponible"""
+        if self._pg_search_available is None:
+            available = False
+            try:
+                if db.engine.dialect.name == 'postgresql':
+                    # Colonne créée par une version antérieure de la migration (sans unaccent):
+                    # index mémoire jusqu'à ce que add_persona_search_index.py soit relancé
+                    available = db.session.execute(text(
+                        "SELECT 1 FROM information_schema.columns "
+                        "WHERE table_name = 'customer_persona' AND column_name = 'search_vector' "
+                        "AND generation_expression LIKE '%persona_unaccent%'"
+                    )).first() is not None
+            except Exception as e:
+                logger.warning(f"Persona search backend detection failed: {e}")
+            self._pg_search_available = available
+            logger.info(f"Persona search backend: {'postgresql' if available else 'memory'}")
+        return self._pg_search_available
+
+    def sync(self, force: bool = False) -> int:
+        """
+        Synchronise l'index mémoire avec la table customer_persona
+
+        Seuls les personas créés (id > dernier id indexé) ou modifiés depuis la dernière
+        synchronisation sont relus. Les suppressions sont détectées au moment de la recherche.
+
+        Returns:
+            Nombre de personas (ré)indexés
+        """
+        now = time.time()
+        if not force and not self._dirty and now - self._last_sync < REFRESH_INTERVAL:
+            return 0
+
+        with self._sync_lock:
+            query = db.session.query(
+                CustomerPersona.id, CustomerPersona.title, CustomerPersona.description,
+                CustomerPersona.niche_market_id, CustomerPersona.boutique_id,
+                CustomerPersona.updated_at,
+                *[getattr(CustomerPersona, name) for name in ATTRIBUTE_WEIGHTS]
+            )
+            if self._last_updated_at is not None:
+                query = query.filter(or_(
+                    CustomerPersona.id > self._max_indexed_id,
+                    CustomerPersona.updated_at >= self._last_updated_at
+                ))
+
+            count = 0
+            for row in query.yield_per(5000):
+                self.memory_index.add_persona(row)
+                self._max_indexed_id = max(self._max_indexed_id, row.id)
+                if row.updated_at and (self._last_updated_at is None or row.updated_at > self._last_updated_at):
+                    self._last_updated_at = row.updated_at
+                count += 1
+
+            if self._last_updated_at is None:
+                # Table vide ou sans dates: la prochaine synchronisation reste incrémentale
+                self._last_updated_at = datetime.min
+            self._last_sync = now
+            self._dirty = False
+
+        if count:
+            logger.debug(f"Persona search index synced: {count} personas")
+        return count
+
+    def _search_postgres(self, criteria: Dict, limit: int, niche_market_id: Optional[int],
+                         boutique_id: Optional[int]) -> List[Tuple[int, float]]:
+        """
+        Recherche classée via tsvector (ts_rank_cd) et pg_trgm (similarity), accents ignorés
+
+        Comme l'index mémoire: les personas correspondant au texte (candidats trouvés par les
+        index GIN) sont classés avec le poids des attributs partagés, puis la page est
+        complétée par les personas ne correspondant que par leurs attributs (index lower(col)).
+        """
+        title = (criteria.get('title') or '').strip()
+        title_tokens, keyword_tokens, attributes = _split_criteria(criteria)
+        tokens = title_tokens + keyword_tokens
+
+        params = {'limit': limit}
+        scope_filters = []
+        if niche_market_id is not None:
+            params['niche_market_id'] = niche_market_id
+            scope_filters.append("niche_market_id = :niche_market_id")
+        if boutique_id is not None:
+            params['boutique_id'] = boutique_id
+            scope_filters.append("boutique_id = :boutique_id")
+
+        attribute_terms = []
+        attribute_conditions = []
+        for name, value in attributes.items():
+            params[f'attr_{name}'] = value
+            params[f'weight_{name}'] = ATTRIBUTE_WEIGHTS[name]
+            condition = f"lower({name}) = :attr_{name}"
+            attribute_terms.append(f"CASE WHEN {condition} THEN :weight_{name} ELSE 0 END")
+            attribute_conditions.append(condition)
+
+        score_terms = []
+        match_terms = []
+        if tokens:
+            # Les mots ne contiennent que des caractères \w: pas d'opérateur tsquery injecté
+            params['tsquery'] = ' | '.join(sorted(set(tokens)))
+            score_terms.append("ts_rank_cd(search_vector, to_tsquery('simple', :tsquery), 32) * 10")
+            match_terms.append("search_vector @@ to_tsquery('simple', :tsquery)")
+        if title:
+            params['title'] = title
+            score_terms.append("similarity(persona_unaccent(title), persona_unaccent(:title)) * 2")
+            match_terms.append("persona_unaccent(title) % persona_unaccent(:title)")
+
+        results = []
+        if match_terms:
+            filters = [f"({' OR '.join(match_terms)})"] + scope_filters
+            sql = (
+                f"SELECT id, ({' + '.join(score_terms + attribute_terms)}) AS score FROM customer_persona "
+                f"WHERE {' AND '.join(filters)} ORDER BY score DESC, id ASC LIMIT :limit"
+            )
+            results = [(row.id, float(row.score)) for row in db.session.execute(text(sql), params)]
+
+        if attribute_conditions and len(results) < limit:
+            params['fill'] = limit - len(results)
+            filters = [f"({' OR '.join(attribute_conditions)})"] + scope_filters
+            if match_terms:
+                # Page incomplète: tous les personas correspondant au texte sont déjà dans results
+                filters.append(f"NOT ({' OR '.join(match_terms)})")
+            sql = (
+                f"SELECT id, ({' + '.join(attribute_terms)}) AS score FROM customer_persona "
+                f"WHERE {' AND '.join(filters)} ORDER BY score DESC, id ASC LIMIT :fill"
+            )
+            results.extend((row.id, float(row.score)) for row in db.session.execute(text(sql), params))
+        return results
+
+    def search_ids(self, criteria: Dict, limit: int = 5, niche_market_id: Optional[int] = None,
+                   boutique_id: Optional[int] = None) -> List[Tuple[int, float]]:
+        """
+        Retourne les identifiants des personas les plus pertinents avec leur score
+
+        Returns:
+            Liste de tuples (persona_id, score) triés par score décroissant
+        """
+        if self.uses_postgres():
+            try:
+                return self._search_postgres(criteria, limit, niche_market_id, boutique_id)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f"PostgreSQL persona search failed, falling back to memory index: {e}")
+                self._pg_search_available = False
+
+        self.sync()
+        return self.memory_index.search(criteria, limit, niche_market_id, boutique_id)
+
+    def search(self, criteria: Dict, limit: int = 5, niche_market_id: Optional[int] = None,
+               boutique_id: Optional[int] = None) -> List[Tuple[CustomerPersona, float]]:
+        """
+        Recherche des personas classés par pertinence
+
+        Args:
+            criteria: Critères (title, description_keywords, age_range, income_bracket,
+                      price_sensitivity, gender_affinity, education_level)
+            limit: Nombre maximum de résultats
+            niche_market_id: Filtrer par niche de marché (optionnel)
+            boutique_id: Filtrer par boutique (optionnel)
+
+        Returns:
+            Liste de tuples (CustomerPersona, score) triés par score décroissant
+        """
+        ranked = self.search_ids(criteria, limit, niche_market_id, boutique_id)
+        if not ranked:
+            return []
+
+        personas = {
+            persona.id: persona
+            for persona in CustomerPersona.query.filter(CustomerPersona.id.in_([pid for pid, _ in ranked])).all()
+        }
+
+        results = []
+        for persona_id, score in ranked:
+            persona = personas.get(persona_id)
+            if persona is None:
+                # Persona supprimé depuis la dernière synchronisation
+                self.memory_index.remove(persona_id)
+                continue
+            results.append((persona, score))
+        return results
+
+
+persona_search_engine = PersonaSearchEngine()
+
+
+@event.listens_for(CustomerPersona, 'after_insert')
+@event.listens_for(CustomerPersona, 'after_update')
+def _persona_changed(mapper, connection, target):
+    """Les écritures ORM sur les personas déclenchent une resynchronisation"""
+    persona_search_engine.mark_dirty()
+
+
+@event.listens_for(CustomerPersona, 'after_delete')
+def _persona_deleted(mapper, connection, target):
+    """Retire immédiatement un persona supprimé de l'index mémoire"""
+    persona_search_engine.memory_index.remove(target.id)
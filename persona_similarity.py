@@ -0,0 +1,523 @@
+"""
+Index de similarité des personas (déduplication et réutilisation)
+
+Les textes de personas (CustomerPersona et Customer.persona) sont projetés localement,
+sans appel réseau, dans un espace vectoriel de dimension fixe par hachage signé des
+mots et des bigrammes de mots. Les vecteurs normalisés sont stockés dans une matrice
+NumPy: une requête top-k est un produit matrice-vecteur suivi d'un argpartition.
+
+Usages:
+- choisir les personas existants les plus proches à montrer au modèle pour éviter
+  les répétitions (au lieu des derniers personas créés)
+- détecter les quasi-doublons après génération
+- proposer la réutilisation d'un persona existant au lieu d'un nouvel appel au LLM: le profil
+  du client (âge, genre, lieu, revenus, ...) est comparé aux profils des clients déjà servis,
+  dont le persona principal est repris
+"""
+import logging
+import threading
+import time
+import zlib
+from datetime import datetime
+from typing import Dict, Hashable, Iterable, List, Optional, Tuple
+
+import numpy as np
+from sqlalchemy import event, or_
+
+from app import db
+from models import Customer, CustomerPersona, CustomerPersonaAssociation
+from persona_search import tokenize
+
+logger = logging.getLogger(__name__)
+
+# Dimension des vecteurs hachés (128 x float32 = 512 octets par persona, ~50 Mo pour 100 000)
+VECTOR_DIM = 128
+
+# Similarité cosinus à partir de laquelle deux personas sont considérés comme doublons
+DUPLICATE_THRESHOLD = 0.92
+
+# Similarité minimale entre deux profils client pour réutiliser le persona de l'autre client
+# (profils identiques à un champ près: 0.85-0.90; genre et tranche d'âge différents: ~0.5)
+REUSE_THRESHOLD = 0.85
+
+# Intervalle minimal entre deux synchronisations de l'index avec la base
+REFRESH_INTERVAL = 2.0
+
+# Types de documents indexés
+KIND_PERSONA = 'persona'
+KIND_CUSTOMER = 'customer'
+# Entrées du profil client (comparées entre elles, jamais à un texte de persona)
+KIND_PROFILE = 'profile'
+
+# Types indexés par texte de persona (requêtes par défaut)
+TEXT_KINDS = (KIND_PERSONA, KIND_CUSTOMER)
+
+# Tranches d'âge des profils (bornes incluses), comme CustomerPersona.age_range
+AGE_RANGES = ((0, 17), (18, 24), (25, 34), (35, 44), (45, 54), (55, 64))
+
+
+class HashedTextVectorizer:
+    """
+    Vectorisation par hachage signé (feature hashing) des mots et bigrammes de mots
+
+    Les indices sont calculés avec crc32 (stable entre processus, contrairement à hash())
+    et mis en cache par mot: le vocabulaire des personas reste limité.
+    """
+
+    def __init__(self, dim: int = VECTOR_DIM):
+        self.dim = dim
+        self._feature_cache: Dict[str, Tuple[int, float]] = {}
+
+    def _feature(self, token: str) -> Tuple[int, float]:
+        """Retourne (indice, signe) d'un mot ou bigramme"""
+        feature = self._feature_cache.get(token)
+        if feature is None:
+            digest = zlib.crc32(token.encode('utf-8'))
+            feature = (digest % self.dim, 1.0 if digest & 0x80000000 else -1.0)
+            if len(self._feature_cache) < 500000:
+                self._feature_cache[token] = feature
+        return feature
+
+    def transform(self, text: Optional[str]) -> np.ndarray:
+        """
+        Calcule le vecteur normalisé (norme L2 = 1) d'un texte
+
+        Args:
+            text: Texte du persona
+
+        Returns:
+            Vecteur float32 de dimension dim (nul si le texte est vide)
+        """
+        tokens = tokenize(text)
+        if not tokens:
+            return np.zeros(self.dim, dtype=np.float32)
+
+        cache = self._feature_cache
+        features = [cache.get(token) or self._feature(token) for token in tokens]
+        # Les bigrammes capturent un peu de l'ordre des mots (poids 0.5)
+        bigrams = [f'{first} {second}' for first, second in zip(tokens, tokens[1:])]
+        features.extend(cache.get(bigram) or self._feature(bigram) for bigram in bigrams)
+        indices = [index for index, _ in features]
+        signs = [sign for _, sign in features]
+        for position in range(len(tokens), len(signs)):
+            signs[position] *= 0.5
+
+        vector = np.bincount(indices, weights=signs, minlength=self.dim).astype(np.float32)
+        # Amortit les mots très répétés (équivalent d'un tf sous-linéaire)
+        vector = np.sign(vector) * np.sqrt(np.abs(vector))
+        norm = np.linalg.norm(vector)
+        if norm > 0:
+            vector /= norm
+        return vector
+
+
+class VectorIndex:
+    """
+    Index de vecteurs normalisés en mémoire (matrice NumPy à capacité croissante)
+
+    Chaque vecteur est identifié par une clé hashable et porte un identifiant de niche
+    (-1 si aucun) pour filtrer les requêtes. Les suppressions déplacent la dernière
+    ligne à la place de la ligne supprimée: la matrice reste dense.
+    """
+
+    def __init__(self, dim: int = VECTOR_DIM, initial_capacity: int = 1024):
+        self.dim = dim
+        self._vectors = np.zeros((initial_capacity, dim), dtype=np.float32)
+        self._niches = np.full(initial_capacity, -1, dtype=np.int64)
+        self._keys: List[Hashable] = []
+        self._rows: Dict[Hashable, int] = {}
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._keys)
+
+    def __contains__(self, key):
+        return key in self._rows
+
+    def _ensure_capacity(self, size: int) -> None:
+        capacity = self._vectors.shape[0]
+        if size <= capacity:
+            return
+        while capacity < size:
+            capacity *= 2
+        vectors = np.zeros((capacity, self.dim), dtype=np.float32)
+        vectors[:len(self._keys)] = self._vectors[:len(self._keys)]
+        niches = np.full(capacity, -1, dtype=np.int64)
+        niches[:len(self._keys)] = self._niches[:len(self._keys)]
+        self._vectors, self._niches = vectors, niches
+
+    def add(self, key: Hashable, vector: np.ndarray, niche_market_id: Optional[int] = None) -> None:
+        """Ajoute ou remplace le vecteur associé à une clé"""
+        with self._lock:
+            row = self._rows.get(key)
+            if row is None:
+                row = len(self._keys)
+                self._ensure_capacity(row + 1)
+                self._keys.append(key)
+                self._rows[key] = row
+            self._vectors[row] = vector
+            self._niches[row] = niche_market_id if niche_market_id is not None else -1
+
+    def add_many(self, keys: List[Hashable], vectors: np.ndarray,
+                 niche_market_ids: Optional[Iterable[Optional[int]]] = None) -> None:
+        """Ajoute un lot de vecteurs (clés nouvelles ou existantes)"""
+        niche_list = list(niche_market_ids) if niche_market_ids is not None else [None] * len(keys)
+        with self._lock:
+            for key, vector, niche_market_id in zip(keys, vectors, niche_list):
+                self.add(key, vector, niche_market_id)
+
+    def remove(self, key: Hashable) -> None:
+        """Retire une clé de l'index (sans effet si elle est absente)"""
+        with self._lock:
+            row = self._rows.pop(key, None)
+            if row is None:
+                return
+            last = len(self._keys) - 1
+            if row != last:
+                moved_key = self._keys[last]
+                self._vectors[row] = self._vectors[last]
+                self._niches[row] = self._niches[last]
+                self._keys[row] = moved_key
+                self._rows[moved_key] = row
+            self._keys.pop()
+
+    def query(self, vector: np.ndarray, k: int = 5, niche_market_id: Optional[int] = None,
+              exclude: Optional[Iterable[Hashable]] = None,
+              min_score: Optional[float] = None) -> List[Tuple[Hashable, float]]:
+        """
+        Retourne les k vecteurs les plus similaires (similarité cosinus)
+
+        Args:
+            vector: Vecteur normalisé de la requête
+            k: Nombre de résultats
+            niche_market_id: Restreindre à une niche de marché (optionnel)
+            exclude: Clés à ignorer (ex: le document interrogé lui-même)
+            min_score: Similarité minimale (optionnel)
+
+        Returns:
+            Liste de tuples (clé, similarité) triés par similarité décroissante
+        """
+        with self._lock:
+            size = len(self._keys)
+            if size == 0 or k <= 0 or not vector.any():
+                return []
+
+            if niche_market_id is None:
+                rows = None
+                scores = self._vectors[:size] @ vector
+            else:
+                # Le produit n'est calculé que sur les lignes de la niche
+                rows = np.flatnonzero(self._niches[:size] == niche_market_id)
+                if rows.size == 0:
+                    return []
+                scores = self._vectors[rows] @ vector
+
+            excluded_rows = [self._rows[key] for key in (exclude or ()) if key in self._rows]
+            if excluded_rows:
+                if rows is None:
+                    scores[excluded_rows] = -np.inf
+                else:
+                    scores[np.isin(rows, excluded_rows)] = -np.inf
+
+            wanted = min(k, scores.size)
+            if wanted < scores.size:
+                candidates = np.argpartition(-scores, wanted - 1)[:wanted]
+            else:
+                candidates = np.arange(scores.size)
+            candidates = candidates[np.argsort(-scores[candidates], kind='stable')]
+
+            # Une similarité nulle ou négative ne rapproche pas deux personas
+            floor = 1e-6 if min_score is None else max(min_score, 1e-6)
+            return [
+                (self._keys[row if rows is None else rows[row]], float(scores[row]))
+                for row in candidates
+                if scores[row] >= floor
+            ]
+
+
+class PersonaSimilarityIndex:
+    """
+    Index de similarité des personas synchronisé avec la base
+
+    Indexe CustomerPersona (titre + description + objectif, points de douleur, déclencheurs),
+    Customer.persona et les entrées du profil client dans trois VectorIndex distincts; les
+    résultats sont des clés (KIND_PERSONA, id), (KIND_CUSTOMER, id) ou (KIND_PROFILE, id). La synchronisation est incrémentale
+    (id / updated_at), comme l'index de recherche de persona_search.
+    """
+
+    def __init__(self, dim: int = VECTOR_DIM):
+        self.vectorizer = HashedTextVectorizer(dim)
+        self.indexes = {kind: VectorIndex(dim) for kind in (KIND_PERSONA, KIND_CUSTOMER, KIND_PROFILE)}
+        self._sync_lock = threading.Lock()
+        self._watermarks: Dict[str, Tuple[int, Optional[datetime]]] = {kind: (0, None) for kind in self.indexes}
+        self._last_sync = 0.0
+        self._dirty = True
+
+    @staticmethod
+    def persona_text(persona) -> str:
+        """Texte indexé pour un CustomerPersona (ou une ligne équivalente)"""
+        parts = (
+            getattr(persona, 'title', None),
+            getattr(persona, 'description', None),
+            getattr(persona, 'primary_goal', None),
+            getattr(persona, 'pain_points', None),
+            getattr(persona, 'buying_triggers', None),
+        )
+        return ' '.join(part for part in parts if part)
+
+    def mark_dirty(self) -> None:
+        """Force une synchronisation à la prochaine requête"""
+        self._dirty = True
+
+    def reset(self) -> None:
+        """Vide l'index"""
+        with self._sync_lock:
+            self.indexes = {kind: VectorIndex(self.vectorizer.dim) for kind in self.indexes}
+            self._watermarks = {kind: (0, None) for kind in self.indexes}
+            self._last_sync = 0.0
+            self._dirty = True
+
+    def add_text(self, kind: str, item_id: int, text: Optional[str],
+                 niche_market_id: Optional[int] = None) -> None:
+        """Indexe (ou réindexe) un texte; un texte vide retire l'élément"""
+        if not text:
+            self.indexes[kind].remove(item_id)
+            return
+        self.indexes[kind].add(item_id, self.vectorizer.transform(text), niche_market_id)
+
+    def remove(self, kind: str, item_id: int) -> None:
+        """Retire un élément de l'index"""
+        self.indexes[kind].remove(item_id)
+
+    def _sync_kind(self, kind: str, model, columns, text_func) -> int:
+        max_id, last_updated_at = self._watermarks[kind]
+        query = db.session.query(model.id, model.niche_market_id, model.updated_at, *columns)
+        if last_updated_at is not None:
+            query = query.filter(or_(model.id > max_id, model.updated_at >= last_updated_at))
+
+        count = 0
+        for row in query.yield_per(5000):
+            self.add_text(kind, row.id, text_func(row), row.niche_market_id)
+            max_id = max(max_id, row.id)
+            if row.updated_at and (last_updated_at is None or row.updated_at > last_updated_at):
+                last_updated_at = row.updated_at
+            count += 1
+
+        self._watermarks[kind] = (max_id, last_updated_at or datetime.min)
+        return count
+
+    def sync(self, force: bool = False) -> int:
+        """
+        Synchronise l'index avec les tables customer_persona et customer (persona et profil)
+
+        Returns:
+            Nombre d'éléments (ré)indexés
+        """
+        now = time.time()
+        if not force and not self._dirty and now - self._last_sync < REFRESH_INTERVAL:
+            return 0
+
+        with self._sync_lock:
+            count = self._sync_kind(
+                KIND_PERSONA, CustomerPersona,
+                (CustomerPersona.title, CustomerPersona.description, CustomerPersona.primary_goal,
+                 CustomerPersona.pain_points, CustomerPersona.buying_triggers),
+                self.persona_text
+            )
+            count += self._sync_kind(
+                KIND_CUSTOMER, Customer, (Customer.persona,), lambda row: row.persona
+            )
+            count += self._sync_kind(
+                KIND_PROFILE, Customer,
+                (Customer.age, Customer.gender, Customer.location, Customer.income_level,
+                 Customer.education, Customer.occupation, Customer.interests),
+                profile_inputs_text
+            )
+            self._last_sync = now
+            self._dirty = False
+
+        if count:
+            logger.debug(f"Persona similarity index synced: {count} items")
+        return count
+
+    def most_similar(self, text: Optional[str], k: int = 5, kinds: Optional[Iterable[str]] = None,
+                     niche_market_id: Optional[int] = None,
+                     exclude: Optional[Iterable[Tuple[str, int]]] = None,
+                     min_score: Optional[float] = None) -> List[Tuple[Tuple[str, int], float]]:
+        """
+        Retourne les k personas existants les plus proches d'un texte
+
+        Args:
+            text: Texte candidat (persona généré ou description du profil)
+            k: Nombre de résultats
+            kinds: Types à retourner (KIND_PERSONA, KIND_CUSTOMER, KIND_PROFILE); TEXT_KINDS par défaut
+            niche_market_id: Restreindre à une niche de marché (optionnel)
+            exclude: Clés (kind, id) à ignorer
+            min_score: Similarité minimale (optionnel)
+
+        Returns:
+            Liste de tuples ((kind, id), similarité) triés par similarité décroissante
+        """
+        vector = self.vectorizer.transform(text)
+        excluded = set(exclude or ())
+        results = []
+        for kind in (kinds or TEXT_KINDS):
+            ignored = [item_id for excluded_kind, item_id in excluded if excluded_kind == kind]
+            results.extend(
+                ((kind, item_id), score)
+                for item_id, score in self.indexes[kind].query(vector, k, niche_market_id, ignored, min_score)
+            )
+        results.sort(key=lambda item: -item[1])
+        return results[:k]
+
+    def find_duplicates(self, text: Optional[str], threshold: float = DUPLICATE_THRESHOLD,
+                        kinds: Optional[Iterable[str]] = None, niche_market_id: Optional[int] = None,
+                        exclude: Optional[Iterable[Tuple[str, int]]] = None,
+                        limit: int = 5) -> List[Tuple[Tuple[str, int], float]]:
+        """Retourne les éléments dont la similarité avec le texte dépasse le seuil"""
+        return self.most_similar(text, limit, kinds, niche_market_id, exclude, min_score=threshold)
+
+
+persona_similarity_index = PersonaSimilarityIndex()
+
+
+def customer_profile_text(customer) -> str:
+    """
+    Construit le texte de requête d'un client avant génération (pas encore de persona)
+
+    Args:
+        customer: Instance Customer
+
+    Returns:
+        Texte décrivant le profil (âge, localisation, intérêts, niveau de revenu, ...)
+    """
+    parts = [
+        customer.persona,
+        f"{customer.age} ans" if customer.age else None,
+        customer.gender,
+        customer.location,
+        customer.income_level,
+        customer.education,
+        customer.occupation,
+        ' '.join(customer.get_interests_list()),
+    ]
+    return ' '.join(str(part) for part in parts if part)
+
+
+def _age_range(age: Optional[int]) -> Optional[str]:
+    """Tranche d'âge d'un profil ("25-34", "65+")"""
+    if not age:
+        return None
+    for low, high in AGE_RANGES:
+        if age <= high:
+            return f"{low}-{high}"
+    return f"{AGE_RANGES[-1][1] + 1}+"
+
+
+def profile_inputs_text(customer) -> str:
+    """
+    Texte des entrées du profil d'un client (ou d'une ligne équivalente), sans son persona
+
+    L'âge est ramené à sa tranche: deux profils ne diffèrent pas pour un an d'écart.
+
+    Args:
+        customer: Customer ou ligne avec age, gender, location, income_level, education,
+            occupation et interests (valeurs séparées par des virgules)
+
+    Returns:
+        Texte comparé aux profils des autres clients (voir suggest_reusable_persona)
+    """
+    age_range = _age_range(getattr(customer, 'age', None))
+    interests = (getattr(customer, 'interests', None) or '').split(',')
+    parts = [
+        f"{age_range} ans" if age_range else None,
+        getattr(customer, 'gender', None),
+        getattr(customer, 'location', None),
+        getattr(customer, 'income_level', None),
+        getattr(customer, 'education', None),
+        getattr(customer, 'occupation', None),
+        ' '.join(interest.strip() for interest in interests),
+    ]
+    return ' '.join(str(part) for part in parts if part and str(part).strip())
+
+
+def similar_persona_texts(text: Optional[str], k: int = 3, niche_market_id: Optional[int] = None,
+                          exclude_customer_id: Optional[int] = None) -> List[str]:
+    """
+    Retourne les textes des personas existants les plus proches (pour les éviter dans le prompt)
+
+    Args:
+        text: Texte de référence (profil du client ou persona candidat)
+        k: Nombre de personas à retourner
+        niche_market_id: Restreindre à une niche de marché (optionnel)
+        exclude_customer_id: Client à exclure (celui pour lequel on génère)
+
+    Returns:
+        Liste de textes de personas, du plus proche au moins proche
+    """
+    persona_similarity_index.sync()
+    exclude = [(KIND_CUSTOMER, exclude_customer_id)] if exclude_customer_id else None
+    ranked = persona_similarity_index.most_similar(
+        text, k, kinds=[KIND_CUSTOMER], niche_market_id=niche_market_id, exclude=exclude
+    )
+    if not ranked:
+        return []
+
+    ids = [item_id for (_, item_id), _ in ranked]
+    texts = dict(db.session.query(Customer.id, Customer.persona).filter(Customer.id.in_(ids)).all())
+    return [texts[item_id] for item_id in ids if texts.get(item_id)]
+
+
+def suggest_reusable_persona(text: Optional[str], niche_market_id: Optional[int] = None,
+                             threshold: float = REUSE_THRESHOLD,
+                             exclude_customer_id: Optional[int] = None) -> Optional[Tuple[CustomerPersona, float]]:
+    """
+    Propose le persona principal d'un client au profil suffisamment proche pour être réutilisé
+
+    Args:
+        text: Entrées du profil client (voir profile_inputs_text)
+        niche_market_id: Restreindre à une niche de marché (optionnel)
+        threshold: Similarité minimale entre les deux profils
+        exclude_customer_id: Client à exclure (celui pour lequel on génère)
+
+    Returns:
+        Tuple (CustomerPersona, similarité des profils) ou None si aucun client proche n'a de
+        persona principal
+    """
+    persona_similarity_index.sync()
+    exclude = [(KIND_PROFILE, exclude_customer_id)] if exclude_customer_id else None
+    ranked = persona_similarity_index.most_similar(
+        text, 5, kinds=[KIND_PROFILE], niche_market_id=niche_market_id, exclude=exclude, min_score=threshold
+    )
+    if not ranked:
+        return None
+
+    ids = [item_id for (_, item_id), _ in ranked]
+    primary = dict(db.session.query(
+        CustomerPersonaAssociation.customer_id, CustomerPersonaAssociation.persona_id
+    ).filter(CustomerPersonaAssociation.customer_id.in_(ids), CustomerPersonaAssociation.is_primary.is_(True)).all())
+    for (_, customer_id), score in ranked:
+        persona = db.session.get(CustomerPersona, primary[customer_id]) if customer_id in primary else None
+        if persona is not None:
+            return persona, score
+    return None
+
+
+@event.listens_for(CustomerPersona, 'after_insert')
+@event.listens_for(CustomerPersona, 'after_update')
+@event.listens_for(Customer, 'after_insert')
+@event.listens_for(Customer, 'after_update')
+def _persona_text_changed(mapper, connection, target):
+    """Les écritures ORM déclenchent une resynchronisation incrémentale"""
+    persona_similarity_index.mark_dirty()
+
+
+@event.listens_for(CustomerPersona, 'after_delete')
+def _persona_deleted(mapper, connection, target):
+    persona_similarity_index.remove(KIND_PERSONA, target.id)
+
+
+@event.listens_for(Customer, 'after_delete')
+def _customer_deleted(mapper, connection, target):
+    persona_similarity_index.remove(KIND_CUSTOMER, target.id)
+    persona_similarity_index.remove(KIND_PROFILE, target.id)
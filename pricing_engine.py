@@ -0,0 +1,282 @@
+"""
+Moteur de prix déterministe et vectorisé pour les produits importés
+
+Toutes les règles de prix sont calculées sur des colonnes NumPy pour un lot entier de
+produits, sans appel au modèle ni tirage aléatoire:
+- coefficient de marché (target_market) multiplié par un palier de marge selon le coût
+  (les produits bon marché supportent un coefficient plus élevé)
+- facteurs de popularité (commandes) et de note moyenne
+- positionnement dans la fourchette des prix concurrents (quartiles), à une position
+  propre à chaque marché
+- plancher de marge par marché, prioritaire sur tout le reste
+- terminaisons psychologiques (.99, .95, dizaines) qui ne descendent jamais sous le plancher
+
+Le modèle n'est plus sollicité que pour le texte explicatif (aliexpress_importer.explain_pricing).
+"""
+import logging
+import re
+from typing import Any, Dict, List, Mapping, Optional, Sequence, Union
+
+import numpy as np
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_MARKET = "moyenne_gamme"
+
+# Profil de prix par marché cible:
+# markup: coefficient appliqué au coût, band_position: position visée dans la fourchette
+# concurrente (0 = bas, 1 = haut), margin_floor: marge minimale sur le prix de vente,
+# promo_percent: remise proposée si elle respecte le plancher, round_endings: terminaisons .99/.95
+MARKET_PROFILES: Dict[str, Dict[str, Any]] = {
+    "entrée_gamme": {"markup": 1.5, "band_position": 0.25, "margin_floor": 0.25, "promo_percent": 15, "round_endings": True},
+    "moyenne_gamme": {"markup": 2.0, "band_position": 0.5, "margin_floor": 0.35, "promo_percent": 10, "round_endings": True},
+    "haut_de_gamme": {"markup": 2.5, "band_position": 0.75, "margin_floor": 0.45, "promo_percent": 5, "round_endings": True},
+    "luxe": {"markup": 3.5, "band_position": 1.0, "margin_floor": 0.6, "promo_percent": 0, "round_endings": False},
+}
+
+# Paliers de marge selon le coût: (coût maximum exclu, multiplicateur)
+MARKUP_TIERS = ((5.0, 1.4), (20.0, 1.15), (100.0, 1.0), (np.inf, 0.85))
+
+# Paliers de popularité (commandes minimum exclues, facteur) et de note (note minimum, facteur)
+POPULARITY_TIERS = ((5000, 1.15), (1000, 1.1))
+RATING_TIERS = ((4.8, 1.1), (4.5, 1.05))
+
+# Quartiles des prix concurrents délimitant la fourchette de positionnement
+COMPETITOR_BAND = (0.25, 0.75)
+
+MARKETS = tuple(MARKET_PROFILES)
+_MARKET_INDEX = {market: index for index, market in enumerate(MARKETS)}
+_PROFILE_COLUMNS = {
+    field: np.array([MARKET_PROFILES[market][field] for market in MARKETS], dtype=np.float64)
+    for field in ("markup", "band_position", "margin_floor", "promo_percent", "round_endings")
+}
+_TIER_BOUNDS = np.array([bound for bound, _ in MARKUP_TIERS])
+_TIER_FACTORS = np.array([factor for _, factor in MARKUP_TIERS])
+
+_NON_NUMERIC = re.compile(r'[^\d.,]')
+_NON_DIGIT = re.compile(r'[^\d]')
+
+
+def parse_price(value: Any) -> float:
+    """Prix affiché ('US $12,50', 12.5...) -> float, NaN si illisible"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(_NON_NUMERIC.sub('', str(value).replace(',', '.')))
+    except ValueError:
+        return np.nan
+
+
+def parse_orders(value: Any) -> float:
+    """Nombre de commandes ('1 234 vendus') -> float, 0 si absent"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    digits = _NON_DIGIT.sub('', str(value or ''))
+    return float(digits) if digits else 0.0
+
+
+def parse_rating(value: Any) -> float:
+    """Note moyenne ('4,7') -> float, 0 si absente"""
+    if isinstance(value, (int, float)):
+        return float(value)
+    try:
+        return float(str(value).replace(',', '.'))
+    except ValueError:
+        return 0.0
+
+
+def market_codes(target_market: Union[str, Sequence[str]], size: int) -> np.ndarray:
+    """Indices de profil par produit (marché inconnu: DEFAULT_MARKET)"""
+    default = _MARKET_INDEX[DEFAULT_MARKET]
+    if isinstance(target_market, str):
+        return np.full(size, _MARKET_INDEX.get(target_market, default), dtype=np.intp)
+    return np.fromiter((_MARKET_INDEX.get(market, default) for market in target_market), dtype=np.intp, count=size)
+
+
+def competitor_bands(competitor_prices: Sequence[Optional[Sequence[float]]],
+                     quantiles=COMPETITOR_BAND) -> np.ndarray:
+    """
+    Quartiles bas et haut des prix concurrents de chaque produit
+
+    Les listes de longueurs différentes sont complétées par NaN, triées (NaN en fin de
+    ligne) puis interpolées linéairement, comme np.quantile, sans boucle par produit.
+
+    Args:
+        competitor_prices: Prix concurrents par produit (None ou liste vide: pas de fourchette)
+        quantiles: Quantiles (bas, haut) de la fourchette
+
+    Returns:
+        Tableau (n, 2), NaN pour les produits sans prix concurrents
+    """
+    n = len(competitor_prices)
+    width = max((len(prices) for prices in competitor_prices if prices), default=0)
+    if width == 0:
+        return np.full((n, 2), np.nan)
+
+    matrix = np.full((n, width), np.nan)
+    for row, prices in enumerate(competitor_prices):
+        if prices:
+            matrix[row, :len(prices)] = prices
+    matrix[~(matrix > 0)] = np.nan
+    matrix.sort(axis=1)
+    counts = np.count_nonzero(~np.isnan(matrix), axis=1)
+
+    bands = np.full((n, 2), np.nan)
+    has_prices = counts > 0
+    for column, q in enumerate(quantiles):
+        position = q * np.maximum(counts - 1, 0)
+        lower = np.floor(position).astype(np.intp)
+        upper = np.minimum(lower + 1, np.maximum(counts - 1, 0))
+        low_values = np.take_along_axis(matrix, lower[:, None], axis=1)[:, 0]
+        high_values = np.take_along_axis(matrix, upper[:, None], axis=1)[:, 0]
+        values = low_values + (position - lower) * (high_values - low_values)
+        bands[:, column] = np.where(has_prices, values, np.nan)
+    return bands
+
+
+def psychological_prices(prices: np.ndarray, minimum: np.ndarray, round_endings: np.ndarray) -> np.ndarray:
+    """
+    Terminaisons psychologiques, jamais sous le prix minimum
+
+    Sous 50: .99, de 50 à 100: .95, au-delà: dizaine - 0.01. Sans terminaisons (luxe):
+    entier sous 100, multiple de 10 au-delà. Le prix retenu est la terminaison la plus
+    proche sous le prix visé, relevée au premier palier valide si elle passe sous le minimum.
+    """
+    ending = np.where(prices < 50, 0.01, np.where(prices < 100, 0.05, 0.01)) * round_endings
+    unit = np.where(prices < 100, 1.0, 10.0)
+    below = np.floor((prices + ending) / unit) * unit - ending
+    floor_step = np.ceil((minimum + ending) / unit) * unit - ending
+    return np.round(np.maximum(below, floor_step), 2)
+
+
+def compute_prices(costs, target_market: Union[str, Sequence[str]] = DEFAULT_MARKET,
+                   orders=None, ratings=None, bands: Optional[np.ndarray] = None) -> Dict[str, np.ndarray]:
+    """
+    Calcule les prix d'un lot de produits
+
+    Args:
+        costs: Prix d'achat (NaN ou <= 0: prix inconnu, tous les résultats valent 0)
+        target_market: Marché cible commun ou par produit
+        orders: Nombres de commandes (optionnel)
+        ratings: Notes moyennes (optionnel)
+        bands: Fourchettes concurrentes (n, 2) de competitor_bands (optionnel)
+
+    Returns:
+        Colonnes NumPy: base_price, coefficient, tier_factor, popularity_factor, rating_factor,
+        optimal_price, floor_price, psychological_price, promo_percent, promo_price, profit_margin
+    """
+    costs = np.asarray(costs, dtype=np.float64)
+    n = costs.shape[0]
+    codes = market_codes(target_market, n)
+    orders = np.zeros(n) if orders is None else np.asarray(orders, dtype=np.float64)
+    ratings = np.zeros(n) if ratings is None else np.asarray(ratings, dtype=np.float64)
+    valid = costs > 0
+    base = np.where(valid, costs, 0.0)
+
+    coefficient = _PROFILE_COLUMNS["markup"][codes]
+    tier_factor = _TIER_FACTORS[np.searchsorted(_TIER_BOUNDS, base, side='right')]
+    popularity_factor = np.ones(n)
+    for threshold, factor in reversed(POPULARITY_TIERS):
+        popularity_factor = np.where(orders > threshold, factor, popularity_factor)
+    rating_factor = np.ones(n)
+    for threshold, factor in reversed(RATING_TIERS):
+        rating_factor = np.where(ratings >= threshold, factor, rating_factor)
+
+    markup_price = base * coefficient * tier_factor * popularity_factor * rating_factor
+
+    # Positionnement dans la fourchette concurrente: moyenne du prix de marge et de la cible
+    # de fourchette, bornée par la fourchette
+    optimal = markup_price
+    if bands is not None:
+        low, high = bands[:, 0], bands[:, 1]
+        has_band = ~np.isnan(low)
+        target = low + _PROFILE_COLUMNS["band_position"][codes] * (high - low)
+        positioned = np.clip((markup_price + target) / 2, low, high)
+        optimal = np.where(has_band, positioned, markup_price)
+
+    margin_floor = _PROFILE_COLUMNS["margin_floor"][codes]
+    floor_price = base / (1 - margin_floor)
+    optimal = np.maximum(optimal, floor_price)
+    psychological = psychological_prices(optimal, floor_price, _PROFILE_COLUMNS["round_endings"][codes])
+
+    promo_percent = _PROFILE_COLUMNS["promo_percent"][codes]
+    promo_price = np.round(psychological * (1 - promo_percent / 100), 2)
+    promo_allowed = promo_price >= floor_price
+    promo_percent = np.where(promo_allowed, promo_percent, 0.0)
+    promo_price = np.where(promo_allowed, promo_price, psychological)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        profit_margin = np.where(psychological > 0, (psychological - base) / psychological * 100, 0.0)
+
+    columns = {
+        "base_price": base,
+        "coefficient": coefficient,
+        "tier_factor": tier_factor,
+        "popularity_factor": popularity_factor,
+        "rating_factor": rating_factor,
+        "optimal_price": np.round(optimal, 2),
+        "floor_price": np.round(floor_price, 2),
+        "psychological_price": psychological,
+        "promo_percent": promo_percent,
+        "promo_price": promo_price,
+        "profit_margin": np.round(profit_margin, 2),
+    }
+    for name, column in columns.items():
+        if name not in ("coefficient", "tier_factor", "popularity_factor", "rating_factor"):
+            columns[name] = np.where(valid, column, 0.0)
+    return columns
+
+
+def price_products(products: Sequence[Mapping[str, Any]], target_market: Union[str, Sequence[str]] = DEFAULT_MARKET,
+                   competitor_prices: Optional[Sequence[Optional[Sequence[float]]]] = None) -> List[Dict[str, Any]]:
+    """
+    Stratégies de prix d'un lot de produits importés
+
+    Args:
+        products: Données produit extraites (clés prix, nombre_commandes, note_moyenne)
+        target_market: Marché cible commun ou par produit
+        competitor_prices: Prix des produits concurrents par produit (optionnel, ex: résultats
+            de aliexpress_search.search_similar_products_many)
+
+    Returns:
+        Stratégies de prix, dans l'ordre des produits (même format que
+        aliexpress_importer.optimize_pricing_strategy)
+    """
+    n = len(products)
+    costs = np.fromiter((parse_price(p.get("prix", 0)) for p in products), dtype=np.float64, count=n)
+    orders = np.fromiter((parse_orders(p.get("nombre_commandes")) for p in products), dtype=np.float64, count=n)
+    ratings = np.fromiter((parse_rating(p.get("note_moyenne") or 0) for p in products), dtype=np.float64, count=n)
+    bands = competitor_bands(competitor_prices) if competitor_prices is not None else None
+    columns = compute_prices(costs, target_market, orders, ratings, bands)
+
+    markets = [target_market] * n if isinstance(target_market, str) else list(target_market)
+    lists = {name: column.tolist() for name, column in columns.items()}
+    band_lists = np.round(bands, 2).tolist() if bands is not None else [[np.nan, np.nan]] * n
+    strategies = []
+    for i in range(n):
+        optimal = lists["optimal_price"][i]
+        low, high = band_lists[i]
+        strategies.append({
+            "base_price": lists["base_price"][i],
+            "original_price": lists["base_price"][i],
+            "optimal_price": optimal,
+            "psychological_price": lists["psychological_price"][i],
+            "promo_percent": int(lists["promo_percent"][i]),
+            "promo_price": lists["promo_price"][i],
+            "floor_price": lists["floor_price"][i],
+            "market_segment": markets[i] if markets[i] in MARKET_PROFILES else DEFAULT_MARKET,
+            "profit_margin": lists["profit_margin"][i],
+            "competitor_band": None if low != low else {"low": low, "high": high},
+            "price_factors": {
+                "base_coefficient": lists["coefficient"][i],
+                "tier_factor": lists["tier_factor"][i],
+                "popularity_factor": lists["popularity_factor"][i],
+                "rating_factor": lists["rating_factor"][i],
+            },
+            "price_recommendations": [
+                {"name": "Prix compétitif", "price": round(optimal * 0.9, 2)},
+                {"name": "Prix standard", "price": optimal},
+                {"name": "Prix premium", "price": round(optimal * 1.1, 2)},
+            ],
+        })
+    return strategies
@@ -6,9 +6,131 @@ import os
 import json
 import logging
 import datetime
+import textwrap
 from typing import Dict, List, Optional, Tuple, Any
 
 from boutique_ai import grok_client, GROK_3
+from prompt_compaction import prompt_compactor
+from prompt_registry import prompt_registry
+from token_accounting import token_accountant
+
+# Usage des complétions attribué au générateur de contenu produit
+grok_client = token_accountant.metered(grok_client, 'product_generator')
+
+# Éléments optionnels du contenu produit: (template, option, valeur par défaut)
+PRODUCT_CONTENT_ELEMENTS = (
+    ('description', 'generate_description', True),
+    ('meta', 'generate_meta', True),
+    ('variants', 'generate_variants', True),
+    ('comparative', 'generate_comparative', False),
+)
+
+# Templates des prompts produit (compilés au chargement par prompt_registry)
+prompt_registry.register_many({
+    'product_content_product': """
+        Je dois créer du contenu optimisé pour ce produit:
+
+        PRODUIT:
+        - Nom: {name}
+        - Catégorie: {category}
+        - Prix: {price}€
+        - Description actuelle: {description}
+    """,
+    'product_content_audience': """
+        PUBLIC CIBLE:
+        - Nom: {name}
+        - Âge: {age}
+        - Localisation: {location}
+        - Genre: {gender}
+        - Intérêts: {interests}
+        - Persona: {persona}
+    """,
+    'product_content_instructions': """
+        INSTRUCTIONS SPÉCIFIQUES:
+        {instructions}
+    """,
+    'product_content_description': """
+        1. DESCRIPTION OPTIMISÉE:
+           - Un titre optimisé SEO et marketing pour le produit (max 100 caractères)
+           - Une description détaillée et persuasive qui met en valeur les avantages et caractéristiques principales
+           - Le texte doit être optimisé pour le référencement et la conversion
+    """,
+    'product_content_meta': """
+        2. MÉTADONNÉES SEO:
+           - Meta title (60 caractères max)
+           - Meta description (160 caractères max)
+           - Alt text pour l'image principale (125 caractères max)
+           - 5-8 mots-clés/tags pertinents
+    """,
+    'product_content_variants': """
+        3. VARIANTES DU PRODUIT:
+           - Suggestions de 3-5 variantes potentielles (couleurs, tailles, matériaux, etc.)
+           - Description courte pour chaque variante
+    """,
+    'product_content_comparative': """
+        4. ANALYSE COMPARATIVE:
+           - Positionnement par rapport à la concurrence
+           - 3-5 points forts par rapport aux produits similaires
+           - Arguments de vente uniques
+    """,
+    'product_content_variants_format': """
+        "variants": [
+            {"name": "Nom de la variante", "description": "Description courte"},
+            ...
+        ]
+    """,
+    'product_content_comparative_format': """
+        "comparative_analysis": {
+            "positioning": "Positionnement marché",
+            "strengths": ["Point fort 1", "Point fort 2", ...],
+            "unique_selling_points": ["Argument unique 1", "Argument unique 2", ...]
+        }
+    """,
+    'product_content_output': """
+        Réponds strictement au format JSON suivant:
+        {
+            "generated_title": "Titre optimisé du produit",
+            "generated_description": "Description détaillée et optimisée",
+            "meta_title": "Meta title SEO",
+            "meta_description": "Meta description SEO",
+            "alt_text": "Texte alternatif pour l'image principale",
+            "keywords": ["mot-clé1", "mot-clé2", ...]{output_fields},
+            "optimization_notes": "Notes sur l'optimisation effectuée"
+        }
+    """,
+    'product_html_templates': """
+        Je dois créer du contenu HTML optimisé pour Shopify à partir de ces données de produit:
+
+        {context}
+
+        Génère un template HTML complet pour Shopify avec les sections suivantes:
+
+        1. Un bloc HTML principal de description produit avec:
+           - Titre H1 optimisé pour le SEO
+           - Description enrichie avec des éléments de mise en valeur
+           - Liste des caractéristiques principales dans un format attrayant
+           - Appels à l'action persuasifs
+           - Mise en forme professionnelle avec CSS intégré
+
+        2. Un bloc HTML séparé optimisé pour les spécifications techniques
+
+        3. Un bloc HTML supplémentaire pour la section FAQ du produit (génère des questions/réponses pertinentes)
+
+        Respecte ces consignes:
+        - Utilise seulement des éléments HTML valides et compatibles avec l'éditeur Shopify
+        - Inclus les classes CSS nécessaires pour un bon rendu
+        - Optimise le contenu pour le SEO et la conversion
+        - Ajoute des microdonnées schema.org pour le référencement
+        - Utilise des éléments HTML5 sémantiques (section, article, etc.)
+
+        Fournis UNIQUEMENT le résultat au format JSON suivant:
+        {
+            "html_description": "HTML complet pour la description principale",
+            "html_specifications": "HTML pour les spécifications techniques",
+            "html_faq": "HTML pour la section FAQ"
+        }
+    """,
+})
 
 async def generate_product_content(
     product_data: Dict[str, Any],
@@ -79,6 +201,8 @@ def _build_product_content_prompt(context: Dict[str, Any]) -> str:
     """
     Construit le prompt pour la génération de contenu produit
     
+    Les sections sont rendues à partir des templates de prompt_registry (product_content_*).
+    
     Args:
         context: Contexte pour la génération
         
@@ -91,111 +215,45 @@ def _build_product_content_prompt(context: Dict[str, Any]) -> str:
     instructions = context.get("instructions", "")
     
     # Construire le prompt principal
-    prompt = f"""
-    Je dois créer du contenu optimisé pour ce produit:
-    
-    PRODUIT:
-    - Nom: {product.get('name', '')}
-    - Catégorie: {product.get('category', '')}
-    - Prix: {product.get('price', '0')}€
-    - Description actuelle: {product.get('base_description', '')}
-    """
+    sections = [prompt_registry.render(
+        'product_content_product',
+        name=product.get('name', ''),
+        category=product.get('category', ''),
+        price=product.get('price', '0'),
+        description=prompt_compactor.text('product_description', product.get('base_description', '')),
+    )]
     
     # Ajouter des informations sur l'audience cible si disponible
     if target_audience:
-        prompt += f"""
-        
-        PUBLIC CIBLE:
-        - Nom: {target_audience.get('name', '')}
-        - Âge: {target_audience.get('age', '')}
-        - Localisation: {target_audience.get('location', '')}
-        - Genre: {target_audience.get('gender', '')}
-        - Intérêts: {', '.join(target_audience.get('interests', []))}
-        - Persona: {target_audience.get('persona', '')}
-        """
+        sections.append(prompt_registry.render(
+            'product_content_audience',
+            name=target_audience.get('name', ''),
+            age=target_audience.get('age', ''),
+            location=target_audience.get('location', ''),
+            gender=target_audience.get('gender', ''),
+            interests=', '.join(target_audience.get('interests', [])),
+            persona=prompt_compactor.text('target_persona', target_audience.get('persona', '')),
+        ))
     
     # Ajouter des instructions spécifiques
     if instructions:
-        prompt += f"""
-        
-        INSTRUCTIONS SPÉCIFIQUES:
-        {instructions}
-        """
-    
-    # Spécifier les éléments à générer
-    prompt += """
-    
-    ÉLÉMENTS À GÉNÉRER:
-    """
-    
-    if options.get("generate_description", True):
-        prompt += """
-        1. DESCRIPTION OPTIMISÉE:
-           - Un titre optimisé SEO et marketing pour le produit (max 100 caractères)
-           - Une description détaillée et persuasive qui met en valeur les avantages et caractéristiques principales
-           - Le texte doit être optimisé pour le référencement et la conversion
-        """
-    
-    if options.get("generate_meta", True):
-        prompt += """
-        2. MÉTADONNÉES SEO:
-           - Meta title (60 caractères max)
-           - Meta description (160 caractères max)
-           - Alt text pour l'image principale (125 caractères max)
-           - 5-8 mots-clés/tags pertinents
-        """
-    
-    if options.get("generate_variants", True):
-        prompt += """
-        3. VARIANTES DU PRODUIT:
-           - Suggestions de 3-5 variantes potentielles (couleurs, tailles, matériaux, etc.)
-           - Description courte pour chaque variante
-        """
+        sections.append(prompt_registry.render('product_content_instructions', instructions=instructions))
     
-    if options.get("generate_comparative", False):
-        prompt += """
-        4. ANALYSE COMPARATIVE:
-           - Positionnement par rapport à la concurrence
-           - 3-5 points forts par rapport aux produits similaires
-           - Arguments de vente uniques
-        """
-    
-    # Format de sortie demandé
-    prompt += """
-    
-    Réponds strictement au format JSON suivant:
-    {
-        "generated_title": "Titre optimisé du produit",
-        "generated_description": "Description détaillée et optimisée",
-        "meta_title": "Meta title SEO",
-        "meta_description": "Meta description SEO",
-        "alt_text": "Texte alternatif pour l'image principale",
-        "keywords": ["mot-clé1", "mot-clé2", ...],
-    """
-    
-    if options.get("generate_variants", True):
-        prompt += """
-        "variants": [
-            {"name": "Nom de la variante", "description": "Description courte"},
-            ...
-        ],
-    """
-    
-    if options.get("generate_comparative", False):
-        prompt += """
-        "comparative_analysis": {
-            "positioning": "Positionnement marché",
-            "strengths": ["Point fort 1", "Point fort 2", ...],
-            "unique_selling_points": ["Argument unique 1", "Argument unique 2", ...]
-        },
-    """
+    # Spécifier les éléments à générer et le format de sortie demandé
+    elements = [
+        name for name, option, default in PRODUCT_CONTENT_ELEMENTS
+        if options.get(option, default)
+    ]
+    sections.append("ÉLÉMENTS À GÉNÉRER:")
+    sections.extend(prompt_registry.render(f'product_content_{name}') for name in elements)
     
-    prompt += """
-        "optimization_notes": "Notes sur l'optimisation effectuée"
-    }
-    """
+    output_fields = ''.join(
+        ',\n' + textwrap.indent(prompt_registry.render(f'product_content_{name}_format'), '    ')
+        for name in ('variants', 'comparative') if name in elements
+    )
+    sections.append(prompt_registry.render('product_content_output', output_fields=output_fields))
     
-    return prompt
+    return '\n\n'.join(sections) + '\n'
 
 async def generate_product_html_templates(
     product_data: Dict[str, Any],
@@ -218,38 +276,10 @@ async def generate_product_html_templates(
             "target_market": target_market
         }
         
-        prompt = f"""
-        Je dois créer du contenu HTML optimisé pour Shopify à partir de ces données de produit:
-        
-        {json.dumps(context, indent=2, ensure_ascii=False)}
-        
-        Génère un template HTML complet pour Shopify avec les sections suivantes:
-        
-        1. Un bloc HTML principal de description produit avec:
-           - Titre H1 optimisé pour le SEO
-           - Description enrichie avec des éléments de mise en valeur
-           - Liste des caractéristiques principales dans un format attrayant
-           - Appels à l'action persuasifs
-           - Mise en forme professionnelle avec CSS intégré
-         
-        2. Un bloc HTML séparé optimisé pour les spécifications techniques
-        
-        3. Un bloc HTML supplémentaire pour la section FAQ du produit (génère des questions/réponses pertinentes)
-        
-        Respecte ces consignes:
-        - Utilise seulement des éléments HTML valides et compatibles avec l'éditeur Shopify
-        - Inclus les classes CSS nécessaires pour un bon rendu
-        - Optimise le contenu pour le SEO et la conversion
-        - Ajoute des microdonnées schema.org pour le référencement
-        - Utilise des éléments HTML5 sémantiques (section, article, etc.)
-        
-        Fournis UNIQUEMENT le résultat au format JSON suivant:
-        {
-            "html_description": "HTML complet pour la description principale",
-            "html_specifications": "HTML pour les spécifications techniques",
-            "html_faq": "HTML pour la section FAQ"
-        }
-        """
+        prompt = prompt_registry.render(
+            'product_html_templates',
+            context=prompt_compactor.json('product_html', context),
+        )
         
         # Appeler l'API pour générer le contenu
         response = await grok_client.chat.completions.create(
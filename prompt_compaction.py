@@ -0,0 +1,242 @@
+"""
+Compaction des prompts chargés en contexte (données produit, texte de page, personas)
+
+La taille du prompt détermine la latence et le coût d'un appel LLM. Avant d'être injecté
+dans un prompt, un contexte passe par prompt_compactor:
+- JSON minifié (sans indentation), valeurs nulles et champs vides supprimés
+- espaces et lignes en double (menus, pieds de page) supprimés des textes
+- champs trop longs coupés à une frontière de mot pour tenir dans le budget de tokens du
+  site d'appel (PROMPT_BUDGETS)
+
+Les tokens sont estimés localement (sans tokenizer) et les volumes avant/après compaction
+sont comptés par site d'appel (voir /admin/llm-usage).
+"""
+import json
+import logging
+import os
+import re
+import threading
+from typing import Any, Dict, List, Optional, Sequence
+
+logger = logging.getLogger(__name__)
+
+# Budgets de tokens par site d'appel
+PROMPT_BUDGETS: Dict[str, int] = {
+    'product_html': 1200,          # product_generator.generate_product_html_templates
+    'product_description': 400,    # description actuelle du produit (generate_product_content)
+    'target_persona': 250,         # persona du public cible (generate_product_content)
+    'aliexpress_page': 1000,       # texte de la page produit (aliexpress_importer)
+    'aliexpress_html': 1200,       # produit + prix pour le template Shopify (aliexpress_importer)
+    'persona_history': 180,        # personas existants montrés au modèle, au total (boutique_ai)
+}
+# Surcharge des budgets, ex: "aliexpress_page=1500,product_html=800"
+PROMPT_BUDGETS.update({
+    name.strip(): int(budget)
+    for name, budget in (item.split('=', 1) for item in os.environ.get("PROMPT_BUDGETS", "").split(',') if '=' in item)
+})
+# Budget d'un site d'appel non configuré
+DEFAULT_BUDGET = int(os.environ.get("PROMPT_DEFAULT_BUDGET", "1000"))
+# Éléments conservés par liste quand un contexte JSON dépasse son budget
+MAX_LIST_ITEMS = int(os.environ.get("PROMPT_MAX_LIST_ITEMS", "10"))
+# En dessous, un champ n'est plus raccourci (le contexte reste au-dessus du budget)
+MIN_FIELD_TOKENS = 16
+
+ELLIPSIS = ' …'
+
+# Mots, signes de ponctuation, sauts de ligne et indentations: un mot coûte environ un token
+# par tranche de 4 caractères, une espace simple est absorbée par le mot qui la suit
+_TOKEN_PIECES = re.compile(r"\w+|[^\w\s]|\n|\s{2,}")
+
+
+def _piece_tokens(piece: str) -> int:
+    if piece.isspace():
+        return 1
+    return (len(piece) + 3) // 4
+
+
+def estimate_tokens(text: Optional[str]) -> int:
+    """
+    Estimation locale du nombre de tokens d'un texte (approximation des tokenizers BPE)
+
+    Args:
+        text: Texte à estimer
+
+    Returns:
+        Nombre de tokens estimé
+    """
+    if not text:
+        return 0
+    return sum(_piece_tokens(piece) for piece in _TOKEN_PIECES.findall(text))
+
+
+def condense_text(text: Optional[str]) -> str:
+    """Espaces normalisés, lignes vides et lignes répétées supprimées"""
+    seen = set()
+    lines = []
+    for line in (text or '').splitlines():
+        line = ' '.join(line.split())
+        if line and line not in seen:
+            seen.add(line)
+            lines.append(line)
+    return '\n'.join(lines)
+
+
+def trim_text(text: Optional[str], max_tokens: int) -> str:
+    """
+    Coupe un texte à max_tokens (frontière de mot, de phrase si elle est proche)
+
+    Args:
+        text: Texte à couper
+        max_tokens: Budget de tokens, marque de coupure comprise
+
+    Returns:
+        Texte inchangé s'il tient dans le budget, sinon son début suivi de ' …'
+    """
+    text = text or ''
+    if estimate_tokens(text) <= max_tokens:
+        return text
+    used = 0
+    end = 0
+    for match in _TOKEN_PIECES.finditer(text):
+        cost = _piece_tokens(match.group())
+        if used + cost > max_tokens - 1:
+            break
+        used += cost
+        end = match.end()
+    cut = text[:end]
+    sentence = max(cut.rfind('. '), cut.rfind('.\n'))
+    if sentence > len(cut) * 0.7:
+        cut = cut[:sentence + 1]
+    return cut.rstrip() + ELLIPSIS
+
+
+def _is_empty(value: Any) -> bool:
+    return value is None or (isinstance(value, (str, list, tuple, dict)) and not value)
+
+
+def prune(value: Any) -> Any:
+    """Supprime récursivement les valeurs nulles et vides (0 et False sont conservés)"""
+    if isinstance(value, dict):
+        pruned = {key: prune(item) for key, item in value.items()}
+        return {key: item for key, item in pruned.items() if not _is_empty(item)}
+    if isinstance(value, (list, tuple)):
+        return [item for item in (prune(item) for item in value) if not _is_empty(item)]
+    if isinstance(value, str):
+        return value.strip()
+    return value
+
+
+def _shorten(value: Any, field_tokens: int) -> Any:
+    if isinstance(value, dict):
+        return {key: _shorten(item, field_tokens) for key, item in value.items()}
+    if isinstance(value, list):
+        return [_shorten(item, field_tokens) for item in value[:MAX_LIST_ITEMS]]
+    if isinstance(value, str):
+        return trim_text(value, field_tokens)
+    return value
+
+
+def dumps_compact(value: Any) -> str:
+    """JSON minifié (séparateurs sans espace, caractères non ASCII conservés)"""
+    return json.dumps(value, ensure_ascii=False, separators=(',', ':'), default=str)
+
+
+def compact_json(value: Any, max_tokens: Optional[int] = None) -> str:
+    """
+    JSON minifié et élagué, raccourci si nécessaire pour tenir dans max_tokens
+
+    Les champs texte sont coupés à un budget par champ divisé par deux jusqu'à ce que le
+    document tienne (les listes sont alors limitées à MAX_LIST_ITEMS éléments).
+
+    Args:
+        value: Données à sérialiser
+        max_tokens: Budget de tokens du document (None: pas de limite)
+
+    Returns:
+        Document JSON
+    """
+    value = prune(value)
+    text = dumps_compact(value)
+    if max_tokens is None or estimate_tokens(text) <= max_tokens:
+        return text
+    field_tokens = max(max_tokens // 4, MIN_FIELD_TOKENS)
+    while True:
+        text = dumps_compact(_shorten(value, field_tokens))
+        if estimate_tokens(text) <= max_tokens:
+            return text
+        if field_tokens <= MIN_FIELD_TOKENS:
+            logger.debug(f"JSON context above its budget after compaction ({estimate_tokens(text)} > {max_tokens} tokens)")
+            return text
+        field_tokens = max(field_tokens // 2, MIN_FIELD_TOKENS)
+
+
+class PromptCompactor:
+    """Compaction des contextes de prompt par site d'appel, avec comptage avant/après"""
+
+    def __init__(self, budgets: Optional[Dict[str, int]] = None):
+        self.budgets = PROMPT_BUDGETS if budgets is None else budgets
+        self._lock = threading.Lock()
+        self._stats: Dict[str, List[int]] = {}
+
+    def budget(self, site: str) -> int:
+        return self.budgets.get(site, DEFAULT_BUDGET)
+
+    def _record(self, site: str, before: int, after: int) -> None:
+        with self._lock:
+            stats = self._stats.setdefault(site, [0, 0, 0])
+            stats[0] += 1
+            stats[1] += before
+            stats[2] += after
+
+    def json(self, site: str, value: Any) -> str:
+        """
+        Contexte JSON compacté pour un site d'appel
+
+        Args:
+            site: Site d'appel (clé de PROMPT_BUDGETS)
+            value: Données du contexte
+
+        Returns:
+            JSON minifié tenant dans le budget du site
+        """
+        compacted = compact_json(value, self.budget(site))
+        before = estimate_tokens(json.dumps(value, indent=2, ensure_ascii=False, default=str))
+        self._record(site, before, estimate_tokens(compacted))
+        return compacted
+
+    def text(self, site: str, text: Optional[str]) -> str:
+        """Texte condensé (espaces, lignes répétées) et coupé au budget du site"""
+        compacted = trim_text(condense_text(text), self.budget(site))
+        self._record(site, estimate_tokens(text), estimate_tokens(compacted))
+        return compacted
+
+    def texts(self, site: str, texts: Sequence[Optional[str]]) -> List[str]:
+        """Plusieurs textes se partageant le budget du site à parts égales"""
+        if not texts:
+            return []
+        share = max(self.budget(site) // len(texts), MIN_FIELD_TOKENS)
+        compacted = [trim_text(condense_text(text), share) for text in texts]
+        self._record(site, sum(estimate_tokens(text) for text in texts),
+                     sum(estimate_tokens(text) for text in compacted))
+        return compacted
+
+    def stats(self) -> Dict[str, Dict[str, Any]]:
+        """Tokens estimés avant/après compaction par site d'appel"""
+        with self._lock:
+            snapshot = {site: list(values) for site, values in self._stats.items()}
+        return {
+            site: {
+                'calls': calls,
+                'tokens_before': before,
+                'tokens_after': after,
+                'saved_ratio': round(1 - after / before, 3) if before else 0.0,
+            }
+            for site, (calls, before, after) in snapshot.items()
+        }
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+prompt_compactor = PromptCompactor()
@@ -0,0 +1,205 @@
+"""
+Registre central des templates de prompts, compilés une fois au chargement
+
+Les templates utilisent la syntaxe {variable}: toute autre accolade (exemples de réponse JSON
+dans les prompts) reste littérale, sans doublement. À l'enregistrement, chaque traduction est:
+- dédentée et découpée en segments littéraux / variables (aucun parsing au rendu)
+- validée: toutes les langues d'un prompt doivent utiliser exactement les variables déclarées
+  (PromptTemplateError au démarrage plutôt qu'un KeyError à l'exécution)
+- versionnée par un hash de son contenu, repris dans les clés de cache des complétions
+  (PromptRegistry.cache_key) pour qu'une modification du texte invalide les réponses en cache
+"""
+import hashlib
+import json
+import logging
+import re
+import textwrap
+import threading
+from typing import Any, Dict, Iterable, List, Mapping, Optional, Tuple
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_LANGUAGE = 'en'
+
+_PLACEHOLDER = re.compile(r"\{(\w+)\}")
+
+
+class PromptTemplateError(ValueError):
+    """Template de prompt invalide (variables incohérentes entre les langues ou non déclarées)"""
+
+
+class MissingPromptVariables(KeyError):
+    """Variables absentes lors du rendu d'un prompt"""
+
+    def __init__(self, name: str, missing: Iterable[str]):
+        self.name = name
+        self.missing = sorted(missing)
+        super().__init__(f"Prompt '{name}': missing variables {', '.join(self.missing)}")
+
+    def __str__(self):
+        return self.args[0]
+
+
+class CompiledPrompt:
+    """Template découpé une fois pour toutes en segments littéraux et variables"""
+
+    __slots__ = ('name', 'language', 'source', 'version', 'variables', '_literals', '_fields')
+
+    def __init__(self, name: str, language: str, source: str):
+        self.name = name
+        self.language = language
+        self.source = textwrap.dedent(source).strip()
+        self.version = hashlib.sha256(self.source.encode('utf-8')).hexdigest()[:12]
+        parts = _PLACEHOLDER.split(self.source)
+        # Indices pairs: texte littéral, indices impairs: noms de variables
+        self._literals: Tuple[str, ...] = tuple(parts[0::2])
+        self._fields: Tuple[str, ...] = tuple(parts[1::2])
+        self.variables = frozenset(self._fields)
+
+    def render(self, values: Mapping[str, Any]) -> str:
+        """
+        Rendu du template
+
+        Args:
+            values: Valeurs des variables (les clés en trop sont ignorées)
+
+        Returns:
+            Prompt rendu
+
+        Raises:
+            MissingPromptVariables: Si une variable du template n'a pas de valeur
+        """
+        try:
+            rendered = [str(values[field]) for field in self._fields]
+        except KeyError:
+            raise MissingPromptVariables(self.name, self.variables - values.keys()) from None
+        out = [self._literals[0]]
+        for value, literal in zip(rendered, self._literals[1:]):
+            out.append(value)
+            out.append(literal)
+        return ''.join(out)
+
+
+class PromptRegistry:
+    """Templates de prompts compilés par nom et par langue"""
+
+    def __init__(self, default_language: str = DEFAULT_LANGUAGE):
+        self.default_language = default_language
+        self._lock = threading.Lock()
+        self._prompts: Dict[str, Dict[str, CompiledPrompt]] = {}
+
+    def register(self, name: str, translations: Any, variables: Optional[Iterable[str]] = None) -> Dict[str, CompiledPrompt]:
+        """
+        Compile et enregistre un prompt
+
+        Args:
+            name: Nom du prompt
+            translations: Template unique (enregistré dans la langue par défaut) ou
+                dictionnaire {langue: template}
+            variables: Variables attendues (None: celles du template de la langue par défaut)
+
+        Returns:
+            Templates compilés par langue
+
+        Raises:
+            PromptTemplateError: Si une traduction n'utilise pas exactement les variables attendues
+        """
+        if isinstance(translations, str):
+            translations = {self.default_language: translations}
+        if not translations:
+            raise PromptTemplateError(f"Prompt '{name}' has no template")
+        compiled = {language: CompiledPrompt(name, language, source) for language, source in translations.items()}
+
+        if variables is not None:
+            expected = frozenset(variables)
+        elif self.default_language in compiled:
+            expected = compiled[self.default_language].variables
+        else:
+            expected = next(iter(compiled.values())).variables
+        for language, prompt in compiled.items():
+            if prompt.variables != expected:
+                missing = sorted(expected - prompt.variables)
+                unknown = sorted(prompt.variables - expected)
+                raise PromptTemplateError(
+                    f"Prompt '{name}' ({language}): missing {missing or '-'}, undeclared {unknown or '-'}"
+                )
+
+        with self._lock:
+            self._prompts[name] = compiled
+        return compiled
+
+    def register_many(self, prompts: Mapping[str, Any]) -> None:
+        """Enregistre un dictionnaire {nom: traductions}"""
+        for name, translations in prompts.items():
+            self.register(name, translations)
+
+    def get(self, name: str, language: Optional[str] = None) -> CompiledPrompt:
+        """
+        Template compilé d'un prompt
+
+        Args:
+            name: Nom du prompt
+            language: Langue souhaitée (repli sur la langue par défaut si non traduite)
+
+        Returns:
+            Template compilé
+
+        Raises:
+            KeyError: Si le prompt n'est pas enregistré
+        """
+        translations = self._prompts[name]
+        prompt = translations.get(language or self.default_language)
+        if prompt is None:
+            prompt = translations.get(self.default_language) or next(iter(translations.values()))
+        return prompt
+
+    def render(self, name: str, language: Optional[str] = None, /, **values: Any) -> str:
+        """
+        Rendu d'un prompt (voir CompiledPrompt.render)
+
+        name et language sont positionnels: les templates peuvent avoir des variables de
+        même nom (ex: {name}, {language}).
+        """
+        return self.get(name, language).render(values)
+
+    def version(self, name: str, language: Optional[str] = None) -> str:
+        """Hash du contenu du template effectivement utilisé pour cette langue"""
+        return self.get(name, language).version
+
+    def cache_key(self, name: str, language: Optional[str] = None, values: Optional[Mapping[str, Any]] = None,
+                  /, **params: Any) -> str:
+        """
+        Clé de cache d'une complétion produite à partir de ce prompt
+
+        La clé combine le nom, la langue et la version du template, les variables de rendu et
+        les paramètres d'appel (modèle, température...): modifier le texte du template change
+        la clé. Utilisable avec performance_cache.cache_ai_response.
+
+        Args:
+            name: Nom du prompt
+            language: Langue du prompt
+            values: Variables de rendu
+            **params: Paramètres de la complétion
+
+        Returns:
+            Clé '<nom>:<version>:<hash>'
+        """
+        prompt = self.get(name, language)
+        payload = json.dumps(
+            [prompt.name, prompt.language, prompt.version, values or {}, params],
+            sort_keys=True, ensure_ascii=False, default=str,
+        )
+        return f"{prompt.name}:{prompt.version}:{hashlib.sha256(payload.encode('utf-8')).hexdigest()[:24]}"
+
+    def names(self) -> List[str]:
+        return sorted(self._prompts)
+
+    def fingerprint(self) -> Dict[str, Dict[str, str]]:
+        """Versions de tous les templates par nom et par langue"""
+        return {
+            name: {language: prompt.version for language, prompt in translations.items()}
+            for name, translations in sorted(self._prompts.items())
+        }
+
+
+prompt_registry = PromptRegistry()
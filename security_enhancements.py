@@ -106,9 +106,11 @@ def add_security_headers(app):
         response.headers['X-Content-Type-Options'] = 'nosniff'
         response.headers['X-Frame-Options'] = 'DENY'
         response.headers['X-XSS-Protection'] = '1; mode=block'
-        response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
-        response.headers['Pragma'] = 'no-cache'
-        response.headers['Expires'] = '0'
+        # Les réponses déclarées publiques (images immuables) gardent leur politique de cache
+        if not response.cache_control.public:
+            response.headers['Cache-Control'] = 'no-cache, no-store, must-revalidate'
+            response.headers['Pragma'] = 'no-cache'
+            response.headers['Expires'] = '0'
         
         # Header personnalisé pour identifier l'application
         response.headers['X-Powered-By'] = 'NinjaLead-Secure'
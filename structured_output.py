@@ -0,0 +1,559 @@
+"""
+Sorties structurées des LLM: parsing JSON tolérant, validation et coercition des champs
+
+Une réponse qui n'est pas du JSON strict n'est plus perdue (ni redemandée en entier):
+- le parser tolérant répare localement ce que les modèles produisent couramment: texte ou
+  balises ``` autour du JSON, virgules finales ou manquantes, clés ou valeurs non quotées,
+  guillemets simples, commentaires, littéraux Python (True/None)
+- une réponse tronquée (conteneurs non fermés en fin de texte) est refermée; si l'appelant
+  fournit une continuation, seule la suite manquante est demandée au modèle
+- la validation par un modèle pydantic (ex: boutique_ai.Customers) corrige champ par champ
+  les erreurs de type courantes ("$12.99" -> 12.99, "a, b" -> ["a", "b"], "male" -> MALE) et
+  écarte en dernier recours les éléments de liste invalides (ex: dernier élément tronqué)
+
+Les taux de réparation et les re-demandes évitées sont comptés (voir /admin/llm-usage).
+"""
+import copy
+import json
+import logging
+import os
+import re
+import threading
+from enum import Enum
+from typing import Any, Awaitable, Callable, Dict, List, Optional, Tuple, get_args, get_origin
+
+from prompt_registry import prompt_registry
+
+logger = logging.getLogger(__name__)
+
+try:
+    from pydantic import ValidationError
+except ImportError:
+    logger.warning("Pydantic package not found. Structured output validation disabled.")
+    ValidationError = None
+
+# Nombre maximum de demandes de continuation pour une réponse tronquée
+MAX_CONTINUATIONS = int(os.environ.get("STRUCTURED_OUTPUT_MAX_CONTINUATIONS", "1"))
+# Passes de coercition avant d'abandonner la validation
+MAX_COERCION_PASSES = 3
+
+prompt_registry.register('json_continuation', """
+    {prompt}
+
+    Your previous answer was cut off. Here it is, exactly as received:
+    {partial}
+
+    Continue the JSON from the exact character where it stops. Output only the missing remainder,
+    without repeating anything and without any explanation or code fence.
+""")
+
+_NUMBER = re.compile(r"[-+]?(?:\d+\.?\d*|\.\d+)(?:[eE][-+]?\d*)?")
+_IDENTIFIER = re.compile(r"[A-Za-z_$][\w$-]*")
+_LITERALS = {
+    'true': True, 'True': True, 'false': False, 'False': False,
+    'null': None, 'None': None, 'undefined': None,
+}
+_BARE_KEY_END = re.compile(r"\s*:")
+_MISSING = object()
+# Valeur illisible au milieu de la réponse (exposant sans chiffres): écartée, le parsing continue
+_INVALID = object()
+
+
+class JSONRepairError(ValueError):
+    """Aucune structure JSON exploitable dans la réponse"""
+
+
+class ParseResult:
+    """Résultat du parsing tolérant d'une réponse"""
+
+    __slots__ = ('value', 'repairs', 'truncated', 'end')
+
+    def __init__(self, value: Any, repairs: List[str], truncated: bool, end: int):
+        self.value = value
+        self.repairs = repairs
+        self.truncated = truncated
+        self.end = end
+
+    @property
+    def repaired(self) -> bool:
+        return bool(self.repairs)
+
+
+class _TolerantParser:
+    """Descente récursive qui avance toujours: chaque écart au JSON est réparé et noté"""
+
+    def __init__(self, text: str):
+        self.text = text
+        self.pos = 0
+        self.repairs: List[str] = []
+        self.truncated = False
+
+    def _note(self, repair: str) -> None:
+        self.repairs.append(repair)
+
+    def _eof(self) -> bool:
+        return self.pos >= len(self.text)
+
+    def _skip(self) -> None:
+        text = self.text
+        while self.pos < len(text):
+            char = text[self.pos]
+            if char.isspace():
+                self.pos += 1
+            elif text.startswith('//', self.pos):
+                end = text.find('\n', self.pos)
+                self.pos = len(text) if end < 0 else end + 1
+                self._note('comment')
+            elif text.startswith('/*', self.pos):
+                end = text.find('*/', self.pos + 2)
+                self.pos = len(text) if end < 0 else end + 2
+                self._note('comment')
+            else:
+                return
+
+    def parse(self) -> Any:
+        self._skip()
+        if self._eof():
+            self.truncated = True
+            return _MISSING
+        char = self.text[self.pos]
+        if char == '{':
+            return self._object()
+        if char == '[':
+            return self._array()
+        if char in '"\'':
+            value = self._string(char)
+        elif char in '-+.' or char.isdigit():
+            value = self._number()
+        else:
+            value = self._bare()
+        # Chaîne, nombre ou littéral coupé par la troncature: écarté plutôt que deviné
+        return _MISSING if self.truncated else value
+
+    def _object(self) -> Dict[str, Any]:
+        self.pos += 1
+        result: Dict[str, Any] = {}
+        while True:
+            self._skip()
+            if self._eof():
+                self.truncated = True
+                return result
+            char = self.text[self.pos]
+            if char == '}':
+                self.pos += 1
+                return result
+            if char == ']':
+                self._note('mismatched_bracket')
+                self.pos += 1
+                return result
+            if char == ',':
+                self._note('extra_comma')
+                self.pos += 1
+                continue
+            if char in '"\'':
+                key = self._string(char)
+                if self._eof() and self.truncated:
+                    return result
+            else:
+                key = self._bare_key()
+            self._skip()
+            if self._eof():
+                self.truncated = True
+                return result
+            if self.text[self.pos] == ':':
+                self.pos += 1
+            else:
+                self._note('missing_colon')
+            value = self.parse()
+            if value is _MISSING or (self.truncated and not value):
+                # Valeur coupée (ou objet/tableau coupé avant son premier élément complet)
+                self._note('incomplete_value')
+                return result
+            if value is not _INVALID:
+                result[str(key)] = value
+            if not self._separator('}'):
+                return result
+
+    def _array(self) -> List[Any]:
+        self.pos += 1
+        result: List[Any] = []
+        while True:
+            self._skip()
+            if self._eof():
+                self.truncated = True
+                return result
+            char = self.text[self.pos]
+            if char == ']':
+                self.pos += 1
+                return result
+            if char == '}':
+                self._note('mismatched_bracket')
+                self.pos += 1
+                return result
+            if char == ',':
+                self._note('extra_comma')
+                self.pos += 1
+                continue
+            value = self.parse()
+            if value is _MISSING or self.truncated:
+                # Dernier élément incomplet: écarté (compté dans dropped_items)
+                self._note('incomplete_element')
+                return result
+            if value is not _INVALID:
+                result.append(value)
+            if not self._separator(']'):
+                return result
+
+    def _separator(self, closing: str) -> bool:
+        """Consomme la virgule après un élément; False si le texte est épuisé"""
+        self._skip()
+        if self._eof():
+            self.truncated = True
+            return False
+        char = self.text[self.pos]
+        if char == ',':
+            self.pos += 1
+            self._skip()
+            if not self._eof() and self.text[self.pos] == closing:
+                self._note('trailing_comma')
+        elif char != closing and char not in ']}':
+            self._note('missing_comma')
+        return True
+
+    def _string(self, quote: str) -> str:
+        if quote != '"':
+            self._note('single_quotes')
+        text = self.text
+        self.pos += 1
+        chunks = []
+        while self.pos < len(text):
+            char = text[self.pos]
+            if char == '\\':
+                escaped = text[self.pos:self.pos + 6] if text.startswith('\\u', self.pos) else text[self.pos:self.pos + 2]
+                try:
+                    chunks.append(json.loads(f'"{escaped}"'))
+                except ValueError:
+                    if len(escaped) < 2 or (escaped.startswith('\\u') and len(escaped) < 6):
+                        # Échappement coupé par la troncature
+                        self.pos = len(text)
+                        break
+                    chunks.append(escaped[1])
+                    self._note('invalid_escape')
+                self.pos += len(escaped)
+                continue
+            if char == quote:
+                # Un guillemet suivi d'autre chose qu'un délimiteur est un guillemet non échappé
+                following = text[self.pos + 1:self.pos + 64].lstrip()
+                if not following or following[0] in ',:}]"':
+                    self.pos += 1
+                    return ''.join(chunks)
+                self._note('unescaped_quote')
+            elif char == '\n':
+                self._note('raw_newline')
+            chunks.append(char)
+            self.pos += 1
+        self.truncated = True
+        return ''.join(chunks)
+
+    def _number(self) -> Any:
+        match = _NUMBER.match(self.text, self.pos)
+        if not match:
+            return self._bare()
+        raw = match.group()
+        self.pos = match.end()
+        if self._eof():
+            # Nombre peut-être coupé (12 pour 125): écarté par parse
+            self.truncated = True
+            return _MISSING
+        if raw[-1] in 'eE+-':
+            self._note('invalid_number')
+            return _INVALID
+        if raw.startswith('+') or raw.startswith('.') or raw.endswith('.'):
+            self._note('number_format')
+        if re.fullmatch(r"[-+]?\d+", raw):
+            return int(raw)
+        return float(raw)
+
+    def _bare_key(self) -> str:
+        match = _IDENTIFIER.match(self.text, self.pos)
+        if match and _BARE_KEY_END.match(self.text, match.end()):
+            self.pos = match.end()
+            self._note('unquoted_key')
+            return match.group()
+        # Clé illisible: tout jusqu'au deux-points
+        end = self.text.find(':', self.pos)
+        end = len(self.text) if end < 0 else end
+        key = self.text[self.pos:end].strip()
+        self.pos = end
+        self._note('unquoted_key')
+        return key
+
+    def _bare(self) -> Any:
+        match = _IDENTIFIER.match(self.text, self.pos)
+        if match and match.group() in _LITERALS:
+            self.pos = match.end()
+            if match.group() not in ('true', 'false', 'null'):
+                self._note('python_literal')
+            return _LITERALS[match.group()]
+        # Valeur non quotée: jusqu'au prochain délimiteur
+        end = self.pos
+        while end < len(self.text) and self.text[end] not in ',}]\n':
+            end += 1
+        if end == len(self.text):
+            # Sans délimiteur, la valeur (ou le littéral: "tru") peut être coupée
+            self.pos = end
+            self.truncated = True
+            return _MISSING
+        value = self.text[self.pos:end].strip()
+        self.pos = max(end, self.pos + 1)
+        self._note('unquoted_string')
+        return value
+
+
+def _json_start(text: str) -> int:
+    positions = [index for index in (text.find('{'), text.find('[')) if index >= 0]
+    return min(positions) if positions else -1
+
+
+def repair_json(text: Optional[str]) -> ParseResult:
+    """
+    Parse une réponse JSON en réparant les écarts courants
+
+    Args:
+        text: Réponse brute du modèle
+
+    Returns:
+        ParseResult: valeur, réparations effectuées et indicateur de troncature
+
+    Raises:
+        JSONRepairError: Si la réponse ne contient ni objet ni tableau JSON
+    """
+    text = text or ''
+    try:
+        return ParseResult(json.loads(text), [], False, len(text))
+    except ValueError:
+        pass
+    start = _json_start(text)
+    if start < 0:
+        raise JSONRepairError(f"No JSON structure in response: {text[:100]!r}")
+    parser = _TolerantParser(text[start:])
+    value = parser.parse()
+    repairs = (['leading_text'] if text[:start].strip() else []) + parser.repairs
+    if parser.text[parser.pos:].strip(' \t\r\n`'):
+        repairs.append('trailing_text')
+    if parser.truncated:
+        repairs.append('truncated')
+    return ParseResult(value, repairs, parser.truncated, start + parser.pos)
+
+
+def _parse_decimal(value: str) -> Optional[float]:
+    cleaned = re.sub(r"[^\d,.\-]", '', value)
+    if ',' in cleaned and '.' in cleaned:
+        cleaned = cleaned.replace(',', '')
+    elif ',' in cleaned:
+        cleaned = cleaned.replace(',', '.')
+    match = _NUMBER.search(cleaned)
+    return float(match.group()) if match else None
+
+
+def _coerce(error_type: str, value: Any, expected: Optional[type]) -> Any:
+    """Valeur corrigée pour une erreur de validation pydantic, ou _MISSING si non corrigeable"""
+    if error_type in ('float_parsing', 'float_type', 'int_parsing', 'int_type', 'int_from_float'):
+        number = value if isinstance(value, (int, float)) else None
+        if isinstance(value, str):
+            number = _parse_decimal(value)
+        if number is None:
+            return _MISSING
+        return round(number) if error_type.startswith('int') else float(number)
+    if error_type == 'string_type':
+        if isinstance(value, (list, tuple)):
+            return ', '.join(str(item) for item in value)
+        if isinstance(value, dict):
+            return json.dumps(value, ensure_ascii=False)
+        return '' if value is None else str(value)
+    if error_type == 'list_type':
+        if value is None:
+            return []
+        if isinstance(value, str):
+            return [item.strip() for item in re.split(r"[,;\n]", value) if item.strip()]
+        if isinstance(value, dict):
+            return list(value.values())
+        return [value]
+    if error_type == 'dict_type' and value is None:
+        return {}
+    if error_type == 'bool_parsing' and isinstance(value, str):
+        lowered = value.strip().lower()
+        if lowered in ('yes', 'oui', 'y', '1', 'vrai'):
+            return True
+        if lowered in ('no', 'non', 'n', '0', 'faux'):
+            return False
+    if error_type == 'enum' and isinstance(value, str) and expected is not None:
+        lowered = value.strip().lower()
+        for member in expected:
+            if lowered in (str(member.value).lower(), member.name.lower()):
+                return member.value
+    return _MISSING
+
+
+def _resolve(data: Any, path: Tuple) -> Any:
+    for key in path:
+        data = data[key]
+    return data
+
+
+def _enum_type(model, loc: Tuple) -> Optional[type]:
+    """Type Enum attendu à l'emplacement loc d'un modèle pydantic (None si introuvable)"""
+    annotation = model
+    for key in loc:
+        if isinstance(key, int):
+            continue
+        fields = getattr(annotation, 'model_fields', None)
+        if not fields or key not in fields:
+            return None
+        annotation = fields[key].annotation
+        while get_origin(annotation) is not None:
+            args = [arg for arg in get_args(annotation) if arg is not type(None)]
+            if not args:
+                return None
+            annotation = args[-1]
+    return annotation if isinstance(annotation, type) and issubclass(annotation, Enum) else None
+
+
+class StructuredOutputEngine:
+    """Parsing tolérant + validation pydantic, avec comptage des réparations"""
+
+    def __init__(self, max_continuations: int = MAX_CONTINUATIONS):
+        self.max_continuations = max_continuations
+        self._lock = threading.Lock()
+        self._stats: Dict[str, int] = {}
+
+    def _count(self, **increments: int) -> None:
+        with self._lock:
+            for name, increment in increments.items():
+                self._stats[name] = self._stats.get(name, 0) + increment
+
+    def _finish(self, result: ParseResult, model):
+        if result.repaired:
+            # Réponse exploitable sans redemander la complétion entière
+            self._count(repaired=1, avoided_rerequests=1,
+                        dropped_items=result.repairs.count('incomplete_element'))
+        else:
+            self._count(clean=1)
+        if model is None:
+            return result.value
+        try:
+            return self.validate(model, result.value)
+        except Exception:
+            self._count(validation_failures=1)
+            raise
+
+    def _parse(self, text: Optional[str]) -> ParseResult:
+        self._count(responses=1)
+        try:
+            return repair_json(text)
+        except JSONRepairError:
+            self._count(repair_failures=1)
+            raise
+
+    def parse(self, text: Optional[str], model=None,
+              continuation: Optional[Callable[[str], str]] = None) -> Any:
+        """
+        Parse (et valide) une réponse structurée
+
+        Args:
+            text: Réponse brute du modèle
+            model: Modèle pydantic de validation (optionnel)
+            continuation: Fonction recevant la réponse partielle et renvoyant la suite,
+                appelée uniquement si la réponse est tronquée
+
+        Returns:
+            Valeur JSON, ou instance du modèle si model est fourni
+
+        Raises:
+            JSONRepairError: Si la réponse ne contient aucune structure JSON
+            ValidationError: Si la valeur ne peut pas être rendue conforme au modèle
+        """
+        result = self._parse(text)
+        for _ in range(self.max_continuations if continuation else 0):
+            if not result.truncated:
+                break
+            self._count(continuations=1)
+            text = (text or '') + (continuation(text or '') or '')
+            result = repair_json(text)
+        return self._finish(result, model)
+
+    async def aparse(self, text: Optional[str], model=None,
+                     continuation: Optional[Callable[[str], Awaitable[str]]] = None) -> Any:
+        """Version asynchrone de parse (continuation est une coroutine)"""
+        result = self._parse(text)
+        for _ in range(self.max_continuations if continuation else 0):
+            if not result.truncated:
+                break
+            self._count(continuations=1)
+            text = (text or '') + (await continuation(text or '') or '')
+            result = repair_json(text)
+        return self._finish(result, model)
+
+    def validate(self, model, data: Any):
+        """
+        Valide des données avec un modèle pydantic en corrigeant les champs mal typés
+
+        Args:
+            model: Classe de modèle pydantic
+            data: Données parsées
+
+        Returns:
+            Instance du modèle
+
+        Raises:
+            ValidationError: Si des erreurs restent après coercition
+        """
+        if ValidationError is None:
+            raise RuntimeError("pydantic is required for structured output validation")
+        data = copy.deepcopy(data)
+        for attempt in range(MAX_COERCION_PASSES + 1):
+            try:
+                return model.model_validate(data)
+            except ValidationError as error:
+                if attempt == MAX_COERCION_PASSES:
+                    raise
+                changed, drops = 0, set()
+                for detail in error.errors():
+                    loc = tuple(detail['loc'])
+                    try:
+                        parent = _resolve(data, loc[:-1]) if loc else None
+                    except (KeyError, IndexError, TypeError):
+                        parent = None
+                    value = _MISSING
+                    if parent is not None and detail['type'] != 'missing':
+                        value = _coerce(detail['type'], detail.get('input'), _enum_type(model, loc))
+                    if value is not _MISSING:
+                        parent[loc[-1]] = value
+                        changed += 1
+                        continue
+                    # Dernier recours: écarter l'élément de liste qui contient l'erreur
+                    indices = [index for index, key in enumerate(loc) if isinstance(key, int)]
+                    if not indices:
+                        raise
+                    drops.add(loc[:indices[-1] + 1])
+                for path in sorted(drops, key=lambda path: path[-1], reverse=True):
+                    try:
+                        del _resolve(data, path[:-1])[path[-1]]
+                    except (KeyError, IndexError, TypeError):
+                        raise error
+                self._count(coerced_fields=changed, dropped_items=len(drops))
+
+    def stats(self) -> Dict[str, Any]:
+        """Compteurs et taux de réparation des réponses structurées"""
+        with self._lock:
+            stats = dict(self._stats)
+        needing_repair = stats.get('repaired', 0) + stats.get('repair_failures', 0)
+        stats['repair_success_rate'] = round(stats.get('repaired', 0) / needing_repair, 3) if needing_repair else 1.0
+        return stats
+
+    def reset_stats(self) -> None:
+        with self._lock:
+            self._stats.clear()
+
+
+structured_output = StructuredOutputEngine()
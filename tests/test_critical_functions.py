@@ -7,6 +7,7 @@ import pytest
 import os
 import sys
 import tempfile
+import time
 from unittest.mock import patch, MagicMock
 
 # Ajouter le répertoire parent au path pour importer l'application
@@ -217,6 +218,1325 @@ class TestBackupSystem:
         assert result is True
         mock_backup.assert_called_once()
 
+class TestBackupEngine:
+    """Tests des sauvegardes en flux et parallèles (adaptateur SQLite)"""
+
+    @pytest.fixture
+    def database(self, tmp_path):
+        import sqlite3
+        path = tmp_path / 'source.db'
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE metric (id INTEGER PRIMARY KEY, name TEXT, value REAL)')
+        connection.execute('CREATE TABLE audit_log (id INTEGER PRIMARY KEY, action TEXT)')
+        connection.execute('CREATE INDEX idx_metric_name ON metric (name)')
+        connection.executemany('INSERT INTO metric (name, value) VALUES (?, ?)',
+                               [(f"m'{i}", i * 0.5) for i in range(3000)])
+        connection.executemany('INSERT INTO audit_log (action) VALUES (?)', [('login',), ('logout',)])
+        connection.commit()
+        connection.close()
+        return path
+
+    @staticmethod
+    def _rows(path):
+        import sqlite3
+        connection = sqlite3.connect(path)
+        try:
+            return (connection.execute('SELECT * FROM metric ORDER BY id').fetchall(),
+                    connection.execute('SELECT * FROM audit_log ORDER BY id').fetchall())
+        finally:
+            connection.close()
+
+    @pytest.mark.parametrize('backup_format', ['custom', 'directory'])
+    def test_backup_verify_and_restore(self, app, tmp_path, database, backup_format):
+        """Sauvegarde compressée, vérifiée, puis restaurée à l'identique"""
+        import shutil
+        from backup_manager import BackupManager
+
+        manager = BackupManager(tmp_path / 'backups', database_url=f"sqlite:///{database}")
+        manifest = manager.run_backup(backup_format, jobs=2, compression='gzip')
+
+        assert manifest['verified'] and manifest['entries'] >= 2
+        assert manager.list_backups()[0]['filename'] == manifest['name']
+        expected = self._rows(database)
+
+        # Restauration sur une base modifiée
+        restored = tmp_path / 'restored.db'
+        shutil.copy(database, restored)
+        manager.database_url = f"sqlite:///{restored}"
+        import sqlite3
+        connection = sqlite3.connect(restored)
+        connection.execute('DELETE FROM metric WHERE id > 10')
+        connection.commit()
+        connection.close()
+
+        assert manager.restore_backup(manifest['name'], jobs=2) is True
+        assert self._rows(restored) == expected
+
+    def test_corrupted_backup_is_rejected(self, app, tmp_path, database):
+        """Une archive altérée échoue à la vérification et n'est pas restaurée"""
+        from backup_manager import BackupManager
+
+        manager = BackupManager(tmp_path / 'backups', database_url=f"sqlite:///{database}")
+        manifest = manager.run_backup('custom', compression='gzip')
+        artifact = tmp_path / 'backups' / manifest['artifact']
+        data = bytearray(artifact.read_bytes())
+        data[len(data) // 2] ^= 0xFF
+        artifact.write_bytes(bytes(data))
+
+        result = manager.verify_backup(manifest['name'])
+        assert not result['valid'] and 'Checksum mismatch' in result['errors'][0]
+        assert manager.restore_backup(manifest['name']) is False
+
+    @pytest.mark.parametrize('version_output, expected', [
+        (b'pg_dump (PostgreSQL) 16.2 (Ubuntu 16.2-1)\n', '--compress=zstd'),
+        (b'pg_dump (PostgreSQL) 15.6\n', '--compress=6'),
+        (b'', '--compress=6'),
+    ])
+    def test_pg_dump_zstd_only_from_version_16(self, app, tmp_path, monkeypatch, version_output, expected):
+        """pg_dump antérieur à 16 (ou de version inconnue) compresse le format directory en gzip"""
+        import subprocess
+        import backup_manager
+
+        commands = []
+
+        def run(cmd, **kwargs):
+            commands.append(cmd)
+            return subprocess.CompletedProcess(cmd, 0, stdout=version_output if '--version' in cmd else b'', stderr=b'')
+
+        monkeypatch.setattr(backup_manager.subprocess, 'run', run)
+        adapter = backup_manager.PostgresBackupAdapter('postgresql://user:secret@db:5432/app')
+        adapter.dump_directory(tmp_path, 2, 'zstd')
+        adapter.dump_directory(tmp_path, 2, 'zstd')
+
+        dumps = [cmd for cmd in commands if '--format=directory' in cmd]
+        assert [cmd for cmd in commands if '--version' in cmd] == [['pg_dump', '--version']]
+        assert all(expected in cmd for cmd in dumps) and len(dumps) == 2
+
+class TestIncrementalBackup:
+    """Tests des sauvegardes incrémentales des tables de télémétrie"""
+
+    @staticmethod
+    def _add_metrics(db, start, count):
+        from models import Metric
+        db.session.add_all([Metric(name=f"metric_{i}", category='system', data={'value': i, 'tags': ['a']},
+                                   execution_time=i / 10) for i in range(start, start + count)])
+        db.session.commit()
+
+    @staticmethod
+    def _snapshot(db):
+        from models import Metric
+        return [(m.id, m.name, m.data, m.execution_time, m.created_at)
+                for m in Metric.query.order_by(Metric.id).all()]
+
+    def test_base_increments_and_replay(self, app, tmp_path):
+        """Base puis incréments: seules les nouvelles lignes sont exportées, le rejeu reconstruit la table"""
+        from app import db
+        from incremental_backup import IncrementalBackup
+
+        backup = IncrementalBackup(tmp_path / 'incremental', tables={'metric': ('id', 'created_at')},
+                                   compression='gzip', settle_seconds=0)
+        self._add_metrics(db, 0, 120)
+        base = backup.run()['metric']
+        assert base['rows'] == 120 and base['from_id'] == 0 and base['bytes'] > 0
+
+        self._add_metrics(db, 120, 30)
+        increment = backup.run()['metric']
+        assert increment['rows'] == 30 and increment['from_id'] == base['to_id']
+        assert backup.run()['metric']['rows'] == 0
+
+        expected = self._snapshot(db)
+        db.session.execute(db.text('DELETE FROM metric'))
+        db.session.commit()
+
+        report = backup.replay()
+        db.session.expire_all()
+        assert report['metric'] == {'rows': 150, 'files': 2, 'duration': report['metric']['duration']}
+        assert self._snapshot(db) == expected
+        assert backup.status()['metric']['rows'] == 150
+        assert backup.covered_tables() == ['metric']
+
+    def test_recent_rows_wait_for_settle_delay(self, app, tmp_path):
+        """Les lignes plus récentes que le délai de stabilisation attendent l'exécution suivante"""
+        from app import db
+        from incremental_backup import IncrementalBackup
+
+        backup = IncrementalBackup(tmp_path / 'incremental', tables={'metric': ('id', 'created_at')},
+                                   compression='gzip', settle_seconds=3600)
+        self._add_metrics(db, 0, 10)
+        assert backup.run()['metric']['rows'] == 0
+        assert backup.load_state()['metric']['high_water_mark'] == 0
+
+    def test_tampered_chain_is_not_replayed(self, app, tmp_path):
+        """Un fichier altéré bloque le rejeu sans toucher la table"""
+        from app import db
+        from backup_manager import BackupError
+        from incremental_backup import IncrementalBackup
+
+        backup = IncrementalBackup(tmp_path / 'incremental', tables={'metric': ('id', 'created_at')},
+                                   compression='gzip', settle_seconds=0)
+        self._add_metrics(db, 0, 20)
+        report = backup.run()['metric']
+        path = tmp_path / 'incremental' / report['file']
+        path.write_bytes(path.read_bytes()[:-4] + b'\0\0\0\0')
+
+        with pytest.raises(BackupError):
+            backup.replay()
+        assert len(self._snapshot(db)) == 20
+
+    def test_mutable_tables_stay_in_full_dump(self, app, tmp_path):
+        """stored_images n'est pas suivi; une ancienne chaîne ne l'exclut plus du dump complet"""
+        import json
+        from incremental_backup import INCREMENTAL_TABLES, IncrementalBackup
+
+        assert 'stored_images' not in INCREMENTAL_TABLES
+        backup = IncrementalBackup(tmp_path / 'incremental')
+        (tmp_path / 'incremental').mkdir()
+        backup.state_path.write_text(json.dumps({
+            name: {'high_water_mark': 10, 'files': [{'file': f'{name}/000000_1_10.ndjson.gz'}]}
+            for name in ('metric', 'stored_images')
+        }))
+        assert backup.covered_tables() == ['metric']
+
+    def test_postgres_copy_keeps_json_intact(self, app, tmp_path):
+        """Chemin PostgreSQL: COPY au format CSV, antislashs, guillemets et retours à la ligne intacts"""
+        import csv
+        import json
+        from types import SimpleNamespace
+        from backup_manager import CompressedWriter
+        from incremental_backup import IncrementalBackup
+
+        rows = [{'id': 1, 'data': {'text': 'guillemet " et\nretour', 'path': 'C:\\dossier\\fichier'}},
+                {'id': 2, 'data': {'regex': '\\d+\\.\\d{2}', 'emoji': 'prix 9,99 €'}}]
+        queries = []
+
+        class FakeCursor:
+            """Émule la sortie de COPY TO STDOUT selon le format demandé"""
+
+            def __enter__(self):
+                return self
+
+            def __exit__(self, *exc):
+                return False
+
+            def copy_expert(self, sql, file):
+                queries.append(sql)
+                if 'FORMAT csv' in sql:
+                    writer = csv.writer(file, delimiter='\x02', quotechar='\x01', lineterminator='\n')
+                    for row in rows:
+                        writer.writerow([json.dumps(row)])
+                else:
+                    # Format texte: les antislashs sont doublés
+                    for row in rows:
+                        file.write(json.dumps(row).replace('\\', '\\\\') + '\n')
+
+        connection = SimpleNamespace(cursor=FakeCursor, commit=lambda: None, close=lambda: None)
+        fake_db = SimpleNamespace(engine=SimpleNamespace(dialect=SimpleNamespace(name='postgresql'),
+                                                         raw_connection=lambda: connection))
+        backup = IncrementalBackup(tmp_path / 'incremental', compression='gzip')
+        path = tmp_path / 'metric.ndjson.gz'
+        writer = CompressedWriter(path, 'gzip')
+        with patch('incremental_backup.db', fake_db):
+            backup._copy_range(SimpleNamespace(name='metric'), 'id', 0, 10, writer)
+        writer.close()
+
+        assert "TO STDOUT (FORMAT csv, QUOTE e'\\x01', DELIMITER e'\\x02')" in queries[0]
+        assert [row for batch in backup._iter_batches(path, 'gzip') for row in batch] == rows
+
+    def test_full_backup_excludes_covered_tables(self, app, tmp_path):
+        """Le dump complet ne garde que le schéma des tables exclues"""
+        import sqlite3
+        from backup_manager import BackupManager
+
+        path = tmp_path / 'source.db'
+        connection = sqlite3.connect(path)
+        connection.execute('CREATE TABLE metric (id INTEGER PRIMARY KEY, name TEXT)')
+        connection.execute('CREATE TABLE customer (id INTEGER PRIMARY KEY, name TEXT)')
+        connection.executemany('INSERT INTO metric (name) VALUES (?)', [('m',)] * 50)
+        connection.execute("INSERT INTO customer (name) VALUES ('c')")
+        connection.commit()
+        connection.close()
+
+        manager = BackupManager(tmp_path / 'backups', database_url=f"sqlite:///{path}")
+        manifest = manager.run_backup('custom', compression='gzip', exclude_data=['metric'])
+        assert manifest['excluded_data'] == ['metric']
+        assert manager.restore_backup(manifest['name']) is True
+
+        connection = sqlite3.connect(path)
+        assert connection.execute('SELECT COUNT(*) FROM metric').fetchone()[0] == 0
+        assert connection.execute('SELECT COUNT(*) FROM customer').fetchone()[0] == 1
+        connection.close()
+
+class TestGDPRExport:
+    """Tests de l'export GDPR en flux"""
+
+    @staticmethod
+    def _seed(db):
+        from models import User, Boutique, Customer, CustomerPersona, Campaign, Metric
+
+        owner = User(id='gdpr-owner', username='gdpr_owner', email='owner@example.com')
+        other = User(id='gdpr-other', username='gdpr_other', email='other@example.com')
+        db.session.add_all([owner, other])
+        db.session.flush()
+        boutique = Boutique(name='Boutique', owner_id=owner.id)
+        foreign = Boutique(name='Autre', owner_id=other.id)
+        persona = CustomerPersona(title='Persona', description='Acheteur', owner_id=owner.id)
+        db.session.add_all([boutique, foreign, persona])
+        db.session.flush()
+        db.session.add_all([Customer(name=f"Client {i}", boutique_id=boutique.id, social_media={'x': i})
+                            for i in range(25)])
+        db.session.add(Customer(name='Client étranger', boutique_id=foreign.id))
+        db.session.add(Campaign(title='Campagne', content='Texte', campaign_type='email', persona_id=persona.id))
+        db.session.add_all([Metric(name='ai_call', user_id=owner.id), Metric(name='ai_call', user_id=other.id)])
+        db.session.commit()
+        return owner
+
+    def test_json_stream_is_paged_and_scoped(self, app):
+        """Le document JSON produit par pages contient toutes les lignes de l'utilisateur et seulement elles"""
+        import json
+        from app import db
+        from gdpr_export import GDPRDataExporter
+
+        owner = self._seed(db)
+        exporter = GDPRDataExporter(page_size=4)
+        counts = {}
+        chunks = list(exporter.stream_json(owner, {'personal_info': {'id': owner.id}}, counts=counts))
+        document = json.loads(''.join(chunks))
+
+        assert len(chunks) > 10
+        assert document['personal_info'] == {'id': owner.id}
+        assert [c['name'] for c in document['customers']] == [f"Client {i}" for i in range(25)]
+        assert document['customers'][3]['social_media'] == {'x': 3}
+        assert len(document['campaigns']) == 1 and len(document['metrics']) == 1
+        assert counts['customers'] == 25 and counts['boutiques'] == 1
+
+    def test_portability_zip_holds_ndjson_per_entity(self, app):
+        """L'archive de portabilité contient un NDJSON par entité fournie par l'utilisateur"""
+        import io
+        import json
+        import zipfile
+        from app import db
+        from gdpr_compliance import gdpr_compliance
+
+        owner = self._seed(db)
+        stream = gdpr_compliance.process_data_portability_request(owner.id, 'ndjson.zip')
+        archive = zipfile.ZipFile(io.BytesIO(b''.join(stream)))
+
+        assert archive.testzip() is None
+        assert json.loads(archive.read('account.json'))['account']['email'] == 'owner@example.com'
+        customers = [json.loads(line) for line in archive.read('customers.ndjson').splitlines()]
+        assert len(customers) == 25
+        assert 'metrics.ndjson' not in archive.namelist()
+        assert json.loads(archive.read('manifest.json'))['entities']['customers'] == 25
+        assert gdpr_compliance.process_data_portability_request('missing') is None
+
+class TestLLMRouter:
+    """Tests du routage entre fournisseurs d'IA (serveurs locaux avec pannes injectées)"""
+
+    @staticmethod
+    def _fake_provider(name, fault):
+        """Serveur compatible /v1/chat/completions; fault = {'status': int, 'delay': float}"""
+        import http.server
+        import json
+        import threading
+        import time
+
+        class ProviderHandler(http.server.BaseHTTPRequestHandler):
+            protocol_version = 'HTTP/1.1'
+            hits = 0
+
+            def log_message(self, *args):
+                pass
+
+            def do_POST(self):
+                ProviderHandler.hits += 1
+                self.rfile.read(int(self.headers.get('Content-Length', 0)))
+                time.sleep(fault.get('delay', 0))
+                status = fault.get('status', 200)
+                body = json.dumps({
+                    'id': 'chatcmpl-test', 'object': 'chat.completion', 'created': 0, 'model': name,
+                    'choices': [{'index': 0, 'finish_reason': 'stop',
+                                 'message': {'role': 'assistant', 'content': f'réponse {name}'}}],
+                } if status == 200 else {'error': {'message': 'injected fault', 'type': 'server_error'}}).encode()
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+        server = http.server.ThreadingHTTPServer(('127.0.0.1', 0), ProviderHandler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        return server, ProviderHandler
+
+    def _manager(self, xai_server, openai_server, timeout=2.0):
+        from openai import OpenAI
+        from ai_utils import AIManager
+
+        manager = AIManager()
+        manager.grok_client = OpenAI(base_url=f"http://127.0.0.1:{xai_server.server_address[1]}/v1",
+                                     api_key='test', max_retries=0, timeout=timeout)
+        manager.openai_client = OpenAI(base_url=f"http://127.0.0.1:{openai_server.server_address[1]}/v1",
+                                       api_key='test', max_retries=0, timeout=timeout)
+        return manager
+
+    def test_breaker_opens_then_probes_after_cooldown(self, app):
+        """Fermé -> ouvert après N échecs -> semi-ouvert (un seul appel test) -> fermé"""
+        from llm_router import ProviderHealth, CLOSED, OPEN, HALF_OPEN
+
+        now = [0.0]
+        health = ProviderHealth('xai', failure_threshold=3, cooldown=10, clock=lambda: now[0])
+        for _ in range(3):
+            assert health.allow()
+            health.record_failure(0.1, RuntimeError('503'))
+        assert health.state == OPEN and not health.allow()
+
+        now[0] = 11
+        assert health.allow() and health.state == HALF_OPEN
+        assert not health.allow()
+        health.record_success(0.2)
+        assert health.state == CLOSED and health.allow()
+
+    def test_caller_error_releases_half_open_probe(self, app):
+        """Un refus de budget pendant l'appel test n'ouvre ni ne bloque le disjoncteur"""
+        from llm_router import LLMRouter, ProviderHealth, HALF_OPEN
+        from token_accounting import TokenBudgetExceeded
+
+        now = [0.0]
+        router = LLMRouter(hedge_after=0, health_factory=lambda name: ProviderHealth(
+            name, failure_threshold=1, cooldown=10, clock=lambda: now[0]))
+        router.health('xai').record_failure(0.1, RuntimeError('503'))
+        now[0] = 11
+
+        def over_budget():
+            raise TokenBudgetExceeded('u', 500, 10)
+
+        with pytest.raises(TokenBudgetExceeded):
+            router.execute([('xai', over_budget)])
+        health = router.health('xai')
+        assert health.state == HALF_OPEN and health.total_failures == 1
+        assert router.execute([('xai', lambda: 'ok')]) == 'ok'
+        assert health.snapshot()['state'] == 'closed'
+
+    def test_failing_provider_is_skipped(self, app):
+        """xAI en erreur 500: repli sur OpenAI, puis xAI n'est plus appelé en premier"""
+        from llm_router import LLMRouter, ProviderHealth
+
+        xai, xai_handler = self._fake_provider('grok', {'status': 500})
+        openai, openai_handler = self._fake_provider('gpt', {})
+        router = LLMRouter(hedge_after=0,
+                           health_factory=lambda name: ProviderHealth(name, failure_threshold=3, cooldown=60))
+        try:
+            manager = self._manager(xai, openai)
+            with patch('ai_utils.llm_router', router):
+                results = [manager.generate_text(f"Prompt {i}") for i in range(8)]
+        finally:
+            xai.shutdown()
+            openai.shutdown()
+
+        assert results == ['réponse gpt'] * 8
+        assert xai_handler.hits <= 3 and openai_handler.hits == 8
+        state = router.state()
+        assert state['ranking']['chat'][0] == 'openai'
+        assert state['providers']['xai:chat']['error_rate'] == 1.0
+
+    def test_open_circuit_fails_fast_without_calling_provider(self, app):
+        """Sans repli, le disjoncteur ouvert rejette la requête sans appeler le fournisseur"""
+        from llm_router import LLMRouter, ProviderHealth, ProviderUnavailableError
+
+        xai, xai_handler = self._fake_provider('grok', {'status': 503})
+        openai, _ = self._fake_provider('gpt', {})
+        router = LLMRouter(hedge_after=0,
+                           health_factory=lambda name: ProviderHealth(name, failure_threshold=3, cooldown=60))
+        errors = []
+        try:
+            manager = self._manager(xai, openai)
+            with patch('ai_utils.llm_router', router):
+                for _ in range(6):
+                    with pytest.raises(ProviderUnavailableError) as excinfo:
+                        manager.generate_text("Prompt", use_fallback=False)
+                    errors.append(excinfo.value.errors['xai'])
+        finally:
+            xai.shutdown()
+            openai.shutdown()
+
+        assert xai_handler.hits == 3
+        assert errors[3:] == ['circuit open'] * 3
+        assert router.state()['providers']['xai:chat']['state'] == 'open'
+
+    def test_image_failures_do_not_open_text_breaker(self, app):
+        """Santé par opération; une réponse sans URL déclenche le repli sans compter comme une panne"""
+        from llm_router import (LLMRouter, ProviderHealth, InvalidProviderResponse, ProviderUnavailableError,
+                                OPEN, CLOSED)
+
+        router = LLMRouter(hedge_after=0,
+                           health_factory=lambda name: ProviderHealth(name, failure_threshold=2, cooldown=60))
+
+        def no_url():
+            raise InvalidProviderResponse('no image URL')
+
+        def unreachable():
+            raise ConnectionError('connection refused')
+
+        assert router.execute([('xai', no_url), ('openai', lambda: 'https://img')], operation='image') == 'https://img'
+        for _ in range(4):
+            with pytest.raises(ProviderUnavailableError):
+                router.execute([('xai', no_url)], operation='image')
+        snapshot = router.health('xai', 'image').snapshot()
+        assert snapshot['state'] == CLOSED and snapshot['total_failures'] == 0 and snapshot['invalid_responses'] == 5
+
+        for _ in range(2):
+            with pytest.raises(ProviderUnavailableError):
+                router.execute([('xai', unreachable)], operation='image')
+        assert router.health('xai', 'image').state == OPEN
+        assert router.execute([('xai', lambda: 'texte')]) == 'texte'
+        assert router.health('xai').state == CLOSED
+        assert set(router.state()['providers']) == {'xai:image', 'openai:image', 'xai:chat'}
+
+        router.reset('xai')
+        assert set(router.state()['providers']) == {'openai:image'}
+
+    def test_hedged_request_wins_over_slow_provider(self, app):
+        """Fournisseur principal lent: la requête couverte répond sans attendre sa latence"""
+        import time
+        from llm_router import LLMRouter
+
+        xai, _ = self._fake_provider('grok', {'delay': 1.0})
+        openai, _ = self._fake_provider('gpt', {})
+        router = LLMRouter(hedge_after=0.1)
+        try:
+            manager = self._manager(xai, openai)
+            with patch('ai_utils.llm_router', router):
+                started = time.monotonic()
+                result = manager.generate_text("Prompt")
+                elapsed = time.monotonic() - started
+        finally:
+            xai.shutdown()
+            openai.shutdown()
+
+        assert result == 'réponse gpt'
+        assert elapsed < 0.8
+
+    def test_slow_provider_is_ranked_below_healthy_one(self, app):
+        """Un p95 nettement plus élevé fait passer le fournisseur demandé au second rang"""
+        from llm_router import LLMRouter
+
+        router = LLMRouter()
+        for _ in range(20):
+            router.health('xai').record_success(3.0)
+            router.health('openai').record_success(0.4)
+        assert router.rank(['xai', 'openai']) == ['openai', 'xai']
+
+        router.reset()
+        for _ in range(20):
+            router.health('xai').record_success(0.5)
+            router.health('openai').record_success(0.4)
+        assert router.rank(['xai', 'openai']) == ['xai', 'openai']
+
+class TestTokenAccounting:
+    """Tests de la comptabilité des tokens LLM (clients factices renvoyant un usage)"""
+
+    @staticmethod
+    def _client(is_async=False, error=None, usage=(30, 20)):
+        from types import SimpleNamespace
+
+        calls = []
+
+        def respond(params):
+            calls.append(params)
+            if error is not None:
+                raise error
+            return SimpleNamespace(
+                model=params['model'],
+                choices=[SimpleNamespace(message=SimpleNamespace(content='ok'))],
+                usage=SimpleNamespace(prompt_tokens=usage[0], completion_tokens=usage[1], total_tokens=sum(usage)),
+            )
+
+        if is_async:
+            async def create(**params):
+                return respond(params)
+        else:
+            def create(**params):
+                return respond(params)
+        return SimpleNamespace(chat=SimpleNamespace(completions=SimpleNamespace(create=create))), calls
+
+    @staticmethod
+    def _user(db, tokens_total=1000):
+        from models import User
+
+        user = User(id='budget-user', username='budget_user', email='budget@example.com',
+                    tokens_total=tokens_total, tokens_used=0)
+        db.session.add(user)
+        db.session.commit()
+        return user
+
+    def test_charges_actual_usage_and_rejects_preflight(self, app):
+        """Débit de l'usage réel; une requête dont le prompt estimé dépasse le budget n'est pas envoyée"""
+        from app import db
+        from token_accounting import TokenAccountant, TokenBudgetExceeded, usage_context
+
+        user = self._user(db)
+        raw, calls = self._client()
+        client = TokenAccountant(enforce=True).metered(raw, 'tests')
+        messages = [{'role': 'user', 'content': 'Décris ce produit'}]
+
+        with usage_context(user_id=user.id):
+            # max_tokens n'est pas réservé: seul le prompt compte dans le contrôle préalable
+            client.chat.completions.create(model='grok-3', messages=messages, max_tokens=2000)
+            db.session.expire_all()
+            assert user.tokens_used == 50
+
+            with pytest.raises(TokenBudgetExceeded) as excinfo:
+                client.chat.completions.create(
+                    model='grok-3', messages=[{'role': 'user', 'content': 'description ' * 2000}], max_tokens=200)
+
+        db.session.expire_all()
+        assert user.tokens_used == 50 and len(calls) == 1
+        assert excinfo.value.remaining == 950
+
+    def test_default_accountant_records_without_rejecting(self, app):
+        """Sans LLM_ENFORCE_BUDGETS, l'usage réel est débité même au-delà du budget"""
+        from app import db
+        from token_accounting import ENFORCE_BUDGETS, TokenAccountant, usage_context
+
+        assert ENFORCE_BUDGETS is False
+        user = self._user(db, tokens_total=10)
+        raw, calls = self._client()
+        client = TokenAccountant().metered(raw, 'tests')
+        with usage_context(user_id=user.id):
+            client.chat.completions.create(model='grok-3', messages=[{'role': 'user', 'content': 'x ' * 500}])
+
+        db.session.expire_all()
+        assert len(calls) == 1 and user.tokens_used == 50
+
+    def test_failed_async_call_is_refunded(self, app):
+        """Un appel asynchrone en échec restitue sa réservation"""
+        import asyncio
+        from app import db
+        from token_accounting import TokenAccountant, usage_context
+
+        user = self._user(db)
+        accountant = TokenAccountant(enforce=True)
+        failing = accountant.metered(self._client(is_async=True, error=RuntimeError('503'))[0], 'tests')
+        working = accountant.metered(self._client(is_async=True, usage=(10, 5))[0], 'tests')
+
+        async def run():
+            with pytest.raises(RuntimeError):
+                await failing.chat.completions.create(model='grok-3', messages=[], max_tokens=500)
+            await working.chat.completions.create(model='grok-3', messages=[], max_tokens=500)
+
+        with usage_context(user_id=user.id):
+            asyncio.run(run())
+        db.session.expire_all()
+        assert user.tokens_used == 15
+
+    def test_usage_aggregated_per_user_model_feature(self, app):
+        """Agrégats écrits par lots puis cumulés; coût estimé selon le prix du modèle"""
+        from app import db
+        from token_accounting import TokenAccountant, usage_context
+
+        accountant = TokenAccountant(enforce=False)
+        client = accountant.metered(self._client(usage=(1000, 500))[0], 'boutique_ai')
+        for _ in range(3):
+            client.chat.completions.create(model='grok-3', messages=[])
+        accountant.flush()
+        with usage_context(feature='osp_value_map'):
+            client.chat.completions.create(model='gpt-4o', messages=[])
+        client.with_feature('product_generator').chat.completions.create(model='grok-3', messages=[])
+        assert accountant.flush() == 2
+
+        rows = {(row['model'], row['feature']): row for row in accountant.summary(group_by=('model', 'feature'))}
+        assert rows[('grok-3', 'boutique_ai')]['calls'] == 3
+        assert rows[('grok-3', 'boutique_ai')]['prompt_tokens'] == 3000
+        assert rows[('grok-3', 'boutique_ai')]['cost_usd'] == pytest.approx(3 * (1000 * 3 + 500 * 15) / 1e6)
+        assert ('gpt-4o', 'osp_value_map') in rows and ('grok-3', 'product_generator') in rows
+        with pytest.raises(ValueError):
+            accountant.summary(group_by=('email',))
+
+    def test_budget_error_does_not_degrade_provider(self, app):
+        """Le routeur propage un refus de budget sans repli ni échec enregistré"""
+        from llm_router import LLMRouter
+        from token_accounting import TokenBudgetExceeded
+
+        def over_budget():
+            raise TokenBudgetExceeded('u', 500, 10)
+
+        fallback = MagicMock(return_value='ok')
+        router = LLMRouter(hedge_after=0)
+        with pytest.raises(TokenBudgetExceeded):
+            router.execute([('xai', over_budget), ('openai', fallback)])
+        assert not fallback.called
+        assert router.health('xai').snapshot()['total_failures'] == 0
+
+class TestPromptCompaction:
+    """Tests de la compaction des contextes de prompt"""
+
+    def test_json_is_minified_and_pruned(self, app):
+        """Pas d'indentation, nulls et champs vides supprimés, 0 et False conservés"""
+        import json
+        from prompt_compaction import compact_json
+
+        context = {'product': {'titre': 'Lampe', 'prix': 0, 'promo': False, 'video_url': None, 'code': '',
+                               'avis': [], 'livraison': {'frais': None}, 'tags': ['led', None, '']}}
+        compacted = compact_json(context)
+
+        assert '\n' not in compacted and ', ' not in compacted
+        assert json.loads(compacted) == {'product': {'titre': 'Lampe', 'prix': 0, 'promo': False, 'tags': ['led']}}
+
+    def test_long_fields_trimmed_to_budget(self, app):
+        """Un contexte trop long tient dans son budget; les champs courts restent intacts"""
+        import json
+        from prompt_compaction import compact_json, estimate_tokens, trim_text
+
+        description = ' '.join(f'Phrase numéro {i} décrivant le produit en détail.' for i in range(200))
+        compacted = compact_json({'titre': 'Sac à dos 40L', 'description': description}, max_tokens=300)
+
+        assert estimate_tokens(compacted) <= 300
+        assert json.loads(compacted)['titre'] == 'Sac à dos 40L'
+        assert json.loads(compacted)['description'].endswith(' …')
+        trimmed = trim_text('un deux trois quatre cinq six sept huit', 4)
+        assert trimmed == 'un deux …' and estimate_tokens(trimmed) <= 4
+
+    def test_texts_share_budget_and_stats_recorded(self, app):
+        """Les textes se partagent le budget du site; tokens avant/après comptés par site"""
+        from prompt_compaction import PromptCompactor, estimate_tokens
+
+        compactor = PromptCompactor(budgets={'history': 90, 'page': 50})
+        personas = ['Persona détaillé avec beaucoup de contexte. ' * 30] * 3
+        compacted = compactor.texts('history', personas)
+        page = compactor.text('page', 'Menu\nAccueil\nMenu\n\n   Lampe   LED   pliable\nMenu')
+
+        assert all(estimate_tokens(text) <= 30 for text in compacted)
+        assert page == 'Menu\nAccueil\nLampe LED pliable'
+        stats = compactor.stats()
+        assert stats['history']['calls'] == 1
+        assert stats['history']['tokens_after'] < stats['history']['tokens_before'] / 5
+        assert stats['page']['tokens_after'] < stats['page']['tokens_before']
+
+class TestPromptRegistry:
+    """Tests du registre de templates de prompts"""
+
+    def test_json_braces_are_literal(self, app):
+        """Les accolades des exemples JSON restent littérales (plus de template renvoyé non rempli)"""
+        from boutique_ai import get_translated_prompt
+
+        prompt = get_translated_prompt('niche_attributes', 'fr', niche='randonnée', persona_excerpt='Alex, 34 ans')
+
+        assert 'niche randonnée' in prompt
+        assert 'Alex, 34 ans' in prompt
+        assert '"sous_categories_preferees"' in prompt
+        assert '{niche}' not in prompt
+
+    def test_translations_validated_at_load(self, app):
+        """Une traduction dont les variables diffèrent est refusée à l'enregistrement"""
+        from prompt_registry import PromptRegistry, PromptTemplateError
+
+        registry = PromptRegistry()
+        with pytest.raises(PromptTemplateError):
+            registry.register('greeting', {'en': 'Hello {name}', 'fr': 'Bonjour {nom}'})
+        with pytest.raises(PromptTemplateError):
+            registry.register('greeting', 'Hello {name}', variables=['name', 'age'])
+        assert 'greeting' not in registry.names()
+
+    def test_missing_variable_and_language_fallback(self, app):
+        """Variable absente signalée par son nom, langue non traduite servie en anglais"""
+        from prompt_registry import PromptRegistry, MissingPromptVariables
+
+        registry = PromptRegistry()
+        registry.register('greeting', {'en': 'Hello {name}, {age}', 'fr': 'Bonjour {name}, {age} ans'})
+
+        assert registry.render('greeting', 'de', name='Ana', age=30) == 'Hello Ana, 30'
+        with pytest.raises(MissingPromptVariables) as error:
+            registry.render('greeting', 'fr', name='Ana')
+        assert error.value.missing == ['age']
+
+    def test_cache_key_follows_template_version(self, app):
+        """La clé de cache change avec le texte du template, pas avec l'ordre des paramètres"""
+        from prompt_registry import PromptRegistry
+
+        registry = PromptRegistry()
+        registry.register('greeting', 'Hello {name}')
+        key = registry.cache_key('greeting', 'en', {'name': 'Ana'}, model='grok-3-fast', temperature=0.7)
+
+        assert key == registry.cache_key('greeting', 'en', {'name': 'Ana'}, temperature=0.7, model='grok-3-fast')
+        assert key != registry.cache_key('greeting', 'en', {'name': 'Bob'}, model='grok-3-fast', temperature=0.7)
+        registry.register('greeting', 'Hi {name}')
+        assert key != registry.cache_key('greeting', 'en', {'name': 'Ana'}, model='grok-3-fast', temperature=0.7)
+
+
+class TestStructuredOutput:
+    """Tests du parsing tolérant et de la validation des sorties structurées"""
+
+    def test_repairs_common_json_defects(self, app):
+        """Balises, virgules finales, clés non quotées, guillemets simples et littéraux Python"""
+        from structured_output import repair_json
+
+        result = repair_json('Voici:\n```json\n{"tags": ["a", "b",], name: \'Lampe\', "stock": True, "promo": None,}\n```')
+
+        assert result.value == {'tags': ['a', 'b'], 'name': 'Lampe', 'stock': True, 'promo': None}
+        assert not result.truncated
+        assert {'leading_text', 'trailing_comma', 'unquoted_key', 'single_quotes'} <= set(result.repairs)
+
+    @pytest.mark.parametrize('text, expected', [
+        ('{"a": 1, "b": tru', {'a': 1}),
+        ('{"a": 1, "b": 12', {'a': 1}),
+        ('{"a": 1, "b": "Lam', {'a': 1}),
+        ('{"n": 1e, "m": 2}', {'m': 2}),
+        ('[{"a":1},{"a":', [{'a': 1}]),
+        ('{"items": [{"a": 1}, {"a": 2, "b"', {'items': [{'a': 1}]}),
+        ('{"a": true', {'a': True}),
+    ])
+    def test_incomplete_values_dropped_not_guessed(self, app, text, expected):
+        """Littéral, nombre, chaîne ou élément coupé: écarté au lieu d'être deviné"""
+        from structured_output import repair_json
+
+        assert repair_json(text).value == expected
+
+    def test_truncated_output_continued_only_when_cut(self, app):
+        """La continuation n'est demandée que pour une réponse tronquée, puis recollée"""
+        from structured_output import StructuredOutputEngine
+
+        engine = StructuredOutputEngine(max_continuations=1)
+        continuation = MagicMock(return_value='"Lampe", "price": 12.5}]}')
+
+        assert engine.parse('{"products": []}', continuation=continuation) == {'products': []}
+        continuation.assert_not_called()
+
+        value = engine.parse('{"products": [{"name": ', continuation=continuation)
+        assert value == {'products': [{'name': 'Lampe', 'price': 12.5}]}
+        continuation.assert_called_once_with('{"products": [{"name": ')
+        assert engine.stats()['continuations'] == 1
+
+    def test_validation_coerces_fields_and_drops_truncated_item(self, app):
+        """Champs mal typés corrigés, dernier client tronqué écarté, réparation comptée"""
+        from boutique_ai import Customers, Gender
+        from structured_output import StructuredOutputEngine
+
+        engine = StructuredOutputEngine(max_continuations=0)
+        raw = (
+            '{"customers": [{"name": "Ana", "age": "34 ans", "location": "Lyon", "gender": "female", '
+            '"language": "fr", "purchase_history": [{"name": "Savon", "category": "soin", "price": "12,50 €", '
+            '"purchase_date": "2026-05-01"}], "interests": "yoga, bio", "search_history": {"savon": 3}, '
+            '"preferred_device": "mobile"}, {"name": "Bob", "age": 51, "locat'
+        )
+
+        customers = engine.parse(raw, Customers)
+
+        assert len(customers.customers) == 1
+        ana = customers.customers[0]
+        assert (ana.age, ana.gender, ana.interests) == (34, Gender.FEMALE, ['yoga', 'bio'])
+        assert ana.purchase_history[0].price == 12.5
+        stats = engine.stats()
+        assert stats['avoided_rerequests'] == 1
+        assert stats['dropped_items'] == 1
+        assert stats['repair_success_rate'] == 1.0
+
+    def test_generate_json_salvages_malformed_response(self, app):
+        """generate_json renvoie la réponse réparée sans nouvel appel au modèle"""
+        from ai_utils import AIManager
+
+        manager = AIManager()
+        with patch.object(AIManager, 'generate_text', return_value='{"taglines": ["Vite", "Bien",],}') as generate_text:
+            assert manager.generate_json(prompt='Carte de valeur') == {'taglines': ['Vite', 'Bien']}
+        assert generate_text.call_count == 1
+
+
+class TestSimilarProductSearch:
+    """Tests de l'agrégateur de recherches de produits similaires"""
+
+    def test_merge_dedupes_by_product_id(self, app):
+        """Un même produit AliExpress trouvé par plusieurs variantes n'apparaît qu'une fois, en tête"""
+        from aliexpress_search import merge_results, product_key
+
+        first = [{"name": "Tapis", "product_url": "https://fr.aliexpress.com/item/1005001.html?spm=a"},
+                 {"name": "Sac", "product_url": "https://www.aliexpress.com/item/1005002.html"}]
+        second = [{"name": "Sac de yoga", "product_url": "https://m.aliexpress.com/item/1005002.html?x=1"}]
+
+        merged = merge_results([first, second], max_results=5)
+
+        assert [product["name"] for product in merged] == ["Sac", "Tapis"]
+        assert product_key(second[0]) == "id:1005002"
+        assert merged[0]["similarity_score"] > merged[1]["similarity_score"]
+
+    def test_concurrency_bounded_and_queries_cached(self, app):
+        """Au plus max_concurrency recherches simultanées, requêtes normalisées servies par le cache"""
+        import asyncio
+        from aliexpress_search import SimilarProductSearch
+
+        in_flight = {'now': 0, 'max': 0}
+        calls = []
+
+        async def stub_search(query, max_results):
+            calls.append(query)
+            in_flight['now'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['now'])
+            await asyncio.sleep(0.01)
+            in_flight['now'] -= 1
+            return [{"name": query, "product_url": f"https://www.aliexpress.com/item/{len(calls)}.html"}]
+
+        search = SimilarProductSearch(search_fn=stub_search, max_concurrency=2)
+        searches = [{"product_description": f"Lampe design {i}", "niche": "Déco", "price_band": (10, 40)} for i in range(4)]
+
+        first = asyncio.run(search.find_many(searches, max_results=3))
+        searched = len(calls)
+        asyncio.run(search.find_many([dict(item, product_description=item["product_description"].upper() + " !")
+                                      for item in searches], max_results=3))
+
+        assert in_flight['max'] == 2
+        assert all(first)
+        assert len(calls) == searched
+        assert search.stats()['cache_hits'] == searched
+
+    def test_slow_query_times_out_alone(self, app):
+        """Une requête trop lente ne vide que sa recherche: les autres campagnes gardent leurs produits"""
+        import asyncio
+        from aliexpress_search import SEARCH_TIMEOUT_MARGIN, SimilarProductSearch
+
+        async def stub_search(query, max_results):
+            if "lente" in query.lower():
+                await asyncio.sleep(5)
+            return [{"name": query, "product_url": f"https://www.aliexpress.com/item/{abs(hash(query))}.html"}]
+
+        search = SimilarProductSearch(search_fn=stub_search, max_concurrency=4, query_timeout=0.05)
+        searches = [{"product_description": "Lampe rapide"}, {"product_description": "Lampe lente"}]
+
+        started = time.monotonic()
+        found = asyncio.run(search.find_many(searches, max_results=3))
+
+        assert time.monotonic() - started < 1
+        assert found[0] and found[1] == []
+        assert search.stats()['cached_queries'] == len(found[0])
+        assert search.timeout_for(searches) == pytest.approx(0.05 + SEARCH_TIMEOUT_MARGIN)
+
+    def test_bulk_save_skips_products_already_linked(self, app):
+        """Un seul INSERT pour plusieurs campagnes, sans doublon pour une campagne"""
+        from app import db
+        from aliexpress_search import save_similar_products
+        from models import Campaign, SimilarProduct
+
+        campaigns = [Campaign(title=f"Campagne {i}", content="...", campaign_type="email") for i in range(2)]
+        db.session.add_all(campaigns)
+        db.session.commit()
+        lamp = {"name": "Lampe", "price": "12.5", "product_url": "https://www.aliexpress.com/item/42.html"}
+
+        saved = save_similar_products({campaigns[0].id: [lamp], campaigns[1].id: [lamp, dict(lamp, name="Lampe bis")]})
+        again = save_similar_products({campaigns[0].id: [dict(lamp, product_url=lamp["product_url"] + "?spm=1")]})
+
+        assert [len(saved[campaign.id]) for campaign in campaigns] == [1, 1]
+        assert saved[campaigns[0].id][0]["price"] == 12.5
+        assert again[campaigns[0].id] == []
+        assert SimilarProduct.query.count() == 2
+
+
+class TestPageFetcher:
+    """Tests du cache disque et de la revalidation des pages produit (serveur HTTP local)"""
+
+    @pytest.fixture
+    def page_server(self):
+        import threading
+        from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+        paragraph = "Lampe de bureau en bois de noyer, variateur tactile et câble textile de deux mètres. " * 8
+        state = {'body': f"<html><body><article><h1>Lampe</h1><p>{paragraph}</p></article></body></html>",
+                 'etag': '"v1"', 'status': 200, 'delay': 0.0, 'requests': [], 'active': 0, 'max_active': 0}
+        lock = threading.Lock()
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                with lock:
+                    state['requests'].append(dict(self.headers))
+                    state['active'] += 1
+                    state['max_active'] = max(state['max_active'], state['active'])
+                try:
+                    time.sleep(state['delay'])
+                    if state['status'] != 200:
+                        self.send_error(state['status'])
+                    elif self.headers.get('If-None-Match') == state['etag']:
+                        self.send_response(304)
+                        self.end_headers()
+                    else:
+                        body = state['body'].encode('utf-8')
+                        self.send_response(200)
+                        self.send_header('Content-Type', 'text/html; charset=utf-8')
+                        self.send_header('Content-Length', str(len(body)))
+                        self.send_header('ETag', state['etag'])
+                        self.end_headers()
+                        self.wfile.write(body)
+                finally:
+                    with lock:
+                        state['active'] -= 1
+
+            def log_message(self, *args):
+                pass
+
+        server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+        threading.Thread(target=server.serve_forever, daemon=True).start()
+        state['url'] = f"http://127.0.0.1:{server.server_port}"
+        yield state
+        server.shutdown()
+        server.server_close()
+
+    def test_cache_then_conditional_revalidation(self, app, page_server, tmp_path):
+        """Page servie depuis le disque, puis revalidée par ETag une fois expirée, retéléchargée si modifiée"""
+        from page_fetcher import PageCache, PageFetcher
+
+        now = [1000.0]
+        fetcher = PageFetcher(PageCache(tmp_path, ttl=60, clock=lambda: now[0]))
+        url = f"{page_server['url']}/item/1005001.html"
+
+        first = fetcher.fetch(url, key='aliexpress-1005001')
+        second = fetcher.fetch(url + '?spm=a2g0o', key='aliexpress-1005001')
+        now[0] += 120
+        revalidated = fetcher.fetch(url, key='aliexpress-1005001')
+        now[0] += 120
+        page_server['etag'], page_server['body'] = '"v2"', page_server['body'].replace('noyer', 'chêne')
+        changed = fetcher.fetch(url, key='aliexpress-1005001')
+
+        assert [first['source'], second['source'], revalidated['source'], changed['source']] == \
+            ['network', 'cache', 'revalidated', 'network']
+        assert 'noyer' in first['text'] and 'chêne' in changed['text']
+        assert len(page_server['requests']) == 3
+        assert page_server['requests'][1].get('If-None-Match') == '"v1"'
+        assert list(tmp_path.glob('*.json.gz'))
+        assert fetcher.stats()['hit_rate'] == 0.5
+
+    def test_stale_copy_served_when_origin_fails(self, app, page_server, tmp_path):
+        """Une erreur du serveur sur une entrée expirée sert la copie en cache; sans copie, PageFetchError"""
+        from page_fetcher import PageCache, PageFetcher, PageFetchError
+
+        now = [0.0]
+        fetcher = PageFetcher(PageCache(tmp_path, ttl=10, clock=lambda: now[0]))
+        url = f"{page_server['url']}/item/42.html"
+        fetcher.fetch(url, key='aliexpress-42')
+        now[0] += 60
+        page_server['status'] = 503
+
+        assert fetcher.fetch(url, key='aliexpress-42')['source'] == 'stale'
+        with pytest.raises(PageFetchError):
+            fetcher.fetch(f"{page_server['url']}/item/43.html", key='aliexpress-43')
+
+    def test_per_host_concurrency_limit(self, app, page_server, tmp_path):
+        """Au plus per_host requêtes simultanées vers un même hôte"""
+        import asyncio
+        from page_fetcher import PageCache, PageFetcher
+
+        page_server['delay'] = 0.05
+        fetcher = PageFetcher(PageCache(tmp_path), per_host=2)
+
+        async def fetch_all():
+            return await asyncio.gather(*(fetcher.afetch(f"{page_server['url']}/item/{i}.html") for i in range(6)))
+
+        pages = asyncio.run(fetch_all())
+
+        assert all(page['source'] == 'network' for page in pages)
+        assert page_server['max_active'] == 2
+
+    def test_product_extraction_reuses_cached_page(self, app, page_server, tmp_path):
+        """Réimporter un produit ne retélécharge pas sa page"""
+        import asyncio
+        import json
+        from unittest.mock import AsyncMock
+        import aliexpress_importer
+        from page_fetcher import PageCache, PageFetcher
+
+        completion = MagicMock()
+        completion.choices[0].message.content = json.dumps({"titre": "Lampe", "prix": "12.5"})
+        url = f"{page_server['url']}/item/1005007.html"
+
+        with patch.object(aliexpress_importer, 'page_fetcher', PageFetcher(PageCache(tmp_path))), \
+                patch.object(aliexpress_importer.grok_client.chat.completions, 'create', AsyncMock(return_value=completion)) as create:
+            for _ in range(2):
+                product = asyncio.run(aliexpress_importer.extract_aliexpress_product_data(url))
+
+        assert product["item_id"] == "1005007"
+        assert len(page_server['requests']) == 1
+        assert 'noyer' in create.call_args.kwargs['messages'][1]['content']
+
+
+class TestPricingEngine:
+    """Tests du moteur de prix vectorisé (sans appel au modèle)"""
+
+    def test_pricing_rules(self, app):
+        """Paliers, facteurs, terminaisons psychologiques et plancher de marge"""
+        from pricing_engine import price_products
+
+        products = [
+            {"prix": "US $12,50", "nombre_commandes": "2 300 vendus", "note_moyenne": "4,9"},
+            {"prix": 3.2},
+            {"prix": 180, "nombre_commandes": 9000},
+            {"prix": "non communiqué"},
+        ]
+        strategies = price_products(products, "moyenne_gamme")
+
+        assert strategies[0]["price_factors"] == {"base_coefficient": 2.0, "tier_factor": 1.15,
+                                                  "popularity_factor": 1.1, "rating_factor": 1.1}
+        assert strategies[0]["psychological_price"] == 33.99
+        assert strategies[1]["price_factors"]["tier_factor"] == 1.4
+        assert strategies[2]["price_factors"]["popularity_factor"] == 1.15
+        assert strategies[2]["psychological_price"] == 349.99
+        assert strategies[3]["psychological_price"] == 0 and strategies[3]["promo_percent"] == 0
+        for strategy in strategies[:3]:
+            assert strategy["psychological_price"] >= strategy["floor_price"]
+            assert strategy["promo_price"] >= strategy["floor_price"]
+            assert strategy["original_price"] == strategy["base_price"]
+
+    def test_competitor_band_and_markets(self, app):
+        """Positionnement dans la fourchette concurrente selon le marché, jamais sous le plancher"""
+        import numpy as np
+        from pricing_engine import competitor_bands, price_products
+
+        bands = competitor_bands([[20, 25, 30, 40], None, [5, 0, -1]])
+        assert bands[0].tolist() == [23.75, 32.5]
+        assert np.isnan(bands[1]).all() and bands[2].tolist() == [5.0, 5.0]
+
+        product = {"prix": 12.5}
+        markets = ["entrée_gamme", "moyenne_gamme", "haut_de_gamme", "luxe"]
+        strategies = price_products([product] * 4, markets, [[20, 25, 30, 40]] * 4)
+        prices = [strategy["psychological_price"] for strategy in strategies]
+
+        assert prices == sorted(prices)
+        assert all(23.75 - 1 <= price <= 32.5 for price in prices)
+        assert strategies[3]["psychological_price"] == 32 and strategies[3]["promo_percent"] == 0
+        cheap = price_products([product], "luxe", [[5, 6]])[0]
+        assert cheap["psychological_price"] >= cheap["floor_price"] == 31.25
+
+    def test_llm_only_for_explanation(self, app):
+        """optimize_pricing_strategy n'appelle le modèle que pour le texte explicatif"""
+        import asyncio
+        from unittest.mock import AsyncMock
+        import aliexpress_importer
+
+        completion = MagicMock()
+        completion.choices[0].message.content = " Prix aligné sur la concurrence. "
+        product = {"titre": "Gourde", "prix": "12.50"}
+
+        with patch.object(aliexpress_importer.grok_client.chat.completions, 'create',
+                          AsyncMock(return_value=completion)) as create:
+            plain = asyncio.run(aliexpress_importer.optimize_pricing_strategy(product, "luxe"))
+            assert create.call_count == 0
+            explained = asyncio.run(aliexpress_importer.optimize_pricing_strategy(product, "luxe", explain=True))
+
+        assert create.call_count == 1
+        assert explained["explanation"] == "Prix aligné sur la concurrence."
+        assert explained["psychological_price"] == plain["psychological_price"]
+        assert str(plain["psychological_price"]) in create.call_args.kwargs['messages'][1]['content']
+
+
+class TestCampaignBatch:
+    """Tests de la génération de campagnes en lot (modèle simulé)"""
+
+    @staticmethod
+    def _seed(db, names):
+        from models import User, Boutique, Customer
+
+        owner = User(id='batch-owner', username='batch_owner', email='batch@example.com')
+        db.session.add(owner)
+        db.session.flush()
+        boutique = Boutique(name='Boutique Rando', description='Matériel de randonnée', owner_id=owner.id)
+        db.session.add(boutique)
+        db.session.flush()
+        customers = [Customer(name=name, age=30, location='Lyon', boutique_id=boutique.id) for name in names]
+        db.session.add_all(customers)
+        db.session.commit()
+        return boutique, customers
+
+    @staticmethod
+    def _fake_generate(failing=(), calls=None, delay=0.0, active=None):
+        import threading
+        from ai_utils import with_ai_error_handling
+
+        lock = threading.Lock()
+
+        @with_ai_error_handling
+        def generate_text(prompt, metric_name="ai_text_generation", **kwargs):
+            if calls is not None:
+                calls.append(prompt)
+            if active is not None:
+                with lock:
+                    active['now'] += 1
+                    active['max'] = max(active['max'], active['now'])
+            try:
+                time.sleep(delay)
+                if any(name in prompt for name in failing):
+                    raise RuntimeError("quota exceeded")
+                return f"Contenu pour {prompt.split('- Nom: ')[1].splitlines()[0]}"
+            finally:
+                if active is not None:
+                    with lock:
+                        active['now'] -= 1
+
+        return generate_text
+
+    def test_batch_persists_campaigns_and_metrics(self, app, tmp_path):
+        """Contexte commun rendu une fois, échec partiel rapporté, campagnes et métriques enregistrées"""
+        from app import db
+        from models import Campaign, Metric
+        import campaign_manager
+
+        boutique, customers = self._seed(db, ['Alice', 'Bob', 'Chloé'])
+        manager = campaign_manager.CampaignManager()
+        items = [(customers[0], 'email'), (customers[1].id, 'email'), (customers[2].id, 'sms'),
+                 (customers[2].id, 'fax'), (999999, 'email'), (customers[0].id, 'email')]
+
+        with patch.object(campaign_manager, 'CAMPAIGN_BATCH_CHECKPOINT_DIR', tmp_path), \
+                patch.object(manager.ai_manager, 'generate_text', self._fake_generate(failing=['Bob'])), \
+                patch.object(manager, '_shared_campaign_sections', wraps=manager._shared_campaign_sections) as shared:
+            report = manager.create_campaigns_batch(items, title='Soldes', boutique_id=boutique.id,
+                                                    target_audience='Randonneurs')
+
+        assert shared.call_count == 1
+        assert [(c['customer_id'], c['campaign_type']) for c in report['created']] == \
+            [(customers[0].id, 'email'), (customers[2].id, 'sms')]
+        assert {(f['customer_id'], f['error']) for f in report['failed']} == {
+            (customers[1].id, 'quota exceeded'), (customers[2].id, 'Type de campagne non supporté: fax'),
+            (999999, 'Client introuvable: ID 999999')}
+
+        campaigns = Campaign.query.order_by(Campaign.id).all()
+        assert [c.content for c in campaigns] == ['Contenu pour Alice', 'Contenu pour Chloé']
+        assert all(c.boutique_id == boutique.id and 'Boutique Rando' in c.prompt_used and 'Randonneurs' in c.prompt_used
+                   and c.generation_params['batch_id'] == report['batch_id'] for c in campaigns)
+        generation = Metric.query.filter_by(name='campaign_content_generation').all()
+        assert len(generation) == 3
+        assert sorted(m.campaign_id for m in generation if m.status) == [c.id for c in campaigns]
+        creation = Metric.query.filter_by(name='campaign_creation').all()
+        assert sorted(m.status for m in creation) == [False, True, True]
+
+    def test_resume_from_checkpoint(self, app, tmp_path):
+        """Relancer un lot ne régénère que les paires en échec"""
+        from app import db
+        from models import Campaign
+        import campaign_manager
+
+        _, customers = self._seed(db, ['Alice', 'Bob', 'Chloé'])
+        manager = campaign_manager.CampaignManager()
+        items = [(customer.id, 'social') for customer in customers]
+        calls = []
+
+        with patch.object(campaign_manager, 'CAMPAIGN_BATCH_CHECKPOINT_DIR', tmp_path):
+            with patch.object(manager.ai_manager, 'generate_text', self._fake_generate(failing=['Bob'])):
+                first = manager.create_campaigns_batch(items, chunk_size=2)
+            with patch.object(manager.ai_manager, 'generate_text', self._fake_generate(calls=calls)):
+                resumed = manager.create_campaigns_batch(items, batch_id=first['batch_id'])
+
+        assert len(first['created']) == 2 and len(first['failed']) == 1
+        assert resumed['skipped'] == 2 and not resumed['failed']
+        assert [c['customer_id'] for c in resumed['created']] == [customers[1].id]
+        assert len(calls) == 1 and 'Bob' in calls[0]
+        assert Campaign.query.count() == 3
+
+    def test_bounded_concurrency(self, app, tmp_path):
+        """Au plus max_concurrency générations simultanées"""
+        from app import db
+        import campaign_manager
+
+        _, customers = self._seed(db, [f"Client {i}" for i in range(6)])
+        manager = campaign_manager.CampaignManager()
+        active = {'now': 0, 'max': 0}
+
+        with patch.object(campaign_manager, 'CAMPAIGN_BATCH_CHECKPOINT_DIR', tmp_path), \
+                patch.object(manager.ai_manager, 'generate_text', self._fake_generate(delay=0.05, active=active)):
+            report = manager.create_campaigns_batch([(c.id, 'ad') for c in customers], max_concurrency=2)
+
+        assert len(report['created']) == 6
+        assert active['max'] == 2
+
+
+class TestOSPCache:
+    """Tests de la mémoïsation des résultats OSP (modèle simulé)"""
+
+    VALUE_MAP = {"taglines": ["Partez léger"], "position_statements": [], "value_propositions": [],
+                 "unique_selling_points": [], "audiences": [], "keywords": ["gourde"]}
+
+    @pytest.fixture
+    def cache(self, app):
+        import osp_cache
+        import osp_tools
+
+        cache = osp_cache.OSPResultCache()
+        with patch.object(osp_cache, 'osp_result_cache', cache), patch.object(osp_tools, 'osp_result_cache', cache):
+            yield cache
+
+    def test_value_map_reused_from_memory_and_saved_analysis(self, app, cache):
+        """Entrées identiques: aucun nouvel appel au modèle, y compris après redémarrage (analyse enregistrée)"""
+        from app import db
+        from models import OSPAnalysis, OSPAnalysisType
+        import osp_tools
+
+        args = dict(product_name="Gourde", product_description="Isotherme 1L", target_audience="Randonneurs",
+                    industry="Outdoor")
+        with patch.object(osp_tools.ai_manager, 'generate_json', return_value=dict(self.VALUE_MAP)) as generate:
+            first_context, second_context, third_context = {}, {}, {}
+            first = osp_tools.generate_product_value_map(**args, cache_context=first_context)
+            osp_tools.generate_product_value_map(**args, cache_context=second_context)
+            db.session.add(OSPAnalysis(analysis_type=OSPAnalysisType.VALUE_MAP, title="Carte", content=first,
+                                       input_hash=first_context['input_hash']))
+            db.session.commit()
+            cache.clear()
+            third = osp_tools.generate_product_value_map(**args, cache_context=third_context)
+            osp_tools.generate_product_value_map(**dict(args, industry="Sport"))
+
+        assert generate.call_count == 2
+        assert [first_context['source'], second_context['source'], third_context['source']] == \
+            ['model', 'memory', 'database']
+        assert third == first
+        stats = cache.stats()
+        assert (stats['memory_hits'], stats['database_hits'], stats['misses']) == (1, 1, 2)
+        assert stats['hit_rate'] == 0.5
+
+    def test_source_edit_invalidates_results(self, app, cache):
+        """Modifier le produit source invalide ses analyses; les compteurs d'une campagne non"""
+        from app import db
+        from models import Campaign, OSPAnalysis, OSPAnalysisType, Product
+        import osp_tools
+
+        product = Product(name="Gourde")
+        campaign = Campaign(title="Soldes", content="Texte", campaign_type="email")
+        db.session.add_all([product, campaign])
+        db.session.commit()
+        analysis = {"scores": {"overall": 4}, "strengths": [], "weaknesses": [], "recommendations": [],
+                    "improved_examples": []}
+
+        with patch.object(osp_tools.ai_manager, 'generate_json', return_value=analysis) as generate:
+            context = {}
+            osp_tools.analyze_content_with_osp_guidelines("Texte", product_id=product.id, cache_context=context)
+            campaign_context = {}
+            osp_tools.analyze_content_with_osp_guidelines("Autre", campaign_id=campaign.id,
+                                                          cache_context=campaign_context)
+            db.session.add_all([
+                OSPAnalysis(analysis_type=OSPAnalysisType.CONTENT_ANALYSIS, title="A", product_id=product.id,
+                            content={'results': analysis}, input_hash=context['input_hash']),
+                OSPAnalysis(analysis_type=OSPAnalysisType.CONTENT_ANALYSIS, title="B", campaign_id=campaign.id,
+                            content={'results': analysis}, input_hash=campaign_context['input_hash']),
+            ])
+            db.session.commit()
+
+            campaign.view_count = 10
+            product.name = "Gourde isotherme"
+            db.session.commit()
+            osp_tools.analyze_content_with_osp_guidelines("Texte", product_id=product.id, cache_context=context)
+            osp_tools.analyze_content_with_osp_guidelines("Autre", campaign_id=campaign.id,
+                                                          cache_context=campaign_context)
+
+        assert generate.call_count == 3
+        assert context['source'] == 'model' and campaign_context['source'] == 'memory'
+        hashes = dict(db.session.query(OSPAnalysis.title, OSPAnalysis.input_hash).all())
+        assert hashes['A'] is None and hashes['B'] == campaign_context['input_hash']
+        assert cache.stats()['invalidated_analyses'] == 1
+
+    def test_failures_are_not_cached(self, app, cache):
+        """Une génération en échec renvoie le résultat de repli sans le mettre en cache"""
+        import osp_tools
+
+        content = {"title": "Gourde", "description": "Isotherme"}
+        with patch.object(osp_tools.ai_manager, 'generate_json',
+                          side_effect=[RuntimeError("timeout"), {"meta_title": "Gourde isotherme"}]) as generate:
+            failed = osp_tools.apply_seo_guidelines(content)
+            optimized = osp_tools.apply_seo_guidelines(content)
+
+        assert failed == content
+        assert optimized["seo"] == {"meta_title": "Gourde isotherme"}
+        assert generate.call_count == 2
+        assert cache.stats()['misses'] == 1
+
+
 class TestAIIntegration:
     """Tests d'intégration IA"""
     
@@ -243,6 +1563,676 @@ class TestAIIntegration:
         # Devrait retourner un message d'erreur approprié
         assert "erreur" in result.lower() or "error" in result.lower()
 
+class TestPersonaSearch:
+    """Tests de la recherche classée des personas"""
+    
+    def _build_index(self):
+        from persona_search import InMemoryPersonaIndex
+        
+        index = InMemoryPersonaIndex()
+        index.add(1, "Acheteur Économe", "Attentif au budget, chasse les promotions",
+                  age_range="25-34", income_bracket="budget", price_sensitivity="élevée")
+        index.add(2, "Amateur de Luxe", "Recherche l'exclusivité et la qualité premium",
+                  age_range="35-44", income_bracket="luxury", price_sensitivity="faible")
+        index.add(3, "Technophile Précoce", "Passionné de gadgets et de promotions tech",
+                  age_range="25-34", income_bracket="middle", niche_market_id=7)
+        return index
+    
+    def test_text_matches_ranked_with_accent_folding(self, app):
+        """Les mots du titre pèsent plus que ceux de la description, accents ignorés"""
+        index = self._build_index()
+        results = index.search({'title': 'econome', 'description_keywords': 'promotions'})
+        assert [persona_id for persona_id, _ in results] == [1, 3]
+    
+    def test_structured_attributes_boost_and_fill(self, app):
+        """Les attributs structurés départagent et complètent les résultats textuels"""
+        index = self._build_index()
+        results = index.search({'description_keywords': 'promotions', 'income_bracket': 'middle'}, limit=3)
+        assert [persona_id for persona_id, _ in results][:2] == [3, 1]
+        
+        results = index.search({'age_range': '25-34', 'income_bracket': 'budget'})
+        assert [persona_id for persona_id, _ in results] == [1, 3]
+    
+    def test_scope_filter_and_removal(self, app):
+        """Filtrage par niche et suppression d'un persona de l'index"""
+        index = self._build_index()
+        assert index.search({'description_keywords': 'promotions'}, niche_market_id=7) == \
+            index.search({'description_keywords': 'promotions'})[1:]
+        index.remove(3)
+        assert [pid for pid, _ in index.search({'description_keywords': 'gadgets promotions'})] == [1]
+
+    def test_postgres_query_filters_by_text_indexes(self, app, monkeypatch):
+        """PostgreSQL: candidats filtrés par les index texte (sans accents), attributs pour le score et le complément"""
+        from types import SimpleNamespace
+        from app import db
+        from persona_search import PersonaSearchEngine
+
+        queries = []
+
+        def execute(statement, params):
+            queries.append((str(statement), dict(params)))
+            return [SimpleNamespace(id=4, score=1.0)] if len(queries) == 2 else []
+
+        monkeypatch.setattr(db.session, 'execute', execute)
+        results = PersonaSearchEngine()._search_postgres(
+            {'title': 'Économe', 'income_bracket': 'Budget'}, 5, None, None)
+
+        (text_sql, text_params), (fill_sql, fill_params) = queries
+        assert text_params['tsquery'] == 'econome'
+        assert 'persona_unaccent(title) %' in text_sql
+        assert 'lower(' not in text_sql.split('WHERE')[1]
+        assert 'lower(income_bracket) = :attr_income_bracket' in fill_sql.split('WHERE')[1]
+        assert 'NOT (search_vector' in fill_sql
+        assert (fill_params['fill'], fill_params['attr_income_bracket']) == (5, 'budget')
+        assert results == [(4, 1.0)]
+
+class TestPersonaSimilarity:
+    """Tests de l'index de similarité des personas"""
+    
+    def _build_index(self):
+        from persona_similarity import PersonaSimilarityIndex, KIND_PERSONA, KIND_CUSTOMER
+        
+        index = PersonaSimilarityIndex()
+        index.add_text(KIND_PERSONA, 1, "Client attentif à son budget qui chasse les promotions et codes de réduction")
+        index.add_text(KIND_PERSONA, 2, "Client fortuné qui privilégie l'exclusivité et la qualité premium", niche_market_id=7)
+        index.add_text(KIND_CUSTOMER, 5, "Sportif passionné de trail et de matériel de montagne léger")
+        return index
+    
+    def test_near_duplicate_detected(self, app):
+        """Un persona reformulé à la marge est détecté comme doublon, pas un persona différent"""
+        from persona_similarity import KIND_PERSONA
+        
+        index = self._build_index()
+        duplicates = index.find_duplicates("Client attentif à son budget, qui chasse les promotions et les codes de réduction")
+        assert [key for key, _ in duplicates] == [(KIND_PERSONA, 1)]
+        assert index.find_duplicates("Amateur de randonnée en montagne") == []
+    
+    def test_most_similar_filters_kind_niche_and_exclusions(self, app):
+        """Filtrage par type, par niche et exclusion de clés"""
+        from persona_similarity import KIND_PERSONA, KIND_CUSTOMER
+        
+        index = self._build_index()
+        assert index.most_similar("trail montagne", k=1)[0][0] == (KIND_CUSTOMER, 5)
+        assert index.most_similar("trail montagne", kinds=[KIND_PERSONA]) == []
+        assert [key for key, _ in index.most_similar("qualité premium client", niche_market_id=7)] == [(KIND_PERSONA, 2)]
+        assert index.most_similar("trail montagne", exclude=[(KIND_CUSTOMER, 5)]) == []
+        index.remove(KIND_CUSTOMER, 5)
+        assert index.most_similar("trail montagne") == []
+
+    def test_reuse_persona_of_customer_with_close_profile(self, app):
+        """Un profil proche (un an d'écart, intérêts dans un autre ordre) reprend le persona principal de l'autre client"""
+        from app import db
+        from models import Customer, CustomerPersona
+        from persona_similarity import persona_similarity_index, profile_inputs_text, suggest_reusable_persona
+
+        profile = dict(gender='female', location='Lyon', income_level='middle', education='master',
+                       occupation='infirmière')
+        persona = CustomerPersona(title="Active urbaine", description="Soignante qui cherche des produits bien-être")
+        served = Customer(name="Claire", age=31, interests="yoga, cuisine, voyages", **profile)
+        new = Customer(name="Julie", age=33, interests="cuisine, yoga, voyages", **profile)
+        other = Customer(name="Marc", age=58, gender='male', location='Marseille', income_level='affluent',
+                         education='bachelor', occupation='avocat', interests="golf, vin")
+        db.session.add_all([persona, served, new, other])
+        db.session.commit()
+        served.assign_persona(persona.id, is_primary=True)
+        db.session.commit()
+        persona_similarity_index.reset()
+
+        reused, similarity = suggest_reusable_persona(profile_inputs_text(new), exclude_customer_id=new.id)
+
+        assert reused.id == persona.id
+        assert similarity >= 0.85
+        assert suggest_reusable_persona(profile_inputs_text(other), exclude_customer_id=other.id) is None
+
+class TestCampaignAnalytics:
+    """Tests du moteur d'analyse des campagnes"""
+    
+    def test_compute_rates_handles_zero_denominators(self, app):
+        """Taux vectorisés, 0 quand il n'y a ni vue ni clic"""
+        from campaign_analytics import compute_rates
+        
+        engagement, conversion = compute_rates([200, 0, 50], [20, 0, 0], [5, 0, 0])
+        assert list(engagement) == [10.0, 0.0, 0.0]
+        assert list(conversion) == [25.0, 0.0, 0.0]
+    
+    def test_campaign_filters(self, app):
+        """Seuls les filtres fournis produisent une condition"""
+        from datetime import datetime
+        from campaign_analytics import campaign_filters
+        
+        assert campaign_filters() == []
+        assert len(campaign_filters(campaign_type='email', date_range=(datetime(2025, 1, 1), datetime(2025, 2, 1)))) == 3
+
+    def test_api_metrics_count_generations_only(self, app):
+        """Par défaut seules les générations de contenu sont agrégées, pas les régénérations"""
+        from app import db
+        from campaign_analytics import api_metrics
+        from models import Campaign, Metric
+
+        campaign = Campaign(title="Campagne", content="...", campaign_type="email")
+        db.session.add(campaign)
+        db.session.commit()
+        db.session.add_all([
+            Metric(name='campaign_content_generation', response_time=100, campaign_id=campaign.id),
+            Metric(name='campaign_content_generation', response_time=300, campaign_id=campaign.id),
+            Metric(name='campaign_content_regeneration', response_time=5000, campaign_id=campaign.id),
+        ])
+        db.session.commit()
+
+        assert api_metrics([]) == {'total_api_calls': 2, 'avg_response_time_ms': 200.0}
+        assert api_metrics([], ('campaign_content_generation', 'campaign_content_regeneration'))['total_api_calls'] == 3
+
+class TestCampaignCounters:
+    """Tests du tampon de compteurs des campagnes"""
+    
+    def test_local_store_drain_and_restore(self, app):
+        """Un lot retiré puis réinjecté après un échec n'est ni perdu ni compté deux fois"""
+        from campaign_counters import LocalCounterStore
+        
+        store = LocalCounterStore()
+        store.increment(1, 'view')
+        store.increment(1, 'view', 2)
+        store.increment(2, 'click')
+        token, deltas = store.drain()
+        assert deltas == {1: {'view': 3}, 2: {'click': 1}}
+        assert store.pending(1) == {'view': 0, 'click': 0, 'conversion': 0}
+        
+        store.increment(1, 'view')
+        store.restore(token, deltas)
+        assert store.pending(1)['view'] == 4
+    
+    def test_unknown_counter_rejected(self, app):
+        """Seuls view, click et conversion sont acceptés"""
+        from campaign_counters import CampaignCounterBuffer, LocalCounterStore
+        
+        with pytest.raises(ValueError):
+            CampaignCounterBuffer(LocalCounterStore()).increment(1, 'share')
+
+    @staticmethod
+    def _fake_redis():
+        """Sous-ensemble de l'API Redis utilisé par RedisCounterStore (dictionnaire en mémoire)"""
+        import fnmatch
+        import redis
+
+        class FakePipeline:
+            def __init__(self, client):
+                self.client = client
+                self.commands = []
+
+            def __getattr__(self, name):
+                return lambda *args, **kwargs: self.commands.append((name, args, kwargs))
+
+            def execute(self):
+                return [getattr(self.client, name)(*args, **kwargs) for name, args, kwargs in self.commands]
+
+        class FakeRedis:
+            def __init__(self):
+                self.data = {}
+                self.expiring = set()
+
+            def hincrby(self, key, field, amount):
+                self.data.setdefault(key, {})
+                self.data[key][field] = self.data[key].get(field, 0) + amount
+
+            def hmget(self, key, fields):
+                return [self.data.get(key, {}).get(field) for field in fields]
+
+            def hgetall(self, key):
+                return {field: str(value) for field, value in self.data.get(key, {}).items()}
+
+            def scan_iter(self, match, count=None):
+                return [key for key in list(self.data) if fnmatch.fnmatch(key, match)]
+
+            def rename(self, source, target):
+                if source not in self.data:
+                    raise redis.ResponseError('no such key')
+                self.data[target] = self.data.pop(source)
+
+            def set(self, key, value, nx=False, ex=None):
+                if nx and key in self.data:
+                    return None
+                self.data[key] = value
+                if ex:
+                    self.expiring.add(key)
+                return True
+
+            def delete(self, key):
+                self.expiring.discard(key)
+                return int(self.data.pop(key, None) is not None)
+
+            def pipeline(self, transaction=True):
+                return FakePipeline(self)
+
+            def expire_all(self):
+                for key in list(self.expiring):
+                    self.delete(key)
+
+        return FakeRedis()
+
+    def test_redis_batches_claimed_once_and_applied_once(self, app):
+        """Un lot en cours n'est pas repris par un autre processus; un lot déjà commité n'est pas réappliqué"""
+        from app import db
+        from models import Campaign
+        from campaign_counters import CampaignCounterBuffer, RedisCounterStore
+
+        campaign = Campaign(title="Soldes", content="Texte", campaign_type="email")
+        db.session.add(campaign)
+        db.session.commit()
+        client = self._fake_redis()
+        worker_a = CampaignCounterBuffer(RedisCounterStore(client))
+        worker_b = CampaignCounterBuffer(RedisCounterStore(client))
+
+        worker_a.increment(campaign.id, 'view', 3)
+        token, deltas = worker_a.store.drain()
+        assert deltas == {campaign.id: {'view': 3}}
+        # Lot réservé par A: B ne le reprend pas
+        assert worker_b.store.drain() == (None, {})
+        worker_a.store.restore(token, deltas)
+
+        # A s'arrête entre le commit et l'acquittement du lot
+        acknowledge = worker_a.store.acknowledge
+        worker_a.store.acknowledge = MagicMock(side_effect=ConnectionError('redis down'))
+        with pytest.raises(ConnectionError):
+            worker_a.flush()
+        worker_a.store.acknowledge = acknowledge
+        db.session.expire_all()
+        assert campaign.view_count == 3
+
+        worker_a.increment(campaign.id, 'click')
+        assert worker_b.flush() == 1
+        assert worker_b.flush() == 0
+        # Réservation expirée: B reprend le lot orphelin, déjà appliqué, et l'écarte
+        client.expire_all()
+        assert worker_b.flush() == 0
+        db.session.expire_all()
+        assert (campaign.view_count, campaign.click_count) == (3, 1)
+        assert not client.scan_iter('campaign_counters:*')
+
+class TestImageDownload:
+    """Tests de validation des images téléchargées"""
+    
+    def test_sniff_image_extension(self, app):
+        """Le type est déterminé par la signature, pas par l'en-tête HTTP"""
+        from image_storage_manager import sniff_image_extension
+        
+        assert sniff_image_extension(b'\x89PNG\r\n\x1a\n\x00\x00\x00\rIHDR') == '.png'
+        assert sniff_image_extension(b'\xff\xd8\xff\xe0\x00\x10JFIF') == '.jpg'
+        assert sniff_image_extension(b'RIFF\x24\x00\x00\x00WEBPVP8 ') == '.webp'
+        assert sniff_image_extension(b'<html><body>') is None
+
+    def test_stored_file_readable_by_web_server(self, app, tmp_path):
+        """Le fichier renommé a les droits d'un fichier normal (0o666 moins l'umask), pas 0o600"""
+        import stat
+        from contextlib import nullcontext
+        from image_storage_manager import STORED_FILE_MODE, ImageStorageManager
+
+        class FakeResponse:
+            headers = {'content-type': 'image/png'}
+
+            def raise_for_status(self):
+                pass
+
+            def iter_content(self, chunk_size):
+                yield b'\x89PNG\r\n\x1a\n' + b'0' * 100
+
+        manager = ImageStorageManager(str(tmp_path))
+        manager.session.get = lambda url, **kwargs: nullcontext(FakeResponse())
+
+        path, size, mime_type, _ = manager.stream_to_file('https://example.com/a.png', tmp_path, 'a')
+
+        assert (path.name, size, mime_type) == ('a.png', 108, 'image/png')
+        assert stat.S_IMODE(path.stat().st_mode) == STORED_FILE_MODE
+
+class TestImageDerivatives:
+    """Tests des déclinaisons responsives des images"""
+    
+    VARIANTS = {
+        'w256.webp': {'filename': 'a_w256_webp.webp', 'width': 256, 'content_type': 'image/webp'},
+        'w640.webp': {'filename': 'a_w640_webp.webp', 'width': 640, 'content_type': 'image/webp'},
+        'w256.avif': {'filename': 'a_w256_avif.avif', 'width': 256, 'content_type': 'image/avif'},
+        '_formats': ['avif', 'webp'],
+    }
+    
+    def test_select_variant_by_width_and_accept(self, app):
+        """Plus petite largeur suffisante, dans le format le plus compact accepté"""
+        from image_derivatives import select_variant
+        
+        assert select_variant(self.VARIANTS, 'image/webp,*/*', 200)['filename'] == 'a_w256_webp.webp'
+        assert select_variant(self.VARIANTS, 'image/webp,*/*', 300)['filename'] == 'a_w640_webp.webp'
+        # Plus large que toutes les déclinaisons: l'original
+        assert select_variant(self.VARIANTS, 'image/webp,*/*', 2000) is None
+        assert select_variant(self.VARIANTS, 'image/avif,image/webp', 100)['filename'] == 'a_w256_avif.avif'
+        # AVIF sans la largeur demandée: repli sur WebP
+        assert select_variant(self.VARIANTS, 'image/avif,image/webp', 300)['filename'] == 'a_w640_webp.webp'
+        assert select_variant(self.VARIANTS, 'image/png', 200) is None
+        assert select_variant(self.VARIANTS, 'image/webp', None) is None
+    
+    def test_render_derivatives_skips_upscaling(self, app, tmp_path):
+        """Seules les largeurs inférieures à l'original sont produites"""
+        from PIL import Image
+        from image_derivatives import render_derivatives
+        
+        source = tmp_path / 'source.png'
+        Image.new('RGB', (400, 200), (200, 30, 30)).save(source)
+        variants = render_derivatives(str(source), str(tmp_path / 'derivatives'), 'source', (256, 640), ('webp',))
+        
+        assert list(variants) == ['w256.webp']
+        assert variants['w256.webp']['height'] == 128
+        assert (tmp_path / 'derivatives' / variants['w256.webp']['filename']).exists()
+
+class TestImageServing:
+    """Tests du service des images (index, cache HTTP, compteurs d'accès)"""
+
+    def test_conditional_request_returns_304(self, app, tmp_path, monkeypatch):
+        """Un ETag connu du navigateur donne un 304 avec les en-têtes de cache immuables"""
+        import image_serving
+        from flask import request
+
+        (tmp_path / 'avatars').mkdir()
+        (tmp_path / 'avatars' / 'a.png').write_bytes(b'\x89PNG' + b'0' * 100)
+        monkeypatch.setattr(image_serving, 'image_index', image_serving.ImagePathIndex(tmp_path))
+
+        with app.test_request_context('/images/a.png'):
+            response = image_serving.serve_image('a.png')
+            etag = response.headers['ETag']
+            assert response.status_code == 200
+            assert 'immutable' in response.headers['Cache-Control']
+
+        with app.test_request_context('/images/a.png', headers={'If-None-Match': etag}):
+            response = image_serving.serve_image('a.png', if_none_match=request.if_none_match)
+            assert response.status_code == 304
+            assert response.headers['ETag'] == etag
+
+        assert image_serving.serve_image('../a.png') is None
+
+    def test_image_stored_by_another_worker_resolved(self, app, tmp_path):
+        """Un fichier trouvé sans ligne n'est pas mémorisé: la ligne écrite ensuite par un autre worker est lue"""
+        from app import db
+        from models import StoredImage
+        from image_serving import ImagePathIndex
+
+        (tmp_path / 'avatars').mkdir()
+        path = tmp_path / 'avatars' / 'b.png'
+        path.write_bytes(b'\x89PNG' + b'0' * 100)
+        index = ImagePathIndex(tmp_path)
+        index.load()
+
+        assert index.resolve('b.png') == (tmp_path / 'avatars', None, None)
+        assert len(index) == 0
+
+        image = StoredImage(hash='h2', original_url='u', local_path=str(path), filename='b.png',
+                            prompt='p', model='m')
+        db.session.add(image)
+        db.session.commit()
+
+        assert index.resolve('b.png') == (tmp_path / 'avatars', image.id, None)
+        assert len(index) == 1
+
+    def test_access_counts_flushed_in_batch(self, app):
+        """Les accès sont cumulés en mémoire puis écrits en un UPDATE par image"""
+        from app import db
+        from models import StoredImage
+        from image_serving import ImageAccessCounter
+
+        image = StoredImage(hash='h1', original_url='u', local_path='generated_images/a.png',
+                            filename='a.png', prompt='p', model='m', access_count=2)
+        db.session.add(image)
+        db.session.commit()
+
+        counter = ImageAccessCounter()
+        for _ in range(3):
+            counter.hit(image.id)
+        assert counter.flush() == 1
+        assert counter.pending(image.id) == 0
+
+        db.session.refresh(image)
+        assert image.access_count == 5
+        assert image.last_accessed is not None
+
+class TestImageGC:
+    """Tests du ramasse-miettes du stockage des images"""
+
+    @pytest.fixture
+    def storage(self, app, tmp_path):
+        from datetime import datetime, timedelta
+        from app import db
+        from models import StoredImage
+
+        (tmp_path / 'avatars').mkdir()
+        now = datetime.utcnow()
+        images = {
+            'old.png': dict(created_at=now - timedelta(days=40)),
+            'pinned.png': dict(created_at=now - timedelta(days=40), is_permanent=True),
+            'idle.png': dict(created_at=now - timedelta(days=5), user_id='u1', last_accessed=now - timedelta(days=4)),
+            'recent.png': dict(created_at=now - timedelta(days=3), user_id='u1', last_accessed=now),
+        }
+        for i, (filename, columns) in enumerate(images.items()):
+            path = tmp_path / 'avatars' / filename
+            path.write_bytes(b'0' * 100)
+            db.session.add(StoredImage(hash=f'h{i}', original_url='u', local_path=str(path), filename=filename,
+                                       prompt='p', model='m', file_size=100, **columns))
+        db.session.add(StoredImage(hash='missing', original_url='u', local_path=str(tmp_path / 'avatars' / 'gone.png'),
+                                   filename='gone.png', prompt='p', model='m', file_size=100))
+        db.session.commit()
+
+        stray = tmp_path / 'avatars' / 'stray.png'
+        stray.write_bytes(b'0' * 50)
+        os.utime(stray, (0, 0))
+        return tmp_path
+
+    def test_dry_run_reports_without_deleting(self, app, storage):
+        """Le dry run chiffre les octets récupérables sans toucher à la base ni au disque"""
+        from models import StoredImage
+        from image_gc import ImageGarbageCollector, ImageGCPolicy
+
+        policy = ImageGCPolicy(max_age_days=30, user_quota_bytes=100)
+        report = ImageGarbageCollector(storage, chunk_size=2).run(policy, dry_run=True)
+
+        assert report['by_reason']['missing_file']['count'] == 1
+        assert report['by_reason']['age']['count'] == 1
+        assert report['by_reason']['user_quota']['count'] == 1
+        assert report['orphan_files'] == 1
+        # Fichier sans ligne signalé mais pas compté comme récupérable (suppression non activée)
+        assert report['reclaimed_bytes'] == 200
+        assert StoredImage.query.count() == 5
+        assert (storage / 'avatars' / 'stray.png').exists()
+
+    def test_policies_respect_pinning_and_lru(self, app, storage):
+        """Les images permanentes restent; le quota évince la moins récemment utilisée"""
+        from models import StoredImage
+        from image_gc import ImageGarbageCollector, ImageGCPolicy
+
+        policy = ImageGCPolicy(max_age_days=30, user_quota_bytes=100, delete_orphan_files=True)
+        report = ImageGarbageCollector(storage, chunk_size=2).run(policy)
+
+        assert report['deleted_images'] == 3
+        assert sorted(image.filename for image in StoredImage.query.all()) == ['pinned.png', 'recent.png']
+        assert sorted(path.name for path in (storage / 'avatars').iterdir()) == ['pinned.png', 'recent.png']
+
+    def test_orphan_files_kept_by_default(self, app, storage):
+        """Un fichier sans ligne (ancien téléversement) est signalé mais reste sur le disque"""
+        from image_gc import ImageGarbageCollector, ImageGCPolicy
+
+        report = ImageGarbageCollector(storage, chunk_size=2).run(ImageGCPolicy())
+
+        assert report['orphan_files'] == 1 and report['by_reason']['orphan_file']['bytes'] == 50
+        assert report['by_reason']['missing_file']['count'] == 1
+        assert (storage / 'avatars' / 'stray.png').exists()
+
+    def test_user_quota_counts_variants(self, app, storage):
+        """Le quota par utilisateur compte les déclinaisons, comme les octets libérés"""
+        from app import db
+        from models import StoredImage
+        from image_gc import ImageGarbageCollector, ImageGCPolicy
+
+        recent = StoredImage.query.filter_by(filename='recent.png').one()
+        recent.variants = {'w256.webp': {'filename': 'recent_w256_webp.webp', 'width': 256, 'file_size': 60}}
+        db.session.commit()
+
+        report = ImageGarbageCollector(storage, chunk_size=2).run(
+            ImageGCPolicy(user_quota_bytes=250, reconcile_orphans=False))
+
+        assert report['by_reason']['user_quota'] == {'count': 1, 'bytes': 100}
+        assert StoredImage.query.filter_by(filename='idle.png').first() is None
+
+class TestImageDedup:
+    """Tests de la déduplication perceptuelle des images"""
+
+    def test_perceptual_hashes_tolerate_noise(self, app, tmp_path):
+        """Un rendu bruité reste proche, une image différente est éloignée"""
+        import numpy as np
+        from PIL import Image
+        from image_dedup import compute_perceptual_hashes, hamming_distance
+
+        rng = np.random.default_rng(0)
+        # Aplats 16x16 agrandis en 256x256: structure nette, comme un visuel généré
+        base = np.kron(rng.integers(0, 256, (16, 16, 3)), np.ones((16, 16, 1))).astype(np.int16)
+        noisy = base + rng.integers(-6, 6, base.shape)
+        other = np.kron(rng.integers(0, 256, (16, 16, 3)), np.ones((16, 16, 1))).astype(np.int16)
+        for name, pixels in (('base', base), ('noisy', noisy), ('other', other)):
+            Image.fromarray(pixels.clip(0, 255).astype(np.uint8)).save(tmp_path / f'{name}.png')
+
+        base_hashes = compute_perceptual_hashes(tmp_path / 'base.png')
+        noisy_hashes = compute_perceptual_hashes(tmp_path / 'noisy.png')
+        other_hashes = compute_perceptual_hashes(tmp_path / 'other.png')
+
+        assert all(hamming_distance(a, b) <= 4 for a, b in zip(base_hashes, noisy_hashes))
+        assert hamming_distance(base_hashes[0], other_hashes[0]) > 16
+
+    def test_multi_index_matches_brute_force(self, app):
+        """La recherche par segments retrouve exactement les empreintes à distance <= rayon"""
+        import random
+        from image_dedup import MultiIndexHashTable, hamming_distance
+
+        rng = random.Random(0)
+        index = MultiIndexHashTable(max_distance=4)
+        hashes = {i: rng.getrandbits(64) for i in range(500)}
+        query = hashes[7]
+        for i in range(500, 520):
+            hashes[i] = query ^ sum(1 << bit for bit in rng.sample(range(64), rng.randint(1, 6)))
+        for item_id, value in hashes.items():
+            index.add(item_id, value, value)
+        index.remove(3)
+
+        expected = sorted((hamming_distance(query, value), item_id) for item_id, value in hashes.items()
+                          if item_id != 3 and hamming_distance(query, value) <= 4)
+        assert index.search(query) == expected
+
+    def test_signed_storage_round_trip(self, app):
+        """Les empreintes 64 bits tiennent dans un BIGINT"""
+        from image_dedup import to_signed, to_unsigned
+
+        for value in (0, 1, (1 << 63) - 1, 1 << 63, (1 << 64) - 1):
+            assert -(1 << 63) <= to_signed(value) < (1 << 63)
+            assert to_unsigned(to_signed(value)) == value
+
+class TestAssetPipeline:
+    """Tests du build des bundles CSS/JS et de leur service précompressé"""
+
+    def test_minifiers_keep_strings_urls_and_regexes(self, app):
+        """Les `//` des chaînes, URLs et regex ne sont pas pris pour des commentaires"""
+        from asset_optimizer import minify_css, minify_js
+
+        css = minify_css('a :hover , b > c { width : calc(100% - 2px) ; background: url("x//y.png") ; } /* fin */')
+        assert css == 'a :hover,b>c{width:calc(100% - 2px);background:url("x//y.png")}'
+
+        js = minify_js('var u = "http://a.b"; // commentaire\nvar r = /\\/\\/[a-z/]+/g;\nlet a = b\n(c)\ni ++ + ++ j')
+        assert js == 'var u="http://a.b";var r=/\\/\\/[a-z/]+/g;let a=b\n(c)\ni++ + ++j'
+
+    def test_build_writes_hashed_bundles_and_manifest(self, app, tmp_path):
+        """Un bundle par groupe, nommé d'après son contenu, avec sa variante gzip"""
+        import gzip
+        from asset_optimizer import AssetOptimizer
+
+        (tmp_path / 'css').mkdir()
+        (tmp_path / 'css' / 'a.css').write_text('.a { color : red ; }\n' * 50)
+        (tmp_path / 'css' / 'b.css').write_text('.b { color : blue ; }')
+        optimizer = AssetOptimizer(str(tmp_path), bundles={'page.css': ['css/a.css', 'css/b.css']})
+
+        entry = optimizer.build(use_brotli=False)['page.css']
+        built = tmp_path / entry['file']
+        assert built.name == f"page.{entry['hash']}.css"
+        assert built.read_text().endswith('.b{color:blue}')
+        assert gzip.decompress((tmp_path / entry['encodings']['gzip']['file']).read_bytes()) == built.read_bytes()
+        assert optimizer.get_asset_url('page.css') == f"/static/{entry['file']}"
+        # Sans build, les sources restent servies séparément
+        assert AssetOptimizer(str(tmp_path / 'none'), bundles={'page.css': ['css/a.css']}).asset_paths('page.css') == ['css/a.css']
+
+    def test_middleware_serves_precompressed_variant(self, app, tmp_path):
+        """Variante gzip négociée, cache immutable et 304 sur ETag"""
+        from werkzeug.test import Client
+        from werkzeug.wrappers import Response
+        from asset_optimizer import AssetOptimizer, PrecompressedAssetMiddleware
+
+        (tmp_path / 'js').mkdir()
+        (tmp_path / 'js' / 'a.js').write_text('console.log("ninja");\n' * 100)
+        optimizer = AssetOptimizer(str(tmp_path), bundles={'page.js': ['js/a.js']})
+        entry = optimizer.build(use_brotli=False)['page.js']
+        client = Client(PrecompressedAssetMiddleware(Response('flask'), optimizer.manifest))
+
+        response = client.get(f"/static/{entry['file']}", headers={'Accept-Encoding': 'gzip, deflate'})
+        assert response.headers['Content-Encoding'] == 'gzip'
+        assert 'immutable' in response.headers['Cache-Control']
+        assert response.headers['Vary'] == 'Accept-Encoding'
+        assert response.get_data() == (tmp_path / entry['encodings']['gzip']['file']).read_bytes()
+
+        identity = client.get(f"/static/{entry['file']}")
+        assert 'Content-Encoding' not in identity.headers
+        assert client.get(f"/static/{entry['file']}", headers={
+            'Accept-Encoding': 'gzip', 'If-None-Match': response.headers['ETag']}).status_code == 304
+        assert client.get('/static/css/other.css').get_data() == b'flask'
+
+class TestCriticalCSS:
+    """Tests de l'extraction du CSS critique par template"""
+
+    HTML = """<html><head><title>t</title></head><body>
+        <nav class="navbar"><a class="brand" href="/">Ninja</a></nav>
+        <main><h1 class="hero-title">Titre</h1><ul><li>1</li><li>2</li></ul></main>
+        <footer class="footer">bas</footer></body></html>"""
+
+    def test_extracts_rules_of_visible_elements(self, app):
+        """Seules les règles des éléments affichés au premier rendu sont conservées"""
+        from critical_css import CriticalCSSExtractor
+
+        css = (':root{--c:red}.navbar a{color:var(--c)}.navbar a:hover{color:blue}.modal{display:none}'
+               'li+li{margin:0}@media (max-width:600px){.hero-title{font-size:1rem}.sidebar{width:0}}'
+               '@media print{nav{display:none}}@keyframes spin{to{transform:rotate(1turn)}}'
+               'h2,main>h1{font-weight:700}.footer{color:gray}')
+
+        critical = CriticalCSSExtractor().extract(self.HTML, css)
+        assert critical == (':root{--c:red}.navbar a{color:var(--c)}li+li{margin:0}'
+                            '@media (max-width:600px){.hero-title{font-size:1rem}}main>h1{font-weight:700}'
+                            '.footer{color:gray}')
+        # Éléments au-delà de la ligne de flottaison
+        assert '.footer' not in CriticalCSSExtractor(fold_limit=6).extract(self.HTML, css)
+
+    def test_cached_by_template_and_bundle_hash(self, app, tmp_path):
+        """Le CSS critique est calculé une fois par template et build, puis mis en ligne"""
+        from asset_optimizer import AssetOptimizer
+        from critical_css import CriticalCSSManager
+
+        (tmp_path / 'css').mkdir()
+        (tmp_path / 'css' / 'a.css').write_text('.navbar { color: red; } .modal { display: none; }')
+        optimizer = AssetOptimizer(str(tmp_path), bundles={'base.css': ['css/a.css']})
+        optimizer.build(use_brotli=False)
+        manager = CriticalCSSManager(optimizer)
+
+        assert manager.get('page.html', 'base.css') is None
+        assert manager.generate('page.html', 'base.css', self.HTML) == '.navbar{color:red}'
+        assert CriticalCSSManager(optimizer).get('page.html', 'base.css') == '.navbar{color:red}'
+
+        with app.test_request_context('/'):
+            from flask import g
+            g.critical_template = 'page.html'
+            tags = str(manager.styles('base.css'))
+        assert tags.startswith('<style>.navbar{color:red}</style>')
+        assert 'rel="preload"' in tags and '<noscript>' in tags
+
+        # Nouveau build: le cache précédent ne s'applique plus
+        (tmp_path / 'css' / 'a.css').write_text('.navbar { color: blue; }')
+        optimizer.build(use_brotli=False)
+        assert manager.get('page.html', 'base.css') is None
+
 class TestFormValidation:
     """Tests de validation des formulaires"""
     
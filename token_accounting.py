@@ -0,0 +1,482 @@
+"""
+Comptabilité des tokens des appels LLM et application des budgets par utilisateur
+
+Les clients OpenAI / xAI sont enveloppés par TokenAccountant.metered(): chaque complétion
+de chat est débitée sur le budget de l'utilisateur selon sa consommation réelle (response.usage).
+
+Avec LLM_ENFORCE_BUDGETS=true, les tokens du prompt sont estimés localement avant l'envoi
+et réservés par un UPDATE conditionnel atomique (tokens_used + n <= tokens_total): une
+requête dont le prompt dépasse le budget restant est refusée avant tout appel au fournisseur
+(TokenBudgetExceeded). Après la réponse, la réservation est ajustée sur la consommation
+réelle et restituée si l'appel échoue. Par défaut l'usage est seulement débité, sans refus,
+tant que les offres n'attribuent pas de budgets.
+
+La consommation (appels, tokens, coût estimé) est agrégée en mémoire par jour, utilisateur,
+modèle et fonctionnalité puis écrite par lots dans llm_usage, comme les compteurs des
+campagnes (voir campaign_counters).
+
+L'utilisateur facturé est celui de la session Flask-Login, ou celui fixé par usage_context()
+pour les tâches de fond; sans utilisateur, l'usage est agrégé sans débit.
+"""
+import atexit
+import contextvars
+import inspect
+import logging
+import os
+import threading
+from collections import defaultdict
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from typing import Any, Dict, Iterable, List, Optional, Sequence, Tuple
+
+from apscheduler.schedulers.background import BackgroundScheduler
+from flask import has_app_context, has_request_context
+from sqlalchemy import case, func, select, update
+
+from app import db
+from models import LLMUsage, User
+from prompt_compaction import estimate_tokens
+
+logger = logging.getLogger(__name__)
+
+# Tokens ajoutés par message (rôle, séparateurs du format de chat)
+MESSAGE_OVERHEAD_TOKENS = 4
+# Tokens de complétion comptés pour une réponse en flux sans usage quand l'appel ne fixe pas max_tokens
+DEFAULT_COMPLETION_TOKENS = int(os.environ.get("LLM_DEFAULT_COMPLETION_TOKENS", "1000"))
+# Refus des requêtes dont le prompt dépasse le budget (false: l'usage réel est débité sans contrôle préalable)
+ENFORCE_BUDGETS = os.environ.get("LLM_ENFORCE_BUDGETS", "false").lower() == "true"
+# Intervalle entre deux écritures des agrégats d'usage (secondes)
+FLUSH_INTERVAL = float(os.environ.get("LLM_USAGE_FLUSH_INTERVAL", "30"))
+
+# Prix en USD par million de tokens (entrée, sortie), par préfixe de modèle
+MODEL_PRICING: Dict[str, Tuple[float, float]] = {
+    'grok-3-mini': (0.30, 0.50),
+    'grok-3': (3.00, 15.00),
+    'grok-2': (2.00, 10.00),
+    'gpt-4o-mini': (0.15, 0.60),
+    'gpt-4o': (2.50, 10.00),
+}
+# Surcharge des prix, ex: "grok-3=3:15,gpt-4o=2.5:10"
+MODEL_PRICING.update({
+    name.strip(): tuple(float(price) for price in prices.split(':', 1))
+    for name, prices in (item.split('=', 1) for item in os.environ.get("LLM_PRICING", "").split(',') if '=' in item)
+})
+
+# Colonnes de regroupement autorisées pour summary()
+GROUP_BY_COLUMNS = ('day', 'user_id', 'model', 'feature')
+
+_context_user: contextvars.ContextVar = contextvars.ContextVar('llm_usage_user', default=None)
+_context_feature: contextvars.ContextVar = contextvars.ContextVar('llm_usage_feature', default=None)
+
+UsageKey = Tuple[Any, str, str, str]
+
+
+class TokenBudgetExceeded(Exception):
+    """Le budget de tokens de l'utilisateur ne couvre pas la requête"""
+
+    # Erreur de l'appelant: ne compte pas comme une panne du fournisseur (voir llm_router)
+    provider_fault = False
+
+    def __init__(self, user_id: str, requested: int, remaining: int):
+        self.user_id = user_id
+        self.requested = requested
+        self.remaining = remaining
+        super().__init__(f"Token budget exceeded for user {user_id}: {requested} requested, {remaining} remaining")
+
+
+def estimate_prompt_tokens(messages: Iterable[Dict[str, Any]]) -> int:
+    """
+    Estimation locale des tokens d'un prompt de chat (voir prompt_compaction.estimate_tokens)
+
+    Args:
+        messages: Messages au format de l'API de chat (contenu texte ou liste de parties)
+
+    Returns:
+        Nombre de tokens estimé
+    """
+    tokens = 0
+    for message in messages or ():
+        content = message.get('content') or ''
+        if isinstance(content, str):
+            tokens += estimate_tokens(content)
+        else:
+            tokens += sum(estimate_tokens(part.get('text')) for part in content if isinstance(part, dict))
+        tokens += MESSAGE_OVERHEAD_TOKENS
+    return tokens
+
+
+def model_cost(model: str, prompt_tokens: int, completion_tokens: int) -> float:
+    """Coût estimé en USD d'un appel (0 si le modèle n'a pas de prix connu)"""
+    prefix = max((name for name in MODEL_PRICING if (model or '').startswith(name)), key=len, default=None)
+    if prefix is None:
+        return 0.0
+    input_price, output_price = MODEL_PRICING[prefix]
+    return (prompt_tokens * input_price + completion_tokens * output_price) / 1_000_000
+
+
+def current_user_id() -> Optional[str]:
+    """Utilisateur facturé: celui de usage_context(), sinon celui de la session Flask-Login"""
+    user_id = _context_user.get()
+    if user_id is not None:
+        return user_id or None
+    if has_request_context():
+        from flask_login import current_user
+        if getattr(current_user, 'is_authenticated', False):
+            return str(current_user.id)
+    return None
+
+
+@contextmanager
+def usage_context(user_id: Optional[str] = None, feature: Optional[str] = None):
+    """
+    Fixe l'utilisateur facturé et/ou la fonctionnalité des appels LLM du bloc
+
+    Args:
+        user_id: Utilisateur facturé ('' pour ne facturer personne, None: inchangé)
+        feature: Fonctionnalité à laquelle l'usage est attribué (None: inchangée)
+    """
+    user_token = _context_user.set(str(user_id)) if user_id is not None else None
+    feature_token = _context_feature.set(feature) if feature is not None else None
+    try:
+        yield
+    finally:
+        if feature_token is not None:
+            _context_feature.reset(feature_token)
+        if user_token is not None:
+            _context_user.reset(user_token)
+
+
+class _MeteredCompletions:
+    """chat.completions d'un client mesuré: réservation, appel, ajustement sur l'usage réel"""
+
+    def __init__(self, completions, accountant: 'TokenAccountant', feature: str):
+        self._completions = completions
+        self._accountant = accountant
+        self._feature = feature
+        self._is_async = inspect.iscoroutinefunction(completions.create)
+
+    def __getattr__(self, name):
+        return getattr(self._completions, name)
+
+    def _begin(self, params: Dict[str, Any]) -> Tuple[Optional[str], str, int]:
+        user_id = current_user_id()
+        feature = _context_feature.get() or self._feature
+        reserved = self._accountant.reserve(user_id, estimate_prompt_tokens(params.get('messages')))
+        return user_id, feature, reserved
+
+    def _finish(self, call: Tuple[Optional[str], str, int], params: Dict[str, Any], response) -> None:
+        user_id, feature, reserved = call
+        model = str(getattr(response, 'model', None) or params.get('model') or 'unknown')
+        usage = getattr(response, 'usage', None)
+        if usage is not None and getattr(usage, 'total_tokens', None) is not None:
+            prompt_tokens = int(usage.prompt_tokens or 0)
+            completion_tokens = int(usage.completion_tokens or 0)
+        elif params.get('stream'):
+            # Réponse en flux sans usage: la complétion maximale tient lieu de consommation
+            prompt_tokens = estimate_prompt_tokens(params.get('messages'))
+            completion_tokens = int(params.get('max_tokens') or params.get('max_completion_tokens')
+                                    or DEFAULT_COMPLETION_TOKENS)
+        else:
+            prompt_tokens = estimate_prompt_tokens(params.get('messages'))
+            choices = getattr(response, 'choices', None) or []
+            content = getattr(choices[0].message, 'content', None) if choices else None
+            completion_tokens = estimate_tokens(content)
+        self._accountant.settle(user_id, reserved, prompt_tokens + completion_tokens)
+        self._accountant.record(user_id, model, feature, prompt_tokens, completion_tokens)
+
+    def create(self, **params):
+        if self._is_async:
+            return self._create_async(params)
+        call = self._begin(params)
+        try:
+            response = self._completions.create(**params)
+        except BaseException:
+            self._accountant.settle(call[0], call[2], 0)
+            raise
+        self._finish(call, params, response)
+        return response
+
+    async def _create_async(self, params: Dict[str, Any]):
+        call = self._begin(params)
+        try:
+            response = await self._completions.create(**params)
+        except BaseException:
+            self._accountant.settle(call[0], call[2], 0)
+            raise
+        self._finish(call, params, response)
+        return response
+
+
+class _MeteredChat:
+    def __init__(self, chat, accountant: 'TokenAccountant', feature: str):
+        self._chat = chat
+        self.completions = _MeteredCompletions(chat.completions, accountant, feature)
+
+    def __getattr__(self, name):
+        return getattr(self._chat, name)
+
+
+class MeteredClient:
+    """Client OpenAI (synchrone ou asynchrone) dont les complétions de chat sont comptabilisées"""
+
+    def __init__(self, client, feature: str, accountant: 'TokenAccountant'):
+        self._client = client
+        self._accountant = accountant
+        self.feature = feature
+        self.chat = _MeteredChat(client.chat, accountant, feature)
+
+    def __getattr__(self, name):
+        return getattr(self._client, name)
+
+    def with_feature(self, feature: str) -> 'MeteredClient':
+        """Même client, usage attribué à une autre fonctionnalité"""
+        return MeteredClient(self._client, feature, self._accountant)
+
+
+class TokenAccountant:
+    """Réservation atomique des budgets de tokens et agrégation de la consommation LLM"""
+
+    def __init__(self, enforce: bool = ENFORCE_BUDGETS):
+        self.enforce = enforce
+        self.scheduler = None
+        self._app = None
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._pending: Dict[UsageKey, List] = defaultdict(lambda: [0, 0, 0, 0.0])
+
+    def metered(self, client, feature: str):
+        """Enveloppe un client OpenAI / xAI (None reste None)"""
+        if client is None:
+            return None
+        if isinstance(client, MeteredClient):
+            return client.with_feature(feature)
+        return MeteredClient(client, feature, self)
+
+    def reserve(self, user_id: Optional[str], tokens: int) -> int:
+        """
+        Réserve des tokens sur le budget de l'utilisateur (UPDATE conditionnel atomique)
+
+        Le débit utilise sa propre connexion et est validé immédiatement: il ne dépend pas de
+        la transaction de la requête en cours.
+
+        Args:
+            user_id: Utilisateur facturé (None: aucun débit)
+            tokens: Tokens à réserver
+
+        Returns:
+            Tokens effectivement réservés (0 sans utilisateur ou si le budget n'est pas appliqué)
+
+        Raises:
+            TokenBudgetExceeded: si le budget restant ne couvre pas la réservation
+        """
+        if not user_id or not self.enforce or tokens <= 0 or not has_app_context():
+            return 0
+        table = User.__table__
+        used = func.coalesce(table.c.tokens_used, 0)
+        with db.engine.begin() as conn:
+            result = conn.execute(
+                update(table)
+                .where(table.c.id == user_id, used + tokens <= func.coalesce(table.c.tokens_total, 0))
+                .values(tokens_used=used + tokens)
+            )
+            if result.rowcount:
+                return tokens
+            row = conn.execute(
+                select(table.c.tokens_total, table.c.tokens_used).where(table.c.id == user_id)
+            ).first()
+        if row is None:
+            # Identifiant sans compte (ex: utilisateur supprimé): usage agrégé sans débit
+            return 0
+        remaining = max(0, (row.tokens_total or 0) - (row.tokens_used or 0))
+        logger.info(f"LLM request rejected for user {user_id}: {tokens} tokens requested, {remaining} remaining")
+        raise TokenBudgetExceeded(user_id, tokens, remaining)
+
+    def settle(self, user_id: Optional[str], reserved: int, actual: int) -> None:
+        """
+        Ajuste le débit d'un appel terminé sur sa consommation réelle
+
+        Args:
+            user_id: Utilisateur facturé
+            reserved: Tokens réservés avant l'appel (restitués si actual vaut 0)
+            actual: Tokens réellement consommés
+        """
+        if not user_id or not has_app_context():
+            return
+        delta = actual - reserved if self.enforce else actual
+        if not delta:
+            return
+        table = User.__table__
+        used = func.coalesce(table.c.tokens_used, 0) + delta
+        try:
+            with db.engine.begin() as conn:
+                conn.execute(update(table).where(table.c.id == user_id).values(tokens_used=case((used < 0, 0), else_=used)))
+        except Exception as e:
+            logger.error(f"Failed to settle {delta} tokens for user {user_id}: {e}")
+
+    def record(self, user_id: Optional[str], model: str, feature: str,
+               prompt_tokens: int, completion_tokens: int) -> float:
+        """
+        Ajoute un appel aux agrégats en attente (sans accès à la base)
+
+        Returns:
+            Coût estimé de l'appel en USD
+        """
+        cost = model_cost(model, prompt_tokens, completion_tokens)
+        key = (datetime.utcnow().date(), user_id or '', model, feature)
+        with self._lock:
+            totals = self._pending[key]
+            totals[0] += 1
+            totals[1] += prompt_tokens
+            totals[2] += completion_tokens
+            totals[3] += cost
+        return cost
+
+    def pending(self) -> Dict[UsageKey, Dict[str, Any]]:
+        """Agrégats pas encore écrits en base"""
+        with self._lock:
+            return {
+                key: {'calls': calls, 'prompt_tokens': prompt, 'completion_tokens': completion, 'cost_usd': cost}
+                for key, (calls, prompt, completion, cost) in self._pending.items()
+            }
+
+    def _upsert(self, rows: List[Dict[str, Any]]) -> None:
+        table = LLMUsage.__table__
+        dialect = db.engine.dialect.name
+        if dialect == 'postgresql':
+            from sqlalchemy.dialects.postgresql import insert
+        elif dialect == 'sqlite':
+            from sqlalchemy.dialects.sqlite import insert
+        else:
+            insert = None
+
+        if insert is not None:
+            stmt = insert(table)
+            stmt = stmt.on_conflict_do_update(
+                index_elements=['day', 'user_id', 'model', 'feature'],
+                set_={column: table.c[column] + stmt.excluded[column]
+                      for column in ('calls', 'prompt_tokens', 'completion_tokens', 'cost_usd')}
+            )
+            db.session.execute(stmt, rows)
+            return
+
+        for row in rows:
+            key = [table.c[column] == row[column] for column in GROUP_BY_COLUMNS]
+            result = db.session.execute(update(table).where(*key).values(
+                {column: table.c[column] + row[column]
+                 for column in ('calls', 'prompt_tokens', 'completion_tokens', 'cost_usd')}
+            ))
+            if not result.rowcount:
+                db.session.execute(table.insert().values(**row))
+
+    def flush(self) -> int:
+        """
+        Écrit les agrégats en attente dans llm_usage (une seule transaction)
+
+        Returns:
+            Nombre de lignes (jour, utilisateur, modèle, fonctionnalité) mises à jour
+        """
+        with self._flush_lock:
+            with self._lock:
+                pending, self._pending = self._pending, defaultdict(lambda: [0, 0, 0, 0.0])
+            if not pending:
+                return 0
+
+            rows = [
+                {'day': day, 'user_id': user_id, 'model': model, 'feature': feature,
+                 'calls': calls, 'prompt_tokens': prompt, 'completion_tokens': completion, 'cost_usd': cost}
+                for (day, user_id, model, feature), (calls, prompt, completion, cost) in sorted(pending.items())
+            ]
+            try:
+                self._upsert(rows)
+                db.session.commit()
+            except Exception as e:
+                db.session.rollback()
+                with self._lock:
+                    for key, values in pending.items():
+                        totals = self._pending[key]
+                        for index, value in enumerate(values):
+                            totals[index] += value
+                logger.error(f"LLM usage flush failed, {len(rows)} aggregates kept pending: {e}")
+                raise
+
+            logger.debug(f"LLM usage flushed ({len(rows)} aggregates)")
+            return len(rows)
+
+    def summary(self, days: int = 30, group_by: Sequence[str] = ('user_id', 'model', 'feature'),
+                user_id: Optional[str] = None) -> List[Dict[str, Any]]:
+        """
+        Consommation agrégée sur les derniers jours, pour la planification de capacité
+
+        Args:
+            days: Nombre de jours couverts (aujourd'hui inclus)
+            group_by: Colonnes de regroupement parmi GROUP_BY_COLUMNS
+            user_id: Limite le résumé à un utilisateur (optionnel)
+
+        Returns:
+            Lignes {colonnes de regroupement..., calls, prompt_tokens, completion_tokens, cost_usd},
+            par coût décroissant
+        """
+        unknown = [column for column in group_by if column not in GROUP_BY_COLUMNS]
+        if unknown:
+            raise ValueError(f"Unsupported group_by column(s): {', '.join(unknown)}")
+
+        columns = [getattr(LLMUsage, column) for column in group_by]
+        cost = func.sum(LLMUsage.cost_usd)
+        query = db.session.query(
+            *columns,
+            func.sum(LLMUsage.calls), func.sum(LLMUsage.prompt_tokens), func.sum(LLMUsage.completion_tokens), cost
+        ).filter(LLMUsage.day >= datetime.utcnow().date() - timedelta(days=max(days, 1) - 1))
+        if user_id is not None:
+            query = query.filter(LLMUsage.user_id == str(user_id))
+        rows = query.group_by(*columns).order_by(cost.desc()).all()
+
+        summary = []
+        for row in rows:
+            values = dict(zip(group_by, row[:len(group_by)]))
+            if 'day' in values:
+                values['day'] = values['day'].isoformat()
+            calls, prompt, completion, total_cost = row[len(group_by):]
+            values.update(calls=int(calls or 0), prompt_tokens=int(prompt or 0),
+                          completion_tokens=int(completion or 0), cost_usd=round(total_cost or 0.0, 6))
+            summary.append(values)
+        return summary
+
+    def _scheduled_flush(self) -> None:
+        try:
+            with self._app.app_context():
+                self.flush()
+        except Exception as e:
+            logger.error(f"Scheduled LLM usage flush failed: {e}")
+
+    def start_flusher(self, app, interval: float = FLUSH_INTERVAL) -> None:
+        """Démarre l'écriture périodique des agrégats (et une dernière écriture à l'arrêt)"""
+        if self.scheduler is not None:
+            logger.warning("LLM usage flusher already running")
+            return
+
+        self._app = app
+        self.scheduler = BackgroundScheduler()
+        self.scheduler.add_job(
+            func=self._scheduled_flush,
+            trigger='interval',
+            seconds=interval,
+            id='llm_usage_flush',
+            name='LLM Usage Flush',
+            max_instances=1,
+            coalesce=True,
+            replace_existing=True
+        )
+        self.scheduler.start()
+        atexit.register(self.stop_flusher)
+        logger.info(f"LLM usage flusher started (every {interval}s)")
+
+    def stop_flusher(self) -> None:
+        """Arrête le job périodique et écrit les derniers agrégats"""
+        if self.scheduler:
+            self.scheduler.shutdown(wait=False)
+            self.scheduler = None
+            self._scheduled_flush()
+            logger.info("LLM usage flusher stopped")
+
+
+token_accountant = TokenAccountant()